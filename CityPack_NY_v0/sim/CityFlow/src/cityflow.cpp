@@ -13,7 +13,18 @@ PYBIND11_MODULE(cityflow, m) {
             "config_file"_a,
             "thread_num"_a=1
         )
-        .def("next_step", &CityFlow::Engine::nextStep)
+        // with release_gil other Python threads (e.g. a streaming server) keep running during the step,
+        // the caller makes sure none of them uses this engine until it returns
+        .def("next_step", [](CityFlow::Engine &engine, bool releaseGil) {
+                if (releaseGil) {
+                    py::gil_scoped_release release;
+                    engine.nextStep();
+                } else {
+                    engine.nextStep();
+                }
+            },
+            "release_gil"_a=false
+        )
         .def("get_vehicle_count", &CityFlow::Engine::getVehicleCount)
         .def("get_vehicles", &CityFlow::Engine::getVehicles, "include_waiting"_a=false)
         .def("get_lane_vehicle_count", &CityFlow::Engine::getLaneVehicleCount)
@@ -25,13 +36,21 @@ PYBIND11_MODULE(cityflow, m) {
         .def("get_leader", &CityFlow::Engine::getLeader, "vehicle_id"_a)
         .def("get_current_time", &CityFlow::Engine::getCurrentTime)
         .def("get_average_travel_time", &CityFlow::Engine::getAverageTravelTime)
+        .def("get_tl_phase", &CityFlow::Engine::getTrafficLightPhase)
+        .def("get_vehicles_in_radius", &CityFlow::Engine::getVehiclesInRadius, "x"_a, "y"_a, "radius"_a)
+        .def("get_vehicles_in_bbox", &CityFlow::Engine::getVehiclesInBox, "min_x"_a, "min_y"_a, "max_x"_a, "max_y"_a)
         .def("set_tl_phase", &CityFlow::Engine::setTrafficLightPhase, "intersection_id"_a, "phase_id"_a)
+        .def("hold_tl_phase", &CityFlow::Engine::holdTrafficLightPhase, "intersection_id"_a, "phase_id"_a)
+        .def("release_tl_phase", &CityFlow::Engine::releaseTrafficLightPhase, "intersection_id"_a)
+        .def("get_replay_header", [](CityFlow::Engine &engine) { return py::bytes(engine.getReplayHeader()); })
+        .def("get_replay_frame", [](CityFlow::Engine &engine) { return py::bytes(engine.getReplayFrame()); })
         .def("set_vehicle_speed", &CityFlow::Engine::setVehicleSpeed, "vehicle_id"_a, "speed"_a)
-        .def("set_replay_file", &CityFlow::Engine::setReplayLogFile, "replay_file"_a)
+        .def("set_replay_file", &CityFlow::Engine::setReplayLogFile, "replay_file"_a, "compression"_a = "")
         .def("set_random_seed", &CityFlow::Engine::setRandomSeed, "seed"_a)
         .def("set_save_replay", &CityFlow::Engine::setSaveReplay, "open"_a)
         .def("push_vehicle", (void (CityFlow::Engine::*)(const std::map<std::string, double>&, const std::vector<std::string>&)) &CityFlow::Engine::pushVehicle)
-        .def("reset", &CityFlow::Engine::reset, "seed"_a=false)
+        .def("push_vehicles", &CityFlow::Engine::pushVehicles, "info"_a, "routes"_a, "route_ids"_a)
+        .def("reset", &CityFlow::Engine::reset, "seed"_a=false, "to"_a="cold")
         .def("load", &CityFlow::Engine::load, "archive"_a)
         .def("snapshot", &CityFlow::Engine::snapshot)
         .def("load_from_file", &CityFlow::Engine::loadFromFile, "path"_a)
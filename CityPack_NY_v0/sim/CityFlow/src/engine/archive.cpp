@@ -1,5 +1,6 @@
 #include "engine/archive.h"
 #include "engine/engine.h"
+#include "roadnet/signalcontroller.h"
 
 #include <sstream>
 #include <string>
@@ -55,6 +56,8 @@ namespace CityFlow {
             drivableArchive.history = lane->history;
             drivableArchive.historyVehicleNum = lane->historyVehicleNum;
             drivableArchive.historyAverageSpeed = lane->historyAverageSpeed;
+            drivableArchive.enteredVehicleCnt = lane->enteredVehicleCnt;
+            drivableArchive.exitedVehicleCnt = lane->exitedVehicleCnt;
         }
 
     }
@@ -68,9 +71,12 @@ namespace CityFlow {
     void Archive::archiveTrafficLight(const TrafficLight *light, Archive::TrafficLightArchive &trafficLightArchive) {
         trafficLightArchive.curPhaseIndex = light->curPhaseIndex;
         trafficLightArchive.remainDuration = light->remainDuration;
+        if (light->controller)
+            trafficLightArchive.controller = light->controller->clone();
     }
 
     void Archive::resume(Engine &engine) const{
+        if (engine.metrics) engine.metrics->flush();
         engine.step = step;
         engine.activeVehicleCount = activeVehicleCount;
         for (auto &veh : engine.vehiclePool) {
@@ -107,6 +113,8 @@ namespace CityFlow {
                 lane->history = archive.history;
                 lane->historyVehicleNum = archive.historyVehicleNum;
                 lane->historyAverageSpeed = archive.historyAverageSpeed;
+                lane->enteredVehicleCnt = archive.enteredVehicleCnt;
+                lane->exitedVehicleCnt = archive.exitedVehicleCnt;
             }
         }
         for (auto &flow : engine.flows) {
@@ -120,9 +128,16 @@ namespace CityFlow {
             const auto &archive = trafficLightsArchive.find(&intersection)->second;
             light.remainDuration = archive.remainDuration;
             light.curPhaseIndex = archive.curPhaseIndex;
+            light.held = false; // holds are not part of the archive, the restored plan or controller runs
+            if (archive.controller)
+                light.controller = archive.controller->clone();
+            else if (light.controller) // controller state is not kept in archive files
+                light.controller->init(light);
         }
         engine.finishedVehicleCnt = this->finishedVehicleCnt;
         engine.cumulativeTravelTime = this->cumulativeTravelTime;
+        engine.vehicleIndexDirty = true;
+        if (engine.metrics) engine.metrics->restart();
     }
 
     Archive::VehiclePool Archive::copyVehiclePool(const VehiclePool &src) {
@@ -292,6 +307,8 @@ namespace CityFlow {
                 drivableValue.AddMember("history", historyValue, allocator);
                 drivableValue.AddMember("historyVehicleNum", drivableArchive.historyVehicleNum, allocator);
                 drivableValue.AddMember("historyAverageSpeed", drivableArchive.historyAverageSpeed, allocator);
+                drivableValue.AddMember("enteredVehicleCnt", static_cast<uint64_t>(drivableArchive.enteredVehicleCnt), allocator);
+                drivableValue.AddMember("exitedVehicleCnt", static_cast<uint64_t>(drivableArchive.exitedVehicleCnt), allocator);
             }
 
             drivablesValue.AddMember(
@@ -519,6 +536,8 @@ namespace CityFlow {
                 }
                 drivableArchive.historyAverageSpeed = getJsonMember<double>("historyAverageSpeed", drivableValue);
                 drivableArchive.historyVehicleNum = getJsonMember<int>("historyVehicleNum", drivableValue);
+                drivableArchive.enteredVehicleCnt = getJsonMember<uint64_t>("enteredVehicleCnt", drivableValue, 0);
+                drivableArchive.exitedVehicleCnt = getJsonMember<uint64_t>("exitedVehicleCnt", drivableValue, 0);
             }
         }
 
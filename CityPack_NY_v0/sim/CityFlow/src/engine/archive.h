@@ -6,12 +6,14 @@
 #include "roadnet/roadnet.h"
 
 #include <deque>
+#include <memory>
 
 namespace CityFlow {
     class Engine;
     class Flow;
     class Vehicle;
     class TrafficLight;
+    class SignalController;
 
     class Archive {
     private:
@@ -19,6 +21,7 @@ namespace CityFlow {
         struct TrafficLightArchive {
             double remainDuration;
             int curPhaseIndex;
+            std::shared_ptr<const SignalController> controller;
         };
 
         struct FlowArchive {
@@ -34,6 +37,8 @@ namespace CityFlow {
             std::list<Lane::HistoryRecord> history;
             int    historyVehicleNum = 0;
             double historyAverageSpeed = 0;
+            size_t enteredVehicleCnt = 0;
+            size_t exitedVehicleCnt = 0;
         };
 
         VehiclePool vehiclePool;
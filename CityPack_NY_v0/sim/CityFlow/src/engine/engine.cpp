@@ -1,4 +1,5 @@
 #include "engine/engine.h"
+#include "roadnet/signalcontroller.h"
 #include "utility/utility.h"
 
 #include <algorithm>
@@ -51,6 +52,14 @@ namespace CityFlow {
             warnings = false;
             rlTrafficLight = getJsonMember<bool>("rlTrafficLight", document);
             laneChange = getJsonMember<bool>("laneChange", document, false);
+            int configWarmUpSteps = getJsonMember<int>("warmUpSteps", document, 0);
+            if (configWarmUpSteps < 0)
+                throw JsonFormatError("warmUpSteps should not be negative");
+            warmUpSteps = (size_t) configWarmUpSteps;
+            double spatialIndexCellSize = getJsonMember<double>("spatialIndexCellSize", document, 50);
+            if (spatialIndexCellSize <= 0)
+                throw JsonFormatError("spatialIndexCellSize should be positive");
+            vehicleIndex = SpatialIndex(spatialIndexCellSize);
             seed = getJsonMember<int>("seed", document);
             rnd.seed(seed);
             dir = getJsonMember<const char*>("dir", document);
@@ -62,6 +71,17 @@ namespace CityFlow {
                 return false;
             }
 
+            if (document.HasMember("trafficLightControl"))
+                loadTrafficLightControl(getJsonMemberObject("trafficLightControl", document));
+
+            if (document.HasMember("metrics")) {
+                const auto &metricsValue = getJsonMemberObject("metrics", document);
+                metrics.reset(new MetricsRecorder(roadnet, interval,
+                                                  getJsonMember<double>("window", metricsValue, 60),
+                                                  dir + getJsonMember<const char*>("laneFile", metricsValue, "lane_metrics.csv"),
+                                                  dir + getJsonMember<const char*>("intersectionFile", metricsValue, "intersection_metrics.csv")));
+            }
+
             if (!loadFlow(dir + flowFile)) {
                 std::cerr << "loading flow file error!" << std::endl;
                 return false;
@@ -70,6 +90,22 @@ namespace CityFlow {
             if (warnings) checkWarning();
             saveReplayInConfig = saveReplay = getJsonMember<bool>("saveReplay", document);
 
+            replayLogFormat = getJsonMember<const char*>("replayLogFormat", document, "text");
+            if (replayLogFormat != "text" && replayLogFormat != "binary")
+                throw JsonFormatError("replayLogFormat should be \"text\" or \"binary\"");
+            replayCompression.codec = getJsonMember<const char*>("replayCompression", document, "none");
+            if (replayCompression.codec != "none" && replayCompression.codec != "zstd")
+                throw JsonFormatError("replayCompression should be \"none\" or \"zstd\"");
+            if (!ReplayWriter::supportsCompression(replayCompression.codec))
+                throw JsonFormatError("replayCompression \"zstd\" needs the engine built with zstd");
+            replayCompression.stepsPerFrame =
+                (size_t) std::max(1, getJsonMember<int>("replayCompressionSteps", document, 100));
+            replayCompression.level = getJsonMember<int>("replayCompressionLevel", document, 3);
+            replayBufferSize = (size_t) std::max(1, getJsonMember<int>("replayBufferSize", document, 2));
+            std::string backpressure = getJsonMember<const char*>("replayBackpressure", document, "block");
+            if (backpressure != "block" && backpressure != "drop")
+                throw JsonFormatError("replayBackpressure should be \"block\" or \"drop\"");
+            replayDropWhenFull = backpressure == "drop";
             if (saveReplay) {
                 std::string roadnetLogFile = getJsonMember<const char*>("roadnetLogFile", document);
                 std::string replayLogFile = getJsonMember<const char*>("replayLogFile", document);
@@ -103,6 +139,42 @@ namespace CityFlow {
         return ans;
     }
 
+    void Engine::loadTrafficLightControl(const rapidjson::Value &control) {
+        const rapidjson::Value *defaults = nullptr, *overrides = nullptr;
+        if (control.HasMember("default"))
+            defaults = &getJsonMemberObject("default", control);
+        if (control.HasMember("intersections")) {
+            overrides = &getJsonMemberObject("intersections", control);
+            for (const auto &member : overrides->GetObject()) {
+                std::string id = member.name.GetString();
+                if (!roadnet.getIntersectionById(id))
+                    throw JsonFormatError("No such intersection: " + id);
+                if (!member.value.IsObject())
+                    throw JsonTypeError("trafficLightControl of " + id, "object");
+            }
+        }
+
+        for (Intersection &intersection : roadnet.getIntersections()) {
+            if (intersection.isVirtualIntersection()) continue;
+            rapidjson::Document config;
+            config.SetObject();
+            auto &allocator = config.GetAllocator();
+            if (defaults)
+                config.CopyFrom(*defaults, allocator);
+            if (overrides && overrides->HasMember(intersection.getId().c_str())) {
+                for (const auto &member : (*overrides)[intersection.getId().c_str()].GetObject()) {
+                    if (config.HasMember(member.name))
+                        config[member.name].CopyFrom(member.value, allocator);
+                    else
+                        config.AddMember(rapidjson::Value(member.name, allocator),
+                                         rapidjson::Value(member.value, allocator), allocator);
+                }
+            }
+            if (!config.HasMember("type")) continue;
+            intersection.getTrafficLight().setController(SignalController::create(config));
+        }
+    }
+
     bool Engine::loadFlow(const std::string &jsonFilename) {
         rapidjson::Document root;
         if (!readJsonFromFile(jsonFilename, root)) {
@@ -254,8 +326,10 @@ namespace CityFlow {
                                   std::vector<Road *> &roads,
                                   std::vector<Intersection *> &intersections,
                                   std::vector<Drivable *> &drivables) {
-        while (!finished) {
+        while (true) {
             threadPlanRoute(roads);
+            // finished is set before the destructor passes the barriers of planRoute
+            if (finished) break;
             if (laneChange) {
                 threadInitSegments(roads);
                 threadPlanLaneChange(vehicles);
@@ -266,6 +340,7 @@ namespace CityFlow {
             threadUpdateLocation(drivables);
             threadUpdateAction(vehicles);
             threadUpdateLeaderAndGap(drivables);
+            threadUpdateTrafficLight(intersections);
         }
     }
 
@@ -289,6 +364,8 @@ namespace CityFlow {
 
                 if ((vehicle->getChangedDrivable()) != nullptr || vehicle->hasSetEnd()) {
                     vehicleItr = vehicles.erase(vehicleItr);
+                    if (drivable->isLane())
+                        static_cast<Lane *>(drivable)->countExitedVehicle();
                 }else{
                     vehicleItr++;
                 }
@@ -389,6 +466,20 @@ namespace CityFlow {
         endBarrier.wait();
     }
 
+    void Engine::threadUpdateTrafficLight(const std::vector<Intersection *> &intersections) {
+        startBarrier.wait();
+        for (Intersection *intersection : intersections) {
+            TrafficLight &trafficLight = intersection->getTrafficLight();
+            if (trafficLight.isHeld())
+                continue;
+            if (trafficLight.getController())
+                trafficLight.updateController(interval);
+            else if (!rlTrafficLight)
+                trafficLight.passTime(interval);
+        }
+        endBarrier.wait();
+    }
+
     void Engine::threadInitSegments(const std::vector<Road *> &roads) {
         startBarrier.wait();
         for (Road *road : roads)
@@ -477,6 +568,7 @@ namespace CityFlow {
     void Engine::updateLocation() {
         startBarrier.wait();
         endBarrier.wait();
+        vehicleIndexDirty = true;
         std::sort(pushBuffer.begin(), pushBuffer.end(), vehicleCmp);
         for (auto &vehiclePair : pushBuffer) {
             Vehicle *vehicle = vehiclePair.first;
@@ -487,6 +579,7 @@ namespace CityFlow {
                     vehicle->setEnterLaneLinkTime(step);
                 } else {
                     vehicle->setEnterLaneLinkTime(std::numeric_limits<int>::max());
+                    static_cast<Lane *>(drivable)->countEnteredVehicle();
                 }
             }
         }
@@ -509,33 +602,29 @@ namespace CityFlow {
                 activeVehicleCount += 1;
                 Vehicle * tail = lane->getLastVehicle();
                 lane->pushVehicle(vehicle);
+                lane->countEnteredVehicle();
                 vehicle->updateLeaderAndGap(tail);
                 buffer.pop_front();
             }
         }
     }
 
-    void Engine::updateLog() {
-        std::string result;
+    void Engine::snapshotReplayFrame(ReplayFrame &frame) const {
+        frame.clear();
         for (const Vehicle* vehicle: getRunningVehicles()) {
             Point pos = vehicle->getPoint();
             Point dir = vehicle->getCurDrivable()->getDirectionByDistance(vehicle->getDistance());
-
-            int lc = vehicle->lastLaneChangeDirection();
-            result.append(
-                    double2string(pos.x) + " " + double2string(pos.y) + " " + double2string(atan2(dir.y, dir.x)) + " "
-                            + vehicle->getId() + " " + std::to_string(lc) + " " + double2string(vehicle->getLen()) + " "
-                            + double2string(vehicle->getWidth()) + ",");
+            frame.vehicles.push_back({pos.x, pos.y, atan2(dir.y, dir.x), vehicle->getLen(), vehicle->getWidth(),
+                                      vehicle->lastLaneChangeDirection()});
+            frame.vehicleIds.push_back(vehicle->getId());
         }
-        result.append(";");
 
         for (const Road &road : roadnet.getRoads()) {
             if (road.getEndIntersection().isVirtualIntersection())
                 continue;
-            result.append(road.getId());
             for (const Lane &lane : road.getLanes()) {
                 if (lane.getEndIntersection()->isImplicitIntersection()){
-                    result.append(" i");
+                    frame.lightStates.push_back('i');
                     continue;
                 }
 
@@ -546,11 +635,34 @@ namespace CityFlow {
                         break;
                     }
                 }
-                result.append(can_go ? " g" : " r");
+                frame.lightStates.push_back(can_go ? 'g' : 'r');
             }
-            result.append(",");
         }
-        logOut << result << std::endl;
+    }
+
+    void Engine::updateLog() {
+        snapshotReplayFrame(replayFrame);
+        if (replayWriter) replayWriter->push(replayFrame);
+    }
+
+    void Engine::updateVehicleIndex() {
+        if (!vehicleIndexDirty) return;
+        // walk the drivables instead of the vehicle pool, which also holds all waiting vehicles,
+        // and sort by priority to get the order of getRunningVehicles
+        std::vector<std::pair<int, Point>> vehicles;
+        vehicles.reserve(activeVehicleCount);
+        for (const Drivable *drivable : roadnet.getDrivables())
+            for (const Vehicle *vehicle : drivable->getVehicles())
+                if (vehicle->isReal() && vehicle->isRunning())
+                    vehicles.emplace_back(vehicle->getPriority(), vehicle->getPoint());
+        std::sort(vehicles.begin(), vehicles.end(),
+                  [](const std::pair<int, Point> &a, const std::pair<int, Point> &b) { return a.first < b.first; });
+        std::vector<Point> points;
+        points.reserve(vehicles.size());
+        for (const auto &vehicle : vehicles)
+            points.emplace_back(vehicle.second);
+        vehicleIndex.build(points);
+        vehicleIndexDirty = false;
     }
 
     void Engine::updateLeaderAndGap() {
@@ -563,6 +675,11 @@ namespace CityFlow {
         endBarrier.wait();
     }
 
+    void Engine::updateTrafficLight() {
+        startBarrier.wait();
+        endBarrier.wait();
+    }
+
     void Engine::nextStep() {
         for (auto &flow : flows)
             flow.nextStep(interval);
@@ -580,11 +697,9 @@ namespace CityFlow {
         updateAction();
         updateLeaderAndGap();
 
-        if (!rlTrafficLight) {
-            std::vector<Intersection> &intersections = roadnet.getIntersections();
-            for (auto &intersection : intersections)
-                intersection.getTrafficLight().passTime(interval);
-        }
+        updateTrafficLight();
+
+        if (metrics) metrics->record(getCurrentTime());
 
         if (saveReplay) {
             updateLog();
@@ -690,6 +805,25 @@ namespace CityFlow {
         return n == 0 ? 0 : tt / n;
     }
 
+    std::map<std::string, int> Engine::getTrafficLightPhase() {
+        std::map<std::string, int> ret;
+        for (Intersection &intersection : roadnet.getIntersections()) {
+            if (intersection.isVirtualIntersection()) continue;
+            ret.emplace(intersection.getId(), intersection.getTrafficLight().getCurrentPhaseIndex());
+        }
+        return ret;
+    }
+
+    std::vector<int> Engine::getVehiclesInRadius(double x, double y, double radius) {
+        updateVehicleIndex();
+        return vehicleIndex.queryRadius(x, y, radius);
+    }
+
+    std::vector<int> Engine::getVehiclesInBox(double minX, double minY, double maxX, double maxY) {
+        updateVehicleIndex();
+        return vehicleIndex.queryBox(minX, minY, maxX, maxY);
+    }
+
     void Engine::pushVehicle(const std::map<std::string, double> &info, const std::vector<std::string> &roads) {
         VehicleInfo vehicleInfo;
         std::map<std::string, double>::const_iterator it;
@@ -716,6 +850,63 @@ namespace CityFlow {
         vehicle->getFirstRoad()->addPlanRouteVehicle(vehicle);
     }
 
+    void Engine::pushVehicles(const std::map<std::string, std::vector<double>> &info,
+                              const std::vector<std::vector<std::string>> &routes,
+                              const std::vector<int> &routeIds) {
+        static const std::pair<const char *, double VehicleInfo::*> fields[] = {
+            {"speed", &VehicleInfo::speed}, {"length", &VehicleInfo::len}, {"width", &VehicleInfo::width},
+            {"maxPosAcc", &VehicleInfo::maxPosAcc}, {"maxNegAcc", &VehicleInfo::maxNegAcc},
+            {"usualPosAcc", &VehicleInfo::usualPosAcc}, {"usualNegAcc", &VehicleInfo::usualNegAcc},
+            {"minGap", &VehicleInfo::minGap}, {"maxSpeed", &VehicleInfo::maxSpeed},
+            {"headwayTime", &VehicleInfo::headwayTime}
+        };
+
+        // look every column up once instead of probing the map for each vehicle
+        size_t vehicleNum = routeIds.size();
+        std::vector<std::pair<double VehicleInfo::*, const std::vector<double> *>> columns;
+        for (const auto &field : fields) {
+            auto it = info.find(field.first);
+            if (it == info.end()) continue;
+            if (it->second.size() != vehicleNum)
+                throw std::invalid_argument("Column '" + it->first + "' has " + std::to_string(it->second.size())
+                                            + " values, expected " + std::to_string(vehicleNum));
+            columns.emplace_back(field.second, &it->second);
+        }
+
+        // resolve each route of the table once, vehicles with the same route id share the Route object
+        std::vector<std::shared_ptr<const Route>> routeTable;
+        routeTable.reserve(routes.size());
+        for (const auto &route : routes) {
+            if (route.empty())
+                throw std::invalid_argument("Route " + std::to_string(routeTable.size()) + " is empty");
+            std::vector<Road *> roads;
+            roads.reserve(route.size());
+            for (const auto &roadId : route) {
+                Road *road = roadnet.getRoadById(roadId);
+                if (!road)
+                    throw std::runtime_error("Road '" + roadId + "' not found");
+                roads.push_back(road);
+            }
+            routeTable.emplace_back(std::make_shared<const Route>(roads));
+        }
+        for (int routeId : routeIds) {
+            if (routeId < 0 || (size_t) routeId >= routeTable.size())
+                throw std::out_of_range("Route id " + std::to_string(routeId) + " out of range");
+        }
+
+        for (size_t i = 0; i < vehicleNum; ++i) {
+            VehicleInfo vehicleInfo;
+            for (const auto &column : columns)
+                vehicleInfo.*(column.first) = (*column.second)[i];
+            vehicleInfo.route = routeTable[routeIds[i]];
+
+            Vehicle *vehicle = new Vehicle(vehicleInfo,
+                "manually_pushed_" + std::to_string(manuallyPushCnt++), this);
+            pushVehicle(vehicle, false);
+            vehicle->getFirstRoad()->addPlanRouteVehicle(vehicle);
+        }
+    }
+
     void Engine::setTrafficLightPhase(const std::string &id, int phaseIndex) {
         if (!rlTrafficLight) {
             std::cerr << "please set rlTrafficLight to true to enable traffic light control" << std::endl;
@@ -724,13 +915,51 @@ namespace CityFlow {
         roadnet.getIntersectionById(id)->getTrafficLight().setPhase(phaseIndex);
     }
 
-    void Engine::setReplayLogFile(const std::string &logFile) {
+    void Engine::holdTrafficLightPhase(const std::string &id, int phaseIndex) {
+        Intersection *intersection = roadnet.getIntersectionById(id);
+        if (!intersection || intersection->isVirtualIntersection())
+            throw std::invalid_argument("No such signalized intersection: " + id);
+        TrafficLight &trafficLight = intersection->getTrafficLight();
+        if (phaseIndex < 0 || phaseIndex >= (int) trafficLight.getPhases().size())
+            throw std::out_of_range("Phase " + std::to_string(phaseIndex) + " out of range for intersection " + id);
+        trafficLight.hold(phaseIndex);
+    }
+
+    void Engine::releaseTrafficLightPhase(const std::string &id) {
+        Intersection *intersection = roadnet.getIntersectionById(id);
+        if (!intersection || intersection->isVirtualIntersection())
+            throw std::invalid_argument("No such signalized intersection: " + id);
+        intersection->getTrafficLight().release();
+    }
+
+    std::string Engine::getReplayHeader() {
+        if (!replayLayout) replayLayout.reset(new ReplayLayout(roadnet));
+        streamEncoder.reset(new BinaryReplayEncoder(*replayLayout));
+        std::string buffer;
+        streamEncoder->encodeHeader(buffer);
+        return buffer;
+    }
+
+    std::string Engine::getReplayFrame() {
+        if (!streamEncoder)
+            throw std::logic_error("getReplayHeader should be called before getReplayFrame");
+        snapshotReplayFrame(streamFrame);
+        std::string buffer;
+        streamEncoder->encodeFrame(streamFrame, buffer);
+        return buffer;
+    }
+
+    void Engine::setReplayLogFile(const std::string &logFile, const std::string &compression) {
         if (!saveReplayInConfig) {
             std::cerr << "saveReplay is not set to true in config file!" << std::endl;
             return;
         }
-        if (logOut.is_open()) logOut.close();
-        logOut.open(dir + logFile);
+        if (!compression.empty()) {
+            if (!ReplayWriter::supportsCompression(compression))
+                throw std::invalid_argument("Unsupported replay compression: " + compression);
+            replayCompression.codec = compression;
+        }
+        openReplayLog(dir + logFile);
     }
 
     void Engine::setSaveReplay(bool open) {
@@ -741,7 +970,31 @@ namespace CityFlow {
         saveReplay = open;
     }
     
-    void Engine::reset(bool resetRnd) {
+    void Engine::reset(bool resetRnd, const std::string &to) {
+        if (to == "warm") {
+            if (warmUpArchive) {
+                std::mt19937 curRnd = rnd;
+                warmUpArchive->resume(*this);
+                if (!resetRnd) rnd = curRnd;
+                return;
+            }
+            reset(resetRnd);
+            // neither replay nor metrics are recorded during warm-up
+            bool curSaveReplay = saveReplay;
+            std::unique_ptr<MetricsRecorder> curMetrics = std::move(metrics);
+            saveReplay = false;
+            for (size_t i = 0; i < warmUpSteps; ++i)
+                nextStep();
+            saveReplay = curSaveReplay;
+            metrics = std::move(curMetrics);
+            if (metrics) metrics->restart();
+            warmUpArchive.reset(new Archive(*this));
+            return;
+        }
+        if (to != "cold")
+            throw std::invalid_argument("reset target should be \"cold\" or \"warm\", got \"" + to + "\"");
+
+        if (metrics) metrics->flush();
         for (auto &vehiclePair : vehiclePool) delete vehiclePair.second.first;
         for (auto &pool : threadVehiclePool) pool.clear();
         vehiclePool.clear();
@@ -754,18 +1007,19 @@ namespace CityFlow {
         for (auto &flow : flows) flow.reset();
         step = 0;
         activeVehicleCount = 0;
+        vehicleIndexDirty = true;
+        if (metrics) metrics->restart();
         if (resetRnd) {
             rnd.seed(seed);
         }
     }
 
     Engine::~Engine() {
-        logOut.close();
+        replayWriter.reset();
+        metrics.reset();
         finished = true;
-        for (int i = 0; i < (laneChange ? 9 : 6); ++i) {
-            startBarrier.wait();
-            endBarrier.wait();
-        }
+        startBarrier.wait();
+        endBarrier.wait();
         for (auto &thread : threadPool) thread.join();
         for (auto &vehiclePair : vehiclePool) delete vehiclePair.second.first;
     }
@@ -774,7 +1028,16 @@ namespace CityFlow {
         if (!writeJsonToFile(jsonFile, jsonRoot)) {
             std::cerr << "write roadnet log file error" << std::endl;
         }
-        logOut.open(logFile);
+        openReplayLog(logFile);
+    }
+
+    void Engine::openReplayLog(const std::string &logFile) {
+        // the previous file is completed and closed first
+        replayWriter.reset();
+        if (!replayLayout) replayLayout.reset(new ReplayLayout(roadnet));
+        replayWriter.reset(new AsyncReplayWriter(ReplayWriter::create(replayLogFormat, *replayLayout, logFile,
+                                                                      replayCompression),
+                                                 replayBufferSize, replayDropWhenFull));
     }
 
     std::vector<const Vehicle *> Engine::getRunningVehicles(bool includeWaiting) const {
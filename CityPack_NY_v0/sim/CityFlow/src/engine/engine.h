@@ -4,7 +4,10 @@
 #include "flow/flow.h"
 #include "roadnet/roadnet.h"
 #include "engine/archive.h"
+#include "engine/metrics.h"
+#include "engine/replay.h"
 #include "utility/barrier.h"
+#include "utility/spatialindex.h"
 
 #include <mutex>
 #include <thread>
@@ -49,7 +52,15 @@ namespace CityFlow {
         std::vector<std::thread> threadPool;
         bool finished = false;
         std::string dir;
-        std::ofstream logOut;
+        std::string replayLogFormat = "text";
+        ReplayCompression replayCompression;
+        std::unique_ptr<ReplayLayout> replayLayout;
+        size_t replayBufferSize = 2;
+        bool replayDropWhenFull = false;
+        std::unique_ptr<AsyncReplayWriter> replayWriter;
+        ReplayFrame replayFrame;
+        std::unique_ptr<BinaryReplayEncoder> streamEncoder; // frames handed to the caller, see getReplayFrame
+        ReplayFrame streamFrame;
 
         bool rlTrafficLight;
         bool laneChange;
@@ -58,6 +69,14 @@ namespace CityFlow {
         int finishedVehicleCnt = 0;
         double cumulativeTravelTime = 0;
 
+        SpatialIndex vehicleIndex;
+        bool vehicleIndexDirty = true; // vehicles moved since the index was built
+
+        std::unique_ptr<MetricsRecorder> metrics;
+
+        size_t warmUpSteps = 0;
+        std::unique_ptr<Archive> warmUpArchive; // state after warm-up, captured by the first warm reset
+
     private:
         void vehicleControl(Vehicle &vehicle, std::vector<std::pair<Vehicle *, double>> &buffer);
 
@@ -73,6 +92,7 @@ namespace CityFlow {
 
         void planLaneChange();
 
+        void updateTrafficLight();
 
         void threadController(std::set<Vehicle *> &vehicles, 
                               std::vector<Road *> &roads,
@@ -95,16 +115,26 @@ namespace CityFlow {
 
         void threadPlanLaneChange(const std::set<Vehicle *> &vehicles);
 
+        void threadUpdateTrafficLight(const std::vector<Intersection *> &intersections);
+
         void handleWaiting();
 
+        void snapshotReplayFrame(ReplayFrame &frame) const;
+
         void updateLog();
 
+        void openReplayLog(const std::string &logFile);
+
+        void updateVehicleIndex();
+
         bool checkWarning();
 
         bool loadRoadNet(const std::string &jsonFile);
 
         bool loadFlow(const std::string &jsonFilename);
 
+        void loadTrafficLightControl(const rapidjson::Value &control);
+
         std::vector<const Vehicle *> getRunningVehicles(bool includeWaiting=false) const;
 
         void scheduleLaneChange();
@@ -140,6 +170,10 @@ namespace CityFlow {
 
         void pushVehicle(const std::map<std::string, double> &info, const std::vector<std::string> &roads);
 
+        void pushVehicles(const std::map<std::string, std::vector<double>> &info,
+                          const std::vector<std::vector<std::string>> &routes,
+                          const std::vector<int> &routeIds);
+
         size_t getVehicleCount() const;
 
         std::vector<std::string> getVehicles(bool includeWaiting = false) const;
@@ -160,9 +194,27 @@ namespace CityFlow {
 
         double getAverageTravelTime() const;
 
+        std::map<std::string, int> getTrafficLightPhase();
+
+        std::vector<int> getVehiclesInRadius(double x, double y, double radius);
+
+        std::vector<int> getVehiclesInBox(double minX, double minY, double maxX, double maxY);
+
         void setTrafficLightPhase(const std::string &id, int phaseIndex);
 
-        void setReplayLogFile(const std::string &logFile);
+        // fixes the phase of a light until released, whatever drives it (plan, controller or rlTrafficLight)
+        void holdTrafficLightPhase(const std::string &id, int phaseIndex);
+
+        void releaseTrafficLightPhase(const std::string &id);
+
+        // binary replay of the current state, for streaming without a replay file: the header starts a new
+        // stream, each frame only carries the ids not sent since the header
+        std::string getReplayHeader();
+
+        std::string getReplayFrame();
+
+        // compression is "none" or "zstd", empty keeps the compression of the config
+        void setReplayLogFile(const std::string &logFile, const std::string &compression = "");
 
         void setSaveReplay(bool open);
 
@@ -170,7 +222,7 @@ namespace CityFlow {
 
         void setRandomSeed(int seed) { rnd.seed(seed); }
         
-        void reset(bool resetRnd = false);
+        void reset(bool resetRnd = false, const std::string &to = "cold");
 
         // archive
         void load(const Archive &archive) { archive.resume(*this); }
@@ -0,0 +1,180 @@
+#include "engine/metrics.h"
+#include "roadnet/roadnet.h"
+#include "vehicle/vehicle.h"
+#include "utility/utility.h"
+
+#include <cmath>
+#include <iostream>
+#include <map>
+
+namespace CityFlow {
+
+    MetricsRecorder::MetricsRecorder(const RoadNet &roadnet, double interval, double window,
+                                     const std::string &laneFile, const std::string &intersectionFile)
+        : interval(interval), windowSteps(std::max<size_t>(1, (size_t) std::lround(window / interval))) {
+        std::map<const Intersection *, int> intersectionIndex;
+        for (const Intersection &intersection : roadnet.getIntersections()) {
+            if (intersection.isVirtualIntersection()) continue;
+            intersectionIndex[&intersection] = (int) intersectionIds.size();
+            intersectionIds.push_back(intersection.getId());
+        }
+        lanes = roadnet.getLanes();
+        for (const Lane *lane : lanes) {
+            laneIds.push_back(lane->getId());
+            auto iter = intersectionIndex.find(lane->getEndIntersection());
+            laneIntersection.push_back(iter == intersectionIndex.end() ? -1 : iter->second);
+        }
+        laneStats.assign(lanes.size(), LaneStat());
+        intersectionStats.assign(intersectionIds.size(), IntersectionStat());
+        takeBaseline();
+
+        if (!laneFile.empty()) {
+            laneOut.open(laneFile);
+            if (!laneOut.is_open())
+                std::cerr << "cannot open metrics file " << laneFile << std::endl;
+            laneOut << "time,duration,lane,entered,exited,meanSpeed,maxQueue,greenTime\n";
+        }
+        if (!intersectionFile.empty()) {
+            intersectionOut.open(intersectionFile);
+            if (!intersectionOut.is_open())
+                std::cerr << "cannot open metrics file " << intersectionFile << std::endl;
+            intersectionOut << "time,duration,intersection,entered,exited,meanSpeed,maxQueue\n";
+        }
+        writer = std::thread(&MetricsRecorder::writerLoop, this);
+    }
+
+    MetricsRecorder::~MetricsRecorder() {
+        flush();
+        {
+            std::lock_guard<std::mutex> guard(mutex);
+            stopped = true;
+        }
+        cv.notify_one();
+        writer.join();
+    }
+
+    void MetricsRecorder::takeBaseline() {
+        for (size_t i = 0; i < lanes.size(); ++i) {
+            laneStats[i] = LaneStat();
+            laneStats[i].lastEntered = lanes[i]->getEnteredVehicleCount();
+            laneStats[i].lastExited = lanes[i]->getExitedVehicleCount();
+        }
+        for (auto &stat : intersectionStats)
+            stat = IntersectionStat();
+        steps = 0;
+    }
+
+    void MetricsRecorder::record(double time) {
+        if (steps == 0) windowStart = time;
+        for (auto &stat : intersectionStats)
+            stat.queue = 0;
+        for (size_t i = 0; i < lanes.size(); ++i) {
+            const Lane *lane = lanes[i];
+            LaneStat &stat = laneStats[i];
+            size_t queue = 0;
+            for (const Vehicle *vehicle : lane->getVehicles()) {
+                double speed = vehicle->getSpeed();
+                stat.speedSum += speed;
+                if (speed < 0.1) ++queue;
+            }
+            stat.speedSamples += lane->getVehicleCount();
+            if (queue > stat.maxQueue) stat.maxQueue = queue;
+
+            const auto &laneLinks = lane->getLaneLinks();
+            bool green = !laneLinks.empty();
+            for (const LaneLink *laneLink : laneLinks) {
+                if (!laneLink->isAvailable()) {
+                    green = false;
+                    break;
+                }
+            }
+            if (green) stat.greenTime += interval;
+            if (laneIntersection[i] >= 0) intersectionStats[laneIntersection[i]].queue += queue;
+        }
+        for (auto &stat : intersectionStats)
+            if (stat.queue > stat.maxQueue) stat.maxQueue = stat.queue;
+
+        if (++steps >= windowSteps) flush();
+    }
+
+    void MetricsRecorder::flush() {
+        if (steps == 0) return;
+        Batch batch;
+        batch.time = windowStart;
+        batch.duration = steps * interval;
+        batch.lanes.resize(lanes.size());
+        batch.intersections.resize(intersectionIds.size());
+        for (size_t i = 0; i < lanes.size(); ++i) {
+            const LaneStat &stat = laneStats[i];
+            Row &row = batch.lanes[i];
+            row.entered = lanes[i]->getEnteredVehicleCount() - stat.lastEntered;
+            row.exited = lanes[i]->getExitedVehicleCount() - stat.lastExited;
+            row.maxQueue = stat.maxQueue;
+            row.speedSamples = stat.speedSamples;
+            row.speedSum = stat.speedSum;
+            row.greenTime = stat.greenTime;
+            if (laneIntersection[i] >= 0) {
+                Row &intersectionRow = batch.intersections[laneIntersection[i]];
+                intersectionRow.entered += row.entered;
+                intersectionRow.exited += row.exited;
+                intersectionRow.speedSamples += row.speedSamples;
+                intersectionRow.speedSum += row.speedSum;
+            }
+        }
+        for (size_t i = 0; i < intersectionIds.size(); ++i)
+            batch.intersections[i].maxQueue = intersectionStats[i].maxQueue;
+        takeBaseline();
+
+        {
+            std::lock_guard<std::mutex> guard(mutex);
+            pending.emplace_back(std::move(batch));
+        }
+        cv.notify_one();
+    }
+
+    void MetricsRecorder::restart() {
+        takeBaseline();
+    }
+
+    void MetricsRecorder::writeBatch(const Batch &batch) {
+        std::string prefix = double2string(batch.time) + "," + double2string(batch.duration) + ",";
+        auto meanSpeed = [](const Row &row) {
+            return row.speedSamples ? double2string(row.speedSum / row.speedSamples) : std::string();
+        };
+        if (laneOut.is_open()) {
+            std::string result;
+            for (size_t i = 0; i < batch.lanes.size(); ++i) {
+                const Row &row = batch.lanes[i];
+                result.append(prefix + laneIds[i] + "," + std::to_string(row.entered) + ","
+                              + std::to_string(row.exited) + "," + meanSpeed(row) + ","
+                              + std::to_string(row.maxQueue) + "," + double2string(row.greenTime) + "\n");
+            }
+            laneOut << result;
+            laneOut.flush();
+        }
+        if (intersectionOut.is_open()) {
+            std::string result;
+            for (size_t i = 0; i < batch.intersections.size(); ++i) {
+                const Row &row = batch.intersections[i];
+                result.append(prefix + intersectionIds[i] + "," + std::to_string(row.entered) + ","
+                              + std::to_string(row.exited) + "," + meanSpeed(row) + ","
+                              + std::to_string(row.maxQueue) + "\n");
+            }
+            intersectionOut << result;
+            intersectionOut.flush();
+        }
+    }
+
+    void MetricsRecorder::writerLoop() {
+        std::unique_lock<std::mutex> lock(mutex);
+        while (true) {
+            cv.wait(lock, [this] { return stopped || !pending.empty(); });
+            if (pending.empty()) break; // stopped and drained
+            Batch batch = std::move(pending.front());
+            pending.pop_front();
+            lock.unlock();
+            writeBatch(batch);
+            lock.lock();
+        }
+    }
+}
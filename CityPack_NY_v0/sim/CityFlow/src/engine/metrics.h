@@ -0,0 +1,94 @@
+#ifndef CITYFLOW_METRICS_H
+#define CITYFLOW_METRICS_H
+
+#include <condition_variable>
+#include <deque>
+#include <fstream>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <vector>
+
+namespace CityFlow {
+    class RoadNet;
+
+    class Lane;
+
+    /*
+     * Accumulates per-lane and per-intersection statistics over fixed windows of simulation time.
+     * Each finished window is handed to a writer thread which appends it to the csv files, so the
+     * simulation thread only updates counters.
+     */
+    class MetricsRecorder {
+    private:
+        struct LaneStat {
+            size_t lastEntered = 0;
+            size_t lastExited = 0;
+            size_t speedSamples = 0;
+            size_t maxQueue = 0;
+            double speedSum = 0;
+            double greenTime = 0;
+        };
+
+        struct IntersectionStat {
+            size_t queue = 0; // queue of the current step
+            size_t maxQueue = 0;
+        };
+
+        struct Row {
+            size_t entered = 0, exited = 0, maxQueue = 0, speedSamples = 0;
+            double speedSum = 0, greenTime = 0;
+        };
+
+        struct Batch {
+            double time, duration;
+            std::vector<Row> lanes;
+            std::vector<Row> intersections;
+        };
+
+        double interval;
+        size_t windowSteps;
+        size_t steps = 0;
+        double windowStart = 0;
+        std::vector<Lane *> lanes;
+        std::vector<int> laneIntersection; // index into intersectionIds of the end intersection, -1 if virtual
+        std::vector<std::string> laneIds;
+        std::vector<std::string> intersectionIds;
+        std::vector<LaneStat> laneStats;
+        std::vector<IntersectionStat> intersectionStats;
+
+        std::ofstream laneOut, intersectionOut;
+        std::deque<Batch> pending;
+        std::mutex mutex;
+        std::condition_variable cv;
+        bool stopped = false;
+        std::thread writer;
+
+        void takeBaseline();
+
+        void writeBatch(const Batch &batch);
+
+        void writerLoop();
+
+    public:
+        MetricsRecorder(const RoadNet &roadnet, double interval, double window,
+                        const std::string &laneFile, const std::string &intersectionFile);
+
+        MetricsRecorder(const MetricsRecorder &) = delete;
+
+        MetricsRecorder &operator=(const MetricsRecorder &) = delete;
+
+        ~MetricsRecorder();
+
+        // called once per step with the time of the step, after vehicles and traffic lights are updated
+        void record(double time);
+
+        // hands the current (partial) window to the writer
+        void flush();
+
+        // discards the current window, used when the engine state jumps (reset, load)
+        void restart();
+    };
+}
+
+#endif //CITYFLOW_METRICS_H
@@ -0,0 +1,361 @@
+#include "engine/replay.h"
+#include "roadnet/roadnet.h"
+#include "utility/utility.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstring>
+#include <iostream>
+#include <limits>
+#include <stdexcept>
+
+#ifdef CITYFLOW_WITH_ZSTD
+#include <zstd.h>
+#endif
+
+namespace CityFlow {
+
+    namespace {
+        // the binary format is little-endian, as are all the platforms the engine is built for
+        template <typename T>
+        void put(std::string &buffer, T value) {
+            char bytes[sizeof(T)];
+            std::memcpy(bytes, &value, sizeof(T));
+            buffer.append(bytes, sizeof(T));
+        }
+
+        void putString(std::string &buffer, const std::string &str) {
+            put<uint16_t>(buffer, (uint16_t) std::min<size_t>(str.size(), UINT16_MAX));
+            buffer.append(str, 0, std::min<size_t>(str.size(), UINT16_MAX));
+        }
+
+        template <typename T>
+        T quantize(double value, double scale) {
+            double scaled = std::round(value * scale);
+            scaled = std::min(std::max(scaled, (double) std::numeric_limits<T>::min()),
+                              (double) std::numeric_limits<T>::max());
+            return (T) scaled;
+        }
+    }
+
+    void ReplayFrame::clear() {
+        vehicles.clear();
+        vehicleIds.clear();
+        lightStates.clear();
+    }
+
+    ReplayLayout::ReplayLayout(const RoadNet &roadnet) {
+        for (const Road &road : roadnet.getRoads()) {
+            if (road.getEndIntersection().isVirtualIntersection())
+                continue;
+            roadIds.push_back(road.getId());
+            implicitLanes.emplace_back();
+            for (const Lane &lane : road.getLanes())
+                implicitLanes.back().push_back(lane.getEndIntersection()->isImplicitIntersection());
+        }
+    }
+
+    size_t ReplayLayout::getLaneCount() const {
+        size_t cnt = 0;
+        for (const auto &lanes : implicitLanes)
+            cnt += lanes.size();
+        return cnt;
+    }
+
+#ifdef CITYFLOW_WITH_ZSTD
+    /*
+     * Zstandard seekable format (contrib/seekable_format in the zstd sources): the frames of stepsPerFrame steps are
+     * compressed as independent zstd frames, the file ends with a seek table giving the compressed and decompressed
+     * size of every frame. The first and the last frame before the seek table are skippable frames holding the
+     * replay metadata as JSON, a reader only decompresses the frames of the steps it needs, `zstd -d` gives back
+     * the plain replay log.
+     */
+    class ReplayCompressor {
+    private:
+        static const uint32_t skippableMagic = 0x184D2A50;
+        static const uint32_t seekTableMagic = 0x184D2A5E;
+        static const uint32_t seekableMagic = 0x8F92EAB1;
+
+        std::ostream &out;
+        size_t stepsPerFrame;
+        int level;
+        ZSTD_CCtx *context;
+        std::string pending, compressed;
+        size_t pendingSteps = 0, steps = 0;
+        std::vector<std::pair<uint32_t, uint32_t>> seekTable; // compressed and decompressed size of every frame
+
+        void writeRaw(const std::string &data, uint32_t decompressedSize) {
+            out.write(data.data(), data.size());
+            seekTable.emplace_back((uint32_t) data.size(), decompressedSize);
+        }
+
+        void writeMetadata(const std::string &json) {
+            compressed.clear();
+            put<uint32_t>(compressed, skippableMagic);
+            put<uint32_t>(compressed, (uint32_t) json.size());
+            compressed.append(json);
+            writeRaw(compressed, 0);
+        }
+
+        void compressFrame() {
+            compressed.resize(ZSTD_compressBound(pending.size()));
+            size_t size = ZSTD_compressCCtx(context, &compressed[0], compressed.size(),
+                                            pending.data(), pending.size(), level);
+            if (ZSTD_isError(size)) {
+                std::cerr << "cannot compress replay frame: " << ZSTD_getErrorName(size) << std::endl;
+                size = 0;
+            }
+            compressed.resize(size);
+            writeRaw(compressed, (uint32_t) pending.size());
+            pending.clear();
+            pendingSteps = 0;
+        }
+
+    public:
+        ReplayCompressor(std::ostream &out, const std::string &format, const ReplayCompression &compression)
+            : out(out), stepsPerFrame(std::max<size_t>(1, compression.stepsPerFrame)), level(compression.level),
+              context(ZSTD_createCCtx()) {
+            writeMetadata("{\"format\":\"" + format + "\",\"stepsPerFrame\":" + std::to_string(stepsPerFrame) + "}");
+        }
+
+        ~ReplayCompressor() { ZSTD_freeCCtx(context); }
+
+        void append(const std::string &data) { pending.append(data); }
+
+        void endStep() {
+            ++steps;
+            if (++pendingSteps >= stepsPerFrame) compressFrame();
+        }
+
+        void finish() {
+            if (!pending.empty()) compressFrame();
+            writeMetadata("{\"steps\":" + std::to_string(steps) + "}");
+
+            compressed.clear();
+            put<uint32_t>(compressed, seekTableMagic);
+            put<uint32_t>(compressed, (uint32_t) (seekTable.size() * 8 + 9));
+            for (const auto &entry : seekTable) {
+                put<uint32_t>(compressed, entry.first);
+                put<uint32_t>(compressed, entry.second);
+            }
+            put<uint32_t>(compressed, (uint32_t) seekTable.size());
+            put<uint8_t>(compressed, 0); // no checksums
+            put<uint32_t>(compressed, seekableMagic);
+            out.write(compressed.data(), compressed.size());
+        }
+    };
+#else
+    class ReplayCompressor {
+    public:
+        void append(const std::string &) {}
+
+        void endStep() {}
+
+        void finish() {}
+    };
+#endif
+
+    ReplayWriter::ReplayWriter(const ReplayLayout &layout, const std::string &fileName, const std::string &format,
+                               const ReplayCompression &compression)
+        : layout(layout) {
+        if (!supportsCompression(compression.codec))
+            throw std::invalid_argument("Unsupported replay compression: " + compression.codec);
+        bool plainText = format == "text" && compression.codec == "none";
+        out.open(fileName, plainText ? std::ios::out : std::ios::out | std::ios::binary);
+        if (!out.is_open())
+            std::cerr << "cannot open replay log file " << fileName << std::endl;
+#ifdef CITYFLOW_WITH_ZSTD
+        if (compression.codec == "zstd")
+            compressor.reset(new ReplayCompressor(out, format, compression));
+#endif
+    }
+
+    ReplayWriter::~ReplayWriter() {
+        if (compressor) compressor->finish();
+    }
+
+    void ReplayWriter::writeHeader(const std::string &header) {
+        if (compressor)
+            compressor->append(header);
+        else
+            out.write(header.data(), header.size());
+    }
+
+    void ReplayWriter::writeFrame(const ReplayFrame &frame) {
+        buffer.clear();
+        encodeFrame(frame, buffer);
+        if (compressor) {
+            compressor->append(buffer);
+            compressor->endStep();
+        } else {
+            // no flush per frame, the stream is flushed when the file is closed
+            out.write(buffer.data(), buffer.size());
+        }
+    }
+
+    bool ReplayWriter::supportsCompression(const std::string &codec) {
+#ifdef CITYFLOW_WITH_ZSTD
+        if (codec == "zstd") return true;
+#endif
+        return codec == "none";
+    }
+
+    std::unique_ptr<ReplayWriter> ReplayWriter::create(const std::string &format, const ReplayLayout &layout,
+                                                       const std::string &fileName,
+                                                       const ReplayCompression &compression) {
+        if (format == "text")
+            return std::unique_ptr<ReplayWriter>(new TextReplayWriter(layout, fileName, compression));
+        if (format == "binary")
+            return std::unique_ptr<ReplayWriter>(new BinaryReplayWriter(layout, fileName, compression));
+        throw std::invalid_argument("Unknown replay log format: " + format);
+    }
+
+    TextReplayWriter::TextReplayWriter(const ReplayLayout &layout, const std::string &fileName,
+                                       const ReplayCompression &compression)
+        : ReplayWriter(layout, fileName, "text", compression) {}
+
+    void TextReplayWriter::encodeFrame(const ReplayFrame &frame, std::string &result) {
+        for (size_t i = 0; i < frame.vehicles.size(); ++i) {
+            const auto &vehicle = frame.vehicles[i];
+            result.append(
+                    double2string(vehicle.x) + " " + double2string(vehicle.y) + " " + double2string(vehicle.heading) + " "
+                            + frame.vehicleIds[i] + " " + std::to_string(vehicle.lc) + " " + double2string(vehicle.len) + " "
+                            + double2string(vehicle.width) + ",");
+        }
+        result.append(";");
+
+        size_t laneIndex = 0;
+        for (size_t i = 0; i < layout.roadIds.size(); ++i) {
+            result.append(layout.roadIds[i]);
+            for (size_t j = 0; j < layout.implicitLanes[i].size(); ++j) {
+                result.append(" ");
+                result.push_back(frame.lightStates[laneIndex++]);
+            }
+            result.append(",");
+        }
+        result.push_back('\n');
+    }
+
+    BinaryReplayEncoder::BinaryReplayEncoder(const ReplayLayout &layout) : layout(layout) {
+        for (const auto &lanes : layout.implicitLanes)
+            signalizedLaneCount += std::count(lanes.begin(), lanes.end(), false);
+    }
+
+    void BinaryReplayEncoder::encodeHeader(std::string &buffer) const {
+        buffer.append("CFRB", 4);
+        put<uint16_t>(buffer, version);
+        put<uint16_t>(buffer, 0); // flags, reserved
+        put<uint32_t>(buffer, (uint32_t) layout.roadIds.size());
+        for (size_t i = 0; i < layout.roadIds.size(); ++i) {
+            putString(buffer, layout.roadIds[i]);
+            put<uint16_t>(buffer, (uint16_t) layout.implicitLanes[i].size());
+            for (bool implicit : layout.implicitLanes[i])
+                put<uint8_t>(buffer, implicit ? 1 : 0);
+        }
+    }
+
+    void BinaryReplayEncoder::encodeFrame(const ReplayFrame &frame, std::string &buffer) {
+        put<uint32_t>(buffer, (uint32_t) frame.vehicles.size());
+
+        // ids seen for the first time in this frame, in order of appearance
+        size_t newIdCountPos = buffer.size();
+        put<uint32_t>(buffer, 0);
+        uint32_t newIdCount = 0;
+        std::vector<uint32_t> indices(frame.vehicles.size());
+        for (size_t i = 0; i < frame.vehicles.size(); ++i) {
+            auto result = idIndex.emplace(frame.vehicleIds[i], (uint32_t) idIndex.size());
+            if (result.second) {
+                putString(buffer, frame.vehicleIds[i]);
+                ++newIdCount;
+            }
+            indices[i] = result.first->second;
+        }
+        std::memcpy(&buffer[newIdCountPos], &newIdCount, sizeof(newIdCount));
+
+        for (size_t i = 0; i < frame.vehicles.size(); ++i) {
+            const auto &vehicle = frame.vehicles[i];
+            put<int32_t>(buffer, quantize<int32_t>(vehicle.x, 100));
+            put<int32_t>(buffer, quantize<int32_t>(vehicle.y, 100));
+            put<int16_t>(buffer, quantize<int16_t>(vehicle.heading, 10000));
+            put<int8_t>(buffer, (int8_t) vehicle.lc);
+            put<uint8_t>(buffer, 0);
+            put<uint16_t>(buffer, quantize<uint16_t>(vehicle.len, 100));
+            put<uint16_t>(buffer, quantize<uint16_t>(vehicle.width, 100));
+            put<uint32_t>(buffer, indices[i]);
+        }
+
+        // one bit per signalized lane, least significant bit first, 1 for green
+        std::string lights((signalizedLaneCount + 7) / 8, '\0');
+        size_t bit = 0;
+        for (char state : frame.lightStates) {
+            if (state == 'i') continue;
+            if (state == 'g') lights[bit >> 3] |= (char) (1 << (bit & 7));
+            ++bit;
+        }
+        buffer.append(lights);
+    }
+
+    BinaryReplayWriter::BinaryReplayWriter(const ReplayLayout &layout, const std::string &fileName,
+                                           const ReplayCompression &compression)
+        : ReplayWriter(layout, fileName, "binary", compression), encoder(layout) {
+        std::string header;
+        encoder.encodeHeader(header);
+        writeHeader(header);
+    }
+
+    void BinaryReplayWriter::encodeFrame(const ReplayFrame &frame, std::string &buffer) {
+        encoder.encodeFrame(frame, buffer);
+    }
+
+    AsyncReplayWriter::AsyncReplayWriter(std::unique_ptr<ReplayWriter> writer, size_t capacity, bool dropWhenFull)
+        : writer(std::move(writer)), capacity(std::max<size_t>(1, capacity)), dropWhenFull(dropWhenFull) {
+        thread = std::thread(&AsyncReplayWriter::writerLoop, this);
+    }
+
+    AsyncReplayWriter::~AsyncReplayWriter() {
+        {
+            std::lock_guard<std::mutex> guard(mutex);
+            stopped = true;
+        }
+        notEmpty.notify_one();
+        thread.join();
+        if (droppedCnt > 0)
+            std::cerr << droppedCnt << " replay frames dropped, the replay writer could not keep up" << std::endl;
+    }
+
+    void AsyncReplayWriter::push(ReplayFrame &frame) {
+        std::unique_lock<std::mutex> lock(mutex);
+        if (pending.size() >= capacity) {
+            if (dropWhenFull) {
+                ++droppedCnt;
+                frame.clear();
+                return;
+            }
+            notFull.wait(lock, [this] { return pending.size() < capacity; });
+        }
+        pending.emplace_back();
+        std::swap(pending.back(), frame);
+        if (!spare.empty()) {
+            std::swap(frame, spare.back());
+            spare.pop_back();
+        }
+        lock.unlock();
+        frame.clear();
+        notEmpty.notify_one();
+    }
+
+    void AsyncReplayWriter::writerLoop() {
+        std::unique_lock<std::mutex> lock(mutex);
+        while (true) {
+            notEmpty.wait(lock, [this] { return stopped || !pending.empty(); });
+            if (pending.empty()) break; // stopped and drained
+            ReplayFrame frame = std::move(pending.front());
+            pending.pop_front();
+            lock.unlock();
+            writer->writeFrame(frame);
+            lock.lock();
+            spare.push_back(std::move(frame));
+            notFull.notify_all();
+        }
+    }
+}
@@ -0,0 +1,173 @@
+#ifndef CITYFLOW_REPLAY_H
+#define CITYFLOW_REPLAY_H
+
+#include <condition_variable>
+#include <cstdint>
+#include <deque>
+#include <fstream>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <unordered_map>
+#include <vector>
+
+namespace CityFlow {
+    class RoadNet;
+
+    // what the replay shows of one step
+    struct ReplayFrame {
+        struct VehicleRecord {
+            double x, y, heading, len, width;
+            int lc;
+        };
+
+        std::vector<VehicleRecord> vehicles;
+        std::vector<std::string> vehicleIds;
+        std::vector<char> lightStates; // 'g', 'r' or 'i' for every lane of the replay layout
+
+        void clear();
+    };
+
+    /*
+     * Roads and lanes shown in the replay, in output order: roads whose end intersection is not virtual,
+     * with the lanes ending at an implicit intersection (no signal) marked.
+     */
+    struct ReplayLayout {
+        std::vector<std::string> roadIds;
+        std::vector<std::vector<bool>> implicitLanes;
+
+        explicit ReplayLayout(const RoadNet &roadnet);
+
+        size_t getLaneCount() const;
+    };
+
+    // how a replay log is compressed, codec is "none" or "zstd"
+    struct ReplayCompression {
+        std::string codec = "none";
+        size_t stepsPerFrame = 100;
+        int level = 3;
+    };
+
+    class ReplayCompressor;
+
+    class ReplayWriter {
+    private:
+        std::unique_ptr<ReplayCompressor> compressor; // null when written as is
+        std::string buffer;
+
+    protected:
+        const ReplayLayout &layout;
+        std::ofstream out;
+
+        // bytes before the first frame
+        void writeHeader(const std::string &header);
+
+        // append the encoding of frame to buffer
+        virtual void encodeFrame(const ReplayFrame &frame, std::string &buffer) = 0;
+
+    public:
+        ReplayWriter(const ReplayLayout &layout, const std::string &fileName, const std::string &format,
+                     const ReplayCompression &compression);
+
+        // finishes the compressed frames and the seek table
+        virtual ~ReplayWriter();
+
+        bool isOpen() const { return out.is_open(); }
+
+        void writeFrame(const ReplayFrame &frame);
+
+        // whether this build can write replay logs compressed with codec
+        static bool supportsCompression(const std::string &codec);
+
+        // format is "text" or "binary"
+        static std::unique_ptr<ReplayWriter> create(const std::string &format, const ReplayLayout &layout,
+                                                    const std::string &fileName,
+                                                    const ReplayCompression &compression = ReplayCompression());
+    };
+
+    // one line per frame, read by the frontend
+    class TextReplayWriter : public ReplayWriter {
+    public:
+        TextReplayWriter(const ReplayLayout &layout, const std::string &fileName,
+                         const ReplayCompression &compression);
+
+    protected:
+        void encodeFrame(const ReplayFrame &frame, std::string &buffer) override;
+    };
+
+    /*
+     * Little-endian binary replay encoding, see tools/replay/readme.md for the layout.
+     * Vehicles are fixed-width quantized records, ids are written once and referred to by index,
+     * the lights of the signalized lanes are packed into a bit vector.
+     * Frames must be encoded in order, the ids already written are remembered.
+     */
+    class BinaryReplayEncoder {
+    private:
+        const ReplayLayout &layout;
+        std::unordered_map<std::string, uint32_t> idIndex;
+        size_t signalizedLaneCount = 0;
+
+    public:
+        static const uint16_t version = 1;
+
+        explicit BinaryReplayEncoder(const ReplayLayout &layout);
+
+        // append to buffer
+        void encodeHeader(std::string &buffer) const;
+
+        void encodeFrame(const ReplayFrame &frame, std::string &buffer);
+    };
+
+    class BinaryReplayWriter : public ReplayWriter {
+    private:
+        BinaryReplayEncoder encoder;
+
+    public:
+        BinaryReplayWriter(const ReplayLayout &layout, const std::string &fileName,
+                           const ReplayCompression &compression);
+
+    protected:
+        void encodeFrame(const ReplayFrame &frame, std::string &buffer) override;
+    };
+
+    /*
+     * Runs a ReplayWriter on its own thread. The simulation thread only hands over the frame snapshot,
+     * at most capacity frames wait to be written; when the queue is full the simulation thread waits
+     * for the writer, or with dropWhenFull the frame is dropped.
+     * Frame buffers are recycled between the two threads so steady state pushes do not allocate.
+     */
+    class AsyncReplayWriter {
+    private:
+        std::unique_ptr<ReplayWriter> writer;
+        size_t capacity;
+        bool dropWhenFull;
+        size_t droppedCnt = 0;
+
+        std::deque<ReplayFrame> pending;
+        std::vector<ReplayFrame> spare;
+        std::mutex mutex;
+        std::condition_variable notEmpty, notFull;
+        bool stopped = false;
+        std::thread thread;
+
+        void writerLoop();
+
+    public:
+        AsyncReplayWriter(std::unique_ptr<ReplayWriter> writer, size_t capacity, bool dropWhenFull);
+
+        AsyncReplayWriter(const AsyncReplayWriter &) = delete;
+
+        AsyncReplayWriter &operator=(const AsyncReplayWriter &) = delete;
+
+        // writes the pending frames and closes the file
+        ~AsyncReplayWriter();
+
+        // takes the content of frame, leaving it with a recycled buffer to fill the next frame
+        void push(ReplayFrame &frame);
+
+        size_t getDroppedCount() const { return droppedCnt; }
+    };
+}
+
+#endif //CITYFLOW_REPLAY_H
@@ -16,7 +16,7 @@ namespace CityFlow {
 
         explicit Route(const std::vector<Road *> &route) : route(route) { }
 
-        std::vector<Road *> getRoute() const { return route; }
+        const std::vector<Road *> &getRoute() const { return route; }
     };
 }
 #endif //CITYFLOW_ROUTE_H
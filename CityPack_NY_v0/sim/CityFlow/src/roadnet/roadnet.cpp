@@ -832,6 +832,8 @@ FOUND:;
     void Lane::reset() {
         waitingBuffer.clear();
         vehicles.clear();
+        enteredVehicleCnt = 0;
+        exitedVehicleCnt = 0;
     }
 
     std::vector<Vehicle *> Lane::getVehiclesBeforeDistance(double dis, size_t segmentIndex, double deltaDis) {
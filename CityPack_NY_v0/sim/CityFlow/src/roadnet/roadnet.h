@@ -302,6 +302,8 @@ namespace CityFlow {
         std::vector<LaneLink *> laneLinks;
         Road *belongRoad = nullptr;
         std::deque<Vehicle *> waitingBuffer;
+        size_t enteredVehicleCnt = 0;
+        size_t exitedVehicleCnt = 0;
 
         struct HistoryRecord {
             int vehicleNum;
@@ -366,6 +368,15 @@ namespace CityFlow {
             waitingBuffer.emplace_back(vehicle);
         }
 
+        /* cumulative number of vehicles entered and exited, used by signal controllers and metrics */
+        size_t getEnteredVehicleCount() const { return enteredVehicleCnt; }
+
+        size_t getExitedVehicleCount() const { return exitedVehicleCnt; }
+
+        void countEnteredVehicle() { ++enteredVehicleCnt; }
+
+        void countExitedVehicle() { ++exitedVehicleCnt; }
+
         /* segmentation */
         void buildSegmentation(size_t numSegs);
 
@@ -426,6 +437,8 @@ namespace CityFlow {
 
         Road *getEndRoad() const { return this->endRoad; }
 
+        RoadLinkType getType() const { return this->type; }
+
         bool isAvailable() const {
             return this->intersection->trafficLight.getCurrentPhase().roadLinkAvailable[this->index];
         }
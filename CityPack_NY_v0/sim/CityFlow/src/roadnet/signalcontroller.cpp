@@ -0,0 +1,271 @@
+#include "roadnet/signalcontroller.h"
+#include "roadnet/roadnet.h"
+#include "vehicle/vehicle.h"
+#include "utility/utility.h"
+
+#include <algorithm>
+
+namespace CityFlow {
+
+    void SignalController::init(TrafficLight &light) {
+        const auto &phases = light.getPhases();
+        const auto &roadLinks = light.getIntersection().getRoadLinks();
+        phaseInfos.assign(phases.size(), PhaseInfo());
+        greenPhases.clear();
+        inLanes.clear();
+
+        for (size_t i = 0; i < phases.size(); ++i) {
+            PhaseInfo &info = phaseInfos[i];
+            const auto &available = phases[i].getRoadLinkAvailable();
+            for (size_t j = 0; j < roadLinks.size() && j < available.size(); ++j) {
+                if (!available[j]) continue;
+                if (roadLinks[j].getType() != turn_right)
+                    info.green = true;
+                for (const LaneLink &laneLink : roadLinks[j].getLaneLinks()) {
+                    info.laneLinks.emplace_back(laneLink.getStartLane(), laneLink.getEndLane());
+                    if (std::find(info.inLanes.begin(), info.inLanes.end(), laneLink.getStartLane()) == info.inLanes.end())
+                        info.inLanes.push_back(laneLink.getStartLane());
+                }
+            }
+            if (info.green) greenPhases.push_back((int) i);
+        }
+
+        for (size_t i = 0; i < phases.size(); ++i) {
+            size_t next = (i + 1) % phases.size();
+            if (phaseInfos[i].green && !phaseInfos[next].green) {
+                phaseInfos[i].transition = (int) next;
+                phaseInfos[i].transitionTime = phases[next].getTime();
+            }
+        }
+
+        for (const RoadLink &roadLink : roadLinks)
+            for (const LaneLink &laneLink : roadLink.getLaneLinks())
+                if (std::find(inLanes.begin(), inLanes.end(), laneLink.getStartLane()) == inLanes.end())
+                    inLanes.push_back(laneLink.getStartLane());
+
+        clock = greenTime = transitionRemain = 0;
+        curGreen = nextGreen = -1;
+        if (greenPhases.empty()) return;
+
+        int cur = light.getCurrentPhaseIndex();
+        if (phaseInfos[cur].green) {
+            curGreen = cur;
+        } else {
+            // currently in a transition phase, finish it before showing the next green phase
+            curGreen = nextGreen = nextGreenPhase(cur);
+            transitionRemain = phases[cur].getTime();
+        }
+    }
+
+    void SignalController::step(TrafficLight &light, double interval) {
+        if (greenPhases.empty()) {
+            light.passTime(interval);
+            return;
+        }
+        clock += interval;
+        if (transitionRemain > 0) {
+            transitionRemain -= interval;
+            if (transitionRemain > 0) return;
+            curGreen = nextGreen;
+            greenTime = 0;
+            light.setPhase(curGreen);
+            return;
+        }
+
+        greenTime += interval;
+        int target = choosePhase(interval);
+        if (greenTime < minGreen || target < 0 || target == curGreen)
+            return;
+
+        nextGreen = target;
+        int transition = phaseInfos[curGreen].transition;
+        if (transition >= 0 && phaseInfos[curGreen].transitionTime > 0) {
+            transitionRemain = phaseInfos[curGreen].transitionTime;
+            light.setPhase(transition);
+        } else {
+            curGreen = target;
+            greenTime = 0;
+            light.setPhase(curGreen);
+        }
+    }
+
+    int SignalController::nextGreenPhase(int phaseIndex) const {
+        int n = (int) phaseInfos.size();
+        for (int i = 1; i <= n; ++i) {
+            int index = (phaseIndex + i) % n;
+            if (phaseInfos[index].green) return index;
+        }
+        return -1;
+    }
+
+    bool SignalController::isServed(const Lane *lane, int phaseIndex) const {
+        const auto &lanes = phaseInfos[phaseIndex].inLanes;
+        return std::find(lanes.begin(), lanes.end(), lane) != lanes.end();
+    }
+
+    bool SignalController::hasDemand(int phaseIndex, double distance) const {
+        for (const Lane *lane : phaseInfos[phaseIndex].inLanes)
+            if (countApproaching(lane, distance) > 0) return true;
+        return false;
+    }
+
+    int SignalController::nextDemandedPhase(double distance) const {
+        int n = (int) phaseInfos.size();
+        for (int i = 1; i < n; ++i) {
+            int phaseIndex = (curGreen + i) % n;
+            if (phaseInfos[phaseIndex].green && hasDemand(phaseIndex, distance)) return phaseIndex;
+        }
+        return curGreen;
+    }
+
+    size_t SignalController::countApproaching(const Lane *lane, double distance, bool movingOnly) {
+        // vehicles are ordered from the end of the lane
+        size_t cnt = 0;
+        double threshold = lane->getLength() - distance;
+        for (const Vehicle *vehicle : lane->getVehicles()) {
+            if (vehicle->getDistance() < threshold) break;
+            if (!movingOnly || vehicle->getSpeed() >= 0.1) ++cnt;
+        }
+        return cnt;
+    }
+
+    std::shared_ptr<SignalController> SignalController::create(const rapidjson::Value &config) {
+        std::string type = getJsonMember<const char*>("type", config);
+        if (type == "fixed")
+            return std::make_shared<FixedTimeController>();
+        if (type == "maxPressure")
+            return std::make_shared<MaxPressureController>(getJsonMember<double>("minGreen", config, 20));
+        if (type == "webster")
+            return std::make_shared<WebsterController>(getJsonMember<double>("minGreen", config, 5),
+                                                       getJsonMember<double>("updateInterval", config, 300),
+                                                       getJsonMember<double>("saturationFlow", config, 0.5),
+                                                       getJsonMember<double>("minCycle", config, 30),
+                                                       getJsonMember<double>("maxCycle", config, 180));
+        if (type == "sotl")
+            return std::make_shared<SOTLController>(getJsonMember<double>("minGreen", config, 10),
+                                                    getJsonMember<double>("theta", config, 150),
+                                                    getJsonMember<double>("mu", config, 3),
+                                                    getJsonMember<double>("omega", config, 25),
+                                                    getJsonMember<double>("approachDistance", config, 100));
+        if (type == "actuated")
+            return std::make_shared<ActuatedController>(getJsonMember<double>("minGreen", config, 5),
+                                                        getJsonMember<double>("maxGreen", config, 60),
+                                                        getJsonMember<double>("detectorDistance", config, 30));
+        throw JsonFormatError("Unknown traffic light controller type: " + type);
+    }
+
+    std::shared_ptr<SignalController> FixedTimeController::clone() const {
+        return std::make_shared<FixedTimeController>(*this);
+    }
+
+    void FixedTimeController::step(TrafficLight &light, double interval) {
+        light.passTime(interval);
+    }
+
+    std::shared_ptr<SignalController> MaxPressureController::clone() const {
+        return std::make_shared<MaxPressureController>(*this);
+    }
+
+    double MaxPressureController::getPressure(int phaseIndex) const {
+        double pressure = 0;
+        for (const auto &laneLink : phaseInfos[phaseIndex].laneLinks)
+            pressure += (double) laneLink.first->getVehicleCount() - (double) laneLink.second->getVehicleCount();
+        return pressure;
+    }
+
+    int MaxPressureController::choosePhase(double interval) {
+        if (greenTime < minGreen) return curGreen;
+        int best = curGreen;
+        double bestPressure = getPressure(curGreen);
+        for (int phaseIndex : greenPhases) {
+            double pressure = getPressure(phaseIndex);
+            if (pressure > bestPressure) {
+                best = phaseIndex;
+                bestPressure = pressure;
+            }
+        }
+        return best;
+    }
+
+    std::shared_ptr<SignalController> WebsterController::clone() const {
+        return std::make_shared<WebsterController>(*this);
+    }
+
+    void WebsterController::init(TrafficLight &light) {
+        SignalController::init(light);
+        splits.assign(phaseInfos.size(), 0);
+        for (int phaseIndex : greenPhases)
+            splits[phaseIndex] = light.getPhases()[phaseIndex].getTime();
+        lastUpdate = 0;
+        lastEnteredCnt.clear();
+        for (const Lane *lane : inLanes)
+            lastEnteredCnt[lane] = lane->getEnteredVehicleCount();
+    }
+
+    void WebsterController::updateSplits() {
+        double elapsed = clock - lastUpdate;
+        std::vector<double> flowRatios(phaseInfos.size(), 0);
+        double totalRatio = 0, lostTime = 0;
+        for (int phaseIndex : greenPhases) {
+            double ratio = 0;
+            for (const Lane *lane : phaseInfos[phaseIndex].inLanes) {
+                double flow = (lane->getEnteredVehicleCount() - lastEnteredCnt[lane]) / elapsed;
+                ratio = std::max(ratio, flow / saturationFlow);
+            }
+            flowRatios[phaseIndex] = ratio;
+            totalRatio += ratio;
+            lostTime += phaseInfos[phaseIndex].transitionTime;
+        }
+        for (const Lane *lane : inLanes)
+            lastEnteredCnt[lane] = lane->getEnteredVehicleCount();
+        if (totalRatio <= 0) return;
+
+        double cycle = totalRatio < 0.95 ? (1.5 * lostTime + 5) / (1 - totalRatio) : maxCycle;
+        cycle = std::min(std::max(cycle, minCycle), maxCycle);
+        double effectiveGreen = std::max(cycle - lostTime, minGreen * greenPhases.size());
+        for (int phaseIndex : greenPhases)
+            splits[phaseIndex] = std::max(minGreen, effectiveGreen * flowRatios[phaseIndex] / totalRatio);
+    }
+
+    int WebsterController::choosePhase(double interval) {
+        if (clock - lastUpdate >= updateInterval) {
+            updateSplits();
+            lastUpdate = clock;
+        }
+        return greenTime >= splits[curGreen] ? nextGreenPhase(curGreen) : curGreen;
+    }
+
+    std::shared_ptr<SignalController> SOTLController::clone() const {
+        return std::make_shared<SOTLController>(*this);
+    }
+
+    int SOTLController::choosePhase(double interval) {
+        if (kappaPhase != curGreen) {
+            kappa = 0;
+            kappaPhase = curGreen;
+        }
+        size_t approachingRed = 0, approachingGreen = 0;
+        for (const Lane *lane : inLanes) {
+            if (isServed(lane, curGreen))
+                approachingGreen += countApproaching(lane, omega, true);
+            else
+                approachingRed += countApproaching(lane, approachDistance);
+        }
+        kappa += approachingRed * interval;
+
+        if (kappa < theta) return curGreen;
+        // do not cut a small platoon that is about to cross, stopped vehicles do not count as a platoon
+        if (approachingGreen > 0 && approachingGreen < mu) return curGreen;
+        return nextDemandedPhase(approachDistance);
+    }
+
+    std::shared_ptr<SignalController> ActuatedController::clone() const {
+        return std::make_shared<ActuatedController>(*this);
+    }
+
+    int ActuatedController::choosePhase(double interval) {
+        if (greenTime < minGreen) return curGreen;
+        if (greenTime < maxGreen && hasDemand(curGreen, detectorDistance)) return curGreen;
+        return nextDemandedPhase(detectorDistance);
+    }
+}
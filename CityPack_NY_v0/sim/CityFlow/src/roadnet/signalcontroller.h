@@ -0,0 +1,161 @@
+#ifndef CITYFLOW_SIGNALCONTROLLER_H
+#define CITYFLOW_SIGNALCONTROLLER_H
+
+#include "rapidjson/document.h"
+
+#include <map>
+#include <memory>
+#include <vector>
+
+namespace CityFlow {
+    class Lane;
+
+    class TrafficLight;
+
+    /*
+     * Base class of the native traffic signal controllers.
+     *
+     * Phases that let at least one non right-turn road link pass are green phases, the other phases
+     * are transition phases. A controller only decides which green phase to show next, the transition
+     * phase following the current green phase in "lightphases" (if any) is inserted on every switch.
+     */
+    class SignalController {
+    protected:
+        struct PhaseInfo {
+            bool green = false;
+            int transition = -1;
+            double transitionTime = 0;
+            std::vector<std::pair<Lane *, Lane *>> laneLinks; // (start lane, end lane) of available lane links
+            std::vector<Lane *> inLanes;                       // incoming lanes served by the phase
+        };
+
+        std::vector<PhaseInfo> phaseInfos;
+        std::vector<int> greenPhases;
+        std::vector<Lane *> inLanes;
+
+        double minGreen;
+        double clock = 0;
+        double greenTime = 0;
+        double transitionRemain = 0;
+        int curGreen = -1;
+        int nextGreen = -1;
+
+        int nextGreenPhase(int phaseIndex) const;
+
+        bool isServed(const Lane *lane, int phaseIndex) const;
+
+        bool hasDemand(int phaseIndex, double distance) const;
+
+        // next green phase in the cycle with vehicles approaching within distance, curGreen if there is none
+        int nextDemandedPhase(double distance) const;
+
+        static size_t countApproaching(const Lane *lane, double distance, bool movingOnly = false);
+
+        // returns the green phase to switch to, curGreen to keep the current one
+        virtual int choosePhase(double interval) = 0;
+
+    public:
+        explicit SignalController(double minGreen) : minGreen(minGreen) {}
+
+        virtual ~SignalController() = default;
+
+        virtual std::shared_ptr<SignalController> clone() const = 0;
+
+        virtual void init(TrafficLight &light);
+
+        virtual void step(TrafficLight &light, double interval);
+
+        static std::shared_ptr<SignalController> create(const rapidjson::Value &config);
+    };
+
+    // cycles the plan defined in "lightphases", as the engine does without controllers
+    class FixedTimeController : public SignalController {
+    protected:
+        int choosePhase(double interval) override { return curGreen; }
+
+    public:
+        FixedTimeController() : SignalController(0) {}
+
+        std::shared_ptr<SignalController> clone() const override;
+
+        void step(TrafficLight &light, double interval) override;
+    };
+
+    // switches to the green phase with the largest sum of (upstream - downstream) lane vehicle counts
+    class MaxPressureController : public SignalController {
+    protected:
+        int choosePhase(double interval) override;
+
+        double getPressure(int phaseIndex) const;
+
+    public:
+        explicit MaxPressureController(double minGreen) : SignalController(minGreen) {}
+
+        std::shared_ptr<SignalController> clone() const override;
+    };
+
+    // fixed-time plan whose cycle length and splits are re-optimized with Webster's formula
+    class WebsterController : public SignalController {
+    private:
+        double updateInterval;
+        double saturationFlow;
+        double minCycle;
+        double maxCycle;
+        double lastUpdate = 0;
+        std::vector<double> splits;
+        std::map<const Lane *, size_t> lastEnteredCnt;
+
+        void updateSplits();
+
+    protected:
+        int choosePhase(double interval) override;
+
+    public:
+        WebsterController(double minGreen, double updateInterval, double saturationFlow,
+                          double minCycle, double maxCycle)
+            : SignalController(minGreen), updateInterval(updateInterval), saturationFlow(saturationFlow),
+              minCycle(minCycle), maxCycle(maxCycle) {}
+
+        std::shared_ptr<SignalController> clone() const override;
+
+        void init(TrafficLight &light) override;
+    };
+
+    // self-organizing traffic lights: switch once enough vehicle-seconds waited on red
+    class SOTLController : public SignalController {
+    private:
+        double theta;
+        double mu;
+        double omega;
+        double approachDistance;
+        double kappa = 0;
+        int kappaPhase = -1;
+
+    protected:
+        int choosePhase(double interval) override;
+
+    public:
+        SOTLController(double minGreen, double theta, double mu, double omega, double approachDistance)
+            : SignalController(minGreen), theta(theta), mu(mu), omega(omega), approachDistance(approachDistance) {}
+
+        std::shared_ptr<SignalController> clone() const override;
+    };
+
+    // extends the green phase while vehicles are detected near the stop line, up to maxGreen
+    class ActuatedController : public SignalController {
+    private:
+        double maxGreen;
+        double detectorDistance;
+
+    protected:
+        int choosePhase(double interval) override;
+
+    public:
+        ActuatedController(double minGreen, double maxGreen, double detectorDistance)
+            : SignalController(minGreen), maxGreen(maxGreen), detectorDistance(detectorDistance) {}
+
+        std::shared_ptr<SignalController> clone() const override;
+    };
+}
+
+#endif //CITYFLOW_SIGNALCONTROLLER_H
@@ -1,5 +1,6 @@
 #include "roadnet/trafficlight.h"
 #include "roadnet/roadnet.h"
+#include "roadnet/signalcontroller.h"
 
 namespace CityFlow {
 
@@ -40,8 +41,36 @@ namespace CityFlow {
         curPhaseIndex = phaseIndex;
     }
 
+    void TrafficLight::hold(int phaseIndex) {
+        curPhaseIndex = phaseIndex;
+        remainDuration = phases[phaseIndex].time;
+        held = true;
+    }
+
+    void TrafficLight::release() {
+        if (!held)
+            return;
+        held = false;
+        if (controller)
+            controller->init(*this);
+    }
+
+    void TrafficLight::setController(std::shared_ptr<SignalController> controller) {
+        this->controller = std::move(controller);
+        if (this->controller)
+            this->controller->init(*this);
+    }
+
+    void TrafficLight::updateController(double interval) {
+        if (controller)
+            controller->step(*this, interval);
+    }
+
     void TrafficLight::reset() {
+        held = false;
         init(0);
+        if (controller)
+            controller->init(*this);
     }
 
 }
@@ -1,6 +1,7 @@
 #ifndef CITYFLOW_TRAFFICLIGHT_H
 #define CITYFLOW_TRAFFICLIGHT_H
 
+#include <memory>
 #include <vector>
 
 namespace CityFlow {
@@ -12,6 +13,8 @@ namespace CityFlow {
 
     class TrafficLight;
 
+    class SignalController;
+
     class LightPhase {
         friend class RoadNet;
         friend class RoadLink;
@@ -20,6 +23,10 @@ namespace CityFlow {
         unsigned int phase = 0;
         double time = 0.0;
         std::vector<bool> roadLinkAvailable;
+    public:
+        double getTime() const { return time; }
+
+        const std::vector<bool> &getRoadLinkAvailable() const { return roadLinkAvailable; }
     };
 
     class TrafficLight {
@@ -31,6 +38,8 @@ namespace CityFlow {
         std::vector<int> roadLinkIndices;
         double remainDuration = 0.0;
         int curPhaseIndex = 0;
+        std::shared_ptr<SignalController> controller;
+        bool held = false; // phase fixed from outside, neither the plan nor the controller changes it
     public:
         void init(int initPhaseIndex);
 
@@ -42,10 +51,28 @@ namespace CityFlow {
 
         std::vector<LightPhase> &getPhases();
 
+        const std::vector<LightPhase> &getPhases() const { return phases; }
+
+        const Intersection &getIntersection() const { return *intersection; }
+
+        SignalController *getController() const { return controller.get(); }
+
+        void setController(std::shared_ptr<SignalController> controller);
+
+        void updateController(double interval);
+
         void passTime(double seconds);
 
         void setPhase(int phaseIndex);
 
+        bool isHeld() const { return held; }
+
+        // keeps the light at phaseIndex until release
+        void hold(int phaseIndex);
+
+        // hands the light back to its plan or controller, which restarts from the held phase
+        void release();
+
         void reset();
     };
 }
@@ -0,0 +1,85 @@
+#include "utility/spatialindex.h"
+
+#include <algorithm>
+
+namespace CityFlow {
+
+    long SpatialIndex::getCol(double x) const {
+        return std::min(std::max((long) std::floor((x - minX) / cellSize), 0L), cols - 1);
+    }
+
+    long SpatialIndex::getRow(double y) const {
+        return std::min(std::max((long) std::floor((y - minY) / cellSize), 0L), rows - 1);
+    }
+
+    void SpatialIndex::build(const std::vector<Point> &points) {
+        items.clear();
+        itemPoints.clear();
+        cellStart.clear();
+        cols = rows = 0;
+        if (points.empty()) return;
+
+        double maxX = points[0].x, maxY = points[0].y;
+        minX = points[0].x, minY = points[0].y;
+        for (const Point &point : points) {
+            minX = std::min(minX, point.x);
+            minY = std::min(minY, point.y);
+            maxX = std::max(maxX, point.x);
+            maxY = std::max(maxY, point.y);
+        }
+        cols = (long) std::floor((maxX - minX) / cellSize) + 1;
+        rows = (long) std::floor((maxY - minY) / cellSize) + 1;
+
+        // counting sort of the points by cell
+        std::vector<size_t> cellOf(points.size());
+        cellStart.assign(cols * rows + 1, 0);
+        for (size_t i = 0; i < points.size(); ++i) {
+            cellOf[i] = getRow(points[i].y) * cols + getCol(points[i].x);
+            ++cellStart[cellOf[i] + 1];
+        }
+        for (size_t i = 1; i < cellStart.size(); ++i)
+            cellStart[i] += cellStart[i - 1];
+
+        items.resize(points.size());
+        itemPoints.resize(points.size());
+        std::vector<size_t> next(cellStart.begin(), cellStart.end() - 1);
+        for (size_t i = 0; i < points.size(); ++i) {
+            size_t pos = next[cellOf[i]]++;
+            items[pos] = (int) i;
+            itemPoints[pos] = points[i];
+        }
+    }
+
+    template <typename Pred>
+    std::vector<int> SpatialIndex::query(double minX, double minY, double maxX, double maxY, Pred inside) const {
+        std::vector<int> ret;
+        if (items.empty() || maxX < this->minX || maxY < this->minY
+            || minX > this->minX + cols * cellSize || minY > this->minY + rows * cellSize)
+            return ret;
+        long colBegin = getCol(minX), colEnd = getCol(maxX);
+        long rowBegin = getRow(minY), rowEnd = getRow(maxY);
+        for (long row = rowBegin; row <= rowEnd; ++row) {
+            // cells of a row are contiguous
+            size_t begin = cellStart[row * cols + colBegin], end = cellStart[row * cols + colEnd + 1];
+            for (size_t i = begin; i < end; ++i)
+                if (inside(itemPoints[i]))
+                    ret.push_back(items[i]);
+        }
+        std::sort(ret.begin(), ret.end());
+        return ret;
+    }
+
+    std::vector<int> SpatialIndex::queryRadius(double x, double y, double radius) const {
+        double radius2 = radius * radius;
+        return query(x - radius, y - radius, x + radius, y + radius, [x, y, radius2](const Point &point) {
+            double dx = point.x - x, dy = point.y - y;
+            return dx * dx + dy * dy <= radius2;
+        });
+    }
+
+    std::vector<int> SpatialIndex::queryBox(double minX, double minY, double maxX, double maxY) const {
+        return query(minX, minY, maxX, maxY, [=](const Point &point) {
+            return point.x >= minX && point.x <= maxX && point.y >= minY && point.y <= maxY;
+        });
+    }
+}
@@ -0,0 +1,44 @@
+#ifndef CITYFLOW_SPATIALINDEX_H
+#define CITYFLOW_SPATIALINDEX_H
+
+#include "utility/utility.h"
+
+#include <vector>
+
+namespace CityFlow {
+
+    /*
+     * Uniform grid over a set of points, stored cell by cell (CSR layout) so that a query only
+     * touches the contiguous ranges of the cells overlapping it.
+     * Queries return indices into the point vector given to build, in ascending order.
+     */
+    class SpatialIndex {
+    private:
+        double cellSize;
+        double minX = 0, minY = 0;
+        long cols = 0, rows = 0;
+        std::vector<size_t> cellStart;
+        std::vector<int> items;
+        std::vector<Point> itemPoints;
+
+        long getCol(double x) const;
+
+        long getRow(double y) const;
+
+        template <typename Pred>
+        std::vector<int> query(double minX, double minY, double maxX, double maxY, Pred inside) const;
+
+    public:
+        explicit SpatialIndex(double cellSize = 50) : cellSize(cellSize) {}
+
+        void build(const std::vector<Point> &points);
+
+        size_t size() const { return items.size(); }
+
+        std::vector<int> queryRadius(double x, double y, double radius) const;
+
+        std::vector<int> queryBox(double minX, double minY, double maxX, double maxY) const;
+    };
+}
+
+#endif //CITYFLOW_SPATIALINDEX_H
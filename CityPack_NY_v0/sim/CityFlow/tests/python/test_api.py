@@ -40,5 +40,49 @@ class TestAPI(unittest.TestCase):
 
         del eng
 
+    def test_spatial_query(self):
+        """radius and bounding box queries return indices into get_vehicles()"""
+        eng = cityflow.Engine(config_file=self.config_file, thread_num=1)
+        for _ in range(300):
+            eng.next_step()
+
+        all_indices = list(range(len(eng.get_vehicles())))
+        self.assertTrue(all_indices)
+        self.assertEqual(eng.get_vehicles_in_bbox(-1e6, -1e6, 1e6, 1e6), all_indices)
+        self.assertEqual(eng.get_vehicles_in_radius(0, 0, 1e6), all_indices)
+        self.assertEqual(eng.get_vehicles_in_bbox(1e6, 1e6, 2e6, 2e6), [])
+
+        for x, y in [(0, 0), (150, -50), (-200, 30)]:
+            small = eng.get_vehicles_in_radius(x, y, 50)
+            large = eng.get_vehicles_in_radius(x, y, 150)
+            box = eng.get_vehicles_in_bbox(x - 150, y - 150, x + 150, y + 150)
+            self.assertEqual(small, sorted(small))
+            self.assertTrue(set(small) <= set(large) <= set(box))
+
+        eng.next_step()
+        self.assertEqual(eng.get_vehicles_in_radius(0, 0, 1e6), list(range(len(eng.get_vehicles()))))
+        del eng
+
+    def test_push_vehicles(self):
+        """push a batch of vehicles sharing a route table"""
+        eng = cityflow.Engine(config_file=self.config_file, thread_num=1)
+
+        routes = [["road_0_1_0", "road_1_1_0"], ["road_1_0_1", "road_1_1_1"]]
+        route_ids = [0, 1, 0, 1, 0]
+        info = {"maxSpeed": [10.0, 11.0, 12.0, 13.0, 14.0], "length": [5.0] * 5}
+        eng.push_vehicles(info, routes, route_ids)
+        eng.next_step()
+        pushed = [v for v in eng.get_vehicles(include_waiting=True) if v.startswith("manually_pushed_")]
+        self.assertEqual(len(pushed), 5)
+
+        with self.assertRaises(ValueError):
+            eng.push_vehicles({"maxSpeed": [10.0]}, routes, route_ids)
+        with self.assertRaises(IndexError):
+            eng.push_vehicles({}, routes, [2])
+        with self.assertRaises(RuntimeError):
+            eng.push_vehicles({}, [["no_such_road"]], [0])
+
+        del eng
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
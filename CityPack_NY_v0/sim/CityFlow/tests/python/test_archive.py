@@ -1,3 +1,6 @@
+import json
+import os
+import tempfile
 import unittest
 import cityflow
 import time
@@ -117,5 +120,36 @@ class TestArchive(unittest.TestCase):
 
         del engine
 
+    def test_warm_reset(self):
+        """ Reset to the state captured after warm-up """
+        with open(self.config_file) as f:
+            config = json.load(f)
+        config["warmUpSteps"] = self.period
+        fd, config_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(config, f)
+        self.addCleanup(os.remove, config_file)
+
+        engine = cityflow.Engine(config_file=config_file, thread_num=4)
+        self.run_steps(engine, self.period)
+        warm_record = self.get_record(engine)
+
+        engine.reset(seed=True, to="warm")
+        self.assertEqual(engine.get_current_time(), self.period)
+        self.assertEqual(self.get_record(engine), warm_record)
+        self.run_steps(engine, self.period)
+        record = self.get_record(engine)
+
+        for i in range(2):
+            engine.reset(to="cold")
+            self.assertEqual(engine.get_vehicle_count(), 0)
+            engine.reset(seed=True, to="warm")
+            self.assertEqual(self.get_record(engine), warm_record)
+            self.run_and_check(engine, record)
+
+        with self.assertRaises(ValueError):
+            engine.reset(to="hot")
+        del engine
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
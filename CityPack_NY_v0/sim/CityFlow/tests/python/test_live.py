@@ -0,0 +1,123 @@
+import base64
+import http.client
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+import cityflow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "tools", "live"))
+from live_server import LiveSimulation, make_server, frame_new_ids  # noqa: E402
+
+
+class TestLiveServer(unittest.TestCase):
+
+    config_file = "./examples/config.json"
+    intersection_id = "intersection_1_1"
+
+    def setUp(self):
+        with open(self.config_file) as f:
+            config = json.load(f)
+        config["saveReplay"] = False
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(config, f)
+        self.addCleanup(os.remove, path)
+
+        self.engine = cityflow.Engine(config_file=path, thread_num=1)
+        self.simulation = LiveSimulation(self.engine, steps_per_second=0, max_steps=300, client_buffer=4, paused=True)
+        self.server = make_server(self.simulation, port=0)
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        self.simulation.start()
+
+    def tearDown(self):
+        self.simulation.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        del self.engine
+
+    def request(self, method, path, body=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        connection.request(method, path, json.dumps(body) if body is not None else None)
+        response = connection.getresponse()
+        result = response.status, json.loads(response.read())
+        connection.close()
+        return result
+
+    def run_steps(self, steps):
+        target = self.simulation.step + steps
+        for _ in range(steps):
+            self.request("POST", "/control/step")
+        while self.request("GET", "/state")[1]["step"] < target:
+            pass
+
+    def read_events(self, response, count):
+        events = []
+        event = None
+        while len(events) < count:
+            line = response.readline().decode().rstrip("\n")
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                events.append((event, line[len("data: "):]))
+        return events
+
+    def test_stream(self):
+        """a client joining late gets the ids streamed before, then every frame in order"""
+        self.run_steps(20)
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        connection.request("GET", "/stream")
+        response = connection.getresponse()
+        self.assertEqual(response.getheader("Content-Type"), "text/event-stream")
+        (header_event, header), (ids_event, ids) = self.read_events(response, 2)
+        self.assertEqual((header_event, ids_event), ("header", "ids"))
+        self.assertEqual(base64.b64decode(header), self.simulation.header)
+        ids = json.loads(ids)
+        self.assertGreater(len(ids), 0)
+
+        status, state = self.request("POST", "/control/resume")
+        self.assertEqual(status, 200)
+        self.assertFalse(state["paused"])
+        steps = []
+        for event, data in self.read_events(response, 50):
+            if event == "ids":
+                ids += json.loads(data)
+                continue
+            step, frame = data.split(" ")
+            frame = base64.b64decode(frame)
+            ids += frame_new_ids(frame)
+            steps.append(int(step))
+        connection.close()
+        # frames may be dropped for a slow client, the ids are resent
+        self.assertGreaterEqual(steps[0], 20)
+        self.assertEqual(steps, sorted(set(steps)))
+        self.assertEqual(ids, self.simulation.ids[:len(ids)])
+
+    def test_control(self):
+        """phase overrides are applied between steps and rejected for unknown lights"""
+        status, state = self.request("POST", "/control/phase", {"intersection": self.intersection_id, "phase": 3})
+        self.assertEqual(status, 200)
+        self.assertEqual(state["held"], {self.intersection_id: 3})
+        status, _ = self.request("POST", "/control/speed", {"stepsPerSecond": 0})
+        self.assertEqual(status, 200)
+        self.run_steps(30)
+        with self.simulation.engine_lock:
+            self.assertEqual(self.engine.get_tl_phase()[self.intersection_id], 3)
+        status, state = self.request("POST", "/control/release", {"intersection": self.intersection_id})
+        self.assertEqual(state["held"], {})
+
+        self.assertEqual(self.request("POST", "/control/phase", {"intersection": "none", "phase": 0})[0], 400)
+        self.assertEqual(self.request("POST", "/control/phase", {"intersection": self.intersection_id})[0], 400)
+        self.assertEqual(self.request("POST", "/control/unknown", {})[0], 400)
+        status, state = self.request("GET", "/state")
+        self.assertEqual(status, 200)
+        self.assertTrue(state["paused"])
+
+
+if __name__ == '__main__':
+    unittest.main()
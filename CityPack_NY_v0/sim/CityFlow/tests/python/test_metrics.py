@@ -0,0 +1,76 @@
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+import cityflow
+
+
+class TestMetrics(unittest.TestCase):
+
+    config_file = "./examples/config.json"
+    window = 100
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lane_file = os.path.join(self.tmp_dir, "lane_metrics.csv")
+        self.intersection_file = os.path.join(self.tmp_dir, "intersection_metrics.csv")
+        with open(self.config_file) as f:
+            config = json.load(f)
+        config["roadnetFile"] = os.path.join(config["dir"], config["roadnetFile"])
+        config["flowFile"] = os.path.join(config["dir"], config["flowFile"])
+        config["dir"] = ""
+        config["saveReplay"] = False
+        config["metrics"] = {"window": self.window, "laneFile": self.lane_file,
+                             "intersectionFile": self.intersection_file}
+        self.metrics_config = os.path.join(self.tmp_dir, "config.json")
+        with open(self.metrics_config, "w") as f:
+            json.dump(config, f)
+
+    def tearDown(self):
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+        os.rmdir(self.tmp_dir)
+
+    @staticmethod
+    def read(path):
+        with open(path) as f:
+            return list(csv.DictReader(f))
+
+    def test_windows(self):
+        """one row per lane and window, intersections aggregate their incoming lanes"""
+        engine = cityflow.Engine(config_file=self.metrics_config, thread_num=2)
+        for _ in range(3 * self.window + 50):
+            engine.next_step()
+        del engine
+
+        lanes = self.read(self.lane_file)
+        intersections = self.read(self.intersection_file)
+        self.assertEqual(sorted({row["time"] for row in lanes}, key=float), ["0.0", "100.0", "200.0", "300.0"])
+        self.assertEqual([row["duration"] for row in intersections], ["100.0"] * 3 + ["50.0"])
+        for row in lanes:
+            self.assertLessEqual(float(row["greenTime"]), float(row["duration"]))
+
+        window_lanes = [row for row in lanes if row["time"] == "100.0" and row["lane"].startswith("road_1_0_1")]
+        self.assertGreater(int(intersections[1]["entered"]), 0)
+        self.assertTrue(any(int(row["exited"]) > 0 for row in window_lanes))
+        self.assertTrue(any(int(row["maxQueue"]) > 0 for row in lanes))
+
+    def test_reset(self):
+        """reset flushes the partial window and starts counting again"""
+        engine = cityflow.Engine(config_file=self.metrics_config, thread_num=1)
+        for _ in range(50):
+            engine.next_step()
+        engine.reset()
+        for _ in range(self.window):
+            engine.next_step()
+        del engine
+
+        intersections = self.read(self.intersection_file)
+        self.assertEqual([(row["time"], row["duration"]) for row in intersections],
+                         [("0.0", "50.0"), ("0.0", "100.0")])
+
+
+if __name__ == '__main__':
+    unittest.main()
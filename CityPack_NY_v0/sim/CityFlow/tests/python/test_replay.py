@@ -0,0 +1,374 @@
+import gzip
+import http.client
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+import pyarrow
+import pyarrow.compute
+import pyarrow.dataset
+import pyarrow.parquet as pq
+
+import cityflow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "tools", "replay"))
+from replay_format import open_replay, BinaryReplayReader, TextReplayReader, LIGHT_IMPLICIT  # noqa: E402
+from convert_replay import convert  # noqa: E402
+import chunked_replay  # noqa: E402
+import decimate_replay  # noqa: E402
+import replay_server  # noqa: E402
+import replay_analytics  # noqa: E402
+
+try:
+    import georeference_replay
+except ImportError:  # pyproj is optional
+    georeference_replay = None
+
+try:
+    import compressed_replay
+except ImportError:  # zstandard is optional
+    compressed_replay = None
+
+
+class TestReplay(unittest.TestCase):
+
+    config_file = "./examples/config.json"
+    steps = 200
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_config(self, replay_format, **options):
+        with open(self.config_file) as f:
+            config = json.load(f)
+        config["roadnetFile"] = os.path.join(config["dir"], config["roadnetFile"])
+        config["flowFile"] = os.path.join(config["dir"], config["flowFile"])
+        config["dir"] = ""
+        config["roadnetLogFile"] = os.path.join(self.tmp_dir, "replay_roadnet.json")
+        config["replayLogFile"] = os.path.join(self.tmp_dir, "replay." + replay_format)
+        config["replayLogFormat"] = replay_format
+        config.update(options)
+        config_file = os.path.join(self.tmp_dir, "config_%s.json" % replay_format)
+        with open(config_file, "w") as f:
+            json.dump(config, f)
+        return config_file, config["replayLogFile"]
+
+    def run_engine(self, replay_format, **options):
+        config_file, replay_file = self.make_config(replay_format, **options)
+        engine = cityflow.Engine(config_file=config_file, thread_num=1)
+        for _ in range(self.steps):
+            engine.next_step()
+        del engine
+        return replay_file
+
+    def assertFramesClose(self, reader, expected_reader):
+        frames = list(reader)
+        expected_frames = list(expected_reader)
+        self.assertEqual(len(frames), len(expected_frames))
+        self.assertEqual(reader.layout, expected_reader.layout)
+        for frame, expected in zip(frames, expected_frames):
+            self.assertEqual([reader.ids[i] for i in frame.vehicles["id"]],
+                             [expected_reader.ids[i] for i in expected.vehicles["id"]])
+            for field in ["x", "y", "length", "width"]:
+                np.testing.assert_allclose(frame.vehicles[field], expected.vehicles[field], atol=0.005)
+            np.testing.assert_allclose(frame.vehicles["heading"], expected.vehicles["heading"], atol=5e-5)
+            np.testing.assert_array_equal(frame.vehicles["lane_change"], expected.vehicles["lane_change"])
+            np.testing.assert_array_equal(frame.lights, expected.lights)
+        return frames
+
+    def test_binary_matches_text(self):
+        """the binary replay holds the frames of the text replay, quantized"""
+        text_file = self.run_engine("text")
+        binary_file = self.run_engine("binary")
+        self.assertIsInstance(open_replay(binary_file), BinaryReplayReader)
+        self.assertIsInstance(open_replay(text_file), TextReplayReader)
+        self.assertLess(os.path.getsize(binary_file), os.path.getsize(text_file))
+
+        frames = self.assertFramesClose(BinaryReplayReader(binary_file), TextReplayReader(text_file))
+        self.assertEqual(len(frames), self.steps)
+        self.assertGreater(len(frames[-1].vehicles), 0)
+        lights = np.concatenate([frame.lights for frame in frames])
+        self.assertTrue(np.any(lights == 0) and np.any(lights == 1))
+        self.assertTrue(np.all(lights[lights > 1] == LIGHT_IMPLICIT))
+
+    def test_convert(self):
+        """text -> binary -> text keeps the frames"""
+        text_file = self.run_engine("text")
+        binary_file = os.path.join(self.tmp_dir, "converted.bin")
+        text_back_file = os.path.join(self.tmp_dir, "converted.txt")
+        self.assertEqual(convert(text_file, binary_file), self.steps)
+        self.assertEqual(convert(binary_file, text_back_file), self.steps)
+        self.assertFramesClose(TextReplayReader(text_back_file), TextReplayReader(text_file))
+
+    def test_set_replay_file(self):
+        """switching the replay file completes the previous one while the engine keeps running"""
+        config_file, replay_file = self.make_config("text", replayBufferSize=1)
+        engine = cityflow.Engine(config_file=config_file, thread_num=1)
+        for _ in range(self.steps):
+            engine.next_step()
+        engine.set_replay_file(os.path.join(self.tmp_dir, "replay2.txt"))
+        self.assertEqual(len(list(TextReplayReader(replay_file))), self.steps)
+        for _ in range(10):
+            engine.next_step()
+        del engine
+        self.assertEqual(len(list(TextReplayReader(os.path.join(self.tmp_dir, "replay2.txt")))), 10)
+
+    def test_drop_when_full(self):
+        """with the drop policy whole frames may be skipped, the file stays readable"""
+        replay_file = self.run_engine("binary", replayBufferSize=1, replayBackpressure="drop")
+        frames = list(BinaryReplayReader(replay_file))
+        self.assertGreater(len(frames), 0)
+        self.assertLessEqual(len(frames), self.steps)
+
+    def test_stream_frames(self):
+        """frames taken from the engine form the binary replay it writes"""
+        config_file, replay_file = self.make_config("binary")
+        engine = cityflow.Engine(config_file=config_file, thread_num=1)
+        stream = [engine.get_replay_header()]
+        for _ in range(self.steps):
+            engine.next_step()
+            stream.append(engine.get_replay_frame())
+        del engine
+        with open(replay_file, "rb") as f:
+            self.assertEqual(b"".join(stream), f.read())
+
+    def test_chunked(self):
+        """any step of a chunked replay decodes to the frame of the original replay"""
+        text_file = self.run_engine("text")
+        chunked_file = os.path.join(self.tmp_dir, "replay.chunked")
+        self.assertEqual(chunked_replay.convert(text_file, chunked_file, keyframe_interval=30), self.steps)
+
+        expected_reader = TextReplayReader(text_file)
+        expected = list(expected_reader)
+        with chunked_replay.ChunkedReplayReader(chunked_file) as reader:
+            self.assertEqual(len(reader), self.steps)
+            self.assertEqual(reader.layout, expected_reader.layout)
+            for step in [0, 29, 30, 31, 115, self.steps - 1, 7]:
+                frame = reader.frame(step)
+                np.testing.assert_array_equal(frame.lights, expected[step].lights)
+                np.testing.assert_array_equal(frame.vehicles["x"], expected[step].vehicles["x"])
+                self.assertEqual([reader.ids[i] for i in frame.vehicles["id"]],
+                                 [expected_reader.ids[i] for i in expected[step].vehicles["id"]])
+            self.assertEqual(len(list(reader.frames(100, 150))), 50)
+
+            start, end = reader.chunk_range(115)
+            with open(chunked_file, "rb") as f:
+                f.seek(start)
+                chunk = f.read(end - start).decode().splitlines()
+            self.assertEqual([line.split("|")[:2] for line in chunk[:2]], [["K", "90"], ["D", "91"]])
+            self.assertEqual(len(chunk), 30)
+
+    @unittest.skipIf(compressed_replay is None, "zstandard is not installed")
+    def test_compressed(self):
+        """compressed logs hold the frames of the plain ones, a step range only decompresses the frames holding it"""
+        text_file = self.run_engine("text")
+        config_file, _ = self.make_config("text", replayLogFile=os.path.join(self.tmp_dir, "unused.txt"),
+                                          replayCompressionSteps=30)
+        engine = cityflow.Engine(config_file=config_file, thread_num=1)
+        compressed_file = os.path.join(self.tmp_dir, "replay.txt.zst")
+        try:
+            engine.set_replay_file(compressed_file, compression="zstd")
+        except ValueError:
+            del engine
+            self.skipTest("the engine is built without zstd")
+        for _ in range(self.steps):
+            engine.next_step()
+        del engine
+
+        reader = open_replay(compressed_file)
+        self.assertIsInstance(reader, compressed_replay.CompressedTextReplayReader)
+        self.assertEqual(len(reader), self.steps)
+        self.assertLess(os.path.getsize(compressed_file) * 3, os.path.getsize(text_file))
+        expected = self.assertFramesClose(reader, TextReplayReader(text_file))
+
+        self.assertEqual(reader.replay.step_frames(95, 125), (4, 6, 90))
+        frames = list(reader.frames(95, 125))
+        self.assertEqual(len(frames), 30)
+        for frame, expected_frame in zip(frames, expected[95:125]):
+            np.testing.assert_array_equal(frame.lights, expected_frame.lights)
+            np.testing.assert_array_equal(frame.vehicles["x"], expected_frame.vehicles["x"])
+        with open(text_file, "rb") as f:
+            lines = f.readlines()
+        self.assertEqual(reader.lines(10, 20), b"".join(lines[10:20]))
+        self.assertEqual(reader.lines(190, 500), b"".join(lines[190:]))
+        self.assertEqual(replay_server.open_source(compressed_file).window(59, 61), b"".join(lines[59:61]))
+
+        binary_file = self.run_engine("binary")
+        compressed_file = self.run_engine("binary", replayCompression="zstd",
+                                          replayLogFile=os.path.join(self.tmp_dir, "replay.bin.zst"))
+        reader = open_replay(compressed_file)
+        self.assertIsInstance(reader, compressed_replay.CompressedBinaryReplayReader)
+        self.assertFramesClose(reader, BinaryReplayReader(binary_file))
+        self.assertEqual(len(list(reader.frames(150, 160))), 10)
+
+    def test_decimate(self):
+        """decimation keeps every n-th frame, rounds positions and drops vehicles outside the viewport"""
+        text_file = self.run_engine("text")
+        output_file = os.path.join(self.tmp_dir, "decimated.txt")
+        polygon = np.array([[0, 0], [200, 0], [200, 200], [0, 200]], dtype=np.float64)
+        decimator = decimate_replay.Decimator(every=4, precision=1, polygon=polygon)
+        self.assertEqual(decimator.run(text_file, output_file), (self.steps, self.steps // 4))
+
+        expected = list(TextReplayReader(text_file))
+        for i, frame in enumerate(TextReplayReader(output_file)):
+            source = expected[i * 4]
+            np.testing.assert_array_equal(frame.lights, source.lights)
+            vehicles = frame.vehicles
+            self.assertTrue(np.all((vehicles["x"] >= 0) & (vehicles["x"] <= 200)))
+            np.testing.assert_allclose(vehicles["x"], np.round(vehicles["x"], 1))
+            inside = decimate_replay.inside_polygon(polygon, source.vehicles["x"], source.vehicles["y"])
+            self.assertEqual(len(vehicles), np.count_nonzero(inside))
+
+    def test_decimate_drop_unchanged_lights(self):
+        """keyframes hold every light, readers and server windows carry the other roads forward"""
+        text_file = self.run_engine("text")
+        output_file = os.path.join(self.tmp_dir, "decimated.txt")
+        decimator = decimate_replay.Decimator(drop_unchanged_lights=True, light_keyframe_interval=30)
+        self.assertEqual(decimator.run(text_file, output_file), (self.steps, self.steps))
+        with open(output_file) as f:
+            header = f.readline()
+            roads = [line.split(";")[1].count(",") for line in f]
+        self.assertEqual(header, '#lights {"keyframeInterval": 30}\n')
+        self.assertTrue(all(roads[i] == roads[0] for i in range(0, self.steps, 30)))
+        self.assertLess(min(roads), roads[0])
+
+        source_reader = TextReplayReader(text_file)
+        expected = list(source_reader)
+        reader = TextReplayReader(output_file)
+        for frame, source in zip(reader, expected):
+            np.testing.assert_array_equal(frame.lights, source.lights)
+        self.assertEqual(reader.layout, source_reader.layout)
+
+        window_file = os.path.join(self.tmp_dir, "window.txt")
+        with open(window_file, "wb") as f:
+            f.write(replay_server.TextReplaySource(output_file).window(45, 50))
+        for frame, source in zip(TextReplayReader(window_file), expected[45:50]):
+            np.testing.assert_array_equal(frame.lights, source.lights)
+
+    def test_replay_server(self):
+        """windows of text and chunked replays are served with range, ETag and gzip support"""
+        text_file = self.run_engine("text")
+        chunked_replay.convert(text_file, os.path.join(self.tmp_dir, "replay.chunked"), keyframe_interval=30)
+        with open(text_file, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+
+        server = replay_server.make_server(self.tmp_dir, port=0, max_window=50)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+
+        def get(path, **headers):
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            return response, response.read()
+
+        try:
+            response, body = get("/replays")
+            self.assertEqual([replay["name"] for replay in json.loads(body)], ["replay.chunked", "replay.text"])
+            response, body = get("/replay/replay.text/index")
+            self.assertEqual(json.loads(body)["frames"], self.steps)
+            self.assertTrue(os.path.exists(text_file + replay_server.INDEX_SUFFIX))
+
+            response, body = get("/replay/replay.text?from=10&to=20")
+            self.assertEqual(body, b"".join(lines[10:20]))
+            etag = response.getheader("ETag")
+            response, body = get("/replay/replay.text?from=10&to=20", **{"If-None-Match": etag})
+            self.assertEqual((response.status, body), (304, b""))
+
+            response, body = get("/replay/replay.text?from=150", **{"Accept-Encoding": "gzip"})
+            self.assertEqual(response.getheader("Content-Encoding"), "gzip")
+            self.assertEqual(response.getheader("X-Replay-To"), "200")
+            self.assertEqual(gzip.decompress(body), b"".join(lines[150:200]))
+
+            response, body = get("/replay/replay.text?from=0&to=200")
+            self.assertEqual(response.getheader("X-Replay-To"), "50")
+            response, body = get("/replay/replay.text?from=0&to=2", Range="bytes=5-104")
+            self.assertEqual((response.status, body), (206, b"".join(lines[:2])[5:105]))
+            response, body = get("/replay/replay.text", Range="bytes=-100", **{"Accept-Encoding": "gzip"})
+            self.assertEqual((response.status, body), (206, b"".join(lines)[-100:]))
+            response, body = get("/replay/replay.text", **{"Accept-Encoding": "gzip"})
+            self.assertEqual(gzip.decompress(body), b"".join(lines))
+
+            response, body = get("/replay/replay.chunked?from=25&to=35")
+            self.assertEqual([line.split(b";")[1] for line in body.splitlines(keepends=True)],
+                             [line.split(b";")[1] for line in lines[25:35]])
+            self.assertEqual(get("/replay/..%2Fsecret")[0].status, 404)
+            self.assertEqual(get("/replay/replay.text?from=500")[0].status, 416)
+        finally:
+            connection.close()
+            server.shutdown()
+            server.server_close()
+            for source in server.RequestHandlerClass.library.sources.values():
+                if isinstance(source, replay_server.ChunkedReplaySource):
+                    source.close()
+
+    def test_analytics(self):
+        """worker processes over small blocks give the statistics of a single pass over the whole log"""
+        text_file = self.run_engine("text")
+        with open(os.path.join(self.tmp_dir, "replay_roadnet.json")) as f:
+            matcher = replay_analytics.RoadMatcher(json.load(f))
+        results = []
+        for processes, block_size in [(1, 1 << 30), (2, 1 << 14)]:
+            output = tempfile.mkdtemp(dir=self.tmp_dir)
+            analytics = replay_analytics.Analytics(output, matcher, window_steps=60)
+            self.assertEqual(analytics.run(text_file, processes, block_size), self.steps)
+            results.append(pq.read_table(os.path.join(output, "vehicles.parquet")).to_pydict())
+        self.assertEqual(results[0].keys(), results[1].keys())
+        for name in results[0]:
+            if name in ["distance", "mean_speed"]:  # summed in another order
+                np.testing.assert_allclose(results[0][name], results[1][name], err_msg=name)
+            else:
+                self.assertEqual(results[0][name], results[1][name], name)
+
+        reader = TextReplayReader(text_file)
+        frames = list(reader)
+        trajectories = pyarrow.dataset.dataset(os.path.join(output, "trajectories"), partitioning="hive").to_table()
+        self.assertEqual(trajectories.num_rows, sum(len(frame.vehicles) for frame in frames))
+        self.assertEqual(sorted(set(trajectories.column("window").to_pylist())), [0, 1, 2, 3])
+
+        vehicle = trajectories.filter(pyarrow.compute.equal(trajectories.column("vehicle_id").cast(pyarrow.string()),
+                                                            results[0]["vehicle_id"][0])).sort_by("step")
+        steps = vehicle.column("step").to_numpy()
+        x, y = vehicle.column("x").to_numpy(), vehicle.column("y").to_numpy()
+        np.testing.assert_allclose(vehicle.column("speed").to_numpy(zero_copy_only=False)[1:],
+                                   np.hypot(np.diff(x), np.diff(y)), rtol=1e-5)
+        self.assertEqual(results[0]["first_step"][0], steps[0])
+        self.assertAlmostEqual(results[0]["distance"][0], np.hypot(np.diff(x), np.diff(y)).sum())
+
+        roads = pyarrow.dataset.dataset(os.path.join(output, "roads"), partitioning="hive").to_table()
+        self.assertEqual(roads.num_rows, 4 * len(matcher.road_ids))
+        self.assertGreater(sum(roads.column("entered").to_pylist()), 0)
+
+    @unittest.skipIf(georeference_replay is None, "pyproj is not installed")
+    def test_georeference(self):
+        """georeferenced positions follow the transform of the web player"""
+        text_file = self.run_engine("text")
+        output_file = os.path.join(self.tmp_dir, "georeferenced.txt")
+        preset = georeference_replay.PRESETS["traffic-flow"]
+        transformer = georeference_replay.make_transformer(preset["center"], preset["scale"], preset["rotation"],
+                                                           "EPSG:4326")
+        header = {"crs": "EPSG:4326"}
+        self.assertEqual(georeference_replay.georeference(text_file, output_file, transformer, header), self.steps)
+        with open(output_file) as f:
+            self.assertEqual(json.loads(f.readline()[len(georeference_replay.GEOREF_PREFIX):]), header)
+
+        source = list(TextReplayReader(text_file))[-1].vehicles
+        frame = list(TextReplayReader(output_file))[-1].vehicles
+        # convertCoords and convertBearing of web/js/traffic-flow.js
+        rad = np.radians(preset["rotation"])
+        lng = preset["center"][0] + (source["x"] * np.cos(rad) - source["y"] * np.sin(rad)) * preset["scale"][0]
+        lat = preset["center"][1] + (source["x"] * np.sin(rad) + source["y"] * np.cos(rad)) * preset["scale"][1]
+        np.testing.assert_allclose(frame["x"], lng, atol=1e-7)
+        np.testing.assert_allclose(frame["y"], lat, atol=1e-7)
+        np.testing.assert_allclose(frame["heading"], (90 + np.degrees(source["heading"]) + 360) % 360, atol=0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+import unittest
+
+import cityflow
+
+
+class TestSignalController(unittest.TestCase):
+
+    config_file = "./examples/config.json"
+    intersection_id = "intersection_1_1"
+    controller_types = ["fixed", "maxPressure", "webster", "sotl", "actuated"]
+
+    def make_config(self, control, rl_traffic_light=False, **options):
+        with open(self.config_file) as f:
+            config = json.load(f)
+        config["saveReplay"] = False
+        config["rlTrafficLight"] = rl_traffic_light
+        config["trafficLightControl"] = control
+        config.update(options)
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(config, f)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def run_phases(self, engine, steps):
+        phases = []
+        for _ in range(steps):
+            engine.next_step()
+            phases.append(engine.get_tl_phase()[self.intersection_id])
+        return phases
+
+    def test_controllers(self):
+        """Every controller type switches phases and only shows phases of the roadnet"""
+        for controller_type in self.controller_types:
+            config_file = self.make_config({"default": {"type": controller_type, "updateInterval": 120}})
+            engine = cityflow.Engine(config_file=config_file, thread_num=2)
+            phases = self.run_phases(engine, 600)
+            self.assertGreater(len(set(phases)), 2, controller_type)
+            self.assertTrue(all(0 <= phase < 8 for phase in phases), controller_type)
+            del engine
+
+    def test_fixed_matches_default(self):
+        """The fixed controller reproduces the plan the engine cycles without controllers"""
+        engine = cityflow.Engine(config_file=self.make_config({}), thread_num=1)
+        expected = self.run_phases(engine, 300)
+        del engine
+        config_file = self.make_config({"intersections": {self.intersection_id: {"type": "fixed"}}})
+        engine = cityflow.Engine(config_file=config_file, thread_num=1)
+        self.assertEqual(self.run_phases(engine, 300), expected)
+        del engine
+
+    def test_rl_traffic_light(self):
+        """Controlled intersections keep running when rlTrafficLight is on"""
+        config_file = self.make_config({"default": {"type": "maxPressure", "minGreen": 5}}, rl_traffic_light=True)
+        engine = cityflow.Engine(config_file=config_file, thread_num=1)
+        self.assertGreater(len(set(self.run_phases(engine, 600))), 2)
+        del engine
+
+    def test_hold_phase(self):
+        """A held phase stays until released, then the plan or controller takes over again"""
+        for control in [{}, {"default": {"type": "maxPressure", "minGreen": 5}}]:
+            engine = cityflow.Engine(config_file=self.make_config(control), thread_num=1)
+            self.run_phases(engine, 50)
+            engine.hold_tl_phase(self.intersection_id, 3)
+            self.assertEqual(set(self.run_phases(engine, 300)), {3})
+            engine.release_tl_phase(self.intersection_id)
+            self.assertGreater(len(set(self.run_phases(engine, 600))), 2)
+            with self.assertRaises(ValueError):
+                engine.hold_tl_phase("no_such_intersection", 0)
+            with self.assertRaises(IndexError):
+                engine.hold_tl_phase(self.intersection_id, 100)
+            del engine
+
+    def test_warm_reset_releases_held_lights(self):
+        """A warm reset hands held lights back to the plan, as a cold reset does"""
+        engine = cityflow.Engine(config_file=self.make_config({}, warmUpSteps=5), thread_num=1)
+        engine.reset(to="warm")
+        expected = self.run_phases(engine, 300)
+        self.assertGreater(len(set(expected)), 2)
+        engine.hold_tl_phase(self.intersection_id, 2)
+        self.run_phases(engine, 50)
+        engine.reset(to="warm")
+        self.assertEqual(self.run_phases(engine, 300), expected)
+        del engine
+
+    def test_archive(self):
+        """Controller state is restored together with the engine state"""
+        config_file = self.make_config({"default": {"type": "sotl"}})
+        engine = cityflow.Engine(config_file=config_file, thread_num=2)
+        self.run_phases(engine, 200)
+        archive = engine.snapshot()
+        phases = self.run_phases(engine, 300)
+        engine.load(archive)
+        self.assertEqual(self.run_phases(engine, 300), phases)
+        del engine
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import cityflow
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "generator", "generate_grid_scenario.py")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rowNum", type=int, default=20)
+    parser.add_argument("--colNum", type=int, default=20)
+    parser.add_argument("--distance", type=int, default=300)
+    parser.add_argument("--straightLanes", type=int, default=2,
+                        help="straight lanes per road, one lane saturates below 20000 running vehicles")
+    parser.add_argument("--vehicles", type=int, default=20000, help="number of running vehicles to reach before querying")
+    parser.add_argument("--maxSteps", type=int, default=3600)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--radius", type=float, default=200)
+    parser.add_argument("--cellSize", type=float, default=50)
+    parser.add_argument("--threadNum", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def generate_scenario(args, dir):
+    subprocess.check_call([sys.executable, GENERATOR, str(args.rowNum), str(args.colNum),
+                           "--rowDistance", str(args.distance), "--columnDistance", str(args.distance),
+                           "--numStraightLanes", str(args.straightLanes), "--tlPlan", "--interval", "1.0",
+                           "--roadnetFile", "roadnet.json", "--flowFile", "flow.json", "--dir", dir])
+    config = {
+        "interval": 1.0,
+        "seed": args.seed,
+        "dir": dir,
+        "roadnetFile": "roadnet.json",
+        "flowFile": "flow.json",
+        "rlTrafficLight": False,
+        "saveReplay": False,
+        "spatialIndexCellSize": args.cellSize
+    }
+    config_file = os.path.join(dir, "config.json")
+    json.dump(config, open(config_file, "w"))
+    return config_file
+
+
+def summarize(name, times):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    p50 = times[len(times) // 2]
+    p99 = times[min(len(times) - 1, int(len(times) * 0.99))]
+    print("%-8s mean %.4f ms  p50 %.4f ms  p99 %.4f ms" % (name, mean * 1e3, p50 * 1e3, p99 * 1e3))
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    dir = tempfile.mkdtemp() + os.sep
+    eng = cityflow.Engine(generate_scenario(args, dir), thread_num=args.threadNum)
+
+    start = time.perf_counter()
+    for step in range(args.maxSteps):
+        eng.next_step()
+        if eng.get_vehicle_count() >= args.vehicles:
+            break
+    print("simulated %d steps in %.1f s, %d running vehicles"
+          % (step + 1, time.perf_counter() - start, eng.get_vehicle_count()))
+    if eng.get_vehicle_count() < args.vehicles:
+        print("warning: %d running vehicles not reached, raise --straightLanes or the grid size" % args.vehicles)
+
+    width = (args.colNum + 1) * args.distance
+    height = (args.rowNum + 1) * args.distance
+    points = [(random.uniform(0, width), random.uniform(0, height)) for _ in range(args.queries)]
+
+    # the index is rebuilt lazily by the first query after a step
+    start = time.perf_counter()
+    eng.get_vehicles_in_radius(0, 0, 0)
+    print("index build %.3f ms" % ((time.perf_counter() - start) * 1e3))
+
+    radius_times, bbox_times, found = [], [], 0
+    for x, y in points:
+        start = time.perf_counter()
+        found += len(eng.get_vehicles_in_radius(x, y, args.radius))
+        radius_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        eng.get_vehicles_in_bbox(x - args.radius, y - args.radius, x + args.radius, y + args.radius)
+        bbox_times.append(time.perf_counter() - start)
+
+    print("%d queries, radius %.0f m, %.1f vehicles per query" % (args.queries, args.radius, found / args.queries))
+    summarize("radius", radius_times)
+    summarize("bbox", bbox_times)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""Runs a simulation and streams its frames to map clients while it runs, without a replay file.
+
+The engine is advanced on a background thread. After every step the frame is encoded by the engine in the binary
+replay format (``Engine.get_replay_frame``) and pushed to the clients connected to ``GET /stream``, a Server-Sent
+Events stream:
+
+- ``event: header``: the binary replay header (road layout), base64
+- ``event: ids``: JSON list of vehicle ids, appended to the ids the client already has. Sent on connection with all
+  the ids streamed so far, and again before a frame when frames carrying new ids were dropped for a slow client
+- ``event: frame``: ``<step> <base64 frame>``, id indices refer to the list built from the ``ids`` events and the
+  new ids of the frames
+
+Every client has a bounded queue, a client that cannot keep up loses its oldest frames instead of slowing down the
+simulation. Control requests (JSON bodies) are applied between two steps:
+
+- ``POST /control/pause``, ``POST /control/resume``, ``POST /control/step`` (one step while paused)
+- ``POST /control/speed`` ``{"stepsPerSecond": 10}``, 0 runs as fast as possible
+- ``POST /control/phase`` ``{"intersection": id, "phase": 2}`` holds the phase of a light until
+  ``POST /control/release`` ``{"intersection": id}``
+- ``GET /state``: step, time, vehicle count, speed, held phases and number of clients
+"""
+import argparse
+import base64
+import json
+import queue
+import struct
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import cityflow
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="run a simulation and stream its frames over Server-Sent Events")
+    parser.add_argument("config", type=str, help="engine config file")
+    parser.add_argument("--threadNum", type=int, default=1)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--stepsPerSecond", type=float, default=10, help="simulation speed, 0 runs as fast as possible")
+    parser.add_argument("--steps", type=int, default=0, help="stop after this many steps, 0 runs until stopped")
+    parser.add_argument("--clientBuffer", type=int, default=32, help="frames queued per client before dropping")
+    parser.add_argument("--paused", action="store_true", help="start paused")
+    return parser.parse_args()
+
+
+def frame_new_ids(frame):
+    """Vehicle ids introduced by a binary replay frame."""
+    vehicle_count, new_id_count = struct.unpack_from("<II", frame)
+    offset = 8
+    ids = []
+    for _ in range(new_id_count):
+        length, = struct.unpack_from("<H", frame, offset)
+        ids.append(frame[offset + 2:offset + 2 + length].decode())
+        offset += 2 + length
+    return ids
+
+
+class Client:
+    def __init__(self, id_count, capacity):
+        self.id_count = id_count  # ids known to the client
+        self.frames = queue.Queue(capacity)
+        self.dropped = 0
+
+    def push(self, item):
+        while True:
+            try:
+                self.frames.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+class LiveSimulation:
+    def __init__(self, engine, steps_per_second=10, max_steps=0, client_buffer=32, paused=False):
+        self.engine = engine
+        self.steps_per_second = steps_per_second
+        self.max_steps = max_steps
+        self.client_buffer = client_buffer
+        self.paused = paused
+        self.step = 0
+        self.held = {}  # intersection id -> held phase
+
+        self.engine_lock = threading.Lock()  # the engine is used by one thread at a time
+        self.clients_lock = threading.Lock()
+        self.clients = set()
+        self.ids = []  # all ids streamed since the header, append only
+        self.header = engine.get_replay_header()
+        self.wake = threading.Condition()
+        self.stopped = False
+        self.pending_steps = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.wake:
+            self.stopped = True
+            self.wake.notify_all()
+        self.thread.join()
+
+    def _wait(self):
+        """Waits until the next step is due, returns False when stopped."""
+        with self.wake:
+            while not self.stopped and (self.paused and self.pending_steps == 0
+                                        or self.max_steps and self.step >= self.max_steps):
+                self.wake.wait()
+            if self.pending_steps:
+                self.pending_steps -= 1
+            return not self.stopped
+
+    def _run(self):
+        next_time = time.monotonic()
+        while self._wait():
+            with self.engine_lock:
+                # engine_lock keeps the request handlers away from the engine while the GIL is released
+                self.engine.next_step(release_gil=True)
+                frame = self.engine.get_replay_frame()
+                step = self.step
+                self.step += 1
+            self.broadcast(step, frame)
+
+            if self.steps_per_second > 0 and not self.paused:
+                next_time = max(next_time + 1 / self.steps_per_second, time.monotonic() - 1)
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    with self.wake:
+                        self.wake.wait(delay)
+            else:
+                next_time = time.monotonic()
+
+    def broadcast(self, step, frame):
+        with self.clients_lock:
+            ids_before = len(self.ids)
+            self.ids.extend(frame_new_ids(frame))
+            item = (step, frame, ids_before, len(self.ids))
+            for client in self.clients:
+                client.push(item)
+
+    def connect(self):
+        with self.clients_lock:
+            client = Client(len(self.ids), self.client_buffer)
+            self.clients.add(client)
+            return client, self.ids[:client.id_count]
+
+    def disconnect(self, client):
+        with self.clients_lock:
+            self.clients.discard(client)
+
+    def control(self, action, params):
+        with self.wake:
+            if action == "pause":
+                self.paused = True
+            elif action == "resume":
+                self.paused = False
+            elif action == "step":
+                self.pending_steps += 1
+            elif action == "speed":
+                self.steps_per_second = max(0.0, float(params["stepsPerSecond"]))
+            elif action == "phase":
+                intersection, phase = str(params["intersection"]), int(params["phase"])
+                with self.engine_lock:
+                    self.engine.hold_tl_phase(intersection, phase)
+                self.held[intersection] = phase
+            elif action == "release":
+                intersection = str(params["intersection"])
+                with self.engine_lock:
+                    self.engine.release_tl_phase(intersection)
+                self.held.pop(intersection, None)
+            else:
+                raise KeyError(action)
+            self.wake.notify_all()
+        return self.state()
+
+    def state(self):
+        with self.engine_lock:
+            current_time = self.engine.get_current_time()
+            vehicle_count = self.engine.get_vehicle_count()
+        with self.clients_lock:
+            clients = len(self.clients)
+        return {"step": self.step, "time": current_time, "vehicles": vehicle_count, "paused": self.paused,
+                "stepsPerSecond": self.steps_per_second, "held": dict(self.held), "clients": clients}
+
+
+class LiveHandler(BaseHTTPRequestHandler):
+    simulation = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_event(self, event, data):
+        self.wfile.write(("event: %s\ndata: %s\n\n" % (event, data)).encode())
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.end_headers()
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/state":
+            self._send_json(200, self.simulation.state())
+        elif path == "/stream":
+            self._stream()
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if not path.startswith("/control/"):
+            self._send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or b"{}")
+            self._send_json(200, self.simulation.control(path[len("/control/"):], params))
+        except KeyError as e:
+            self._send_json(400, {"error": "missing or unknown %s" % e})
+        except (ValueError, TypeError, IndexError) as e:
+            # bad json or values, and the errors of the engine for unknown intersections or phases
+            self._send_json(400, {"error": str(e)})
+
+    def _stream(self):
+        simulation = self.simulation
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        client, ids = simulation.connect()
+        try:
+            self._send_event("header", base64.b64encode(simulation.header).decode())
+            self._send_event("ids", json.dumps(ids))
+            self.wfile.flush()
+            while not simulation.stopped:
+                try:
+                    step, frame, ids_before, ids_after = client.frames.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b": keep-alive\n\n")
+                    self.wfile.flush()
+                    continue
+                if ids_before > client.id_count:
+                    # frames introducing these ids were dropped
+                    self._send_event("ids", json.dumps(simulation.ids[client.id_count:ids_before]))
+                self._send_event("frame", "%d %s" % (step, base64.b64encode(frame).decode()))
+                client.id_count = ids_after
+                if client.frames.empty():
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            simulation.disconnect(client)
+
+
+def make_server(simulation, host="127.0.0.1", port=8765):
+    handler = type("Handler", (LiveHandler,), {"simulation": simulation})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    args = parse_args()
+    engine = cityflow.Engine(args.config, thread_num=args.threadNum)
+    simulation = LiveSimulation(engine, args.stepsPerSecond, args.steps, args.clientBuffer, args.paused)
+    server = make_server(simulation, args.host, args.port)
+    simulation.start()
+    print("streaming on http://%s:%d/stream" % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulation.stop()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
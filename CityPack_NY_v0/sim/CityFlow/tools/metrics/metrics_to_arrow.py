@@ -0,0 +1,61 @@
+import argparse
+import os
+
+import pyarrow as pa
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="convert metrics csv files written by the engine to Parquet or Arrow IPC")
+    parser.add_argument("inputs", nargs="+", help="lane or intersection metrics csv files")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    parser.add_argument("--outDir", type=str, default=None, help="defaults to the directory of each input")
+    parser.add_argument("--compression", type=str, default="zstd")
+    parser.add_argument("--blockSize", type=int, default=1 << 24, help="bytes of csv read per batch")
+    return parser.parse_args()
+
+
+COLUMN_TYPES = {
+    "time": pa.float64(),
+    "duration": pa.float64(),
+    "lane": pa.string(),
+    "intersection": pa.string(),
+    "entered": pa.int64(),
+    "exited": pa.int64(),
+    "meanSpeed": pa.float64(),
+    "maxQueue": pa.int64(),
+    "greenTime": pa.float64()
+}
+
+
+def convert(input_file, output_file, format, compression, block_size):
+    # the csv is streamed batch by batch, long runs do not have to fit in memory
+    reader = csv.open_csv(input_file, read_options=csv.ReadOptions(block_size=block_size),
+                          convert_options=csv.ConvertOptions(column_types=COLUMN_TYPES))
+    schema = reader.schema
+    rows = 0
+    if format == "parquet":
+        writer = pq.ParquetWriter(output_file, schema, compression=compression)
+        write = writer.write_batch
+    else:
+        writer = pa.ipc.new_file(output_file, schema,
+                                 options=pa.ipc.IpcWriteOptions(compression=None if compression == "none" else compression))
+        write = writer.write_batch
+    try:
+        for batch in reader:
+            write(batch)
+            rows += batch.num_rows
+    finally:
+        writer.close()
+    return rows
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    for input_file in args.inputs:
+        out_dir = args.outDir if args.outDir is not None else os.path.dirname(input_file)
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        output_file = os.path.join(out_dir, name + (".parquet" if args.format == "parquet" else ".arrow"))
+        rows = convert(input_file, output_file, args.format, args.compression, args.blockSize)
+        print("%s -> %s (%d rows)" % (input_file, output_file, rows))
@@ -0,0 +1,167 @@
+"""Chunked replay: keyframes every ``keyframeInterval`` steps, light changes only in between, and a byte offset index.
+
+Layout (utf-8 text, one record per line):
+
+- header: JSON object with ``format``, ``version``, ``keyframeInterval`` and ``layout`` (``[road_id, implicit lanes]``)
+- keyframe ``K|<step>|<vehicles>;<lights>``: vehicles as in the text replay, lights as one ``g``/``r``/``i`` per lane
+- delta frame ``D|<step>|<vehicles>;<changes>``: changes are ``<lane index>:<state>`` separated by ``,`` for the
+  lanes whose light changed since the previous frame
+- index ``I|<JSON>``: ``frames`` (number of frames) and ``keyframes`` (byte offset of every keyframe)
+- footer ``F|<offset of the index line, 20 digits>``, always the last ``FOOTER_SIZE`` bytes
+
+A step is reached by reading from the keyframe before it, ``chunk_range`` gives the bytes to fetch with a range
+request.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from replay_format import open_replay, parse_vehicles, format_vehicles, Interner, ReplayFrame, \
+    LIGHT_CHARS, LIGHT_VALUES
+
+FORMAT_NAME = "cityflow-chunked-replay"
+FORMAT_VERSION = 1
+FOOTER_SIZE = 23  # "F|" + 20 digits + "\n"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="convert a replay log to the chunked replay format")
+    parser.add_argument("input", type=str, help="text or binary replay log")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--keyframeInterval", type=int, default=100, help="steps between two keyframes")
+    return parser.parse_args()
+
+
+class ChunkedReplayWriter:
+    def __init__(self, path, layout, ids, keyframe_interval=100):
+        self.f = open(path, "wb")
+        self.ids = ids
+        self.keyframe_interval = keyframe_interval
+        self.keyframes = []
+        self.frames = 0
+        self.last_lights = None
+        header = {"format": FORMAT_NAME, "version": FORMAT_VERSION, "keyframeInterval": keyframe_interval,
+                  "layout": [[road_id, implicit] for road_id, implicit in layout]}
+        self.f.write((json.dumps(header) + "\n").encode())
+
+    def write(self, frame):
+        vehicles = format_vehicles(frame.vehicles, self.ids)
+        if self.frames % self.keyframe_interval == 0:
+            self.keyframes.append(self.f.tell())
+            line = "K|%d|%s;%s\n" % (self.frames, vehicles, "".join(LIGHT_CHARS[state] for state in frame.lights))
+        else:
+            changed = np.flatnonzero(frame.lights != self.last_lights)
+            line = "D|%d|%s;%s\n" % (self.frames, vehicles,
+                                     ",".join("%d:%s" % (lane, LIGHT_CHARS[frame.lights[lane]]) for lane in changed))
+        self.f.write(line.encode())
+        self.last_lights = frame.lights.copy()
+        self.frames += 1
+
+    def close(self):
+        index_offset = self.f.tell()
+        index = {"frames": self.frames, "keyframes": self.keyframes}
+        self.f.write(("I|" + json.dumps(index) + "\n").encode())
+        self.f.write(("F|%020d\n" % index_offset).encode())
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChunkedReplayReader:
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        header = json.loads(self.f.readline())
+        if header.get("format") != FORMAT_NAME:
+            raise ValueError("%s is not a chunked replay" % path)
+        if header["version"] != FORMAT_VERSION:
+            raise ValueError("unsupported chunked replay version %d" % header["version"])
+        self.keyframe_interval = header["keyframeInterval"]
+        self.layout = [(road_id, implicit) for road_id, implicit in header["layout"]]
+
+        self.f.seek(-FOOTER_SIZE, os.SEEK_END)
+        footer = self.f.read(FOOTER_SIZE).decode()
+        if not footer.startswith("F|"):
+            raise ValueError("%s has no index, the file may be truncated" % path)
+        self.index_offset = int(footer[2:])
+        self.f.seek(self.index_offset)
+        index = json.loads(self.f.readline().decode()[2:])
+        self.frame_count = index["frames"]
+        self.keyframes = index["keyframes"]
+        self._interner = Interner()
+
+    @property
+    def ids(self):
+        return self._interner.ids
+
+    def __len__(self):
+        return self.frame_count
+
+    def chunk_range(self, step):
+        """Byte range [start, end) holding the keyframe before step and the frames up to the next keyframe."""
+        chunk = step // self.keyframe_interval
+        end = self.keyframes[chunk + 1] if chunk + 1 < len(self.keyframes) else self.index_offset
+        return self.keyframes[chunk], end
+
+    def frames(self, start=0, stop=None):
+        """Yields the frames of steps [start, stop), decoding from the keyframe before start."""
+        stop = self.frame_count if stop is None else min(stop, self.frame_count)
+        if start >= stop:
+            return
+        self.f.seek(self.chunk_range(start)[0])
+        lights = None
+        for step in range(start - start % self.keyframe_interval, stop):
+            kind, _, rest = self.f.readline().decode().rstrip("\n").split("|", 2)
+            vehicles, states = rest.split(";", 1)
+            if kind == "K":
+                lights = np.array([LIGHT_VALUES[state] for state in states], dtype=np.uint8)
+            else:
+                lights = lights.copy()
+                for change in states.split(","):
+                    if change:
+                        lane, state = change.split(":")
+                        lights[int(lane)] = LIGHT_VALUES[state]
+            if step >= start:
+                yield ReplayFrame(parse_vehicles(vehicles, self._interner), lights)
+
+    def frame(self, step):
+        if not 0 <= step < self.frame_count:
+            raise IndexError("step %d out of range" % step)
+        return next(self.frames(step, step + 1))
+
+    def __iter__(self):
+        return self.frames()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def convert(input_file, output_file, keyframe_interval=100):
+    reader = open_replay(input_file)
+    writer = None
+    try:
+        for frame in reader:
+            if writer is None:
+                writer = ChunkedReplayWriter(output_file, reader.layout, reader.ids, keyframe_interval)
+            writer.write(frame)
+    finally:
+        if writer is not None:
+            writer.close()
+    return writer.frames if writer is not None else 0
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    frames = convert(args.input, args.output, args.keyframeInterval)
+    print("%d frames, %d -> %d bytes" % (frames, os.path.getsize(args.input), os.path.getsize(args.output)))
@@ -0,0 +1,203 @@
+"""Reads the compressed replay logs the engine writes with ``replayCompression`` set to ``"zstd"``.
+
+The log follows the Zstandard seekable format (``contrib/seekable_format`` in the zstd sources), ``zstd -d`` turns it
+back into the plain text or binary log:
+
+- a skippable frame (magic ``0x184D2A50``) with the JSON metadata ``{"format", "stepsPerFrame"}``
+- the replay, ``stepsPerFrame`` steps per independent zstd frame (the binary header is in the first one)
+- a skippable frame with ``{"steps"}``, the number of steps written
+- the seek table: a skippable frame (magic ``0x184D2A5E``) with the compressed and decompressed size of every frame
+  above, ending with the frame count, a descriptor byte and the magic ``0x8F92EAB1``
+
+The steps ``[start, stop)`` of a text log are read by decompressing only the frames holding them. Binary logs
+declare every vehicle id once, so their frames are decompressed from the start.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+import zstandard
+
+from replay_format import TextReplayReader, BinaryReplayReader
+
+SKIPPABLE_MAGIC = 0x184D2A50
+SEEK_TABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct("<IBI")  # frame count, descriptor, magic
+CHECKSUM_FLAG = 0x80
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="extract steps of a compressed replay log as text replay lines")
+    parser.add_argument("input", type=str, help="replay log written with replayCompression \"zstd\"")
+    parser.add_argument("--from", dest="start", type=int, default=0, help="first step")
+    parser.add_argument("--to", dest="stop", type=int, default=None, help="step after the last one, default the end")
+    parser.add_argument("--output", type=str, default=None, help="default standard output")
+    return parser.parse_args()
+
+
+def read_skippable(data):
+    """JSON content of a skippable metadata frame."""
+    magic, size = struct.unpack_from("<II", data)
+    if magic != SKIPPABLE_MAGIC:
+        raise ValueError("not a compressed replay log")
+    return json.loads(data[8:8 + size])
+
+
+class SeekTable:
+    """Offsets and sizes of the frames of a seekable zstd file."""
+
+    def __init__(self, f):
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size < SEEK_TABLE_FOOTER.size:
+            raise ValueError("no seek table, the log was not closed by the engine")
+        f.seek(size - SEEK_TABLE_FOOTER.size)
+        count, descriptor, magic = SEEK_TABLE_FOOTER.unpack(f.read(SEEK_TABLE_FOOTER.size))
+        if magic != SEEKABLE_MAGIC:
+            raise ValueError("no seek table, the log was not closed by the engine")
+        entry_size = 12 if descriptor & CHECKSUM_FLAG else 8
+        table_size = 8 + count * entry_size + SEEK_TABLE_FOOTER.size
+        f.seek(size - table_size)
+        table = f.read(table_size)
+        if struct.unpack_from("<I", table)[0] != SEEK_TABLE_MAGIC:
+            raise ValueError("corrupted seek table")
+        entries = np.frombuffer(table, dtype="<u4", count=count * entry_size // 4, offset=8).reshape(count, -1)
+        self.compressed_sizes = entries[:, 0].astype(np.int64)
+        self.decompressed_sizes = entries[:, 1].astype(np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.compressed_sizes)])
+
+    def __len__(self):
+        return len(self.compressed_sizes)
+
+
+class CompressedReplay:
+    """Metadata, seek table and frame access of a compressed log, files are opened per read so that threads can
+    share it."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            head = f.read(8)
+            metadata = read_skippable(head + f.read(struct.unpack_from("<I", head, 4)[0]))
+            self.format = metadata["format"]
+            self.steps_per_frame = metadata["stepsPerFrame"]
+            try:
+                self.table = SeekTable(f)
+            except ValueError:
+                self.table = None  # still readable from the start
+        self.steps = None
+        if self.table is not None:
+            self.steps = read_skippable(self.read_frames(len(self.table) - 1, len(self.table), raw=True))["steps"]
+
+    def check_seekable(self):
+        if self.table is None:
+            raise ValueError("%s has no seek table, the log was not closed by the engine" % self.path)
+
+    def read_frames(self, first, last, raw=False):
+        """Frames ``[first, last)`` of the seek table, decompressed unless ``raw``."""
+        self.check_seekable()
+        with open(self.path, "rb") as f:
+            f.seek(int(self.table.offsets[first]))
+            data = f.read(int(self.table.offsets[last] - self.table.offsets[first]))
+        if raw:
+            return data
+        decompressor = zstandard.ZstdDecompressor()
+        parts = []
+        offset = 0
+        for index in range(first, last):
+            size = int(self.table.compressed_sizes[index])
+            if self.table.decompressed_sizes[index]:
+                parts.append(decompressor.decompress(data[offset:offset + size]))
+            offset += size
+        return b"".join(parts)
+
+    def step_frames(self, start, stop):
+        """Seek table frames ``[first, last)`` holding the steps ``[start, stop)``, and the first step of ``first``."""
+        first = start // self.steps_per_frame
+        last = (stop + self.steps_per_frame - 1) // self.steps_per_frame
+        return 1 + first, 1 + last, first * self.steps_per_frame  # the metadata frame comes first
+
+    def open_stream(self):
+        """Binary file object of the whole decompressed log."""
+        return zstandard.ZstdDecompressor().stream_reader(open(self.path, "rb"), read_across_frames=True,
+                                                          closefd=True)
+
+
+class CompressedTextReplayReader(TextReplayReader):
+    def __init__(self, path, replay=None):
+        super().__init__(path)
+        self.replay = replay or CompressedReplay(path)
+
+    def __len__(self):
+        self.replay.check_seekable()
+        return self.replay.steps
+
+    def _open(self):
+        return io.TextIOWrapper(self.replay.open_stream(), encoding="utf-8")
+
+    def lines(self, start, stop=None):
+        """Text lines of the steps ``[start, stop)``, as bytes."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return b""
+        first, last, first_step = self.replay.step_frames(start, stop)
+        data = self.replay.read_frames(first, last)
+        begin = 0
+        for _ in range(start - first_step):
+            begin = data.index(b"\n", begin) + 1
+        end = begin
+        for _ in range(stop - start):
+            end = data.index(b"\n", end) + 1
+        return data[begin:end]
+
+    def frames(self, start, stop=None):
+        """Frames of the steps ``[start, stop)``."""
+        for line in self.lines(start, stop).decode().splitlines():
+            yield self._parse_line(line)
+
+
+class CompressedBinaryReplayReader(BinaryReplayReader):
+    def __init__(self, path, replay=None):
+        super().__init__(path)
+        self.replay = replay or CompressedReplay(path)
+
+    def __len__(self):
+        self.replay.check_seekable()
+        return self.replay.steps
+
+    def _open(self):
+        return io.BufferedReader(self.replay.open_stream())
+
+    def frames(self, start, stop=None):
+        """Frames of the steps ``[start, stop)``, the ids are read from the frames before."""
+        return itertools.islice(iter(self), start, stop)
+
+
+def open_compressed_replay(path):
+    replay = CompressedReplay(path)
+    if replay.format == "binary":
+        return CompressedBinaryReplayReader(path, replay)
+    return CompressedTextReplayReader(path, replay)
+
+
+def main():
+    args = parse_args()
+    reader = open_compressed_replay(args.input)
+    if not isinstance(reader, CompressedTextReplayReader):
+        sys.exit("binary logs are extracted with zstd -d and convert_replay.py")
+    data = reader.lines(args.start, args.stop)
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(data)
+    else:
+        sys.stdout.buffer.write(data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import os
+
+from replay_format import open_replay, BinaryReplayReader, TextReplayWriter, BinaryReplayWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="convert a replay log between the text and binary formats")
+    parser.add_argument("input", type=str, help="replay log, the format is detected")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--format", choices=["text", "binary"], default=None,
+                        help="output format, defaults to the other format of the input")
+    return parser.parse_args()
+
+
+def convert(input_file, output_file, format=None):
+    reader = open_replay(input_file)
+    if format is None:
+        format = "text" if isinstance(reader, BinaryReplayReader) else "binary"
+    writer_class = TextReplayWriter if format == "text" else BinaryReplayWriter
+    frames = 0
+    writer = None
+    try:
+        for frame in reader:
+            if writer is None:
+                # the layout of a text replay is only known after its first frame
+                writer = writer_class(output_file, reader.layout, reader.ids)
+            writer.write(frame)
+            frames += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    return frames
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    frames = convert(args.input, args.output, args.format)
+    print("%d frames, %d -> %d bytes" % (frames, os.path.getsize(args.input), os.path.getsize(args.output)))
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+
+import numpy as np
+
+from replay_format import LIGHTS_HEADER
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="write a reduced copy of a text replay log, streaming it line by line")
+    parser.add_argument("input", type=str, help="text replay log")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--every", type=int, default=1, help="keep one step out of every N")
+    parser.add_argument("--interpolate", action="store_true",
+                        help="mark in the metadata that players may interpolate positions between kept steps")
+    parser.add_argument("--precision", type=int, default=None,
+                        help="decimals of positions and vehicle sizes, default keeps the values as written")
+    parser.add_argument("--headingPrecision", type=int, default=3, help="decimals of headings when --precision is set")
+    parser.add_argument("--viewport", type=str, default=None,
+                        help="json file with a polygon in replay coordinates, vehicles outside of it are dropped: "
+                             "a list of [x, y] or a GeoJSON Polygon (outer ring)")
+    parser.add_argument("--dropUnchangedLights", action="store_true",
+                        help="only write the light record of a road when it differs from the last written one")
+    parser.add_argument("--lightKeyframeInterval", type=int, default=100,
+                        help="with --dropUnchangedLights, write the lights of every road once every N output frames")
+    return parser.parse_args()
+
+
+def load_polygon(path):
+    with open(path) as f:
+        polygon = json.load(f)
+    if isinstance(polygon, dict):
+        if polygon.get("type") == "Feature":
+            polygon = polygon["geometry"]
+        polygon = polygon["coordinates"][0]
+    return np.array(polygon, dtype=np.float64)
+
+
+def inside_polygon(polygon, x, y):
+    """Even-odd rule, vectorized over the points."""
+    inside = np.zeros(len(x), dtype=bool)
+    x0, y0 = polygon[-1]
+    for x1, y1 in polygon:
+        crosses = (y1 > y) != (y0 > y)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            xs = x1 + (y - y1) * (x0 - x1) / (y0 - y1)
+        inside ^= crosses & (x < xs)
+        x0, y0 = x1, y1
+    return inside
+
+
+class Decimator:
+    def __init__(self, every=1, precision=None, heading_precision=3, polygon=None, drop_unchanged_lights=False,
+                 light_keyframe_interval=100):
+        if light_keyframe_interval < 1:
+            raise ValueError("light_keyframe_interval must be at least 1")
+        self.every = every
+        self.precision = precision
+        self.heading_precision = heading_precision
+        self.polygon = polygon
+        self.drop_unchanged_lights = drop_unchanged_lights
+        self.light_keyframe_interval = light_keyframe_interval
+        self.last_lights = {}  # road id -> light record last written, bounded by the number of roads
+
+    def _vehicles(self, text):
+        records = [vehicle.split(" ") for vehicle in text.split(",") if vehicle]
+        if not records:
+            return ""
+        if self.polygon is not None:
+            x = np.array([float(record[0]) for record in records])
+            y = np.array([float(record[1]) for record in records])
+            records = [record for record, keep in zip(records, inside_polygon(self.polygon, x, y)) if keep]
+        if self.precision is None:
+            return "".join(" ".join(record) + "," for record in records)
+        p, h = self.precision, self.heading_precision
+        return "".join("%.*f %.*f %.*f %s %s %.*f %.*f," % (
+            p, float(x), p, float(y), h, float(heading), vehicle_id, lc, p, float(length), p, float(width))
+                       for x, y, heading, vehicle_id, lc, length, width in records)
+
+    def _lights(self, text, keyframe):
+        if not self.drop_unchanged_lights:
+            return text
+        result = []
+        for record in text.split(","):
+            if not record:
+                continue
+            road_id = record.split(" ", 1)[0]
+            if keyframe or self.last_lights.get(road_id) != record:
+                self.last_lights[road_id] = record
+                result.append(record + ",")
+        return "".join(result)
+
+    def frame(self, line, keyframe=True):
+        """Reduced copy of a frame, with --dropUnchangedLights only keyframes hold the lights of every road."""
+        vehicles, lights = line.rstrip("\n").split(";", 1)
+        return self._vehicles(vehicles) + ";" + self._lights(lights, keyframe) + "\n"
+
+    def run(self, input_file, output_file):
+        source_frames = frames = 0
+        with open(input_file) as fin, open(output_file, "w") as fout:
+            for line in fin:
+                if not line.strip():
+                    continue
+                if line.startswith("#"):
+                    fout.write(line)
+                    continue
+                if source_frames % self.every == 0:
+                    if frames == 0 and self.drop_unchanged_lights:
+                        # players and readers rebuild the lights of a frame from the keyframe before it
+                        fout.write(LIGHTS_HEADER + json.dumps({"keyframeInterval": self.light_keyframe_interval}) + "\n")
+                    fout.write(self.frame(line, frames % self.light_keyframe_interval == 0))
+                    frames += 1
+                source_frames += 1
+        return source_frames, frames
+
+
+def main():
+    args = parse_args()
+    polygon = load_polygon(args.viewport) if args.viewport else None
+    decimator = Decimator(args.every, args.precision, args.headingPrecision, polygon, args.dropUnchangedLights,
+                          args.lightKeyframeInterval)
+    source_frames, frames = decimator.run(args.input, args.output)
+
+    bytes_in, bytes_out = os.path.getsize(args.input), os.path.getsize(args.output)
+    metadata = {
+        "source": os.path.basename(args.input),
+        "sourceFrames": source_frames,
+        "frames": frames,
+        # frame i of the output is step i * every of the source
+        "every": args.every,
+        "interpolate": args.interpolate,
+        "precision": args.precision,
+        "headingPrecision": args.headingPrecision if args.precision is not None else None,
+        "viewport": polygon.tolist() if polygon is not None else None,
+        # when true a road without light record keeps the state it had in the last frame, every
+        # lightKeyframeInterval-th frame holds all roads
+        "dropUnchangedLights": args.dropUnchangedLights,
+        "lightKeyframeInterval": args.lightKeyframeInterval if args.dropUnchangedLights else None,
+        "bytesIn": bytes_in,
+        "bytesOut": bytes_out,
+        "compressionRatio": bytes_in / bytes_out if bytes_out else None
+    }
+    with open(args.output + ".meta.json", "w") as f:
+        json.dump(metadata, f, indent=2)
+    print("%d -> %d frames, %d -> %d bytes, compression ratio %.2f" % (
+        source_frames, frames, bytes_in, bytes_out, metadata["compressionRatio"] or 0))
+
+
+if __name__ == '__main__':
+    main()
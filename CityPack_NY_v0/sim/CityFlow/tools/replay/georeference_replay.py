@@ -0,0 +1,119 @@
+"""Georeferences a text replay: vehicle positions become lng/lat (EPSG:4326) or Web Mercator (EPSG:3857) and
+headings become map bearings, so the web players draw vehicles without converting them.
+
+The local to lng/lat transform is the affine one of the web players (rotation, then meters to degrees scale and
+translation), run as a pyproj pipeline on all the vehicles of a frame at once. The output starts with a line
+
+    #georef {"crs": ..., "transform": ..., "bounds": ...}
+
+followed by the frames in the text replay format, with ``x y heading`` replaced by ``lng lat bearing``
+(``easting northing bearing`` for EPSG:3857). Bearings are in degrees clockwise from north.
+"""
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+from pyproj import Transformer
+
+from replay_format import LIGHTS_HEADER
+
+GEOREF_PREFIX = "#georef "
+
+# transforms used by the web players, keep in sync with web/js
+PRESETS = {
+    "traffic-flow": {"center": [-74.0184, 40.7013], "scale": [1 / 85000, 1 / 111111], "rotation": -0.84},
+    "cityflow-replay": {"center": [-73.9712, 40.7831], "scale": [1 / 85000, 1 / 111111], "rotation": 0.0}
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="convert the vehicle positions of a text replay to map coordinates")
+    parser.add_argument("roadnet", type=str, help="replay roadnet json (roadnetLogFile), gives the bounds")
+    parser.add_argument("input", type=str, help="text replay log")
+    parser.add_argument("output", type=str)
+    parser.add_argument("--crs", choices=["EPSG:4326", "EPSG:3857"], default="EPSG:4326")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="traffic-flow",
+                        help="transform of the web player the replay is for")
+    parser.add_argument("--center", type=float, nargs=2, default=None, metavar=("LNG", "LAT"),
+                        help="lng/lat of the local origin, overrides the preset")
+    parser.add_argument("--scale", type=float, nargs=2, default=None, metavar=("LNG", "LAT"),
+                        help="degrees per meter, overrides the preset")
+    parser.add_argument("--rotation", type=float, default=None, help="degrees, overrides the preset")
+    return parser.parse_args()
+
+
+def make_transformer(center, scale, rotation, crs):
+    rad = math.radians(rotation)
+    cos, sin = math.cos(rad), math.sin(rad)
+    steps = ["+proj=affine +xoff=%r +yoff=%r +s11=%r +s12=%r +s21=%r +s22=%r" % (
+        center[0], center[1], scale[0] * cos, -scale[0] * sin, scale[1] * sin, scale[1] * cos)]
+    if crs == "EPSG:3857":
+        steps.append("+proj=unitconvert +xy_in=deg +xy_out=rad")
+        steps.append("+proj=webmerc +ellps=WGS84")
+    return Transformer.from_pipeline("+proj=pipeline " + " ".join("+step " + step for step in steps))
+
+
+def to_bearing(heading):
+    # same as convertBearing of the web players
+    return (90 + np.degrees(heading) + 360) % 360
+
+
+def roadnet_bounds(roadnet_file, transformer):
+    with open(roadnet_file) as f:
+        roadnet = json.load(f)
+    roadnet = roadnet.get("static", roadnet)
+    points = np.array([node["point"] for node in roadnet["nodes"]], dtype=np.float64)
+    if len(points) == 0:
+        return None
+    x, y = transformer.transform(points[:, 0], points[:, 1])
+    return [float(x.min()), float(y.min()), float(x.max()), float(y.max())]
+
+
+def georeference(input_file, output_file, transformer, header):
+    # coordinates are written with about 1cm precision
+    position_format = "%.7f" if header["crs"] == "EPSG:4326" else "%.2f"
+    frames = 0
+    with open(input_file) as fin, open(output_file, "w") as fout:
+        fout.write(GEOREF_PREFIX + json.dumps(header) + "\n")
+        for line in fin:
+            if line.startswith(LIGHTS_HEADER):
+                fout.write(line)  # decimated logs: the frames only hold the lights that changed
+            if not line.strip() or line.startswith("#"):
+                continue
+            vehicles, lights = line.rstrip("\n").split(";", 1)
+            records = [vehicle.split(" ") for vehicle in vehicles.split(",") if vehicle]
+            result = []
+            if records:
+                values = np.array([record[:3] for record in records], dtype=np.float64)
+                x, y = transformer.transform(values[:, 0], values[:, 1])
+                bearing = to_bearing(values[:, 2])
+                for record, vx, vy, vb in zip(records, x, y, bearing):
+                    result.append("%s %s %.2f %s," % (position_format % vx, position_format % vy, vb,
+                                                      " ".join(record[3:])))
+            fout.write("".join(result) + ";" + lights + "\n")
+            frames += 1
+    return frames
+
+
+def main():
+    args = parse_args()
+    preset = PRESETS[args.preset]
+    center = args.center if args.center is not None else preset["center"]
+    scale = args.scale if args.scale is not None else preset["scale"]
+    rotation = args.rotation if args.rotation is not None else preset["rotation"]
+    transformer = make_transformer(center, scale, rotation, args.crs)
+
+    header = {
+        "crs": args.crs,
+        "transform": {"center": center, "scale": scale, "rotation": rotation},
+        "bounds": roadnet_bounds(args.roadnet, transformer),
+        "source": os.path.basename(args.input)
+    }
+    frames = georeference(args.input, args.output, transformer, header)
+    print("%d frames georeferenced to %s, bounds %s" % (frames, args.crs, header["bounds"]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+"""Extracts vehicle trajectories and vehicle and road statistics from a text replay log, as partitioned Parquet.
+
+The log is read once, sequentially, in blocks of whole frames. Each block goes to a worker process along with the
+last two frames before it (as context, so speeds and stops at the block boundary are exact), and at most
+``2 * processes`` blocks are in flight, so memory does not grow with the length of the log. Workers compute the
+statistics vectorized per frame and write their trajectories directly; the main process merges the per-vehicle
+partial results and writes the road statistics of a time window once all blocks covering it are done.
+
+Output directory:
+
+- ``trajectories/bucket=<b>/window=<w>/part-<block>.parquet``: one row per vehicle and step. ``bucket`` is
+  ``crc32(vehicle_id) % buckets`` (all rows of a vehicle share it), ``window`` is ``step // windowSteps``
+- ``vehicles.parquet``: one row per vehicle: first and last step, travel time, distance, mean speed, stopped time,
+  number of stops, origin and destination
+- ``roads/window=<w>/part-0.parquet`` (with ``--roadnet``): per road and window, vehicle-steps, mean speed, stopped
+  vehicle-steps and entered vehicles
+
+Speeds come from the displacement between consecutive steps, a vehicle is stopped below ``--stopSpeed``. Vehicles
+are matched to roads with the replay roadnet (``roadnetLogFile``): a vehicle is on a road when it lies within the
+lanes of one of its segments (road points run to the intersection centers, so vehicles crossing an intersection are
+mostly counted on the road they come from or go to).
+"""
+import argparse
+import json
+import math
+import os
+import zlib
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from replay_format import BINARY_MAGIC
+
+BLOCK_SIZE = 1 << 26
+CONTEXT_FRAMES = 2
+
+_options = None  # set once per worker process, the road matcher is not sent with every block
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="extract trajectories and statistics of a text replay as Parquet")
+    parser.add_argument("input", type=str, help="text replay log")
+    parser.add_argument("output", type=str, help="output directory, created")
+    parser.add_argument("--roadnet", type=str, default=None, help="replay roadnet json, enables the road statistics")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds per step of the replay")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--blockSize", type=int, default=BLOCK_SIZE, help="bytes of log per block")
+    parser.add_argument("--buckets", type=int, default=16, help="vehicle id hash partitions of the trajectories")
+    parser.add_argument("--windowSteps", type=int, default=300, help="steps per time window partition")
+    parser.add_argument("--stopSpeed", type=float, default=0.1, help="m/s below which a vehicle is stopped")
+    parser.add_argument("--compression", type=str, default="zstd")
+    return parser.parse_args()
+
+
+class RoadMatcher:
+    """Finds the road each position lies on, through a uniform grid of road segments."""
+
+    def __init__(self, roadnet, cell_size=50.0, tolerance=0.5):
+        roadnet = roadnet.get("static", roadnet)
+        self.road_ids = [edge["id"] for edge in roadnet["edges"]]
+        self.cell_size = cell_size
+        self.tolerance = tolerance
+        segments = []
+        for road, edge in enumerate(roadnet["edges"]):
+            width = sum(edge["laneWidths"])
+            for (x0, y0), (x1, y1) in zip(edge["points"], edge["points"][1:]):
+                length = math.hypot(x1 - x0, y1 - y0)
+                if length > 0:
+                    segments.append((x0, y0, (x1 - x0) / length, (y1 - y0) / length, length, width, road))
+        segments = np.array(segments, dtype=np.float64).reshape(-1, 7)
+        self.ax, self.ay, self.ux, self.uy, self.length, self.width = segments[:, :6].T
+        self.segment_road = segments[:, 6].astype(np.int32)
+
+        # lanes lie on the right of the road points: normal (uy, -ux), from 0 to the road width
+        cells = {}
+        nx, ny = self.uy, -self.ux
+        for i in range(len(segments)):
+            xs = [self.ax[i], self.ax[i] + self.ux[i] * self.length[i]]
+            ys = [self.ay[i], self.ay[i] + self.uy[i] * self.length[i]]
+            xs += [x + nx[i] * self.width[i] for x in xs]
+            ys += [y + ny[i] * self.width[i] for y in ys]
+            for cx in range(self._cell(min(xs) - tolerance), self._cell(max(xs) + tolerance) + 1):
+                for cy in range(self._cell(min(ys) - tolerance), self._cell(max(ys) + tolerance) + 1):
+                    cells.setdefault(self._key(cx, cy), []).append(i)
+        keys = sorted(cells)
+        self.cell_keys = np.array(keys, dtype=np.int64)
+        self.cell_count = np.array([len(cells[key]) for key in keys], dtype=np.int64)
+        self.cell_start = np.concatenate([[0], np.cumsum(self.cell_count)[:-1]]).astype(np.int64)
+        self.cell_segments = np.array([i for key in keys for i in cells[key]], dtype=np.int64)
+
+    def _cell(self, value):
+        return int(math.floor(value / self.cell_size))
+
+    @staticmethod
+    def _key(cx, cy):
+        return (cx + (1 << 20)) * (1 << 21) + (cy + (1 << 20))
+
+    def match(self, x, y):
+        """Index into ``road_ids`` of the road of each position, -1 for none."""
+        road = np.full(len(x), -1, dtype=np.int32)
+        if len(x) == 0 or len(self.cell_keys) == 0:
+            return road
+        keys = self._key(np.floor(x / self.cell_size).astype(np.int64), np.floor(y / self.cell_size).astype(np.int64))
+        pos = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+        counts = np.where(self.cell_keys[pos] == keys, self.cell_count[pos], 0)
+        vehicle = np.repeat(np.arange(len(x)), counts)
+        offsets = np.arange(len(vehicle)) - np.repeat(np.cumsum(counts) - counts, counts)
+        segment = self.cell_segments[np.repeat(self.cell_start[pos], counts) + offsets]
+
+        dx, dy = x[vehicle] - self.ax[segment], y[vehicle] - self.ay[segment]
+        along = dx * self.ux[segment] + dy * self.uy[segment]
+        across = dx * self.uy[segment] - dy * self.ux[segment]
+        on = ((along >= -self.tolerance) & (along <= self.length[segment] + self.tolerance)
+              & (across >= -self.tolerance) & (across <= self.width[segment] + self.tolerance))
+        # first matching segment of each vehicle
+        matched, first = np.unique(vehicle[on], return_index=True)
+        road[matched] = self.segment_road[segment[on][first]]
+        return road
+
+
+def split_frame(line):
+    """Vehicle ids and arrays of a text frame, without building per vehicle records."""
+    vehicles = line.split(";", 1)[0]
+    tokens = vehicles.replace(",", " ").split()
+    ids = tokens[3::7]
+    if len(tokens) != 7 * len(ids):
+        raise ValueError("malformed frame: %.80s" % line)
+    return (ids, np.array(tokens[0::7], dtype=np.float64), np.array(tokens[1::7], dtype=np.float64),
+            np.array(tokens[2::7], dtype=np.float64), np.array(tokens[4::7], dtype=np.int8))
+
+
+class GrowingArrays:
+    """Per-vehicle columns indexed by an interned id, grown on demand."""
+
+    def __init__(self, **columns):
+        self.fill = columns  # column -> (dtype, initial value)
+        self.size = 0
+        self.columns = {name: np.full(0, value, dtype=dtype) for name, (dtype, value) in columns.items()}
+
+    def ensure(self, size):
+        if size <= self.size:
+            return
+        capacity = max(size, 2 * self.size, 1024)
+        for name, (dtype, value) in self.fill.items():
+            column = np.full(capacity, value, dtype=dtype)
+            column[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = column
+        self.size = capacity
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+
+def vehicle_columns():
+    return GrowingArrays(first_step=(np.int64, -1), last_step=(np.int64, -1), distance=(np.float64, 0),
+                         stopped_steps=(np.int64, 0), stops=(np.int64, 0),
+                         origin_x=(np.float64, np.nan), origin_y=(np.float64, np.nan),
+                         destination_x=(np.float64, np.nan), destination_y=(np.float64, np.nan),
+                         origin_road=(np.int32, -1), destination_road=(np.int32, -1))
+
+
+def init_worker(options):
+    global _options
+    _options = options
+
+
+def process_block(task):
+    """Statistics and trajectories of the frames of one block, run in a worker process."""
+    index, first_step, context, block, output = task
+    options = _options
+    matcher = options["matcher"]
+    interval = options["interval"]
+    window_steps = options["window_steps"]
+
+    ids, index_of = [], {}
+    state = GrowingArrays(step=(np.int64, -2), x=(np.float64, 0), y=(np.float64, 0), stopped=(bool, False),
+                          road=(np.int32, -1))
+    vehicles = vehicle_columns()
+    road_count = len(matcher.road_ids) if matcher else 0
+    road_stats = {}  # window -> [vehicle_steps, speed_sum, speed_count, stopped_steps, entered] x roads
+    trajectory = []
+
+    lines = block.decode().split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    frames = [(line, False) for line in context] + [(line, True) for line in lines]
+    step = first_step - len(context)
+    for line, counted in frames:
+        frame_ids, x, y, heading, lane_change = split_frame(line)
+        for vehicle_id in frame_ids:
+            if vehicle_id not in index_of:
+                index_of[vehicle_id] = len(ids)
+                ids.append(vehicle_id)
+        vid = np.array([index_of[vehicle_id] for vehicle_id in frame_ids], dtype=np.int64)
+        state.ensure(len(ids))
+        vehicles.ensure(len(ids))
+
+        contiguous = state["step"][vid] == step - 1
+        displacement = np.where(contiguous, np.hypot(x - state["x"][vid], y - state["y"][vid]), 0.0)
+        speed = np.where(contiguous, displacement / interval, np.nan)
+        stopped = contiguous & (displacement < options["stop_speed"] * interval)
+        new_stop = stopped & ~(state["stopped"][vid] & contiguous)
+        road = matcher.match(x, y) if matcher else np.full(len(vid), -1, dtype=np.int32)
+        entered = (road >= 0) & (road != state["road"][vid])
+
+        if counted:
+            new = vehicles["first_step"][vid] < 0
+            vehicles["first_step"][vid[new]] = step
+            vehicles["origin_x"][vid[new]] = x[new]
+            vehicles["origin_y"][vid[new]] = y[new]
+            vehicles["last_step"][vid] = step
+            vehicles["destination_x"][vid] = x
+            vehicles["destination_y"][vid] = y
+            vehicles["distance"][vid] += displacement
+            vehicles["stopped_steps"][vid] += stopped
+            vehicles["stops"][vid] += new_stop
+            on_road = road >= 0
+            first_road = on_road & (vehicles["origin_road"][vid] < 0)
+            vehicles["origin_road"][vid[first_road]] = road[first_road]
+            vehicles["destination_road"][vid[on_road]] = road[on_road]
+
+            if matcher:
+                stats = road_stats.get(step // window_steps)
+                if stats is None:
+                    stats = road_stats[step // window_steps] = np.zeros((5, road_count), dtype=np.float64)
+                r = road[on_road]
+                measured = on_road & contiguous
+                stats[0] += np.bincount(r, minlength=road_count)
+                stats[1] += np.bincount(road[measured], weights=speed[measured], minlength=road_count)
+                stats[2] += np.bincount(road[measured], minlength=road_count)
+                stats[3] += np.bincount(road[on_road & stopped], minlength=road_count)
+                stats[4] += np.bincount(road[entered], minlength=road_count)
+
+            trajectory.append((vid, np.full(len(vid), step, dtype=np.int64), x, y, heading, speed, lane_change, road))
+
+        state["step"][vid] = step
+        state["x"][vid] = x
+        state["y"][vid] = y
+        state["stopped"][vid] = stopped
+        on_road = road >= 0
+        state["road"][vid[on_road]] = road[on_road]
+        step += 1
+
+    if trajectory:
+        write_trajectories(index, trajectory, ids, matcher, output, options)
+
+    counted = vehicles["first_step"][:len(ids)] >= 0
+    partial = {name: column[:len(ids)][counted] for name, column in vehicles.columns.items()}
+    partial["vehicle_id"] = [vehicle_id for vehicle_id, keep in zip(ids, counted) if keep]
+    return index, len(lines), partial, road_stats
+
+
+def write_trajectories(index, trajectory, ids, matcher, output, options):
+    vid, step, x, y, heading, speed, lane_change, road = (np.concatenate(column) for column in zip(*trajectory))
+    buckets = np.array([zlib.crc32(vehicle_id.encode()) % options["buckets"] for vehicle_id in ids], dtype=np.int64)
+    group = buckets[vid] * (1 << 32) + step // options["window_steps"]
+    order = np.argsort(group, kind="stable")
+    boundaries = np.flatnonzero(np.diff(group[order])) + 1
+    id_dictionary = pa.array(ids, type=pa.string())
+    road_dictionary = pa.array(matcher.road_ids if matcher else [], type=pa.string())
+    for rows in np.split(order, boundaries):
+        bucket, window = divmod(int(group[rows[0]]), 1 << 32)
+        columns = {
+            "vehicle_id": pa.DictionaryArray.from_arrays(pa.array(vid[rows].astype(np.int32)), id_dictionary),
+            "step": pa.array(step[rows]),
+            "time": pa.array(step[rows] * options["interval"]),
+            "x": pa.array(x[rows]),
+            "y": pa.array(y[rows]),
+            "heading": pa.array(heading[rows].astype(np.float32)),
+            "speed": pa.array(speed[rows].astype(np.float32), from_pandas=True),
+            "lane_change": pa.array(lane_change[rows]),
+        }
+        if matcher:
+            road_rows = road[rows]
+            columns["road"] = pa.DictionaryArray.from_arrays(pa.array(road_rows, mask=road_rows < 0), road_dictionary)
+        directory = os.path.join(output, "trajectories", "bucket=%d" % bucket, "window=%d" % window)
+        os.makedirs(directory, exist_ok=True)
+        pq.write_table(pa.table(columns), os.path.join(directory, "part-%05d.parquet" % index),
+                       compression=options["compression"])
+
+
+def read_blocks(path, block_size):
+    """Yields (first step, context frames, block) with whole frames, reading the log once."""
+    with open(path, "rb") as f:
+        header = f.read(len(BINARY_MAGIC))
+        if header == BINARY_MAGIC:
+            raise ValueError("%s is a binary replay, convert it to text with convert_replay.py" % path)
+        f.seek(0)
+        first_line = f.readline()
+        if first_line.startswith(b"#georef"):
+            raise ValueError("%s is georeferenced, run the analytics on the source replay" % path)
+        if not first_line.startswith(b"#"):
+            f.seek(0)
+
+        step = 0
+        context = []
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            if not block.endswith(b"\n"):
+                block += f.readline()
+            if not block.endswith(b"\n"):
+                block += b"\n"  # last line of the file
+            yield step, context, block
+            step += block.count(b"\n")
+            parts = block.rsplit(b"\n", CONTEXT_FRAMES + 1)
+            tail = parts[1:-1] if len(parts) == CONTEXT_FRAMES + 2 else parts[:-1]
+            context = (context + [line.decode() for line in tail])[-CONTEXT_FRAMES:]
+
+
+class Analytics:
+    def __init__(self, output, matcher=None, interval=1.0, buckets=16, window_steps=300, stop_speed=0.1,
+                 compression="zstd"):
+        self.output = output
+        self.matcher = matcher
+        self.interval = interval
+        self.window_steps = window_steps
+        self.compression = compression
+        self.options = {"matcher": matcher, "interval": interval, "buckets": buckets, "window_steps": window_steps,
+                        "stop_speed": stop_speed, "compression": compression}
+        self.index_of = {}
+        self.ids = []
+        self.vehicles = vehicle_columns()
+        self.road_stats = {}
+        self.frames = 0
+
+    def _merge(self, partial, road_stats):
+        for vehicle_id in partial["vehicle_id"]:
+            if vehicle_id not in self.index_of:
+                self.index_of[vehicle_id] = len(self.ids)
+                self.ids.append(vehicle_id)
+        self.vehicles.ensure(len(self.ids))
+        vid = np.array([self.index_of[vehicle_id] for vehicle_id in partial["vehicle_id"]], dtype=np.int64)
+        columns = self.vehicles
+        # blocks are merged in order: first values come from the first block of a vehicle, last ones from the last
+        new = columns["first_step"][vid] < 0
+        for name in ["first_step", "origin_x", "origin_y"]:
+            columns[name][vid[new]] = partial[name][new]
+        no_origin_road = columns["origin_road"][vid] < 0
+        columns["origin_road"][vid[no_origin_road]] = partial["origin_road"][no_origin_road]
+        for name in ["last_step", "destination_x", "destination_y"]:
+            columns[name][vid] = partial[name]
+        has_road = partial["destination_road"] >= 0
+        columns["destination_road"][vid[has_road]] = partial["destination_road"][has_road]
+        for name in ["distance", "stopped_steps", "stops"]:
+            columns[name][vid] += partial[name]
+
+        for window, stats in road_stats.items():
+            if window in self.road_stats:
+                self.road_stats[window] += stats
+            else:
+                self.road_stats[window] = stats
+
+    def _flush_roads(self, before_step):
+        for window in sorted(self.road_stats):
+            if (window + 1) * self.window_steps > before_step:
+                break
+            self._write_roads(window, self.road_stats.pop(window))
+
+    def _write_roads(self, window, stats):
+        vehicle_steps, speed_sum, speed_count, stopped_steps, entered = stats
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_speed = np.where(speed_count > 0, speed_sum / speed_count, np.nan)
+        steps = min(self.window_steps, self.frames - window * self.window_steps)
+        table = pa.table({
+            "road_id": pa.array(self.matcher.road_ids, type=pa.string()),
+            "start_time": pa.array(np.full(len(entered), window * self.window_steps * self.interval)),
+            "duration": pa.array(np.full(len(entered), steps * self.interval)),
+            "vehicle_steps": pa.array(vehicle_steps.astype(np.int64)),
+            "mean_vehicles": pa.array(vehicle_steps / steps),
+            "mean_speed": pa.array(mean_speed, from_pandas=True),
+            "stopped_steps": pa.array(stopped_steps.astype(np.int64)),
+            "entered": pa.array(entered.astype(np.int64)),
+        })
+        directory = os.path.join(self.output, "roads", "window=%d" % window)
+        os.makedirs(directory, exist_ok=True)
+        pq.write_table(table, os.path.join(directory, "part-0.parquet"), compression=self.compression)
+
+    def _write_vehicles(self):
+        count = len(self.ids)
+        columns = {name: column[:count] for name, column in self.vehicles.columns.items()}
+        road_ids = np.array(self.matcher.road_ids if self.matcher else [], dtype=object)
+
+        def roads(index):
+            return pa.array([road_ids[i] if i >= 0 else None for i in index], type=pa.string())
+
+        travel_time = (columns["last_step"] - columns["first_step"]) * self.interval
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_speed = np.where(travel_time > 0, columns["distance"] / travel_time, np.nan)
+        table = {
+            "vehicle_id": pa.array(self.ids, type=pa.string()),
+            "first_step": pa.array(columns["first_step"]),
+            "last_step": pa.array(columns["last_step"]),
+            "travel_time": pa.array(travel_time),
+            "distance": pa.array(columns["distance"]),
+            "mean_speed": pa.array(mean_speed, from_pandas=True),
+            "stopped_time": pa.array(columns["stopped_steps"] * self.interval),
+            "stops": pa.array(columns["stops"]),
+            "origin_x": pa.array(columns["origin_x"]),
+            "origin_y": pa.array(columns["origin_y"]),
+            "destination_x": pa.array(columns["destination_x"]),
+            "destination_y": pa.array(columns["destination_y"]),
+        }
+        if self.matcher:
+            table["origin_road"] = roads(columns["origin_road"])
+            table["destination_road"] = roads(columns["destination_road"])
+        pq.write_table(pa.table(table), os.path.join(self.output, "vehicles.parquet"), compression=self.compression)
+
+    def run(self, input_file, processes=1, block_size=BLOCK_SIZE):
+        """Returns the number of frames."""
+        if os.path.exists(self.output) and os.listdir(self.output):
+            raise ValueError("output directory %s is not empty" % self.output)
+        os.makedirs(self.output, exist_ok=True)
+        tasks = ((index, first_step, context, block, self.output)
+                 for index, (first_step, context, block) in enumerate(read_blocks(input_file, block_size)))
+
+        def collect(result):
+            index, frames, partial, road_stats = result
+            self.frames += frames
+            self._merge(partial, road_stats)
+            self._flush_roads(self.frames)
+
+        if processes <= 1:
+            init_worker(self.options)
+            for task in tasks:
+                collect(process_block(task))
+        else:
+            with Pool(processes, init_worker, (self.options,)) as pool:
+                pending = deque()
+                for task in tasks:
+                    pending.append(pool.apply_async(process_block, (task,)))
+                    if len(pending) >= 2 * processes:
+                        collect(pending.popleft().get())
+                while pending:
+                    collect(pending.popleft().get())
+
+        for window in sorted(self.road_stats):
+            self._write_roads(window, self.road_stats.pop(window))
+        self._write_vehicles()
+        return self.frames
+
+
+def main():
+    args = parse_args()
+    matcher = None
+    if args.roadnet:
+        with open(args.roadnet) as f:
+            matcher = RoadMatcher(json.load(f))
+    compression = None if args.compression == "none" else args.compression
+    analytics = Analytics(args.output, matcher, args.interval, args.buckets, args.windowSteps, args.stopSpeed,
+                          compression)
+    frames = analytics.run(args.input, args.processes, args.blockSize)
+    print("%d frames, %d vehicles written to %s" % (frames, len(analytics.ids), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""Readers and writers for the text and binary replay logs written by the engine.
+
+Both readers yield one ``ReplayFrame`` per step:
+
+- ``vehicles``: NumPy structured array with the fields of ``VEHICLE_DTYPE``, ``id`` indexes ``reader.ids``
+- ``lights``: uint8 array with one entry per lane of ``reader.layout`` (``LIGHT_RED``, ``LIGHT_GREEN`` or ``LIGHT_IMPLICIT``)
+
+``reader.layout`` lists the roads shown in the replay as ``(road_id, implicit)`` pairs, ``implicit`` holding one flag
+per lane, true if the lane ends at an intersection without signal.
+
+Text logs written by ``decimate_replay.py --dropUnchangedLights`` start with a ``#lights {"keyframeInterval": n}``
+header line: every n-th frame (the first one included) holds the lights of every road, the frames in between only
+the roads whose lights changed. ``TextReplayReader`` carries the other roads forward, so its frames are complete.
+"""
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+LIGHT_RED, LIGHT_GREEN, LIGHT_IMPLICIT = 0, 1, 2
+LIGHT_CHARS = "rgi"  # indexed by the light values
+LIGHT_VALUES = {"r": LIGHT_RED, "g": LIGHT_GREEN, "i": LIGHT_IMPLICIT}
+LIGHTS_HEADER = "#lights "
+
+VEHICLE_DTYPE = np.dtype([
+    ("x", np.float64),
+    ("y", np.float64),
+    ("heading", np.float64),
+    ("lane_change", np.int8),
+    ("length", np.float64),
+    ("width", np.float64),
+    ("id", np.uint32)
+])
+
+ReplayFrame = namedtuple("ReplayFrame", ["vehicles", "lights"])
+
+BINARY_MAGIC = b"CFRB"
+BINARY_VERSION = 1
+ZSTD_SKIPPABLE_MAGIC = b"\x50\x2a\x4d\x18"  # compressed logs start with a skippable frame of metadata
+
+# fixed-width vehicle record of the binary format, positions and sizes in centimeters, heading in 1e-4 rad
+RECORD_DTYPE = np.dtype([
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("heading", "<i2"),
+    ("lane_change", "i1"),
+    ("pad", "u1"),
+    ("length", "<u2"),
+    ("width", "<u2"),
+    ("id", "<u4")
+])
+POSITION_SCALE = 100
+HEADING_SCALE = 10000
+
+
+def open_replay(path):
+    """Opens a replay log, detecting its format from the first bytes."""
+    with open(path, "rb") as f:
+        magic = f.read(len(BINARY_MAGIC))
+    if magic == BINARY_MAGIC:
+        return BinaryReplayReader(path)
+    if magic == ZSTD_SKIPPABLE_MAGIC:
+        from compressed_replay import open_compressed_replay  # needs zstandard
+        return open_compressed_replay(path)
+    return TextReplayReader(path)
+
+
+def parse_vehicles(text, interner):
+    """Parses the vehicle part of a text frame, ids are interned with ``interner``."""
+    records = [vehicle.split(" ") for vehicle in text.split(",") if vehicle]
+    vehicles = np.empty(len(records), dtype=VEHICLE_DTYPE)
+    for i, (x, y, heading, vehicle_id, lc, length, width) in enumerate(records):
+        vehicles[i] = (float(x), float(y), float(heading), int(lc), float(length), float(width),
+                       interner.get(vehicle_id))
+    return vehicles
+
+
+def format_vehicles(vehicles, ids):
+    """Formats vehicles as the vehicle part of a text frame."""
+    return "".join("%r %r %r %s %d %r %r," % (
+        float(vehicle["x"]), float(vehicle["y"]), float(vehicle["heading"]), ids[vehicle["id"]],
+        vehicle["lane_change"], float(vehicle["length"]), float(vehicle["width"])) for vehicle in vehicles)
+
+
+def format_frame(frame, layout, ids):
+    """Formats a frame as a line of the text replay."""
+    parts = [format_vehicles(frame.vehicles, ids), ";"]
+    lane = 0
+    for road_id, implicit in layout:
+        states = frame.lights[lane:lane + len(implicit)]
+        parts.append(road_id + "".join(" " + LIGHT_CHARS[state] for state in states) + ",")
+        lane += len(implicit)
+    return "".join(parts) + "\n"
+
+
+def merge_light_records(texts):
+    """Light part of a text frame holding every road, from the light parts of a keyframe and the frames after it."""
+    records = {}
+    for text in texts:
+        for record in text.split(","):
+            if record:
+                records[record.split(" ", 1)[0]] = record
+    return "".join(record + "," for record in records.values())
+
+
+class Interner:
+    def __init__(self):
+        self.ids = []
+        self.index = {}
+
+    def get(self, vehicle_id):
+        index = self.index.get(vehicle_id)
+        if index is None:
+            index = self.index[vehicle_id] = len(self.ids)
+            self.ids.append(vehicle_id)
+        return index
+
+
+class TextReplayReader:
+    def __init__(self, path):
+        self.path = path
+        self.layout = None
+        self._interner = Interner()
+        self._first_lanes = {}  # road id -> index of its first lane in the lights
+        self._lights = None  # lights of the last frame, for logs holding only the lights that changed
+
+    @property
+    def ids(self):
+        return self._interner.ids
+
+    def _parse_lights(self, text):
+        roads = [road.split(" ") for road in text.split(",") if road]
+        if self.layout is None:
+            self.layout = [(road[0], [state == "i" for state in road[1:]]) for road in roads]
+            lane = 0
+            for road_id, implicit in self.layout:
+                self._first_lanes[road_id] = lane
+                lane += len(implicit)
+        if len(roads) == len(self.layout) or self._lights is None:
+            lights = np.array([LIGHT_VALUES[state] for road in roads for state in road[1:]], dtype=np.uint8)
+        else:
+            lights = self._lights.copy()
+            for road in roads:
+                lane = self._first_lanes[road[0]]
+                lights[lane:lane + len(road) - 1] = [LIGHT_VALUES[state] for state in road[1:]]
+        self._lights = lights
+        return lights
+
+    def _parse_line(self, line):
+        vehicles, lights = line.split(";", 1)
+        return ReplayFrame(parse_vehicles(vehicles, self._interner), self._parse_lights(lights))
+
+    def _open(self):
+        return open(self.path)
+
+    def __iter__(self):
+        self._lights = None
+        with self._open() as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):  # header lines such as the one of georeferenced replays
+                    continue
+                yield self._parse_line(line)
+
+
+class TextReplayWriter:
+    def __init__(self, path, layout, ids):
+        self.f = open(path, "w")
+        self.layout = layout
+        self.ids = ids
+
+    def write(self, frame):
+        self.f.write(format_frame(frame, self.layout, self.ids))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BinaryReplayReader:
+    def __init__(self, path):
+        self.path = path
+        self.layout = None
+        self.ids = []
+
+    def _read_string(self, f):
+        length, = struct.unpack("<H", f.read(2))
+        return f.read(length).decode()
+
+    def _read_header(self, f):
+        magic, version, flags, road_count = struct.unpack("<4sHHI", f.read(12))
+        if magic != BINARY_MAGIC:
+            raise ValueError("%s is not a binary replay log" % self.path)
+        if version != BINARY_VERSION:
+            raise ValueError("unsupported binary replay version %d" % version)
+        self.layout = []
+        for _ in range(road_count):
+            road_id = self._read_string(f)
+            lane_count, = struct.unpack("<H", f.read(2))
+            implicit = [flag != 0 for flag in f.read(lane_count)]
+            self.layout.append((road_id, implicit))
+
+    def _open(self):
+        return open(self.path, "rb")
+
+    def __iter__(self):
+        self.ids = []
+        with self._open() as f:
+            self._read_header(f)
+            implicit = np.array([flag for _, lanes in self.layout for flag in lanes], dtype=bool)
+            signalized = np.flatnonzero(~implicit)
+            light_bytes = (len(signalized) + 7) // 8
+            while True:
+                head = f.read(8)
+                if len(head) < 8:
+                    return
+                vehicle_count, new_id_count = struct.unpack("<II", head)
+                for _ in range(new_id_count):
+                    self.ids.append(self._read_string(f))
+                records = np.frombuffer(f.read(vehicle_count * RECORD_DTYPE.itemsize), dtype=RECORD_DTYPE)
+
+                vehicles = np.empty(vehicle_count, dtype=VEHICLE_DTYPE)
+                vehicles["x"] = records["x"] / POSITION_SCALE
+                vehicles["y"] = records["y"] / POSITION_SCALE
+                vehicles["heading"] = records["heading"] / HEADING_SCALE
+                vehicles["lane_change"] = records["lane_change"]
+                vehicles["length"] = records["length"] / POSITION_SCALE
+                vehicles["width"] = records["width"] / POSITION_SCALE
+                vehicles["id"] = records["id"]
+
+                bits = np.unpackbits(np.frombuffer(f.read(light_bytes), dtype=np.uint8), bitorder="little")
+                lights = np.full(len(implicit), LIGHT_IMPLICIT, dtype=np.uint8)
+                lights[signalized] = bits[:len(signalized)]
+                yield ReplayFrame(vehicles, lights)
+
+
+class BinaryReplayWriter:
+    def __init__(self, path, layout, ids):
+        self.f = open(path, "wb")
+        self.layout = layout
+        self.ids = ids
+        self.index = {}
+        self.signalized = np.flatnonzero(~np.array([flag for _, lanes in layout for flag in lanes], dtype=bool))
+
+        header = [struct.pack("<4sHHI", BINARY_MAGIC, BINARY_VERSION, 0, len(layout))]
+        for road_id, implicit in layout:
+            header.append(self._pack_string(road_id))
+            header.append(struct.pack("<H", len(implicit)))
+            header.append(bytes(1 if flag else 0 for flag in implicit))
+        self.f.write(b"".join(header))
+
+    @staticmethod
+    def _pack_string(string):
+        data = string.encode()
+        return struct.pack("<H", len(data)) + data
+
+    def write(self, frame):
+        vehicles = frame.vehicles
+        # ids are renumbered in order of first appearance, as the engine does
+        new_ids = []
+        indices = np.empty(len(vehicles), dtype=np.uint32)
+        for i, vehicle_id in enumerate(vehicles["id"]):
+            name = self.ids[vehicle_id]
+            index = self.index.get(name)
+            if index is None:
+                index = self.index[name] = len(self.index)
+                new_ids.append(self._pack_string(name))
+            indices[i] = index
+
+        records = np.zeros(len(vehicles), dtype=RECORD_DTYPE)
+        records["x"] = np.round(vehicles["x"] * POSITION_SCALE)
+        records["y"] = np.round(vehicles["y"] * POSITION_SCALE)
+        records["heading"] = np.round(vehicles["heading"] * HEADING_SCALE)
+        records["lane_change"] = vehicles["lane_change"]
+        records["length"] = np.round(vehicles["length"] * POSITION_SCALE)
+        records["width"] = np.round(vehicles["width"] * POSITION_SCALE)
+        records["id"] = indices
+
+        lights = np.packbits(frame.lights[self.signalized] == LIGHT_GREEN, bitorder="little")
+        self.f.write(struct.pack("<II", len(vehicles), len(new_ids)) + b"".join(new_ids)
+                     + records.tobytes() + lights.tobytes())
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
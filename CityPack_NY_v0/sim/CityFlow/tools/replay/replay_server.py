@@ -0,0 +1,418 @@
+"""Serves the replay logs of a directory by step window, so a player fetches only the steps it is about to show.
+
+- ``GET /replays``: JSON list of ``{"name", "size"}``
+- ``GET /replay/<name>/index``: JSON ``{"format", "frames", "maxWindow"}``
+- ``GET /replay/<name>?from=&to=``: steps ``[from, to)`` as text replay lines, preceded by the ``#`` header lines of
+  the log (such as ``#georef``). At most ``maxWindow`` steps are returned; ``X-Replay-From``, ``X-Replay-To`` and
+  ``X-Replay-Frames`` give the window served and the length of the replay
+- ``GET /replay/<name>``: the file as is, e.g. for the range requests of ``chunked_replay.chunk_range``
+
+Text logs, compressed text logs (``compressed_replay.py``) and chunked replays (``chunked_replay.py``) are served;
+compressed windows decompress only the frames holding them, chunked windows are decoded to text lines. Text
+logs are indexed in one streaming pass over the file, the index (byte offset of every frame) is kept next to the log
+as ``<log>.index.npz`` and rebuilt when the log changes. The first line of a window of a log written with
+``decimate_replay.py --dropUnchangedLights`` gets the lights of every road, merged from the keyframe before it.
+
+Responses carry an ``ETag`` (``If-None-Match`` gives 304) and support single ``Range`` requests; without ``Range``
+they are gzip compressed for clients accepting it.
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import threading
+import zlib
+from array import array
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+import numpy as np
+
+from chunked_replay import ChunkedReplayReader, FORMAT_NAME as CHUNKED_FORMAT_NAME
+from replay_format import BINARY_MAGIC, LIGHTS_HEADER, ZSTD_SKIPPABLE_MAGIC, format_frame, merge_light_records
+
+INDEX_SUFFIX = ".index.npz"
+BLOCK_SIZE = 1 << 16
+MIN_GZIP_SIZE = 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="serve replay logs by step window with range, ETag and gzip support")
+    parser.add_argument("directory", type=str, help="directory holding the replay logs")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--maxWindow", type=int, default=1000, help="maximum number of steps of one response")
+    parser.add_argument("--index", action="store_true", help="index the text logs of the directory and exit")
+    return parser.parse_args()
+
+
+def build_index(path):
+    """Byte offset of every frame of a text replay, plus the end of the last one, in a single streaming pass.
+    ``#`` lines before the first frame are returned as the header."""
+    offsets = array("Q")
+    header = []
+    offset = end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b"#"):
+                if not offsets:
+                    header.append(line)
+            elif line.strip():
+                offsets.append(offset)
+                end = offset + len(line)
+            offset += len(line)
+    offsets.append(end if offsets else offset)
+    return np.frombuffer(offsets, dtype=np.uint64), b"".join(header)
+
+
+def file_etag(stat):
+    return "%x-%x" % (stat.st_mtime_ns, stat.st_size)
+
+
+class TextReplaySource:
+    format = "text"
+
+    def __init__(self, path):
+        self.path = path
+        stat = os.stat(path)
+        self.etag = file_etag(stat)
+        index_path = path + INDEX_SUFFIX
+        try:
+            with np.load(index_path) as data:
+                if int(data["size"]) != stat.st_size or int(data["mtime"]) != stat.st_mtime_ns:
+                    raise ValueError("stale index")
+                self.offsets = data["offsets"]
+                self.header = data["header"].tobytes()
+        except (OSError, ValueError, KeyError):
+            self.offsets, self.header = build_index(path)
+            try:
+                np.savez(index_path, offsets=self.offsets, header=np.frombuffer(self.header, dtype=np.uint8),
+                         size=stat.st_size, mtime=stat.st_mtime_ns)
+            except OSError:
+                pass  # read-only directory, the index stays in memory
+        self.light_keyframe_interval = None
+        for line in self.header.decode().splitlines():
+            if line.startswith(LIGHTS_HEADER):
+                self.light_keyframe_interval = json.loads(line[len(LIGHTS_HEADER):])["keyframeInterval"]
+
+    @property
+    def frames(self):
+        return len(self.offsets) - 1
+
+    def window(self, start, stop):
+        first = start
+        if self.light_keyframe_interval:
+            first -= start % self.light_keyframe_interval
+        with open(self.path, "rb") as f:
+            f.seek(int(self.offsets[first]))
+            data = f.read(int(self.offsets[stop]) - int(self.offsets[first]))
+        if first == start:
+            return self.header + data
+        lines = data.split(b"\n", start - first + 1)
+        vehicles = lines[start - first].split(b";", 1)[0]
+        lights = merge_light_records(line.split(b";", 1)[1].decode() for line in lines[:start - first + 1])
+        return self.header + vehicles + b";" + lights.encode() + b"\n" + lines[-1]
+
+
+class ChunkedReplaySource:
+    format = "chunked"
+
+    def __init__(self, path):
+        self.path = path
+        self.etag = file_etag(os.stat(path))
+        self.reader = ChunkedReplayReader(path)
+        self.lock = threading.Lock()  # the reader seeks a shared file
+
+    @property
+    def frames(self):
+        return len(self.reader)
+
+    def window(self, start, stop):
+        with self.lock:
+            return "".join(format_frame(frame, self.reader.layout, self.reader.ids)
+                           for frame in self.reader.frames(start, stop)).encode()
+
+    def close(self):
+        with self.lock:
+            self.reader.close()
+
+
+class CompressedReplaySource:
+    format = "zstd"
+
+    def __init__(self, path):
+        from compressed_replay import CompressedTextReplayReader  # needs zstandard
+        self.path = path
+        self.etag = file_etag(os.stat(path))
+        self.reader = CompressedTextReplayReader(path)
+        if self.reader.replay.format != "text":
+            raise ValueError("binary replays are not served, convert them with convert_replay.py or chunked_replay.py")
+
+    @property
+    def frames(self):
+        return len(self.reader)
+
+    def window(self, start, stop):
+        return self.reader.lines(start, stop)
+
+
+def open_source(path):
+    with open(path, "rb") as f:
+        first_line = f.readline()
+    if first_line.startswith(BINARY_MAGIC):
+        raise ValueError("binary replays are not served, convert them with convert_replay.py or chunked_replay.py")
+    if first_line.startswith(ZSTD_SKIPPABLE_MAGIC):
+        return CompressedReplaySource(path)
+    if first_line.startswith(b"{"):
+        try:
+            is_chunked = json.loads(first_line).get("format") == CHUNKED_FORMAT_NAME
+        except ValueError:
+            is_chunked = False
+        if is_chunked:
+            return ChunkedReplaySource(path)
+    return TextReplaySource(path)
+
+
+class ReplayLibrary:
+    """Replay logs of a directory, opened and indexed on first use and again when they change."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def names(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.isfile(os.path.join(self.directory, name))
+                      and not name.endswith(INDEX_SUFFIX) and not name.endswith(".json"))
+
+    def path(self, name):
+        if not name or name != os.path.basename(name) or name.startswith("."):
+            raise KeyError(name)
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            raise KeyError(name)
+        return path
+
+    def get(self, name):
+        path = self.path(name)
+        etag = file_etag(os.stat(path))
+        with self.lock:
+            source = self.sources.get(name)
+            if source is None or source.etag != etag:
+                if isinstance(source, ChunkedReplaySource):
+                    source.close()
+                source = self.sources[name] = open_source(path)
+            return source
+
+
+def parse_range(header, size):
+    """(start, end) of a single ``bytes=`` range, end excluded; None when not satisfiable."""
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        start, end = max(0, size - int(match.group(2))), size
+    else:
+        start = int(match.group(1))
+        end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+    return (start, end) if start < end else None
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    library = None  # set by make_server
+    max_window = 1000
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _common_headers(self, etag, extra):
+        self.send_header("ETag", '"%s"' % etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Expose-Headers", ", ".join(["ETag", "Content-Range"] + list(extra)))
+        for key, value in extra.items():
+            self.send_header(key, str(value))
+
+    def _not_modified(self, etag):
+        if_none_match = self.headers.get("If-None-Match")
+        return if_none_match is not None and ('"%s"' % etag in if_none_match or if_none_match.strip() == "*")
+
+    def _range(self, etag, size):
+        """Requested range, None for the whole body, False if not satisfiable."""
+        header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if header is None or (if_range is not None and if_range.strip() != '"%s"' % etag):
+            return None
+        return parse_range(header, size) or False
+
+    def _accepts_gzip(self):
+        return "gzip" in self.headers.get("Accept-Encoding", "")
+
+    def _send_unsatisfiable(self, size):
+        self.send_response(416)
+        self.send_header("Content-Range", "bytes */%d" % size)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send_bytes(self, body, etag, content_type, extra):
+        byte_range = self._range(etag, len(body))
+        if byte_range is False:
+            self._send_unsatisfiable(len(body))
+            return
+        compress = byte_range is None and self._accepts_gzip() and len(body) >= MIN_GZIP_SIZE
+        if compress:
+            etag += "-gzip"  # the compressed body is another representation
+        if self._not_modified(etag):
+            self.send_response(304)
+            self._common_headers(etag, extra)
+            self.end_headers()
+            return
+        self.send_response(206 if byte_range else 200)
+        if byte_range:
+            start, end = byte_range
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, len(body)))
+            body = body[start:end]
+        elif compress:
+            body = gzip.compress(body, 6)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self._common_headers(etag, extra)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_file(self, path, etag):
+        size = os.path.getsize(path)
+        byte_range = self._range(etag, size)
+        if byte_range is False:
+            self._send_unsatisfiable(size)
+            return
+        start, end = byte_range or (0, size)
+        compress = byte_range is None and self._accepts_gzip() and size >= MIN_GZIP_SIZE
+        if compress:
+            etag += "-gzip"
+        if self._not_modified(etag):
+            self.send_response(304)
+            self._common_headers(etag, {})
+            self.end_headers()
+            return
+        self.send_response(206 if byte_range else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        if byte_range:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+        if compress:
+            # streamed, the compressed size is not known in advance
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Content-Length", str(end - start))
+        self._common_headers(etag, {})
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = f.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                if compressor:
+                    self._write_chunk(compressor.compress(block))
+                else:
+                    self.wfile.write(block)
+        if compressor:
+            self._write_chunk(compressor.flush())
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        try:
+            if parts == ["replays"]:
+                self._send_json(200, [{"name": name, "size": os.path.getsize(self.library.path(name))}
+                                      for name in self.library.names()])
+            elif len(parts) == 3 and parts[0] == "replay" and parts[2] == "index":
+                source = self.library.get(parts[1])
+                self._send_json(200, {"format": source.format, "frames": source.frames, "maxWindow": self.max_window})
+            elif len(parts) == 2 and parts[0] == "replay":
+                query = parse_qs(url.query)
+                if "from" not in query and "to" not in query:
+                    path = self.library.path(parts[1])
+                    self._send_file(path, file_etag(os.stat(path)))
+                    return
+                source = self.library.get(parts[1])
+                start = max(0, int(query.get("from", ["0"])[0]))
+                stop = min(int(query.get("to", [str(source.frames)])[0]), source.frames, start + self.max_window)
+                if start >= stop:
+                    self._send_json(416, {"error": "empty window", "frames": source.frames})
+                    return
+                extra = {"X-Replay-From": start, "X-Replay-To": stop, "X-Replay-Frames": source.frames}
+                self._send_bytes(source.window(start, stop), "%s-%d-%d" % (source.etag, start, stop),
+                                 "text/plain; charset=utf-8", extra)
+            else:
+                self._send_json(404, {"error": "not found"})
+        except KeyError:
+            self._send_json(404, {"error": "no such replay"})
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def make_server(directory, host="127.0.0.1", port=8766, max_window=1000):
+    handler = type("Handler", (ReplayHandler,), {"library": ReplayLibrary(directory), "max_window": max_window})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    args = parse_args()
+    if args.index:
+        library = ReplayLibrary(args.directory)
+        for name in library.names():
+            try:
+                source = library.get(name)
+            except ValueError as e:
+                print("%s: %s" % (name, e))
+                continue
+            print("%s: %s, %d frames" % (name, source.format, source.frames))
+        return
+    server = make_server(args.directory, args.host, args.port, args.maxWindow)
+    print("serving %s on http://%s:%d/replays" % (args.directory, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+预先计算 Traffic Flow 图层的路网几何
+从 CityFlow 路网 JSON 生成道路面、车道线、中心线、路口面、信号灯位置和停车线，
+前端打开图层时只需加载这一个小文件，不再下载原始路网和逐条计算。
+
+车道线、中心线、停车线和信号灯都在道路面的左右边线之间：对每个基准点，右边线 = 左边线 + 垂直方向 x 路宽，
+宽度 w 处的车道线 = 左边线 + (右边线 - 左边线) x w / 路宽。因此文件只保存道路的左右边线、车道宽度和标志，
+其余图层由前端 (web/js/roadnet-geometry.js) 按比例插值得到，结果与逐条计算相同 (量化误差内)。
+坐标量化为 1e-6 度 (约 10 厘米)，左边线和路口轮廓按所有要素连续差分编码，右边线保存为相对左边线的偏移。
+
+几何与前端的坐标变换有关，默认为 traffic-flow.js 的变换；cityflow-replay.html 使用另一组参数：
+    python build_roadnet_geometry.py                       # traffic-flow.js
+    python build_roadnet_geometry.py --center=-73.9712,40.7831 --rotation 0 --output replay_geometry.json
+"""
+
+import argparse
+import json
+import math
+import os
+
+# 与 web/js/traffic-flow.js 中的 config 保持一致
+MAP_CENTER = [-74.0184, 40.7013]
+COORD_SCALE = {"lng": 1 / 85000, "lat": 1 / 111111}
+ROTATION_DEGREES = -0.84
+
+COORD_FACTOR = 1000000
+FORMAT_VERSION = 2
+
+# 道路标志位
+FLAG_CENTER_LINE = 1  # 有反向道路，左边线画中心线
+FLAG_STOP_LINE = 2    # 终点为真实路口，有停车线和信号灯
+FLAG_STOP_REVERSED = 4  # 路口宽度超过最后一段长度，内缩后方向相反，停车线画在左边线的另一侧 (与逐条计算相同)
+
+
+class Transform:
+    """CityFlow 局部坐标（米）到 WGS84 经纬度的变换，与前端 convertCoords 相同"""
+
+    def __init__(self, center=MAP_CENTER, scale=COORD_SCALE, rotation=ROTATION_DEGREES):
+        self.center = list(center)
+        self.scale = dict(scale)
+        self.rotation = rotation
+
+    def convert(self, point):
+        rot = math.radians(self.rotation)
+        x, y = point
+        x_rot = x * math.cos(rot) - y * math.sin(rot)
+        y_rot = x * math.sin(rot) + y * math.cos(rot)
+        return [self.center[0] + x_rot * self.scale["lng"], self.center[1] + y_rot * self.scale["lat"]]
+
+    def move_point_toward(self, from_point, to_point, distance_meters):
+        """沿方向移动指定距离（米），与 movePointToward 相同"""
+        dx = to_point[0] - from_point[0]
+        dy = to_point[1] - from_point[1]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            return from_point
+        avg_scale = (self.scale["lng"] + self.scale["lat"]) / 2
+        scale = distance_meters * avg_scale / length
+        return [from_point[0] + dx * scale, from_point[1] + dy * scale]
+
+    def offset_point(self, point, perp_dir, meters):
+        return [point[0] + perp_dir[0] * meters * self.scale["lng"],
+                point[1] + perp_dir[1] * meters * self.scale["lat"]]
+
+    def to_json(self):
+        return {"center": self.center, "scale": self.scale, "rotation": self.rotation}
+
+
+def get_perpendicular(from_point, to_point):
+    """垂直方向单位向量（经纬度空间），与 getPerpendicular 相同"""
+    dx = to_point[0] - from_point[0]
+    dy = to_point[1] - from_point[1]
+    length = math.hypot(dx, dy)
+    if length == 0:
+        return [0, 0]
+    return [dy / length, -dx / length]
+
+
+def quantize(point):
+    return round(point[0] * COORD_FACTOR), round(point[1] * COORD_FACTOR)
+
+
+class DeltaEncoder:
+    """
+    把多条折线量化后编码为一个扁平整数数组 [dx, dy, ...]，每个点都是与上一个点 (包括上一条折线的末点) 的差值，
+    counts 为每条折线的点数，由前端 decodePolylines 解码
+    """
+
+    def __init__(self):
+        self.counts = []
+        self.coords = []
+        self.prev = (0, 0)
+
+    def add(self, coords):
+        self.counts.append(len(coords))
+        for c in coords:
+            x, y = quantize(c)
+            self.coords += [x - self.prev[0], y - self.prev[1]]
+            self.prev = (x, y)
+
+
+def edge_base_line(edge, nodes, transform):
+    """
+    道路基准线上每个点的位置和垂直方向
+    首尾点向路口内缩路口宽度，与 renderRoadnet 中的处理相同
+    """
+    points = edge["points"]
+    from_node, to_node = nodes[edge["from"]], nodes[edge["to"]]
+    base = []
+    for i, point in enumerate(points):
+        last = len(points) - 1
+        if i == 0 and not from_node["virtual"] and from_node.get("width"):
+            point = transform.move_point_toward(points[0], points[1], from_node["width"])
+            perp_dir = get_perpendicular(points[0], points[1])
+        elif i == last and not to_node["virtual"] and to_node.get("width"):
+            point = transform.move_point_toward(points[i], points[i - 1], to_node["width"])
+            perp_dir = get_perpendicular(points[i - 1], points[i])
+        elif i == 0:
+            perp_dir = get_perpendicular(points[0], points[1])
+        elif i == last:
+            perp_dir = get_perpendicular(points[i - 1], points[i])
+        else:
+            perp_dir = get_perpendicular(points[i - 1], points[i + 1])
+        base.append((point, perp_dir))
+    return base
+
+
+def stop_line_flags(edge, nodes, base):
+    """
+    终点为真实路口且最后一段长度不为零时有停车线和信号灯 (与 initializeTrafficLightLayer 相同)，
+    停车线从左边线末点到右边线末点，信号灯在各车道中心
+    """
+    points = edge["points"]
+    if nodes[edge["to"]]["virtual"] or len(points) < 2:
+        return 0
+    endpoint, prev_point = base[-1][0], points[-2]
+    dx, dy = endpoint[0] - prev_point[0], endpoint[1] - prev_point[1]
+    if math.hypot(dx, dy) == 0:
+        return 0
+    # initializeTrafficLightLayer 按内缩后的终点计算垂直方向
+    if dx * (points[-1][0] - prev_point[0]) + dy * (points[-1][1] - prev_point[1]) < 0:
+        return FLAG_STOP_LINE | FLAG_STOP_REVERSED
+    return FLAG_STOP_LINE
+
+
+def build_geometry(roadnet, transform=None):
+    """生成道路和路口的紧凑几何"""
+    transform = transform or Transform()
+    roadnet = roadnet.get("static", roadnet)
+
+    nodes = {}
+    for node in roadnet["nodes"]:
+        nodes[node["id"]] = {**node, "point": transform.convert(node["point"])}
+    edges = [{**edge, "points": [transform.convert(p) for p in edge["points"]]} for edge in roadnet["edges"]]
+
+    # 反向道路查找，代替前端的逐条遍历
+    directions = {(edge["from"], edge["to"]) for edge in edges}
+
+    road_ids, lanes, lane_widths, flags, offsets = [], [], [], [], []
+    left_lines = DeltaEncoder()
+    min_x = min_y = math.inf
+    max_x = max_y = -math.inf
+
+    for edge in edges:
+        road_width = sum(edge["laneWidths"])
+        base = edge_base_line(edge, nodes, transform)
+        left = [point for point, _ in base]
+        right = [transform.offset_point(point, perp_dir, road_width) for point, perp_dir in base]
+        for c in left + right:
+            min_x, min_y, max_x, max_y = min(min_x, c[0]), min(min_y, c[1]), max(max_x, c[0]), max(max_y, c[1])
+
+        road_ids.append(edge["id"])
+        left_lines.add(left)
+        for left_point, right_point in zip(left, right):
+            (lx, ly), (rx, ry) = quantize(left_point), quantize(right_point)
+            offsets += [rx - lx, ry - ly]
+        lanes.append(edge["nLane"])
+        lane_widths += edge["laneWidths"][:edge["nLane"]]
+        flags.append((FLAG_CENTER_LINE if (edge["to"], edge["from"]) in directions else 0) |
+                     stop_line_flags(edge, nodes, base))
+
+    intersection_ids = []
+    outlines = DeltaEncoder()
+    for node_id, node in nodes.items():
+        outline = node.get("outline")
+        if node["virtual"] or not outline:
+            continue
+        coords = [transform.convert([outline[i], outline[i + 1]]) for i in range(0, len(outline) - 1, 2)]
+        # 前端闭合多边形
+        if len(coords) > 1 and coords[0] == coords[-1]:
+            coords.pop()
+        intersection_ids.append(node_id)
+        outlines.add(coords)
+
+    return {
+        "version": FORMAT_VERSION,
+        "coordFactor": COORD_FACTOR,
+        "transform": transform.to_json(),
+        "bounds": [min_x, min_y, max_x, max_y] if road_ids else None,
+        "roads": {
+            # 与回放文件中的道路 id 相同，信号灯按车道顺序对应回放文件中的车道状态
+            "ids": road_ids,
+            "counts": left_lines.counts,
+            "left": left_lines.coords,
+            "offsets": offsets,
+            "lanes": lanes,
+            "laneWidths": [int(w) if float(w).is_integer() else w for w in lane_widths],
+            "flags": flags
+        },
+        "intersections": {
+            "ids": intersection_ids,
+            "counts": outlines.counts,
+            "coords": outlines.coords
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="预先计算 Traffic Flow 图层的路网几何")
+    parser.add_argument("--roadnet", default="../web/data/roadnet_manhattan.json", help="路网 JSON（replay roadnet 格式）")
+    parser.add_argument("--output", default="../web/data/roadnet_manhattan_geometry.json", help="输出文件")
+    parser.add_argument("--center", default=",".join(map(str, MAP_CENTER)),
+                        help="变换中心 lng,lat (负数开头时写成 --center=...)，与前端的 MAP_CENTER 相同")
+    parser.add_argument("--rotation", type=float, default=ROTATION_DEGREES, help="旋转角度，与前端的 ROTATION_DEGREES 相同")
+    args = parser.parse_args()
+
+    print("🛣️ 预先计算路网几何")
+    with open(args.roadnet, "r", encoding="utf-8") as f:
+        roadnet = json.load(f)
+
+    transform = Transform(center=[float(v) for v in args.center.split(",")], rotation=args.rotation)
+    geometry = build_geometry(roadnet, transform)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(geometry, f, separators=(",", ":"))
+
+    print(f"💾 已保存几何文件: {args.output} ({os.path.getsize(args.output) / 1024 / 1024:.2f} MB, "
+          f"原路网 {os.path.getsize(args.roadnet) / 1024 / 1024:.2f} MB)")
+    print(f"\n📊 统计信息:")
+    roads = geometry["roads"]
+    print(f"   道路: {len(roads['ids']):,}")
+    print(f"   车道线: {sum(lanes - 1 for lanes in roads['lanes']):,}")
+    print(f"   中心线: {sum(1 for flags in roads['flags'] if flags & FLAG_CENTER_LINE):,}")
+    print(f"   路口: {len(geometry['intersections']['ids']):,}")
+    print(f"   停车线 / 信号灯道路: {sum(1 for flags in roads['flags'] if flags & FLAG_STOP_LINE):,}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+图像服务器的两级缓存
+- 内存 LRU：按总字节数淘汰最久未使用的图像
+- 磁盘缓存 (cache/images/)：按总字节数淘汰最久未访问的文件，先写临时文件再原子替换，进程中断不会留下半个文件
+两级都按 TTL 过期。缓存键把经纬度对齐到网格标记点的间距 (15 米)，附近的点击共用同一张图像
+MetadataCache 按同样的网格缓存街景搜索结果
+"""
+
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, Dict, Any
+
+# 与 create_grid_markers.py 的默认网格间距一致
+GRID_SPACING_M = 15
+METERS_PER_DEGREE = 111320
+
+CONTENT_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.webp': 'image/webp', '.avif': 'image/avif'}
+EXTENSIONS = {content_type: ext for ext, content_type in CONTENT_TYPES.items()}
+
+# satellite_40.758900_-73.985100.png / streetview_40.758900_-73.985100_1024.jpg
+FILE_PATTERN = re.compile(r'^(?P<kind>[a-z]+)_(?P<lat>-?\d+\.\d+)_(?P<lon>-?\d+\.\d+)(?:_(?P<quality>\w+))?(?P<ext>\.\w+)$')
+
+
+def snap_to_grid(lat: float, lon: float, spacing: float = GRID_SPACING_M) -> Tuple[float, float]:
+    """经纬度对齐到 spacing 米的网格 (经度间距按纬度换算)"""
+    lat_step = spacing / METERS_PER_DEGREE
+    snapped_lat = round(lat / lat_step) * lat_step
+    lon_step = spacing / (METERS_PER_DEGREE * math.cos(math.radians(snapped_lat)))
+    snapped_lon = round(lon / lon_step) * lon_step
+    return round(snapped_lat, 6), round(snapped_lon, 6)
+
+
+def cache_key(kind: str, lat: float, lon: float, quality: Optional[str] = None, spacing: float = GRID_SPACING_M) -> str:
+    """缓存键，与 cache/images/ 中已有的文件名格式相同"""
+    lat, lon = snap_to_grid(lat, lon, spacing)
+    key = f"{kind}_{lat:.6f}_{lon:.6f}"
+    return f"{key}_{quality}" if quality else key
+
+
+class MemoryLRU:
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (data, content_type, 写入时间)
+        self.size = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[2] > self.ttl:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    def put(self, key: str, data: bytes, content_type: str, created: float):
+        if len(data) > self.max_bytes:
+            return
+        self.remove(key)
+        self.entries[key] = (data, content_type, created)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (old, _, _) = self.entries.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int, ttl: float, spacing: float = GRID_SPACING_M):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spacing = spacing
+        self.entries = OrderedDict()  # key -> (文件名, 大小, 写入时间)，按最近访问排序
+        self.size = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        """
+        建立索引，未对齐网格的旧文件 (如 download_* 保存的图像) 保留原文件名，按对齐后的键索引
+        """
+        files = {}
+        for name in os.listdir(self.directory):
+            match = FILE_PATTERN.match(name)
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp'):
+                os.remove(path)  # 上次中断留下的临时文件
+                continue
+            if not match or match['ext'] not in CONTENT_TYPES:
+                continue
+            key = cache_key(match['kind'], float(match['lat']), float(match['lon']), match['quality'], self.spacing)
+            stat = os.stat(path)
+            # 对齐后的文件名优先于落在同一网格的旧文件
+            legacy = key + match['ext'] != name
+            if key not in files or files[key][0] and not legacy:
+                files[key] = (legacy, stat.st_atime, name, stat.st_size, stat.st_mtime)
+        for key, (_, _, name, size, mtime) in sorted(files.items(), key=lambda item: item[1][1]):
+            self.entries[key] = (name, size, mtime)
+            self.size += size
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self.remove(key)
+            self.evictions += 1
+
+    def lookup(self, key: str):
+        """索引中的 (文件路径, Content-Type, 写入时间)，过期或不存在返回 None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        name, _, created = entry
+        if time.time() - created > self.ttl:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return os.path.join(self.directory, name), CONTENT_TYPES[os.path.splitext(name)[1]], created
+
+    def write(self, key: str, data: bytes, content_type: str) -> str:
+        """原子写入：同目录临时文件写完后 os.replace，返回文件名 (不更新索引，可在锁外调用)"""
+        name = key + EXTENSIONS.get(content_type, '.jpg')
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return name
+
+    def add(self, key: str, name: str, size: int, created: float):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+            if old[0] != name:
+                self._remove_file(old[0])
+        self.entries[key] = (name, size, created)
+        self.size += size
+        self._evict()
+
+    def _remove_file(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+            self._remove_file(entry[0])
+
+
+class ImageCache:
+    """
+    两级图像缓存，线程安全
+    get 依次查询内存和磁盘，磁盘命中的图像放回内存；put 同时写入两级
+    directory 为 None 时只有内存一级 (磁盘由打包存储代替)
+    """
+
+    def __init__(self, directory: Optional[str], memory_bytes: int = 64 << 20, disk_bytes: int = 1 << 30,
+                 ttl: float = 30 * 86400, spacing: float = GRID_SPACING_M):
+        self.spacing = spacing
+        self.memory = MemoryLRU(memory_bytes, ttl)
+        self.disk = DiskCache(directory, disk_bytes, ttl, spacing) if directory else None
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, kind: str, lat: float, lon: float, quality: Optional[str] = None) -> str:
+        return cache_key(kind, lat, lon, quality, self.spacing)
+
+    def snap(self, lat: float, lon: float) -> Tuple[float, float]:
+        return snap_to_grid(lat, lon, self.spacing)
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return key in self.memory.entries or self.disk is not None and key in self.disk.entries
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str, str]]:
+        """
+        Returns:
+            tuple: (图像内容, Content-Type, 命中层 'memory' 或 'disk')，未命中返回 None
+        """
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory_hits += 1
+                return entry[0], entry[1], 'memory'
+            location = self.disk.lookup(key) if self.disk else None
+            if location is None:
+                self.misses += 1
+                return None
+        # 文件在锁外读取，读取时被淘汰删除的按未命中处理
+        path, content_type, created = location
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.disk_hits += 1
+            self.memory.put(key, data, content_type, created)
+        return data, content_type, 'disk'
+
+    def put(self, key: str, data: bytes, content_type: str, disk: bool = True):
+        """disk=False 只放入内存 (如已在打包存储中的图像)"""
+        created = time.time()
+        name = None
+        try:
+            if disk and self.disk:
+                name = self.disk.write(key, data, content_type)
+        except OSError as e:
+            print(f"⚠️  写入磁盘缓存失败: {e}")
+        with self.lock:
+            if name is not None:
+                self.disk.add(key, name, len(data), created)
+            self.memory.put(key, data, content_type, created)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            stats = {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                'memory': {'entries': len(self.memory.entries), 'bytes': self.memory.size,
+                           'max_bytes': self.memory.max_bytes, 'evictions': self.memory.evictions}
+            }
+            if self.disk:
+                stats['disk'] = {'entries': len(self.disk.entries), 'bytes': self.disk.size,
+                                 'max_bytes': self.disk.max_bytes, 'evictions': self.disk.evictions}
+            return stats
+
+
+class MetadataCache:
+    """
+    街景搜索结果缓存 (按网格对齐后的位置)，线程安全
+    /api/images 查询到的街景信息供随后的 /api/streetview 直接使用；附近没有街景 (None) 也缓存，
+    请求失败不缓存。Mapillary 的缩略图 URL 带签名会过期，TTL 应较短
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (搜索结果, 写入时间)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """
+        Returns:
+            tuple: (是否命中, 搜索结果)，命中时结果可能为 None (附近没有街景)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put(self, key: str, value: Optional[Dict[str, Any]]):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time())
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'entries': len(self.entries)
+            }
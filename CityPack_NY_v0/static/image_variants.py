@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+图像转码与多分辨率版本
+上游的 512x512 PNG 卫星图和 1024/2048 街景 JPEG 原样发给浏览器后，弹窗再缩小显示，大部分字节被浪费。
+这里在进程池中把缓存的图像转码为 WebP (可选 AVIF) 的多个尺寸：
+- thumb: 最长边 256 像素
+- panel: 最长边 512 像素 (图像弹窗)
+- full:  原尺寸
+服务器按 size 参数返回对应的版本，转码结果与原图保存在同一缓存/打包存储中，键为 <原图键>_<尺寸>_<格式>
+(如 streetview_40.758848_-73.985028_1024_panel_webp)
+
+Usage:
+    python image_variants.py build cache/packed                 # 为打包存储中已有的图像生成所有版本
+    python image_variants.py bench cache/packed --limit 100     # 对比原图与各版本的字节数
+"""
+
+import argparse
+import io
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any
+
+# 最长边像素，None 为原尺寸；按从大到小的顺序依次缩放
+VARIANT_SIZES = {'full': None, 'panel': 512, 'thumb': 256}
+FORMATS = {'webp': 'image/webp', 'avif': 'image/avif'}
+ENCODE_OPTIONS = {'webp': {'quality': 75, 'method': 4}, 'avif': {'quality': 55, 'speed': 8}}
+
+VARIANT_PATTERN = re.compile(r'_(?:' + '|'.join(VARIANT_SIZES) + ')_(?:' + '|'.join(FORMATS) + ')$')
+
+
+def variant_key(key: str, size: str, image_format: str) -> str:
+    return f"{key}_{size}_{image_format}"
+
+
+def is_variant(key: str) -> bool:
+    return VARIANT_PATTERN.search(key) is not None
+
+
+def supported_formats():
+    """当前 Pillow 能编码的格式"""
+    from PIL import features
+    return [image_format for image_format in FORMATS if features.check(image_format)]
+
+
+def transcode(data: bytes, image_format: str, sizes: Dict[str, Optional[int]] = VARIANT_SIZES) -> Dict[str, bytes]:
+    """
+    在工作进程中运行：解码一次，从大到小依次缩放并编码
+    图像小于某个尺寸时不放大，该尺寸与上一个尺寸使用同一份编码结果
+
+    Returns:
+        dict: 尺寸名 -> 编码后的图像
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as source:
+        image = source.convert('RGB')
+    results = {}
+    encoded = None
+    for size, max_side in sizes.items():
+        if encoded is None or max_side and max(image.size) > max_side:
+            if max_side and max(image.size) > max_side:
+                image.thumbnail((max_side, max_side), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, image_format.upper(), **ENCODE_OPTIONS[image_format])
+            encoded = buffer.getvalue()
+        results[size] = encoded
+    return results
+
+
+class Transcoder:
+    """
+    进程池转码，线程安全
+    transcode 等待转码结果；schedule 在后台线程中运行转码任务 (新缓存的图像提前生成所有版本)，
+    后台线程只负责等待进程池，同时运行的任务数不超过 workers
+    """
+
+    def __init__(self, workers: Optional[int] = None, formats=('webp',)):
+        unsupported = set(formats) - set(supported_formats())
+        if unsupported:
+            raise ValueError(f"Pillow 不支持编码: {', '.join(sorted(unsupported))}")
+        self.formats = list(formats)
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = self._new_pool()
+        self.background = ThreadPoolExecutor(self.workers, thread_name_prefix='transcode')
+        self.lock = threading.Lock()
+        self.transcoded = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = {size: 0 for size in VARIANT_SIZES}
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # 服务器是多线程进程，fork 出的工作进程可能继承其他线程持有的锁，使用 spawn
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def transcode(self, data: bytes, image_format: str) -> Dict[str, bytes]:
+        """无法解码的图像抛出异常 (PIL.UnidentifiedImageError 等)"""
+        start = time.time()
+        executor = self.executor
+        try:
+            variants = executor.submit(transcode, data, image_format).result()
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+                if isinstance(e, BrokenProcessPool) and self.executor is executor:
+                    # 工作进程异常退出 (如解码时内存不足) 后进程池不再可用，换一个新的
+                    self.executor = self._new_pool()
+            raise
+        with self.lock:
+            self.transcoded += 1
+            self.seconds += time.time() - start
+            self.bytes_in += len(data)
+            for size, content in variants.items():
+                self.bytes_out[size] += len(content)
+        return variants
+
+    def schedule(self, fn, *args):
+        self.background.submit(fn, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'formats': self.formats,
+                'workers': self.workers,
+                'transcoded': self.transcoded,
+                'failed': self.failed,
+                'mean_ms': round(self.seconds / self.transcoded * 1000, 1) if self.transcoded else 0.0,
+                # 各尺寸相对原图的字节比例
+                'ratio': {size: round(size_bytes / self.bytes_in, 4) if self.bytes_in else 0.0
+                          for size, size_bytes in self.bytes_out.items()}
+            }
+
+    def close(self):
+        self.background.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
+
+
+def original_keys(store):
+    """打包存储中的原图键 (跳过瓦片和已转码的版本)"""
+    for key in store.keys():
+        if key.startswith(('satellite_', 'streetview_')) and not is_variant(key):
+            yield key
+
+
+def build(store, transcoder: Transcoder, limit: int = 0) -> Dict[str, int]:
+    """为打包存储中的原图生成缺少的版本"""
+    counts = {'transcoded': 0, 'skipped': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def build_one(key: str, image_format: str):
+        entry = store.get(key)
+        if entry is None:
+            return
+        try:
+            variants = transcoder.transcode(entry[0], image_format)
+        except Exception as e:
+            print(f"❌ {key}: {e}")
+            name = 'failed'
+        else:
+            for size, content in variants.items():
+                store.put(variant_key(key, size, image_format), content, FORMATS[image_format])
+            name = 'transcoded'
+        with lock:
+            counts[name] += 1
+
+    with ThreadPoolExecutor(transcoder.workers) as executor:
+        jobs = []
+        for index, key in enumerate(original_keys(store)):
+            if limit and index >= limit:
+                break
+            for image_format in transcoder.formats:
+                if all(variant_key(key, size, image_format) in store for size in VARIANT_SIZES):
+                    counts['skipped'] += 1
+                    continue
+                jobs.append(executor.submit(build_one, key, image_format))
+        for job in jobs:
+            job.result()
+    return counts
+
+
+def bench(store, formats, limit: int = 100) -> Dict[str, Dict[str, Any]]:
+    """
+    在当前进程中转码存储中的前 limit 张原图，按图像类型统计各版本的总字节数和编码耗时
+
+    Returns:
+        dict: 类型 -> {'count', 'original', '<尺寸>_<格式>': 字节数, '<格式>_ms': 平均耗时}
+    """
+    results = {}
+    for index, key in enumerate(original_keys(store)):
+        if index >= limit:
+            break
+        data, _ = store.get(key)
+        kind = key.split('_', 1)[0]
+        result = results.setdefault(kind, {'count': 0, 'original': 0})
+        for image_format in formats:
+            start = time.time()
+            try:
+                variants = transcode(data, image_format)
+            except Exception as e:
+                print(f"⚠️  {key}: {e}")
+                break
+            result[f'{image_format}_ms'] = result.get(f'{image_format}_ms', 0.0) + (time.time() - start) * 1000
+            for size, content in variants.items():
+                name = f'{size}_{image_format}'
+                result[name] = result.get(name, 0) + len(content)
+        else:
+            result['count'] += 1
+            result['original'] += len(data)
+    for result in results.values():
+        for image_format in formats:
+            if result['count'] and f'{image_format}_ms' in result:
+                result[f'{image_format}_ms'] = round(result[f'{image_format}_ms'] / result['count'], 1)
+    return results
+
+
+def main():
+    from packed_store import PackedStore
+
+    parser = argparse.ArgumentParser(description='图像转码为多尺寸 WebP/AVIF')
+    parser.add_argument('command', choices=['build', 'bench'])
+    parser.add_argument('store', help='打包存储目录')
+    parser.add_argument('--formats', default='webp', help='逗号分隔的格式 (webp, avif)')
+    parser.add_argument('--workers', type=int, default=None, help='转码进程数 (默认 CPU 核数)')
+    parser.add_argument('--limit', type=int, default=0, help='只处理前 N 张原图 (bench 默认 100)')
+    args = parser.parse_args()
+    formats = [image_format.strip() for image_format in args.formats.split(',') if image_format.strip()]
+
+    if args.command == 'bench':
+        with PackedStore(args.store, readonly=True) as store:
+            results = bench(store, formats, args.limit or 100)
+        for kind, result in results.items():
+            if not result['count']:
+                continue
+            print(f"📊 {kind}: {result['count']} 张, 原图平均 {result['original'] / result['count'] / 1024:.1f}KB")
+            for name in (f'{size}_{image_format}' for image_format in formats for size in VARIANT_SIZES):
+                print(f"   {name:<12} {result[name] / result['count'] / 1024:8.1f}KB "
+                      f"({result['original'] / result[name]:.1f}x)")
+            for image_format in formats:
+                print(f"   {image_format} 平均编码 {result[f'{image_format}_ms']}ms")
+        return
+
+    transcoder = Transcoder(args.workers, formats)
+    try:
+        with PackedStore(args.store) as store:
+            start = time.time()
+            counts = build(store, transcoder, args.limit)
+    finally:
+        transcoder.close()
+    print(f"✅ 转码 {counts['transcoded']:,} 张, 已有跳过 {counts['skipped']:,} 张, 失败 {counts['failed']:,} 张, "
+          f"{time.time() - start:.1f}s ({transcoder.stats()['ratio']})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+图像服务器压测
+默认在本进程内启动模拟上游 (mock_upstream.py) 和图像服务器，用 --clients 个并发客户端
+在曼哈顿范围内的随机坐标上请求图像，统计吞吐量、延迟分位数 (p50/p90/p99) 和缓存命中率
+(按响应的 X-Cache 统计，--target 压测已运行的服务器时同样有效)；--hot-points 从固定的一组坐标中抽取请求以测量缓存，
+--json 把结果写入文件，便于在 CI 中对比缓存和并发的改动
+
+Usage:
+    python load_test_image_server.py --clients 50 --requests 500
+    python load_test_image_server.py --cache --hot-points 100 --requests 2000 --json result.json
+    python load_test_image_server.py --photo --size panel --endpoint mixed --cache --hot-points 50   # 含转码
+    python load_test_image_server.py --clients 50 --requests 100 --single-threaded   # 对比单线程服务器
+    python load_test_image_server.py --target http://localhost:8081 --endpoint streetview
+    python load_test_image_server.py --satellite-mode tiles --bbox=-73.9870,40.7580,-73.9840,40.7600   # 密集网格上的瓦片命中率
+"""
+
+import argparse
+import json
+import math
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+import requests
+
+import mock_upstream
+import simple_image_server
+from image_cache import ImageCache
+from satellite_streetview_api import SatelliteStreetViewAPI
+
+# 与 manifest.yaml 中的 extent 一致
+MANHATTAN_EXTENT = (-74.0479, 40.6829, -73.9067, 40.8820)
+ENDPOINTS = ['satellite', 'streetview', 'images']
+# X-Cache 中表示命中缓存的值 (miss / coalesced / transcoded 为未命中)
+CACHE_HITS = ('memory', 'disk', 'store')
+
+
+def random_points(count, seed=0, extent=MANHATTAN_EXTENT):
+    rng = random.Random(seed)
+    min_lon, min_lat, max_lon, max_lat = extent
+    return [(rng.uniform(min_lat, max_lat), rng.uniform(min_lon, max_lon)) for _ in range(count)]
+
+
+def percentile(values, q):
+    """最近秩法的分位数，q 为 0-100"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def run_load(base_url, clients, total_requests, endpoint='satellite', seed=0, timeout=60, extent=MANHATTAN_EXTENT,
+             hot_points=0, size=None):
+    """
+    clients 个线程各用一个 keep-alive Session，共发出 total_requests 个请求
+    hot_points 大于 0 时请求的坐标从 hot_points 个固定坐标中随机抽取 (重复访问，测量缓存)；
+    size 为 thumb / panel / full 时请求转码后的版本
+
+    Returns:
+        dict: 请求数、错误数、耗时、吞吐量、延迟分位数和按 X-Cache 统计的缓存命中率
+    """
+    rng = random.Random(seed)
+    if hot_points:
+        pool = random_points(hot_points, seed, extent)
+        points = [rng.choice(pool) for _ in range(total_requests)]
+    else:
+        points = random_points(total_requests, seed, extent)
+    paths = [rng.choice(ENDPOINTS) if endpoint == 'mixed' else endpoint for _ in range(total_requests)]
+    latencies = []
+    errors = []
+    cache_statuses = {}
+    received = [0]
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(clients + 1)
+
+    def client(indices):
+        session = requests.Session()
+        start_barrier.wait()
+        for i in indices:
+            lat, lon = points[i]
+            params = {'lat': lat, 'lon': lon}
+            if size and paths[i] != 'images':
+                params['size'] = size
+            cache_status = None
+            body_bytes = 0
+            begin = time.perf_counter()
+            try:
+                response = session.get(f'{base_url}/api/{paths[i]}', params=params, timeout=timeout)
+                ok = response.status_code == 200
+                status = response.status_code
+                cache_status = response.headers.get('X-Cache')
+                body_bytes = len(response.content)
+            except requests.RequestException as e:
+                ok, status = False, type(e).__name__
+            elapsed = time.perf_counter() - begin
+            with lock:
+                latencies.append(elapsed)
+                received[0] += body_bytes
+                if not ok:
+                    errors.append(status)
+                elif cache_status:
+                    cache_statuses[cache_status] = cache_statuses.get(cache_status, 0) + 1
+        session.close()
+
+    threads = [threading.Thread(target=client, args=(range(c, total_requests, clients),)) for c in range(clients)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+
+    cached = sum(cache_statuses.get(status, 0) for status in CACHE_HITS)
+    image_responses = sum(cache_statuses.values())
+    return {
+        'requests': total_requests,
+        'errors': len(errors),
+        'error_statuses': sorted(set(map(str, errors))),
+        'elapsed_s': elapsed,
+        'throughput_rps': total_requests / elapsed if elapsed > 0 else 0.0,
+        'latency_mean_s': statistics.mean(latencies) if latencies else 0.0,
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p90_s': percentile(latencies, 90),
+        'latency_p99_s': percentile(latencies, 99),
+        'latency_max_s': max(latencies) if latencies else 0.0,
+        'received_bytes': received[0],
+        'cache_statuses': cache_statuses,
+        'cache_hit_rate': cached / image_responses if image_responses else 0.0
+    }
+
+
+def start_local(latency, failure_rate, pool_size, threaded, cache_dir=None, satellite_mode='export', tile_zoom=18,
+                transcode=False, **upstream_options):
+    """
+    启动模拟上游和图像服务器 (随机端口，cache_dir 不为空时启用缓存，satellite_mode 为 tiles 时用内存中的瓦片合成卫星图，
+    transcode=True 时启用 WebP 转码)；upstream_options 传给 MockUpstream (jitter、image_size、thumb_bytes、photo)
+
+    Returns:
+        tuple: (图像服务器地址, 上游, 服务器列表)
+    """
+    upstream = mock_upstream.MockUpstream(latency=latency, failure_rate=failure_rate, **upstream_options)
+    upstream_server = mock_upstream.make_server(upstream, port=0)
+    upstream_url = f'http://localhost:{upstream_server.server_address[1]}'
+
+    api = SatelliteStreetViewAPI(f'{upstream_url}/export', upstream_url, pool_size=pool_size,
+                                 esri_tile_url=f'{upstream_url}/tile/{{z}}/{{y}}/{{x}}')
+    cache = ImageCache(cache_dir) if cache_dir else None
+    tiles = None
+    if satellite_mode == 'tiles':
+        from satellite_tiles import TileCache, TileCompositor
+        tiles = TileCompositor(api, TileCache(), tile_zoom, workers=min(8, pool_size))
+    transcoder = None
+    if transcode:
+        from image_variants import Transcoder
+        transcoder = Transcoder()
+    image_server = simple_image_server.make_server(api, port=0, threaded=threaded, cache=cache, tiles=tiles,
+                                                   transcoder=transcoder)
+
+    servers = [upstream_server, image_server]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://localhost:{image_server.server_address[1]}', upstream, servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='图像服务器压测')
+    parser.add_argument('--target', default=None, help='已运行的图像服务器地址，默认在本进程内启动模拟环境')
+    parser.add_argument('--clients', type=int, default=50, help='并发客户端数')
+    parser.add_argument('--requests', type=int, default=500, help='总请求数')
+    parser.add_argument('--endpoint', choices=ENDPOINTS + ['mixed'], default='satellite')
+    parser.add_argument('--latency', type=float, default=0.2, help='模拟上游延迟(秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='模拟上游延迟的随机抖动(秒)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='模拟上游返回 503 的比例')
+    parser.add_argument('--image-size', type=int, default=256, help='模拟上游卫星图边长(像素)')
+    parser.add_argument('--thumb-bytes', type=int, default=150000, help='模拟上游缩略图占位数据的字节数')
+    parser.add_argument('--photo', action='store_true', help='模拟上游返回可以解码的带纹理图像')
+    parser.add_argument('--pool-size', type=int, default=16, help='每个上游主机的最大连接数')
+    parser.add_argument('--single-threaded', action='store_true', help='使用单线程服务器对比')
+    parser.add_argument('--cache', action='store_true', help='启用缓存 (临时目录)')
+    parser.add_argument('--satellite-mode', choices=['export', 'tiles'], default='export', help='卫星图获取方式')
+    parser.add_argument('--tile-zoom', type=int, default=18, help='瓦片缩放级别')
+    parser.add_argument('--bbox', default=None, help='min_lon,min_lat,max_lon,max_lat 请求坐标的范围 (默认整个曼哈顿)')
+    parser.add_argument('--hot-points', type=int, default=0, help='从这么多个固定坐标中抽取请求 (0 为每个请求随机坐标)')
+    parser.add_argument('--size', choices=['thumb', 'panel', 'full'], default=None, help='请求转码后的版本')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--json', default=None, help='结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    servers = []
+    upstream = None
+    cache_dir = tempfile.mkdtemp(prefix='image_cache_') if args.cache else None
+    if args.target:
+        base_url = args.target.rstrip('/')
+    else:
+        base_url, upstream, servers = start_local(args.latency, args.failure_rate, args.pool_size,
+                                                  not args.single_threaded, cache_dir, args.satellite_mode, args.tile_zoom,
+                                                  transcode=args.size is not None, jitter=args.jitter,
+                                                  image_size=args.image_size, thumb_bytes=args.thumb_bytes,
+                                                  photo=args.photo)
+        mode = '单线程' if args.single_threaded else f'多线程, 连接池 {args.pool_size}'
+        print(f"🧪 模拟上游延迟 {args.latency}s (抖动 {args.jitter}s, 失败率 {args.failure_rate:.1%}), "
+              f"图像服务器 {base_url} ({mode})")
+
+    print(f"🚀 {args.clients} 个并发客户端, {args.requests} 个 {args.endpoint} 请求")
+    extent = tuple(map(float, args.bbox.split(','))) if args.bbox else MANHATTAN_EXTENT
+    result = run_load(base_url, args.clients, args.requests, args.endpoint, seed=args.seed, extent=extent,
+                      hot_points=args.hot_points, size=args.size)
+
+    print(f"\n📊 压测结果:")
+    print(f"   耗时: {result['elapsed_s']:.2f}s")
+    print(f"   吞吐量: {result['throughput_rps']:.1f} req/s, 接收 {result['received_bytes'] / (1 << 20):.1f}MB")
+    print(f"   延迟: p50 {result['latency_p50_s'] * 1000:.0f}ms, p90 {result['latency_p90_s'] * 1000:.0f}ms, "
+          f"p99 {result['latency_p99_s'] * 1000:.0f}ms, 平均 {result['latency_mean_s'] * 1000:.0f}ms, "
+          f"最大 {result['latency_max_s'] * 1000:.0f}ms")
+    print(f"   错误: {result['errors']} {' '.join(result['error_statuses'])}")
+    if result['cache_statuses']:
+        print(f"   缓存命中率 (X-Cache): {result['cache_hit_rate']:.1%} {result['cache_statuses']}")
+    if upstream:
+        result['upstream'] = upstream.stats()
+        print(f"   上游请求: {result['upstream']}, 上游发送 {upstream.bytes_sent / (1 << 20):.1f}MB")
+    health = requests.get(f'{base_url}/health', timeout=10).json()
+    result['health'] = health
+    if 'single_flight' in health:
+        print(f"   合并的请求: {health['single_flight']['coalesced']}")
+    if 'tiles' in health:
+        print(f"   瓦片命中率: {health['tiles']['hit_rate']:.1%} (未命中 {health['tiles']['misses']})")
+    cache_stats = health.get('cache')
+    if cache_stats:
+        print(f"   服务器缓存命中率: {cache_stats['hit_rate']:.1%} (内存 {cache_stats['memory_hits']}, 磁盘 {cache_stats['disk_hits']})")
+    if 'transcoder' in health:
+        print(f"   转码: {health['transcoder']['transcoded']} 张, 平均 {health['transcoder']['mean_ms']}ms")
+    if args.json:
+        result['config'] = {name: value for name, value in vars(args).items() if name != 'json'}
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"   结果已写入 {args.json}")
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    if cache_dir:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
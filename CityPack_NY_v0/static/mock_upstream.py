@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+本地模拟上游服务，用于压测图像服务器而不访问真实的 ESRI / Mapillary
+- GET /export?bbox=...      模拟 ESRI World Imagery 导出接口，返回 PNG
+- GET /tile/<z>/<y>/<x>     模拟 ESRI World Imagery XYZ 瓦片，返回 256x256 PNG
+- GET /images?bbox=...&limit=N 模拟 Mapillary 图像搜索，街景位于固定的 0.0002° 网格上，返回 bbox 内离中心最近的 N 张
+- GET /<id>                 模拟 Mapillary 按 id 查询图像信息
+- GET /thumb/<id>_<size>.jpg 模拟 Mapillary 缩略图，返回 JPEG；带 exp=<Unix 时间> 参数且已过期时返回 403 (签名过期)
+- GET /stats                各路径的请求数
+每个请求按 --latency (加 --jitter 随机抖动) 延迟后响应，--failure-rate 比例的请求返回 503 以触发重试
+默认返回纯色 PNG (--image-size) 和 JPEG 占位数据 (--thumb-bytes)；--photo 返回用 Pillow 编码的带纹理图像，
+缩略图按请求的尺寸生成，体积接近真实图像且可以解码 (用于压测转码)
+
+Usage:
+    python mock_upstream.py --port 8090 --latency 0.2
+    python mock_upstream.py --port 8090 --latency 0.1 --jitter 0.05 --failure-rate 0.01 --photo
+    python simple_image_server.py 8081 --esri-url http://localhost:8090/export --mapillary-url http://localhost:8090
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import argparse
+import io
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+
+
+def make_png(width, height):
+    """生成纯色 PNG (未压缩，体积接近真实卫星图)"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    row = b'\x00' + bytes([40, 90, 60]) * width
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(row * height, 0)) + chunk(b'IEND', b''))
+
+
+def make_photo(width, height, image_format, seed=0):
+    """
+    带纹理的图像 (低频色块加噪声)，压缩后的体积接近真实图像：512x512 PNG 约 450KB，1024x768 JPEG 约 150KB
+    需要 NumPy 和 Pillow
+    """
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 256, (height // 32 + 2, width // 32 + 2, 3), dtype=np.uint8)
+    base = np.asarray(Image.fromarray(blocks).resize((width, height), Image.BICUBIC), dtype=np.float32)
+    pixels = np.clip(base + rng.normal(0, 4, (height, width, 1)), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, image_format, **({'quality': 85} if image_format == 'JPEG' else {}))
+    return buffer.getvalue()
+
+
+STREETVIEW_STEP = 0.0002
+IMAGE_ID = re.compile(r'^/(m?\d+)_(m?\d+)$')
+THUMB_PATH = re.compile(r'^/thumb/[\w-]+_(\d+)\.jpg$')
+
+
+def streetview_image(i, j, host):
+    """网格 (i, j) 处的街景图像 (Mapillary 字段)，朝向由位置决定"""
+    image_id = f'{i}_{j}'.replace('-', 'm')
+    base = f'http://{host}/thumb/{image_id}'
+    return {
+        'id': image_id,
+        'computed_geometry': {'type': 'Point', 'coordinates': [round(j * STREETVIEW_STEP, 7), round(i * STREETVIEW_STEP, 7)]},
+        'captured_at': 1700000000000,
+        'compass_angle': float((i * 37 + j * 53) % 360),
+        'thumb_256_url': f'{base}_256.jpg',
+        'thumb_1024_url': f'{base}_1024.jpg',
+        'thumb_2048_url': f'{base}_2048.jpg'
+    }
+
+
+def streetview_in_bbox(min_lon, min_lat, max_lon, max_lat, limit, host):
+    center_lon, center_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    cells = [(i, j) for i in range(math.ceil(min_lat / STREETVIEW_STEP), math.floor(max_lat / STREETVIEW_STEP) + 1)
+             for j in range(math.ceil(min_lon / STREETVIEW_STEP), math.floor(max_lon / STREETVIEW_STEP) + 1)]
+    cells.sort(key=lambda c: (c[0] * STREETVIEW_STEP - center_lat) ** 2 + (c[1] * STREETVIEW_STEP - center_lon) ** 2)
+    return [streetview_image(i, j, host) for i, j in cells[:limit]]
+
+
+def make_jpeg(size):
+    """JPEG 占位数据 (SOI + 填充 + EOI)，模拟上游不解码内容"""
+    return b'\xff\xd8' + b'\x00' * max(0, size - 4) + b'\xff\xd9'
+
+
+class MockUpstream:
+    def __init__(self, latency=0.2, jitter=0.0, failure_rate=0.0, image_size=256, thumb_bytes=150000,
+                 photo=False, photo_variants=8):
+        """photo=True 时每种图像生成 photo_variants 张不同内容的图像 (首次请求时生成)，按路径选择"""
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.image_size = image_size
+        self.photo = photo
+        self.photo_variants = photo_variants
+        self.photos = {}  # (格式, 宽, 高, 序号) -> 图像
+        self.png = make_png(image_size, image_size)
+        self.tile = make_png(256, 256)
+        self.jpeg = make_jpeg(thumb_bytes)
+        self.counts = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+    def image(self, kind, path):
+        """
+        kind 为 export / tile / thumb 的响应内容；photo 模式下缩略图的宽度取路径中的尺寸 (4:3)
+        """
+        if not self.photo:
+            return {'export': self.png, 'tile': self.tile, 'thumb': self.jpeg}[kind]
+        if kind == 'export':
+            key = ('PNG', self.image_size, self.image_size)
+        elif kind == 'tile':
+            key = ('PNG', 256, 256)
+        else:
+            match = THUMB_PATH.match(path)
+            width = int(match.group(1)) if match else 1024
+            key = ('JPEG', width, width * 3 // 4)
+        key += (zlib.crc32(path.encode()) % self.photo_variants,)
+        with self.lock:
+            data = self.photos.get(key)
+        if data is None:
+            data = make_photo(key[1], key[2], key[0], seed=key[3])
+            with self.lock:
+                self.photos[key] = data
+        return data
+
+    def count(self, path):
+        with self.lock:
+            self.counts[path] = self.counts.get(path, 0) + 1
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_sent += size
+
+    def stats(self):
+        """各路径的请求数"""
+        with self.lock:
+            return dict(self.counts)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    upstream = None  # 由 make_server 设置
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.upstream.sent(len(body))
+
+    def do_GET(self):
+        parsed_url = urlparse(self.path)
+        path = parsed_url.path
+        upstream = self.upstream
+
+        if path == '/stats':
+            self.send_body(200, json.dumps(upstream.stats()).encode(), 'application/json')
+            return
+
+        image_match = IMAGE_ID.match(path)
+        kind = 'image' if image_match else path.split('/')[1] if path.count('/') > 1 else path.lstrip('/')
+        upstream.count(kind)
+        upstream.delay()
+        if random.random() < upstream.failure_rate:
+            self.send_body(503, b'{"error": "mock failure"}', 'application/json')
+            return
+
+        if path == '/export':
+            self.send_body(200, upstream.image('export', self.path), 'image/png')
+        elif path == '/images':
+            query_params = parse_qs(parsed_url.query)
+            bbox = map(float, query_params['bbox'][0].split(','))
+            limit = int(query_params.get('limit', ['10'])[0])
+            images = streetview_in_bbox(*bbox, limit, self.headers.get('Host'))
+            self.send_body(200, json.dumps({'data': images}).encode(), 'application/json')
+        elif image_match:
+            i, j = (int(value.replace('m', '-')) for value in image_match.groups())
+            self.send_body(200, json.dumps(streetview_image(i, j, self.headers.get('Host'))).encode(), 'application/json')
+        elif path.startswith('/tile/'):
+            self.send_body(200, upstream.image('tile', path), 'image/png')
+        elif path.startswith('/thumb/'):
+            expires = parse_qs(parsed_url.query).get('exp')
+            if expires and float(expires[0]) < time.time():
+                self.send_body(403, b'{"error": "URL signature expired"}', 'application/json')
+                return
+            self.send_body(200, upstream.image('thumb', path), 'image/jpeg')
+        else:
+            self.send_body(404, b'{"error": "not found"}', 'application/json')
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(upstream, host='localhost', port=8090):
+    handler = type('Handler', (MockHandler,), {'upstream': upstream})
+    return MockServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟 ESRI / Mapillary 上游服务')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.2, help='每个请求的延迟(秒)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='延迟随机抖动(秒)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='返回 503 的请求比例')
+    parser.add_argument('--image-size', type=int, default=256, help='export 返回的 PNG 边长(像素)')
+    parser.add_argument('--thumb-bytes', type=int, default=150000, help='缩略图占位数据的字节数')
+    parser.add_argument('--photo', action='store_true', help='返回可以解码的带纹理图像 (需要 NumPy 和 Pillow)')
+    args = parser.parse_args()
+
+    upstream = MockUpstream(args.latency, args.jitter, args.failure_rate, args.image_size, args.thumb_bytes, args.photo)
+    server = make_server(upstream, args.host, args.port)
+    print(f"🧪 Mock upstream running on http://{args.host}:{args.port}")
+    print(f"  卫星图: --esri-url http://{args.host}:{args.port}/export")
+    print(f"  瓦片:   --esri-tile-url 'http://{args.host}:{args.port}/tile/{{z}}/{{y}}/{{x}}'")
+    print(f"  街景:   --mapillary-url http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+打包图像存储，代替每个坐标一个文件的缓存目录
+- 分片文件 shard_00000.pack ...：只追加写入，每条记录自带键和 Content-Type，索引损坏时可以从分片重建 (reindex)
+- 索引 index.sqlite：键 -> (分片, 偏移, 长度, Content-Type, 写入时间)，按主键一次查询定位
+读取通过 mmap 映射分片，不为每次读取打开文件；写入持有目录下的文件锁，预取任务和图像服务器可以同时写入。
+同一个键重复写入或记录被删除后，旧数据留在分片中，由 compact 重写分片回收空间
+键与 image_cache.cache_key 相同 (如 satellite_40.758848_-73.985028)
+
+记录格式 (小端)：魔数 b'IMG1'、键长度 u16、Content-Type 长度 u16、数据长度 u32，然后是键、Content-Type 和数据
+
+Usage:
+    python packed_store.py stats cache/packed
+    python packed_store.py migrate cache/packed --from cache/images
+    python packed_store.py compact cache/packed
+    python packed_store.py reindex cache/packed
+"""
+
+import argparse
+import fcntl
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+from typing import Optional, Tuple, Dict, Any, Iterator
+
+from image_cache import CONTENT_TYPES, FILE_PATTERN, GRID_SPACING_M, cache_key
+
+RECORD_MAGIC = b'IMG1'
+RECORD_HEADER = struct.Struct('<4sHHI')
+SHARD_BYTES = 256 << 20
+INDEX_NAME = 'index.sqlite'
+LOCK_NAME = '.lock'
+
+
+def shard_name(shard: int) -> str:
+    return f'shard_{shard:05d}.pack'
+
+
+def list_shards(directory: str):
+    return sorted(int(name[6:11]) for name in os.listdir(directory)
+                  if name.startswith('shard_') and name.endswith('.pack'))
+
+
+def scan_shard(path: str) -> Iterator[Tuple[str, int, int, str]]:
+    """分片中的记录 (键, 数据偏移, 长度, Content-Type)，末尾写了一半的记录忽略"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = 0
+        while position + RECORD_HEADER.size <= size:
+            magic, key_length, type_length, length = RECORD_HEADER.unpack_from(mm, position)
+            if magic != RECORD_MAGIC:
+                raise ValueError(f"{path} 偏移 {position} 处记录损坏")
+            start = position + RECORD_HEADER.size
+            offset = start + key_length + type_length
+            if offset + length > size:
+                break
+            key = mm[start:start + key_length].decode()
+            content_type = mm[start + key_length:offset].decode()
+            yield key, offset, length, content_type
+            position = offset + length
+
+
+class PackedStore:
+    """
+    线程安全；readonly=True 时只读打开 (不创建目录和索引)
+    """
+
+    def __init__(self, directory: str, shard_bytes: int = SHARD_BYTES, readonly: bool = False):
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        self.readonly = readonly
+        self.lock = threading.Lock()
+        self.maps = {}  # 分片 -> mmap
+        self.shard, self.writer = None, None
+        self.lock_file = None
+        index_path = os.path.join(directory, INDEX_NAME)
+        if readonly:
+            if not os.path.exists(index_path):
+                raise FileNotFoundError(f"{index_path} 不存在")
+            self.db = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.lock_file = open(os.path.join(directory, LOCK_NAME), 'a')
+            self.db = sqlite3.connect(index_path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS images ('
+                            'key TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, length INTEGER, '
+                            'content_type TEXT, created REAL) WITHOUT ROWID')
+            self.db.commit()
+        self.db.execute('PRAGMA busy_timeout=10000')
+
+    def _path(self, shard: int) -> str:
+        return os.path.join(self.directory, shard_name(shard))
+
+    def _locked(self):
+        """跨进程的写锁 (调用者已持有 self.lock)"""
+        if self.readonly:
+            raise PermissionError("只读打开的存储不能写入")
+        return _FileLock(self.lock_file)
+
+    def _open_writer(self, size: int):
+        """定位到当前分片末尾 (其他进程可能已追加)，写满时换下一个分片 (超过分片大小的单条记录单独占一个分片)"""
+        if self.writer is None:
+            self.shard = max(list_shards(self.directory), default=0)
+            self.writer = open(self._path(self.shard), 'ab')
+        latest = max(list_shards(self.directory), default=self.shard)
+        if latest != self.shard:
+            self.writer.close()
+            self.shard = latest
+            self.writer = open(self._path(self.shard), 'ab')
+        self.writer.seek(0, os.SEEK_END)
+        if self.writer.tell() > 0 and self.writer.tell() + size > self.shard_bytes:
+            self.writer.close()
+            self.shard += 1
+            self.writer = open(self._path(self.shard), 'ab')
+
+    def _map(self, shard: int, end: int):
+        """分片的 mmap，分片在映射后又追加了数据时重新映射 (旧映射由仍在使用它的线程释放)"""
+        mm = self.maps.get(shard)
+        if mm is None or len(mm) < end:
+            with open(self._path(shard), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = mm
+        return mm
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM images WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def lookup(self, key: str) -> Optional[Tuple[int, int, int, str, float]]:
+        """索引中的 (分片, 数据偏移, 长度, Content-Type, 写入时间)，不存在返回 None"""
+        with self.lock:
+            return self.db.execute('SELECT shard, offset, length, content_type, created FROM images WHERE key = ?',
+                                   (key,)).fetchone()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        """
+        Returns:
+            tuple: (图像内容, Content-Type)，不存在返回 None
+        """
+        with self.lock:
+            entry = self.db.execute('SELECT shard, offset, length, content_type FROM images WHERE key = ?',
+                                    (key,)).fetchone()
+            if entry is None:
+                return None
+            shard, offset, length, content_type = entry
+            try:
+                mm = self._map(shard, offset + length)
+            except (OSError, ValueError):
+                return None  # 分片已被其他进程压缩删除
+        if len(mm) < offset + length:
+            return None
+        return mm[offset:offset + length], content_type
+
+    def put(self, key: str, data: bytes, content_type: str, created: Optional[float] = None):
+        """追加一条记录并更新索引"""
+        key_bytes = key.encode()
+        type_bytes = content_type.encode()
+        header = RECORD_HEADER.pack(RECORD_MAGIC, len(key_bytes), len(type_bytes), len(data))
+        record_size = len(header) + len(key_bytes) + len(type_bytes) + len(data)
+        with self.lock, self._locked():
+            self._open_writer(record_size)
+            start = self.writer.tell()
+            self.writer.write(header + key_bytes + type_bytes)
+            self.writer.write(data)
+            # 先写数据再更新索引，中断时最多留下没有索引的记录
+            self.writer.flush()
+            offset = start + len(header) + len(key_bytes) + len(type_bytes)
+            self.db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, self.shard, offset, len(data), content_type,
+                             time.time() if created is None else created))
+            self.db.commit()
+
+    def remove(self, key: str):
+        with self.lock, self._locked():
+            self.db.execute('DELETE FROM images WHERE key = ?', (key,))
+            self.db.commit()
+
+    def keys(self) -> Iterator[str]:
+        with self.lock:
+            rows = self.db.execute('SELECT key FROM images ORDER BY key').fetchall()
+        for (key,) in rows:
+            yield key
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            count, size, record_bytes = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(length), 0), '
+                f'COALESCE(SUM(length + LENGTH(CAST(key AS BLOB)) + LENGTH(CAST(content_type AS BLOB)) + {RECORD_HEADER.size}), 0) '
+                'FROM images').fetchone()
+        shards = list_shards(self.directory)
+        shard_bytes = sum(os.path.getsize(self._path(shard)) for shard in shards)
+        return {
+            'entries': count,
+            'bytes': size,
+            'shards': len(shards),
+            'shard_bytes': shard_bytes,
+            # 重复写入和删除留下的空间，compact 回收
+            'garbage_bytes': shard_bytes - record_bytes
+        }
+
+    def compact(self) -> Dict[str, int]:
+        """
+        把索引中的记录按键顺序重写到新的分片，一次事务更新索引后删除旧分片
+        压缩期间持有写锁；其他进程的读取按新索引定位，已映射的旧分片在删除后仍然可读
+        """
+        with self.lock, self._locked():
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            old_shards = list_shards(self.directory)
+            before = sum(os.path.getsize(self._path(shard)) for shard in old_shards)
+            self.shard = max(old_shards, default=-1) + 1
+            self.writer = open(self._path(self.shard), 'ab')
+            rows = self.db.execute('SELECT key, shard, offset, length, content_type, created FROM images '
+                                   'ORDER BY key').fetchall()
+            updates = []
+            for key, shard, offset, length, content_type, created in rows:
+                mm = self._map(shard, offset + length)
+                key_bytes = key.encode()
+                type_bytes = content_type.encode()
+                header = RECORD_HEADER.pack(RECORD_MAGIC, len(key_bytes), len(type_bytes), length)
+                record_size = len(header) + len(key_bytes) + len(type_bytes) + length
+                if self.writer.tell() > 0 and self.writer.tell() + record_size > self.shard_bytes:
+                    self.writer.close()
+                    self.shard += 1
+                    self.writer = open(self._path(self.shard), 'ab')
+                start = self.writer.tell()
+                self.writer.write(header + key_bytes + type_bytes)
+                self.writer.write(mm[offset:offset + length])
+                updates.append((self.shard, start + record_size - length, key))
+            self.writer.flush()
+            os.fsync(self.writer.fileno())
+            self.db.executemany('UPDATE images SET shard = ?, offset = ? WHERE key = ?', updates)
+            self.db.commit()
+            for shard in old_shards:
+                self.maps.pop(shard, None)
+                os.remove(self._path(shard))
+            after = sum(os.path.getsize(self._path(shard)) for shard in list_shards(self.directory))
+        return {'entries': len(rows), 'before_bytes': before, 'after_bytes': after}
+
+    def reindex(self) -> int:
+        """从分片重建索引 (同一个键以最后写入的记录为准)，返回记录数"""
+        with self.lock, self._locked():
+            entries = {}
+            for shard in list_shards(self.directory):
+                path = self._path(shard)
+                created = os.path.getmtime(path)
+                for key, offset, length, content_type in scan_shard(path):
+                    entries[key] = (key, shard, offset, length, content_type, created)
+            self.db.execute('DELETE FROM images')
+            self.db.executemany('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?)', entries.values())
+            self.db.commit()
+        return len(entries)
+
+    def migrate(self, directory: str, spacing: float = GRID_SPACING_M, delete: bool = False) -> Dict[str, int]:
+        """
+        导入每个坐标一个文件的缓存目录 (cache/images/)，文件名按 image_cache 的规则对齐到网格作为键；
+        存储中已有的键跳过，对齐后的文件名优先于落在同一网格的旧文件。delete=True 时删除导入的文件
+        """
+        files = {}
+        for name in os.listdir(directory):
+            match = FILE_PATTERN.match(name)
+            if not match or match['ext'] not in CONTENT_TYPES:
+                continue
+            key = cache_key(match['kind'], float(match['lat']), float(match['lon']), match['quality'], spacing)
+            legacy = key + match['ext'] != name
+            if key not in files or files[key][0] and not legacy:
+                files[key] = (legacy, name, CONTENT_TYPES[match['ext']])
+        counts = {'imported': 0, 'skipped': 0}
+        for key, (_, name, content_type) in sorted(files.items()):
+            path = os.path.join(directory, name)
+            if key in self:
+                counts['skipped'] += 1
+            else:
+                with open(path, 'rb') as f:
+                    self.put(key, f.read(), content_type, os.path.getmtime(path))
+                counts['imported'] += 1
+            if delete:
+                os.remove(path)
+        return counts
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            self.maps.clear()
+            self.db.close()
+            if self.lock_file is not None:
+                self.lock_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _FileLock:
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='打包图像存储维护')
+    parser.add_argument('command', choices=['stats', 'migrate', 'compact', 'reindex'])
+    parser.add_argument('store', help='打包存储目录')
+    parser.add_argument('--from', dest='source', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      'cache', 'images'),
+                        help='migrate: 每个坐标一个文件的缓存目录')
+    parser.add_argument('--delete', action='store_true', help='migrate: 导入后删除原文件')
+    args = parser.parse_args()
+
+    with PackedStore(args.store, readonly=args.command == 'stats') as store:
+        if args.command == 'migrate':
+            counts = store.migrate(args.source, delete=args.delete)
+            print(f"📦 导入 {counts['imported']:,} 张图像, 已存在跳过 {counts['skipped']:,} 张")
+        elif args.command == 'compact':
+            result = store.compact()
+            print(f"🗜️ 压缩完成: {result['entries']:,} 张图像, "
+                  f"{result['before_bytes'] / (1 << 20):.1f}MB -> {result['after_bytes'] / (1 << 20):.1f}MB")
+        elif args.command == 'reindex':
+            print(f"🔧 重建索引: {store.reindex():,} 条记录")
+        stats = store.stats()
+    print(f"📊 {stats['entries']:,} 张图像, {stats['bytes'] / (1 << 20):.1f}MB, {stats['shards']} 个分片, "
+          f"可回收 {stats['garbage_bytes'] / (1 << 20):.1f}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+批量预取卫星图和街景图，写入打包存储 (packed_store.py)
+坐标来自网格标记点 (create_grid_markers.py 生成的 GeoJSON)、--bbox 范围内的网格或 --coords 坐标文件，
+对齐到与图像服务器相同的 15 米网格后去重。--workers 个线程并发请求上游，--rate 限制每秒请求数；
+进度保存在检查点文件中，中断后重新运行同一命令从上次的位置继续。
+图像服务器使用 --packed-store 读取同一个存储，评测时不再访问网络；
+--satellite-mode tiles 时预取坐标周围的 XYZ 瓦片 (与图像服务器的瓦片模式相同)，相邻坐标共用的瓦片只请求一次
+
+Usage:
+    python prefetch_images.py --markers ../web/data/image_grid_markers.geojson --store cache/packed
+    python prefetch_images.py --bbox=-73.99,40.75,-73.98,40.76 --kinds satellite --rate 5
+    python prefetch_images.py --coords tasks.csv --workers 8
+    # 对本地模拟上游测试
+    python mock_upstream.py --port 8090 &
+    python prefetch_images.py --bbox=-73.99,40.75,-73.98,40.76 --esri-url http://localhost:8090/export --mapillary-url http://localhost:8090
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import requests
+
+from image_cache import GRID_SPACING_M, METERS_PER_DEGREE, cache_key, snap_to_grid
+from packed_store import PackedStore
+from satellite_streetview_api import SatelliteStreetViewAPI, ESRI_BASE_URL, ESRI_TILE_URL, MAPILLARY_BASE_URL
+
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MARKERS = os.path.join(STATIC_DIR, '..', 'web', 'data', 'image_grid_markers.geojson')
+DEFAULT_STORE = os.path.join(STATIC_DIR, 'cache', 'packed')
+KINDS = ['satellite', 'streetview']
+
+
+def load_markers(path: str) -> Iterator[Tuple[float, float]]:
+    """GeoJSON 点要素的 (纬度, 经度)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        geojson = json.load(f)
+    for feature in geojson['features']:
+        lon, lat = feature['geometry']['coordinates'][:2]
+        yield lat, lon
+
+
+def load_coords(path: str) -> Iterator[Tuple[float, float]]:
+    """
+    任务坐标文件：带 lat,lon 表头的 CSV，或 [{"lat": .., "lon": ..}, ...] / [[lat, lon], ...] 的 JSON，或 GeoJSON
+    """
+    if path.endswith('.csv'):
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                yield float(row['lat']), float(row['lon'])
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict) and 'features' in data:
+        yield from load_markers(path)
+        return
+    for item in data:
+        if isinstance(item, dict):
+            yield float(item['lat']), float(item['lon'])
+        else:
+            yield float(item[0]), float(item[1])
+
+
+def bbox_grid(bbox: str, spacing: float = GRID_SPACING_M) -> Iterator[Tuple[float, float]]:
+    """min_lon,min_lat,max_lon,max_lat 范围内的网格点"""
+    min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(','))
+    lat_step = spacing / METERS_PER_DEGREE
+    lat = min_lat
+    while lat <= max_lat:
+        lon_step = spacing / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+        lon = min_lon
+        while lon <= max_lon:
+            yield lat, lon
+            lon += lon_step
+        lat += lat_step
+
+
+def unique_points(points, spacing: float = GRID_SPACING_M) -> List[Tuple[float, float]]:
+    """对齐到网格并去重，保持原有顺序 (检查点按顺序记录进度)"""
+    seen = set()
+    result = []
+    for lat, lon in points:
+        point = snap_to_grid(lat, lon, spacing)
+        if point not in seen:
+            seen.add(point)
+            result.append(point)
+    return result
+
+
+class RateLimiter:
+    """令牌桶，所有线程共享，rate 为每秒请求数 (0 不限制)"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Checkpoint:
+    """
+    检查点：done 之前的坐标都已处理 (并发完成顺序不定，只推进连续完成的部分)，failed 为失败的坐标序号
+    signature 不同 (换了坐标来源或图像类型) 时从头开始
+    """
+
+    def __init__(self, path: str, signature: dict):
+        self.path = path
+        self.signature = signature
+        self.done = 0
+        self.failed = []
+        self.finished = set()
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('signature') == signature:
+                self.done = state['done']
+                self.failed = state.get('failed', [])
+            else:
+                print(f"⚠️  检查点 {path} 与当前参数不一致，从头开始")
+
+    def complete(self, index: int, ok: bool):
+        with self.lock:
+            if not ok:
+                self.failed.append(index)
+            self.finished.add(index)
+            while self.done in self.finished:
+                self.finished.remove(self.done)
+                self.done += 1
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            state = {'signature': self.signature, 'done': self.done, 'failed': sorted(self.failed)}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+
+class Prefetcher:
+    def __init__(self, api: SatelliteStreetViewAPI, store: PackedStore, kinds=KINDS, quality: str = '1024',
+                 rate: float = 0, spacing: float = GRID_SPACING_M, tiles=None):
+        """tiles 为 satellite_tiles.TileCompositor 时卫星图预取瓦片而不是 export 图像"""
+        self.api = api
+        self.store = store
+        self.kinds = kinds
+        self.quality = quality
+        self.limiter = RateLimiter(rate)
+        self.spacing = spacing
+        self.tiles = tiles
+        self.lock = threading.Lock()
+        self.counts = {'fetched': 0, 'skipped': 0, 'no_streetview': 0, 'failed': 0}
+
+    def count(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+    def summary(self):
+        """各类计数，瓦片数为实际从上游获取的瓦片 (并发等待同一瓦片的不重复计数)"""
+        with self.lock:
+            counts = dict(self.counts)
+        if self.tiles is not None:
+            counts['tiles'] = self.tiles.fetched
+        return counts
+
+    def fetch_point(self, lat: float, lon: float) -> bool:
+        """预取一个坐标的所有图像类型，已在存储中的跳过；返回是否全部成功"""
+        ok = True
+        for kind in self.kinds:
+            if kind == 'satellite' and self.tiles is not None:
+                ok = self.fetch_tiles(lat, lon) and ok
+                continue
+            quality = self.quality if kind == 'streetview' else None
+            key = cache_key(kind, lat, lon, quality, self.spacing)
+            if key in self.store:
+                self.count('skipped')
+                continue
+            try:
+                if kind == 'satellite':
+                    self.limiter.acquire()
+                    content, content_type = self.api.fetch(self.api.get_satellite_image_url(lat, lon))
+                    content_type = content_type or 'image/png'
+                else:
+                    self.limiter.acquire()
+                    streetview_info = self.api.find_nearby_streetview(lat, lon)
+                    image_url = streetview_info and self.api.select_thumb_url(streetview_info, quality)[0]
+                    if not image_url:
+                        self.count('no_streetview')
+                        continue
+                    self.limiter.acquire()
+                    content, content_type = self.api.fetch(image_url)
+                    content_type = content_type or 'image/jpeg'
+            except requests.RequestException as e:
+                print(f"❌ {key}: {e}")
+                self.count('failed')
+                ok = False
+                continue
+            self.store.put(key, content, content_type)
+            self.count('fetched')
+        return ok
+
+    def fetch_tiles(self, lat: float, lon: float) -> bool:
+        """预取坐标窗口中还没有的瓦片，其他线程正在请求的同一瓦片等待其结果"""
+        try:
+            for x, y in self.tiles.missing_tiles(lat, lon):
+                self.limiter.acquire()
+                self.tiles.tile(x, y)
+        except requests.RequestException as e:
+            print(f"❌ 瓦片 ({lat}, {lon}): {e}")
+            self.count('failed')
+            return False
+        return True
+
+    def run(self, points: List[Tuple[float, float]], indices: List[int], checkpoint: Checkpoint,
+            workers: int = 8, save_interval: float = 10):
+        """workers 个线程按顺序领取坐标，每 save_interval 秒保存一次检查点"""
+        pending = iter(indices)
+        pending_lock = threading.Lock()
+        begin = time.time()
+        stop = threading.Event()
+
+        def worker():
+            while True:
+                with pending_lock:
+                    index = next(pending, None)
+                if index is None:
+                    return
+                lat, lon = points[index]
+                checkpoint.complete(index, self.fetch_point(lat, lon))
+
+        def reporter():
+            while not stop.wait(save_interval):
+                checkpoint.save()
+                elapsed = time.time() - begin
+                print(f"   已完成: {checkpoint.done:,}/{len(points):,} 个坐标, {self.summary()} ({elapsed:.0f}s)")
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+        report_thread = threading.Thread(target=reporter, daemon=True)
+        report_thread.start()
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            stop.set()
+            checkpoint.save()
+        return self.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量预取卫星图和街景图')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--markers', default=None, help=f'网格标记点 GeoJSON (默认 {os.path.relpath(DEFAULT_MARKERS)})')
+    source.add_argument('--bbox', default=None, help='min_lon,min_lat,max_lon,max_lat 范围内按网格间距预取 (负数开头时写成 --bbox=...)')
+    source.add_argument('--coords', default=None, help='任务坐标文件 (CSV / JSON / GeoJSON)')
+    parser.add_argument('--store', default=DEFAULT_STORE, help='打包存储目录')
+    parser.add_argument('--checkpoint', default=None, help='检查点文件 (默认 <store>/prefetch_checkpoint.json)')
+    parser.add_argument('--kinds', default=','.join(KINDS), help='图像类型，逗号分隔')
+    parser.add_argument('--quality', default='1024', help='街景缩略图质量')
+    parser.add_argument('--workers', type=int, default=8, help='并发线程数')
+    parser.add_argument('--rate', type=float, default=10, help='每秒最多上游请求数 (0 不限制)')
+    parser.add_argument('--limit', type=int, default=None, help='只预取前 N 个坐标')
+    parser.add_argument('--retry-failed', action='store_true', help='只重试检查点中失败的坐标')
+    parser.add_argument('--satellite-mode', choices=['export', 'tiles'], default='export',
+                        help='tiles: 预取图像服务器瓦片模式使用的 XYZ 瓦片')
+    parser.add_argument('--tile-zoom', type=int, default=18, help='瓦片缩放级别')
+    parser.add_argument('--esri-url', default=ESRI_BASE_URL, help='卫星图像服务地址')
+    parser.add_argument('--esri-tile-url', default=ESRI_TILE_URL, help='卫星瓦片地址模板')
+    parser.add_argument('--mapillary-url', default=MAPILLARY_BASE_URL, help='街景服务地址')
+    parser.add_argument('--retries', type=int, default=3, help='上游请求重试次数')
+    args = parser.parse_args()
+
+    kinds = [kind for kind in args.kinds.split(',') if kind]
+    for kind in kinds:
+        if kind not in KINDS:
+            parser.error(f"未知的图像类型: {kind}")
+
+    if args.bbox:
+        points = bbox_grid(args.bbox)
+        source_name = f'bbox:{args.bbox}'
+    elif args.coords:
+        points = load_coords(args.coords)
+        source_name = f'coords:{os.path.abspath(args.coords)}'
+    else:
+        markers = args.markers or DEFAULT_MARKERS
+        if not os.path.exists(markers):
+            parser.error(f"{markers} 不存在，先运行 create_grid_markers.py 或使用 --bbox / --coords")
+        points = load_markers(markers)
+        source_name = f'markers:{os.path.abspath(markers)}'
+    points = unique_points(points)
+    if args.limit:
+        points = points[:args.limit]
+
+    signature = {'source': source_name, 'kinds': kinds, 'quality': args.quality, 'points': len(points),
+                 'satellite_mode': args.satellite_mode, 'tile_zoom': args.tile_zoom}
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(args.store, 'prefetch_checkpoint.json'), signature)
+    if checkpoint.done:
+        print(f"   从检查点继续: 已完成 {checkpoint.done:,} 个, 失败 {len(checkpoint.failed):,} 个")
+    if args.retry_failed:
+        indices, checkpoint.failed = checkpoint.failed, []
+    else:
+        indices = list(range(checkpoint.done, len(points)))
+    print(f"🛰️ 预取 {', '.join(kinds)}: {len(points):,} 个网格坐标, 待处理 {len(indices):,} 个")
+
+    api = SatelliteStreetViewAPI(args.esri_url, args.mapillary_url, pool_size=args.workers, retries=args.retries,
+                                 esri_tile_url=args.esri_tile_url)
+    with PackedStore(args.store) as store:
+        tiles = None
+        if args.satellite_mode == 'tiles':
+            from satellite_tiles import TileCache, TileCompositor
+            # 只写入存储，内存中不保留解码的瓦片
+            tiles = TileCompositor(api, TileCache(None, store, memory_bytes=0), args.tile_zoom, workers=1)
+        prefetcher = Prefetcher(api, store, kinds, args.quality, args.rate, tiles=tiles)
+        begin = time.time()
+        counts = prefetcher.run(points, indices, checkpoint, args.workers)
+        stats = store.stats()
+
+    print(f"\n📊 预取完成 ({time.time() - begin:.1f}s):")
+    print(f"   下载: {counts['fetched']:,}, 已存在跳过: {counts['skipped']:,}, "
+          f"无街景: {counts['no_streetview']:,}, 瓦片: {counts.get('tiles', 0):,}, 失败: {counts['failed']:,}")
+    print(f"   存储: {stats['entries']:,} 张图像, {stats['bytes'] / (1 << 20):.1f}MB, {stats['shards']} 个分片")
+    if checkpoint.failed:
+        print(f"⚠️  {len(checkpoint.failed):,} 个坐标失败，使用 --retry-failed 重试")
+
+
+if __name__ == '__main__':
+    main()
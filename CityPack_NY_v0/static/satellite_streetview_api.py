@@ -7,32 +7,94 @@ Satellite and Street View Image API
 - 卫星图像: ESRI World Imagery (免费，无需API密钥)
 - 街景图像: Mapillary API (需要access token)
 
+ImageServerClient 通过 simple_image_server.py 的 /api/images/batch 为评测任务批量获取图像
+
 Usage:
     python satellite_streetview_api.py --lat 40.7589 --lon -73.9851
+    python satellite_streetview_api.py --batch tasks.csv --server http://localhost:8081 --output-dir images --size panel
 """
 
 import requests
 import json
 import argparse
 import os
-from typing import Optional, Tuple, Dict, Any
+import tarfile
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Dict, Any, Callable, List, Sequence
 import time
 from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+ESRI_BASE_URL = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/export"
+# XYZ 瓦片 (Web Mercator, 256x256)，注意路径中是 {z}/{y}/{x}
+ESRI_TILE_URL = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}"
+MAPILLARY_BASE_URL = "https://graph.mapillary.com"
+STREETVIEW_FIELDS = 'id,thumb_256_url,thumb_1024_url,thumb_2048_url,computed_geometry,captured_at,compass_angle'
 
 class SatelliteStreetViewAPI:
-    def __init__(self):
+    def __init__(self, esri_base_url: str = ESRI_BASE_URL, mapillary_base_url: str = MAPILLARY_BASE_URL,
+                 pool_size: int = 16, connect_timeout: float = 5, read_timeout: float = 30, retries: int = 3,
+                 esri_tile_url: str = ESRI_TILE_URL):
+        """
+        Args:
+            esri_base_url: 卫星图像服务地址 (测试时可指向本地模拟上游)
+            mapillary_base_url: 街景服务地址
+            pool_size: 每个上游主机的最大连接数，超出的请求排队等待空闲连接
+            connect_timeout: 建立连接超时(秒)
+            read_timeout: 读取响应超时(秒)
+            retries: 连接失败、429 和 5xx 响应的重试次数
+            esri_tile_url: 卫星瓦片地址模板，包含 {z} {x} {y}
+        """
         # Mapillary API配置 (从README中获取的token)
         self.mapillary_token = "YOUR_MAPILLARY_ACCESS_TOKEN_HERE Start with 'MLY|' "
-        self.mapillary_base_url = "https://graph.mapillary.com"
+        self.mapillary_base_url = mapillary_base_url
         
         # ESRI World Imagery配置 (免费服务，无需密钥)
-        self.esri_base_url = "https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/export"
+        self.esri_base_url = esri_base_url
+        self.esri_tile_url = esri_tile_url
         
         # 请求头
         self.headers = {
             'User-Agent': 'CityVerse-SatelliteStreetView/1.0'
         }
 
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = self._create_session(pool_size, retries)
+
+    def _create_session(self, pool_size: int, retries: int) -> requests.Session:
+        """
+        创建线程间共享的 keep-alive 连接池
+        每个主机一个连接池，最多 pool_size 个连接 (pool_block 时超出的请求等待空闲连接，不会新建连接)，
+        失败的 GET 请求按指数退避重试，并遵守 Retry-After
+        """
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def fetch(self, url: str) -> Tuple[bytes, Optional[str]]:
+        """
+        通过共享连接池获取图像
+
+        Returns:
+            tuple: (图像内容, Content-Type)
+        """
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content, response.headers.get('Content-Type')
+
     def get_satellite_image_url(self, lat: float, lon: float, zoom: int = 18, size: Tuple[int, int] = (512, 512)) -> str:
         """
         获取ESRI卫星图像URL
@@ -63,6 +125,10 @@ class SatelliteStreetViewAPI:
         
         return f"{self.esri_base_url}?{urlencode(params)}"
 
+    def get_satellite_tile_url(self, zoom: int, x: int, y: int) -> str:
+        """XYZ 卫星瓦片URL"""
+        return self.esri_tile_url.format(z=zoom, x=x, y=y)
+
     def download_satellite_image(self, lat: float, lon: float, save_path: str = None) -> Optional[str]:
         """
         下载卫星图像
@@ -81,11 +147,10 @@ class SatelliteStreetViewAPI:
             if not save_path:
                 save_path = f"satellite_{lat:.6f}_{lon:.6f}.png"
             
-            response = requests.get(url, headers=self.headers, timeout=30)
-            response.raise_for_status()
+            content, _ = self.fetch(url)
             
             with open(save_path, 'wb') as f:
-                f.write(response.content)
+                f.write(content)
             
             print(f"✅ 卫星图像已保存: {save_path}")
             return save_path
@@ -94,6 +159,77 @@ class SatelliteStreetViewAPI:
             print(f"❌ 获取卫星图像失败: {str(e)}")
             return None
 
+    def find_nearby_streetview(self, lat: float, lon: float) -> Optional[Dict[str, Any]]:
+        """
+        搜索附近的街景图像，请求失败时抛出异常 (可以缓存的结果只有找到和未找到两种)
+
+        Returns:
+            dict: 最近的街景图像信息，附近没有街景返回None
+        """
+        # 搜索附近的图像
+        search_url = f"{self.mapillary_base_url}/images"
+        params = {
+            'access_token': self.mapillary_token,
+            'fields': STREETVIEW_FIELDS,
+            'bbox': f"{lon-0.001},{lat-0.001},{lon+0.001},{lat+0.001}",
+            'limit': 10
+        }
+        
+        response = self.session.get(search_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        
+        data = response.json()
+        
+        if not data.get('data'):
+            print(f"⚠️  在位置 ({lat}, {lon}) 附近未找到街景图像")
+            return None
+        
+        # 选择最近的图像
+        closest_image = data['data'][0]
+        
+        # 计算距离（简单的欧几里得距离）
+        image_coords = closest_image['computed_geometry']['coordinates']
+        image_lon, image_lat = image_coords
+        distance = ((lat - image_lat) ** 2 + (lon - image_lon) ** 2) ** 0.5 * 111000  # 近似米数
+        
+        result = {
+            'id': closest_image['id'],
+            'distance_m': round(distance, 1),
+            'lat': image_lat,
+            'lon': image_lon,
+            'captured_at': closest_image.get('captured_at'),
+            'compass_angle': closest_image.get('compass_angle'),
+            'thumb_256_url': closest_image.get('thumb_256_url'),
+            'thumb_1024_url': closest_image.get('thumb_1024_url'),
+            'thumb_2048_url': closest_image.get('thumb_2048_url')
+        }
+        
+        print(f"✅ 找到街景图像，距离目标点 {result['distance_m']}米")
+        return result
+
+    def search_streetview_bbox(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float,
+                               limit: int = 2000) -> list:
+        """
+        范围内的街景图像 (Mapillary 原始字段，最多 limit 张)，请求失败时抛出异常
+        返回 limit 张时范围内可能还有更多图像，调用者应缩小范围重新查询
+        """
+        params = {
+            'access_token': self.mapillary_token,
+            'fields': STREETVIEW_FIELDS,
+            'bbox': f"{min_lon},{min_lat},{max_lon},{max_lat}",
+            'limit': limit
+        }
+        response = self.session.get(f"{self.mapillary_base_url}/images", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json().get('data', [])
+
+    def get_streetview_image(self, image_id: str) -> Dict[str, Any]:
+        """按 id 获取街景图像信息 (缩略图 URL 带签名会过期，用于重新获取)，请求失败时抛出异常"""
+        params = {'access_token': self.mapillary_token, 'fields': STREETVIEW_FIELDS}
+        response = self.session.get(f"{self.mapillary_base_url}/{image_id}", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
     def search_nearby_streetview(self, lat: float, lon: float, radius: int = 100) -> Optional[Dict[str, Any]]:
         """
         搜索附近的街景图像
@@ -107,51 +243,25 @@ class SatelliteStreetViewAPI:
             dict: 最近的街景图像信息，失败返回None
         """
         try:
-            # 搜索附近的图像
-            search_url = f"{self.mapillary_base_url}/images"
-            params = {
-                'access_token': self.mapillary_token,
-                'fields': 'id,thumb_256_url,thumb_1024_url,thumb_2048_url,computed_geometry,captured_at,compass_angle',
-                'bbox': f"{lon-0.001},{lat-0.001},{lon+0.001},{lat+0.001}",
-                'limit': 10
-            }
-            
-            response = requests.get(search_url, params=params, headers=self.headers, timeout=30)
-            response.raise_for_status()
-            
-            data = response.json()
-            
-            if not data.get('data'):
-                print(f"⚠️  在位置 ({lat}, {lon}) 附近未找到街景图像")
-                return None
-            
-            # 选择最近的图像
-            closest_image = data['data'][0]
-            
-            # 计算距离（简单的欧几里得距离）
-            image_coords = closest_image['computed_geometry']['coordinates']
-            image_lon, image_lat = image_coords
-            distance = ((lat - image_lat) ** 2 + (lon - image_lon) ** 2) ** 0.5 * 111000  # 近似米数
-            
-            result = {
-                'id': closest_image['id'],
-                'distance_m': round(distance, 1),
-                'lat': image_lat,
-                'lon': image_lon,
-                'captured_at': closest_image.get('captured_at'),
-                'compass_angle': closest_image.get('compass_angle'),
-                'thumb_256_url': closest_image.get('thumb_256_url'),
-                'thumb_1024_url': closest_image.get('thumb_1024_url'),
-                'thumb_2048_url': closest_image.get('thumb_2048_url')
-            }
-            
-            print(f"✅ 找到街景图像，距离目标点 {result['distance_m']}米")
-            return result
-            
+            return self.find_nearby_streetview(lat, lon)
         except Exception as e:
             print(f"❌ 搜索街景图像失败: {str(e)}")
             return None
 
+    @staticmethod
+    def select_thumb_url(streetview_info: Dict[str, Any], quality: str = '1024') -> Tuple[Optional[str], str]:
+        """
+        选择缩略图URL，请求的质量不可用时依次尝试 1024、256、2048
+
+        Returns:
+            tuple: (图像URL, 实际质量)，都不可用时URL为None
+        """
+        for candidate in [quality, '1024', '256', '2048']:
+            image_url = streetview_info.get(f'thumb_{candidate}_url')
+            if image_url:
+                return image_url, candidate
+        return None, quality
+
     def download_streetview_image(self, lat: float, lon: float, save_path: str = None, quality: str = '1024') -> Optional[str]:
         """
         下载街景图像
@@ -191,11 +301,10 @@ class SatelliteStreetViewAPI:
             if not save_path:
                 save_path = f"streetview_{lat:.6f}_{lon:.6f}_{quality}.jpg"
             
-            response = requests.get(image_url, headers=self.headers, timeout=30)
-            response.raise_for_status()
+            content, _ = self.fetch(image_url)
             
             with open(save_path, 'wb') as f:
-                f.write(response.content)
+                f.write(content)
             
             print(f"✅ 街景图像已保存: {save_path} (质量: {quality}, 距离: {streetview_info['distance_m']}m)")
             return save_path
@@ -204,13 +313,15 @@ class SatelliteStreetViewAPI:
             print(f"❌ 下载街景图像失败: {str(e)}")
             return None
 
-    def get_images_info(self, lat: float, lon: float) -> Dict[str, Any]:
+    def get_images_info(self, lat: float, lon: float,
+                        search: Optional[Callable[[float, float], Optional[Dict[str, Any]]]] = None) -> Dict[str, Any]:
         """
         获取指定位置的卫星图和街景图信息
         
         Args:
             lat: 纬度
             lon: 经度
+            search: 街景搜索函数 (如带缓存的搜索)，默认 search_nearby_streetview
             
         Returns:
             dict: 包含图像URL和信息的字典
@@ -230,22 +341,159 @@ class SatelliteStreetViewAPI:
         }
         
         # 搜索街景信息
-        streetview_info = self.search_nearby_streetview(lat, lon)
+        streetview_info = (search or self.search_nearby_streetview)(lat, lon)
         if streetview_info:
             result['streetview']['available'] = True
             result['streetview']['info'] = streetview_info
         
         return result
 
+class ImageServerClient:
+    """
+    simple_image_server.py 的批量接口客户端
+    坐标按 chunk_size 分批 POST /api/images/batch，workers 个批次并发；服务器端并发获取并复用缓存，
+    图像按内容 sha256 引用，相同的图像只传输和保存一次
+    """
+
+    def __init__(self, base_url: str = 'http://localhost:8081', connect_timeout: float = 5, read_timeout: float = 600):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+
+    def _batch_body(self, points, kinds, quality, size, image_format, response='json') -> Dict[str, Any]:
+        body = {'points': [list(point) if isinstance(point, (tuple, list)) else point for point in points],
+                'kinds': list(kinds), 'quality': quality, 'response': response}
+        if size:
+            body['size'] = size
+        if image_format:
+            body['format'] = image_format
+        return body
+
+    def _run_chunks(self, points: Sequence, chunk_size: int, workers: int, fn) -> List[Dict[str, Any]]:
+        """按批次并发调用 fn(批次坐标)，结果按原顺序合并，index 为在 points 中的位置"""
+        chunks = [points[start:start + chunk_size] for start in range(0, len(points), chunk_size)]
+        with ThreadPoolExecutor(max(1, workers)) as executor:
+            manifests = list(executor.map(fn, chunks))
+        results = []
+        for start, manifest in zip(range(0, len(points), chunk_size), manifests):
+            for result in manifest['results']:
+                result['index'] += start
+                results.append(result)
+        return results
+
+    def get_images_batch(self, points: Sequence, kinds=('satellite', 'streetview'), quality: str = '1024',
+                         size: Optional[str] = None, image_format: Optional[str] = None,
+                         chunk_size: int = 500, workers: int = 4) -> List[Dict[str, Any]]:
+        """
+        批量获取图像元数据和引用
+
+        Args:
+            points: [(lat, lon), ...] 或 [{'lat', 'lon', 'heading'}, ...]
+            kinds: 图像类型
+            quality: 街景质量
+            size / image_format: 转码后的版本 (thumb / panel / full, webp / avif)，默认原图
+
+        Returns:
+            list: 与 points 顺序相同的结果，每类图像带 sha256，用 get_blob 获取内容
+        """
+        def post(chunk):
+            response = self.session.post(f"{self.base_url}/api/images/batch", timeout=self.timeout,
+                                         json=self._batch_body(chunk, kinds, quality, size, image_format))
+            response.raise_for_status()
+            return response.json()
+
+        return self._run_chunks(points, chunk_size, workers, post)
+
+    def get_blob(self, digest: str) -> Tuple[bytes, Optional[str]]:
+        """按 sha256 获取批量结果中引用的图像，服务器不再保留该引用时抛出 requests.HTTPError (404)"""
+        response = self.session.get(f"{self.base_url}/api/blobs/{digest}", timeout=self.timeout)
+        response.raise_for_status()
+        return response.content, response.headers.get('Content-Type')
+
+    def download_batch(self, points: Sequence, output_dir: str, kinds=('satellite', 'streetview'),
+                       quality: str = '1024', size: Optional[str] = None, image_format: Optional[str] = None,
+                       chunk_size: int = 500, workers: int = 4) -> List[Dict[str, Any]]:
+        """
+        以 tar 流批量下载图像，图像保存为 output_dir/images/<sha256>.<扩展名> (已存在的不重复写入)
+
+        Returns:
+            list: 同 get_images_batch，每类图像的 path 为 output_dir 下的相对路径
+        """
+        os.makedirs(os.path.join(output_dir, 'images'), exist_ok=True)
+        lock = threading.Lock()
+        counts = {'points': 0, 'images': 0}
+
+        def download(chunk):
+            body = self._batch_body(chunk, kinds, quality, size, image_format, response='tar')
+            with self.session.post(f"{self.base_url}/api/images/batch", json=body, timeout=self.timeout,
+                                   stream=True) as response:
+                response.raise_for_status()
+                manifest = None
+                with tarfile.open(fileobj=response.raw, mode='r|') as archive:
+                    for member in archive:
+                        data = archive.extractfile(member).read()
+                        if member.name == 'manifest.json':
+                            manifest = json.loads(data)
+                        elif member.name.startswith('images/') and '/' not in member.name[len('images/'):]:
+                            self._save_image(os.path.join(output_dir, member.name), data)
+                # tar 结束标记后还有填充块，读完后连接才能复用
+                while response.raw.read(1 << 16):
+                    pass
+            if manifest is None:
+                raise ValueError("Batch response has no manifest")
+            with lock:
+                counts['points'] += len(chunk)
+                counts['images'] += manifest['images']
+                print(f"📦 {counts['points']:,}/{len(points):,} 个坐标, {counts['images']:,} 张图像")
+            return manifest
+
+        return self._run_chunks(points, chunk_size, workers, download)
+
+    @staticmethod
+    def _save_image(path: str, data: bytes):
+        """内容寻址，同名文件内容相同，已存在时跳过；先写临时文件再原子替换"""
+        if os.path.exists(path):
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+def run_batch(args):
+    """--batch: 通过图像服务器批量下载坐标文件中的图像，结果写入 output_dir/batch_results.json"""
+    from prefetch_images import load_coords
+
+    points = list(load_coords(args.batch))
+    client = ImageServerClient(args.server)
+    print(f"📥 通过 {args.server} 批量获取 {len(points):,} 个坐标的图像 -> {args.output_dir}")
+    start = time.time()
+    results = client.download_batch(points, args.output_dir, quality=args.quality, size=args.size,
+                                    chunk_size=args.chunk_size, workers=args.workers)
+    path = os.path.join(args.output_dir, 'batch_results.json')
+    with open(path, 'w') as f:
+        json.dump(results, f, ensure_ascii=False)
+    errors = sum(1 for result in results for kind in ('satellite', 'streetview') if 'error' in result.get(kind, {}))
+    print(f"✅ 完成 {len(results):,} 个坐标, 耗时 {time.time() - start:.1f}s, 错误 {errors} 个, 结果: {path}")
+
 def main():
     parser = argparse.ArgumentParser(description='获取指定经纬度的卫星图和街景图')
-    parser.add_argument('--lat', type=float, required=True, help='纬度')
-    parser.add_argument('--lon', type=float, required=True, help='经度')
+    parser.add_argument('--lat', type=float, help='纬度')
+    parser.add_argument('--lon', type=float, help='经度')
     parser.add_argument('--download', action='store_true', help='下载图像到本地')
     parser.add_argument('--output-dir', default='.', help='输出目录')
     parser.add_argument('--quality', choices=['256', '1024', '2048'], default='1024', help='街景图像质量')
+    parser.add_argument('--batch', default=None, help='坐标文件 (CSV/JSON/GeoJSON)，通过图像服务器批量下载')
+    parser.add_argument('--server', default='http://localhost:8081', help='--batch: 图像服务器地址')
+    parser.add_argument('--size', choices=['thumb', 'panel', 'full'], default=None, help='--batch: 转码后的版本，默认原图')
+    parser.add_argument('--chunk-size', type=int, default=500, help='--batch: 每个批量请求的坐标数')
+    parser.add_argument('--workers', type=int, default=4, help='--batch: 并发的批量请求数')
     
     args = parser.parse_args()
+    if args.batch:
+        run_batch(args)
+        return
+    if args.lat is None or args.lon is None:
+        parser.error('需要 --lat 和 --lon (或 --batch)')
     
     # 创建输出目录
     os.makedirs(args.output_dir, exist_ok=True)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+用 XYZ 瓦片合成卫星图
+ESRI export 接口按每个点的 bbox 渲染一张新图，相邻的点几乎不能共用缓存；
+这里改为获取标准的 z18/z19 瓦片 (256x256, Web Mercator)，瓦片缓存后由附近所有的点共用，
+请求的窗口在本地用 NumPy 拼接裁剪、Pillow 编码。网格点密集时预热后瓦片命中率接近 100%
+
+瓦片缓存：内存中保存解码后的像素，磁盘按 <目录>/<z>/<x>/<y>.jpg 保存原始瓦片，或保存到打包存储 (键 tile_<z>_<x>_<y>)
+
+Usage:
+    python satellite_tiles.py --lat 40.7589 --lon -73.9851 --zoom 18 --output satellite.jpg
+"""
+
+import argparse
+import io
+import math
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple, Dict, Any, List
+
+import numpy as np
+from PIL import Image
+
+from image_cache import EXTENSIONS, MemoryLRU
+from single_flight import SingleFlight
+
+TILE_SIZE = 256
+
+
+def lonlat_to_pixel(lat: float, lon: float, zoom: int) -> Tuple[float, float]:
+    """经纬度 -> 缩放级别 zoom 下的全局像素坐标 (Web Mercator)"""
+    scale = TILE_SIZE * (1 << zoom)
+    x = (lon + 180.0) / 360.0 * scale
+    sin_lat = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+
+def window_tiles(lat: float, lon: float, zoom: int, size: Tuple[int, int]):
+    """
+    以 (lat, lon) 为中心、size 像素的窗口
+
+    Returns:
+        tuple: (覆盖的瓦片 [(x, y), ...] 按行排列, 列数, 行数, 窗口在拼接图中的左上角像素)
+    """
+    width, height = size
+    center_x, center_y = lonlat_to_pixel(lat, lon, zoom)
+    left = int(round(center_x - width / 2))
+    top = int(round(center_y - height / 2))
+    x0, y0 = left // TILE_SIZE, top // TILE_SIZE
+    x1, y1 = (left + width - 1) // TILE_SIZE, (top + height - 1) // TILE_SIZE
+    tiles = [(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)]
+    return tiles, x1 - x0 + 1, y1 - y0 + 1, (left - x0 * TILE_SIZE, top - y0 * TILE_SIZE)
+
+
+class TileCache:
+    """
+    瓦片缓存，线程安全
+    内存 LRU 保存解码后的 RGB 像素 (拼接时不再解码)，持久层保存原始瓦片：
+    packed_store 不为 None 时读写打包存储 (只读的打包存储未命中的瓦片只保存在内存)，否则写入 directory (None 时只用内存)
+    """
+
+    def __init__(self, directory: Optional[str] = None, packed_store=None, memory_bytes: int = 128 << 20,
+                 ttl: float = 30 * 86400):
+        self.directory = directory
+        self.packed_store = packed_store
+        self.ttl = ttl
+        self.memory = MemoryLRU(memory_bytes, ttl)
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(zoom: int, x: int, y: int) -> str:
+        return f"tile_{zoom}_{x}_{y}"
+
+    def _path(self, zoom: int, x: int, y: int, ext: str = '') -> str:
+        return os.path.join(self.directory, str(zoom), str(x), f"{y}{ext}")
+
+    def _read(self, zoom: int, x: int, y: int) -> Optional[bytes]:
+        if self.packed_store is not None:
+            entry = self.packed_store.get(self.key(zoom, x, y))
+            return entry[0] if entry is not None else None
+        if not self.directory:
+            return None
+        for ext in ('.jpg', '.png'):
+            path = self._path(zoom, x, y, ext)
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    return None
+                with open(path, 'rb') as f:
+                    return f.read()
+            except OSError:
+                continue
+        return None
+
+    def _write(self, zoom: int, x: int, y: int, data: bytes, content_type: str):
+        if self.packed_store is not None:
+            if not self.packed_store.readonly:
+                self.packed_store.put(self.key(zoom, x, y), data, content_type)
+            return
+        if not self.directory:
+            return
+        path = self._path(zoom, x, y, EXTENSIONS.get(content_type, '.jpg'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print(f"⚠️  写入瓦片缓存失败: {e}")
+
+    def _remember(self, key: str, pixels: np.ndarray):
+        with self.lock:
+            self.memory.put(key, pixels.tobytes(), 'raw', time.time())
+
+    def get(self, zoom: int, x: int, y: int) -> Optional[np.ndarray]:
+        """解码后的瓦片 (TILE_SIZE, TILE_SIZE, 3)，未缓存返回 None"""
+        key = self.key(zoom, x, y)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory_hits += 1
+                return np.frombuffer(entry[0], dtype=np.uint8).reshape(TILE_SIZE, TILE_SIZE, 3)
+        data = self._read(zoom, x, y)
+        if data is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        pixels = decode_tile(data)
+        with self.lock:
+            self.disk_hits += 1
+        self._remember(key, pixels)
+        return pixels
+
+    def contains(self, zoom: int, x: int, y: int) -> bool:
+        """持久层中是否已有瓦片 (预取时跳过)"""
+        if self.packed_store is not None:
+            return self.key(zoom, x, y) in self.packed_store
+        return self._read(zoom, x, y) is not None
+
+    def put(self, zoom: int, x: int, y: int, data: bytes, content_type: str) -> np.ndarray:
+        pixels = decode_tile(data)
+        self._write(zoom, x, y, data, content_type)
+        self._remember(self.key(zoom, x, y), pixels)
+        return pixels
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                'memory': {'entries': len(self.memory.entries), 'bytes': self.memory.size,
+                           'max_bytes': self.memory.max_bytes, 'evictions': self.memory.evictions}
+            }
+
+
+def decode_tile(data: bytes) -> np.ndarray:
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = np.asarray(image.convert('RGB'))
+    if pixels.shape != (TILE_SIZE, TILE_SIZE, 3):
+        raise ValueError(f"瓦片尺寸 {pixels.shape} 不是 {TILE_SIZE}x{TILE_SIZE}")
+    return pixels
+
+
+class TileCompositor:
+    """
+    按窗口获取瓦片并拼接裁剪，线程安全
+    同一瓦片的并发请求合并为一次上游请求，一个窗口的多个瓦片由 workers 个线程并发获取
+    """
+
+    def __init__(self, api, tile_cache: TileCache, zoom: int = 18, size: Tuple[int, int] = (512, 512),
+                 image_format: str = 'JPEG', quality: int = 90, workers: int = 8):
+        self.api = api
+        self.cache = tile_cache
+        self.zoom = zoom
+        self.size = size
+        self.image_format = image_format
+        self.quality = quality
+        self.flights = SingleFlight()
+        self.lock = threading.Lock()
+        self.fetched = 0  # 从上游获取的瓦片数
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tile')
+
+    @property
+    def content_type(self) -> str:
+        return 'image/png' if self.image_format == 'PNG' else 'image/jpeg'
+
+    def tile(self, x: int, y: int) -> np.ndarray:
+        pixels = self.cache.get(self.zoom, x, y)
+        if pixels is not None:
+            return pixels
+
+        def fetch():
+            content, content_type = self.api.fetch(self.api.get_satellite_tile_url(self.zoom, x, y))
+            with self.lock:
+                self.fetched += 1
+            return self.cache.put(self.zoom, x, y, content, content_type or 'image/jpeg')
+
+        pixels, _ = self.flights.do(TileCache.key(self.zoom, x, y), fetch)
+        return pixels
+
+    def compose(self, lat: float, lon: float) -> np.ndarray:
+        """以 (lat, lon) 为中心的窗口像素 (高, 宽, 3)"""
+        tiles, columns, rows, (left, top) = window_tiles(lat, lon, self.zoom, self.size)
+        canvas = np.empty((rows * TILE_SIZE, columns * TILE_SIZE, 3), dtype=np.uint8)
+        for index, pixels in enumerate(self.executor.map(lambda tile: self.tile(*tile), tiles)):
+            row, column = divmod(index, columns)
+            canvas[row * TILE_SIZE:(row + 1) * TILE_SIZE, column * TILE_SIZE:(column + 1) * TILE_SIZE] = pixels
+        width, height = self.size
+        return canvas[top:top + height, left:left + width]
+
+    def render(self, lat: float, lon: float) -> Tuple[bytes, str]:
+        """
+        Returns:
+            tuple: (编码后的图像, Content-Type)
+        """
+        buffer = io.BytesIO()
+        options = {'quality': self.quality} if self.image_format == 'JPEG' else {}
+        Image.fromarray(self.compose(lat, lon)).save(buffer, self.image_format, **options)
+        return buffer.getvalue(), self.content_type
+
+    def missing_tiles(self, lat: float, lon: float) -> List[Tuple[int, int]]:
+        """窗口中持久层还没有的瓦片"""
+        tiles = window_tiles(lat, lon, self.zoom, self.size)[0]
+        return [(x, y) for x, y in tiles if not self.cache.contains(self.zoom, x, y)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {'zoom': self.zoom, 'size': list(self.size), **self.cache.stats(),
+                'fetched': self.fetched, 'coalesced': self.flights.stats()['coalesced']}
+
+
+def main():
+    from satellite_streetview_api import SatelliteStreetViewAPI, ESRI_TILE_URL
+
+    parser = argparse.ArgumentParser(description='用 XYZ 瓦片合成卫星图')
+    parser.add_argument('--lat', type=float, required=True, help='纬度')
+    parser.add_argument('--lon', type=float, required=True, help='经度')
+    parser.add_argument('--zoom', type=int, default=18, help='瓦片缩放级别 (18 约 0.45 米/像素, 19 约 0.23 米/像素)')
+    parser.add_argument('--size', type=int, default=512, help='输出图像边长(像素)')
+    parser.add_argument('--tile-url', default=ESRI_TILE_URL, help='瓦片地址模板')
+    parser.add_argument('--tile-cache-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'tiles'))
+    parser.add_argument('--output', default=None, help='输出文件 (默认 satellite_<lat>_<lon>_z<zoom>.jpg)')
+    args = parser.parse_args()
+
+    api = SatelliteStreetViewAPI(esri_tile_url=args.tile_url)
+    compositor = TileCompositor(api, TileCache(args.tile_cache_dir), args.zoom, (args.size, args.size))
+    content, _ = compositor.render(args.lat, args.lon)
+    output = args.output or f"satellite_{args.lat:.6f}_{args.lon:.6f}_z{args.zoom}.jpg"
+    with open(output, 'wb') as f:
+        f.write(content)
+    print(f"✅ 卫星图像已保存: {output} ({compositor.stats()})")
+
+
+if __name__ == '__main__':
+    main()
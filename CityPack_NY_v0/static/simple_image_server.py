@@ -1,40 +1,127 @@
 #!/usr/bin/env python3
 """
 简化的图像服务器，使用Python内置HTTP服务器
+每个请求由独立线程处理，慢的上游请求不会阻塞其他地图点击；
+所有线程共享同一个 SatelliteStreetViewAPI 及其 keep-alive 连接池
+图像先查两级缓存 (image_cache.py)，坐标对齐到 15 米网格后作为缓存键并向上游请求；
+同一个键的并发未命中请求合并为一个上游请求 (single_flight.py)，街景搜索结果按位置缓存，
+/api/images 查到的街景信息随后的 /api/streetview 直接使用
+--satellite-mode tiles 用缓存的 XYZ 瓦片在本地合成卫星图 (satellite_tiles.py)，代替按点请求 ESRI export
+--streetview-index 用本地街景元数据索引 (streetview_index.py) 查找最近的街景，只为图像内容请求上游
+--packed-store 使用打包存储 (packed_store.py) 代替每个坐标一个文件的磁盘缓存，prefetch_images.py 预取的图像直接可用
+size=thumb|panel|full 返回转码后的 WebP/AVIF 版本 (image_variants.py)，不带 size 时返回上游原图；
+图像响应带 ETag 和 Cache-Control，If-None-Match 匹配时返回 304
+POST /api/images/batch 为评测任务批量获取一组坐标的图像，返回元数据和按 sha256 引用的图像 (/api/blobs/<sha256>)，
+或以 tar 流返回图像和清单
 """
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, HTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
+import argparse
+import hashlib
+import io
 import json
-import sys
-from satellite_streetview_api import SatelliteStreetViewAPI
+import os
+import tarfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from image_cache import EXTENSIONS, ImageCache, MetadataCache, cache_key, snap_to_grid
+from image_variants import VARIANT_SIZES, FORMATS, variant_key
+from packed_store import PackedStore
+from satellite_streetview_api import SatelliteStreetViewAPI, ESRI_BASE_URL, ESRI_TILE_URL, MAPILLARY_BASE_URL
+from single_flight import SingleFlight
 import requests
 
+BATCH_KINDS = ('satellite', 'streetview')
+# 批量请求体上限 (1 万个坐标的 JSON 约 0.5MB)
+MAX_BATCH_BODY = 16 << 20
+
+class NotFound(Exception):
+    """附近没有街景，返回 404"""
+
+class ChunkedWriter:
+    """长度未知的流式响应：HTTP/1.1 用分块编码，HTTP/1.0 直接写入后关闭连接"""
+
+    def __init__(self, wfile, chunked=True):
+        self.wfile = wfile
+        self.chunked = chunked
+
+    def write(self, data):
+        if not data:
+            return 0
+        if self.chunked:
+            self.wfile.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+        else:
+            self.wfile.write(data)
+        return len(data)
+
+    def close(self):
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
 class ImageHandler(BaseHTTPRequestHandler):
-    def __init__(self, *args, **kwargs):
-        self.api = SatelliteStreetViewAPI()
-        super().__init__(*args, **kwargs)
+    # 客户端连接保持 keep-alive
+    protocol_version = 'HTTP/1.1'
+    # 由 make_server 设置，所有请求共享
+    api = None
+    cache = None
+    flights = None
+    search_cache = None
+    packed_store = None
+    tiles = None
+    streetview_index = None
+    streetview_radius = 100
+    transcoder = None
+    max_age = 86400
+    batch_executor = None
+    batch_max_points = 2000
+    blobs = None  # sha256 -> 图像来源 (类型, 纬度, 经度, 质量, 朝向, 版本)，用于 /api/blobs
 
     def do_GET(self):
         try:
             parsed_url = urlparse(self.path)
             path = parsed_url.path
             query_params = parse_qs(parsed_url.query)
-            
+
             if path == '/api/images':
                 self.handle_images_info(query_params)
             elif path == '/api/satellite':
                 self.handle_satellite_image(query_params)
             elif path == '/api/streetview':
                 self.handle_streetview_image(query_params)
+            elif path.startswith('/api/blobs/'):
+                self.handle_blob(path[len('/api/blobs/'):])
             elif path == '/health':
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                self.wfile.write(json.dumps({'status': 'ok'}).encode())
+                health = {'status': 'ok', 'single_flight': self.flights.stats(),
+                          'search_cache': self.search_cache.stats()}
+                if self.cache:
+                    health['cache'] = self.cache.stats()
+                if self.packed_store is not None:
+                    health['packed_store'] = self.packed_store.stats()
+                if self.tiles is not None:
+                    health['tiles'] = self.tiles.stats()
+                if self.streetview_index is not None:
+                    health['streetview_index'] = self.streetview_index.stats()
+                if self.transcoder is not None:
+                    health['transcoder'] = self.transcoder.stats()
+                health['blobs'] = self.blobs.stats()
+                self.send_json(health)
+            else:
+                self.send_error(404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            print(f"Error: {e}")
+            self.send_error(500, str(e))
+
+    def do_POST(self):
+        try:
+            if urlparse(self.path).path == '/api/images/batch':
+                self.handle_batch()
             else:
                 self.send_error(404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
         except Exception as e:
             print(f"Error: {e}")
             self.send_error(500, str(e))
@@ -44,8 +131,48 @@ class ImageHandler(BaseHTTPRequestHandler):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
+    def log_message(self, format, *args):
+        # 并发请求时逐条访问日志过多，只记录错误
+        pass
+
+    def send_body(self, body, content_type, cache_status=None, vary=False):
+        """
+        图像响应带内容哈希 ETag 和 Cache-Control，浏览器缓存过期后带 If-None-Match 重新验证，未变化时返回 304；
+        vary=True 表示格式按 Accept 协商
+        """
+        image = content_type.startswith('image/')
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"' if image else None
+        not_modified = etag is not None and etag in self.headers.get('If-None-Match', '')
+        self.send_response(304 if not_modified else 200)
+        if not not_modified:
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+        if image:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', f'public, max-age={self.max_age}')
+            if vary:
+                self.send_header('Vary', 'Accept')
+        if cache_status:
+            # memory / disk / store / miss / coalesced (共用并发请求的结果) / transcoded (刚转码的版本)
+            self.send_header('X-Cache', cache_status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(body)
+
+    def send_json(self, data):
+        self.send_body(json.dumps(data).encode(), 'application/json')
+
+    def send_upstream_error(self, e):
+        """上游超时返回 504，其他上游错误返回 502"""
+        if isinstance(e, requests.Timeout):
+            self.send_error(504, f"Upstream timeout: {e}")
+        else:
+            self.send_error(502, f"Upstream error: {e}")
+
     def get_lat_lon(self, query_params):
         try:
             lat = float(query_params.get('lat', [None])[0])
@@ -55,76 +182,554 @@ class ImageHandler(BaseHTTPRequestHandler):
             raise ValueError("Missing lat/lon parameters")
 
     def handle_images_info(self, query_params):
+        def search(lat, lon):
+            # 与 search_nearby_streetview 相同，搜索失败时仍返回卫星图信息
+            try:
+                return self.search_streetview(lat, lon)
+            except requests.RequestException as e:
+                print(f"❌ 搜索街景图像失败: {e}")
+                return None
+
         try:
             lat, lon = self.get_lat_lon(query_params)
-            info = self.api.get_images_info(lat, lon)
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(info).encode())
+            info = self.api.get_images_info(lat, lon, search=search)
         except Exception as e:
             self.send_error(400, str(e))
+            return
+        self.send_json(info)
 
     def handle_satellite_image(self, query_params):
         try:
             lat, lon = self.get_lat_lon(query_params)
-            url = self.api.get_satellite_image_url(lat, lon)
-            
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'image/png')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(response.content)
-        except Exception as e:
-            self.send_error(500, str(e))
+            variant = self.get_variant(query_params)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_image(*self.satellite_source(lat, lon), variant)
 
     def handle_streetview_image(self, query_params):
         try:
             lat, lon = self.get_lat_lon(query_params)
-            quality = query_params.get('quality', ['1024'])[0]
-            
-            streetview_info = self.api.search_nearby_streetview(lat, lon)
-            if not streetview_info:
-                self.send_error(404, "No street view available")
-                return
-            
-            url_key = f'thumb_{quality}_url'
-            image_url = streetview_info.get(url_key)
-            
-            if not image_url:
-                for alt_quality in ['1024', '256', '2048']:
-                    alt_url_key = f'thumb_{alt_quality}_url'
-                    image_url = streetview_info.get(alt_url_key)
-                    if image_url:
-                        break
-            
-            if not image_url:
-                self.send_error(404, "No image URL available")
+            variant = self.get_variant(query_params)
+            heading = self.get_heading(query_params.get('heading', [None])[0])
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        quality = query_params.get('quality', ['1024'])[0]
+        self.send_image(*self.streetview_source(lat, lon, quality, heading), variant)
+
+    def handle_batch(self):
+        """
+        请求体 (JSON):
+            points: [[lat, lon], ...] 或 [{"lat", "lon", "heading"}, ...]
+            kinds: 默认 ["satellite", "streetview"]；quality: 街景质量，默认 "1024"
+            size / format: 与单张图像的参数相同，返回转码后的版本
+            response: "json" (默认，图像为 sha256 引用) 或 "tar" (图像和 manifest.json 的 tar 流)，
+                      也可以用 Accept: application/x-tar
+        所有坐标由共享的线程池并发获取，与单张图像的请求共用缓存和请求合并；单个坐标的错误记录在结果中
+        """
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length > MAX_BATCH_BODY:
+                self.send_error(413, "Request body too large")
                 return
-            
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'image/jpeg')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(response.content)
+            body = json.loads(self.rfile.read(length) or b'{}')
+            points = [self.parse_batch_point(point) for point in body.get('points', [])]
+            kinds = body.get('kinds', list(BATCH_KINDS))
+            if not points or not kinds or set(kinds) - set(BATCH_KINDS):
+                raise ValueError(f"Expected points and kinds from {', '.join(BATCH_KINDS)}")
+            variant = self.get_variant({'size': [body.get('size')], 'format': [body.get('format')]})
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_error(400, str(e))
+            return
+        if len(points) > self.batch_max_points:
+            self.send_error(413, f"At most {self.batch_max_points} points per batch")
+            return
+        quality = str(body.get('quality', '1024'))
+        as_tar = body.get('response') == 'tar' or 'application/x-tar' in self.headers.get('Accept', '')
+
+        start = time.time()
+        results = [{'index': index, 'location': {'lat': lat, 'lon': lon}} for index, (lat, lon, _) in enumerate(points)]
+        jobs = {self.batch_executor.submit(self.batch_image, kind, lat, lon, quality, heading, variant): (index, kind)
+                for index, (lat, lon, heading) in enumerate(points) for kind in kinds}
+        if as_tar:
+            self.send_batch_tar(jobs, results, start)
+            return
+        images = set()
+        for job in as_completed(jobs):
+            index, kind = jobs[job]
+            entry, content = job.result()
+            results[index][kind] = entry
+            if content is not None:
+                images.add(entry['sha256'])
+        self.send_json(self.batch_manifest(results, len(images), start))
+
+    def parse_batch_point(self, point):
+        if isinstance(point, dict):
+            return float(point['lat']), float(point['lon']), self.get_heading(point.get('heading'))
+        lat, lon = point[:2]
+        return float(lat), float(lon), None
+
+    def batch_image(self, kind, lat, lon, quality, heading, variant):
+        """
+        批量请求中一个坐标的一类图像
+
+        Returns:
+            tuple: (结果项, 图像内容)，没有图像时内容为 None
+        """
+        entry = {}
+        try:
+            if kind == 'satellite':
+                key, fetch = self.satellite_source(lat, lon)
+            else:
+                streetview_info = self.search_streetview(*self.cache_location(kind, lat, lon)[:2], heading)
+                entry = {'available': streetview_info is not None, 'info': streetview_info}
+                if streetview_info is None:
+                    return entry, None
+                key, fetch = self.streetview_source(lat, lon, quality, heading)
+            content, content_type, cache_status = self.load_image(key, fetch, variant)
+        except NotFound:
+            return {'available': False, 'info': None}, None
+        except requests.RequestException as e:
+            entry['error'] = f"Upstream error: {e}"
+            return entry, None
         except Exception as e:
-            self.send_error(500, str(e))
+            print(f"❌ 批量获取 {kind} ({lat}, {lon}) 失败: {e}")
+            entry['error'] = str(e)
+            return entry, None
+        digest = hashlib.sha256(content).hexdigest()
+        self.blobs.put(digest, (kind, lat, lon, quality, heading, variant))
+        entry.update({'sha256': digest, 'content_type': content_type, 'bytes': len(content), 'cache': cache_status,
+                      'url': f'/api/blobs/{digest}'})
+        return entry, content
 
-if __name__ == "__main__":
-    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
-    server = HTTPServer(('localhost', port), ImageHandler)
-    print(f"🚀 Image server running on http://localhost:{port}")
+    def batch_manifest(self, results, images, start):
+        return {'count': len(results), 'images': images, 'elapsed_s': round(time.time() - start, 3),
+                'errors': sum(1 for result in results for kind in BATCH_KINDS if 'error' in result.get(kind, {})),
+                'results': results}
+
+    def send_batch_tar(self, jobs, results, start):
+        """
+        tar 流：图像按完成顺序写为 images/<sha256>.<扩展名> (相同内容只写一次)，最后写 manifest.json
+        (与 JSON 响应相同，结果项带 path)；长度未知，HTTP/1.1 使用分块编码
+        """
+        chunked = self.protocol_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-tar')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        writer = ChunkedWriter(self.wfile, chunked)
+        written = set()
+        with tarfile.open(fileobj=writer, mode='w|') as archive:
+            for job in as_completed(jobs):
+                index, kind = jobs[job]
+                entry, content = job.result()
+                results[index][kind] = entry
+                if content is None:
+                    continue
+                entry['path'] = f"images/{entry['sha256']}{EXTENSIONS.get(entry['content_type'], '.jpg')}"
+                if entry['sha256'] not in written:
+                    written.add(entry['sha256'])
+                    self.add_tar_member(archive, entry['path'], content)
+            manifest = self.batch_manifest(results, len(written), start)
+            self.add_tar_member(archive, 'manifest.json', json.dumps(manifest).encode())
+        writer.close()
+
+    @staticmethod
+    def add_tar_member(archive, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        archive.addfile(info, io.BytesIO(data))
+
+    def handle_blob(self, digest):
+        """
+        按 sha256 返回批量请求中引用的图像：记录图像来源，按来源重新查询 (通常命中缓存)，
+        内容已变化 (如缓存过期后上游图像更新) 或记录已淘汰时返回 404，需要重新发送批量请求
+        """
+        hit, source = self.blobs.get(digest)
+        if not hit:
+            self.send_error(404, "Unknown image, request the batch again")
+            return
+        kind, lat, lon, quality, heading, variant = source
+        if kind == 'satellite':
+            key, fetch = self.satellite_source(lat, lon)
+        else:
+            key, fetch = self.streetview_source(lat, lon, quality, heading)
+        try:
+            content, content_type, cache_status = self.load_image(key, fetch, variant)
+        except NotFound as e:
+            self.send_error(404, str(e))
+            return
+        except requests.RequestException as e:
+            self.send_upstream_error(e)
+            return
+        if hashlib.sha256(content).hexdigest() != digest:
+            self.send_error(404, "Image changed, request the batch again")
+            return
+        self.send_body(content, content_type, cache_status)
+
+    def get_heading(self, value):
+        """朝向按 45 度取整，没有本地索引或未指定时为 None"""
+        if self.streetview_index is None or value in (None, ''):
+            return None
+        try:
+            return int(round(float(value) / 45)) % 8 * 45
+        except (TypeError, ValueError):
+            raise ValueError("Invalid heading")
+
+    def satellite_source(self, lat, lon):
+        """
+        Returns:
+            tuple: (缓存键, 未命中时获取并保存图像的函数)
+        """
+        # 瓦片合成的图像与 export 的范围不同，缓存键带上缩放级别 (satellite_<lat>_<lon>_z18)
+        quality = f'z{self.tiles.zoom}' if self.tiles is not None else None
+        lat, lon, key = self.cache_location('satellite', lat, lon, quality)
+
+        def fetch():
+            if self.tiles is not None:
+                content, content_type = self.tiles.render(lat, lon)
+                return self.save_image(key, content, content_type)
+            url = self.api.get_satellite_image_url(lat, lon)
+            content, content_type = self.api.fetch(url)
+            return self.save_image(key, content, content_type or 'image/png')
+
+        return key, fetch
+
+    def streetview_source(self, lat, lon, quality='1024', heading=None):
+        """同 satellite_source，heading 不为 None 时缓存键带上朝向 (streetview_<lat>_<lon>_1024_h90)"""
+        cache_quality = quality if heading is None else f'{quality}_h{heading}'
+        lat, lon, key = self.cache_location('streetview', lat, lon, cache_quality)
+
+        def fetch():
+            streetview_info = self.search_streetview(lat, lon, heading)
+            if not streetview_info:
+                raise NotFound("No street view available")
+            content, content_type = self.fetch_thumb(streetview_info, quality)
+            return self.save_image(key, content, content_type or 'image/jpeg')
+
+        return key, fetch
+
+    def fetch_thumb(self, streetview_info, quality):
+        """
+        获取街景缩略图；索引中保存的缩略图 URL 带签名可能已过期，
+        上游拒绝时按 id 重新获取 URL 再试一次
+        """
+        image_url, _ = self.api.select_thumb_url(streetview_info, quality)
+        if not image_url:
+            raise NotFound("No image URL available")
+        try:
+            return self.api.fetch(image_url)
+        except requests.HTTPError as e:
+            if self.streetview_index is None or e.response is None or e.response.status_code not in (400, 403, 404, 410):
+                raise
+        image_url, _ = self.api.select_thumb_url(self.api.get_streetview_image(streetview_info['id']), quality)
+        if not image_url:
+            raise NotFound("No image URL available")
+        return self.api.fetch(image_url)
+
+    def search_streetview(self, lat, lon, heading=None):
+        """
+        带缓存的街景搜索，同一网格点的并发搜索合并为一个上游请求
+        上游错误抛出 requests.RequestException (不缓存)，附近没有街景返回 None (缓存)
+        有本地索引时直接查询索引 (heading 不为 None 时只找朝向接近的图像)，不请求上游
+        """
+        if self.streetview_index is not None:
+            return self.streetview_index.find(lat, lon, heading, self.streetview_radius)
+        if self.cache:
+            lat, lon = self.cache.snap(lat, lon)
+        key = self.flight_key('search', lat, lon)
+        hit, streetview_info = self.search_cache.get(key)
+        if hit:
+            return streetview_info
+
+        def search():
+            result = self.api.find_nearby_streetview(lat, lon)
+            self.search_cache.put(key, result)
+            return result
+
+        streetview_info, _ = self.flights.do(key, search)
+        return streetview_info
+
+    def get_variant(self, query_params):
+        """
+        size 参数对应的 (尺寸, 格式)，不带 size 或未启用转码 (没有 Pillow、--image-formats none) 时为 None (返回原图)
+        格式由 format 参数指定，否则按 Accept 选择：浏览器接受且已启用时用 AVIF，否则用 WebP
+        """
+        size = query_params.get('size', [None])[0]
+        if not size:
+            return None
+        if size not in VARIANT_SIZES:
+            raise ValueError(f"Invalid size: {size} (expected {', '.join(VARIANT_SIZES)})")
+        if self.transcoder is None:
+            return None
+        image_format = query_params.get('format', [None])[0]
+        if image_format is None:
+            accept = self.headers.get('Accept', '')
+            image_format = 'avif' if 'avif' in self.transcoder.formats and 'image/avif' in accept else 'webp'
+        if image_format not in self.transcoder.formats:
+            raise ValueError(f"Format not enabled: {image_format}")
+        return size, image_format
+
+    def send_image(self, key, fetch, variant=None):
+        try:
+            content, content_type, cache_status = self.load_image(key, fetch, variant)
+        except NotFound as e:
+            self.send_error(404, str(e))
+            return
+        except requests.RequestException as e:
+            self.send_upstream_error(e)
+            return
+        self.send_body(content, content_type, cache_status, vary=variant is not None)
+
+    def load_image(self, key, fetch, variant=None):
+        """
+        key 的图像：variant 为 (尺寸, 格式) 时先查转码后的版本，没有时取原图 (缓存或 fetch) 再转码；
+        无法解码的原图直接返回。没有街景抛出 NotFound，上游错误抛出 requests.RequestException
+
+        Returns:
+            tuple: (图像内容, Content-Type, 命中层)
+        """
+        if variant is not None:
+            cached = self.lookup_key(variant_key(key, *variant))
+            if cached:
+                return cached
+        cached = self.lookup_key(key)
+        if cached:
+            content, content_type, cache_status = cached
+        else:
+            content, content_type, cache_status = self.fetch_original(key, fetch)
+        if variant is None:
+            return content, content_type, cache_status
+        size, image_format = variant
+        try:
+            variants = self.transcode_variants(key, content, image_format)
+        except Exception as e:
+            print(f"⚠️  转码 {key} 失败: {e}")
+            return content, content_type, cache_status
+        return variants[size], FORMATS[image_format], 'transcoded'
+
+    def fetch_original(self, key, fetch):
+        """
+        缓存未命中：合并同一个键的并发请求，fetch 返回 (图像内容, Content-Type)
+        新获取的图像在后台转码为所有版本
+        """
+        (content, content_type), shared = self.flights.do(key, fetch)
+        if shared:
+            return content, content_type, 'coalesced'
+        if self.transcoder is not None:
+            for image_format in self.transcoder.formats:
+                self.transcoder.schedule(self.transcode_in_background, key, content, image_format)
+        return content, content_type, 'miss' if self.cache or self.packed_store is not None else None
+
+    def transcode_variants(self, key, content, image_format):
+        """在进程池中生成 key 的所有尺寸 (同一张图像的并发转码合并为一次)，保存后返回 {尺寸: 内容}"""
+        def transcode():
+            variants = self.transcoder.transcode(content, image_format)
+            for size, data in variants.items():
+                self.save_image(variant_key(key, size, image_format), data, FORMATS[image_format])
+            return variants
+
+        variants, _ = self.flights.do(variant_key(key, 'all', image_format), transcode)
+        return variants
+
+    def transcode_in_background(self, key, content, image_format):
+        if self.has_image(variant_key(key, 'full', image_format)):
+            return
+        try:
+            self.transcode_variants(key, content, image_format)
+        except Exception as e:
+            print(f"⚠️  转码 {key} 失败: {e}")
+
+    def cache_location(self, kind, lat, lon, quality=None):
+        """
+        坐标对齐到缓存网格
+
+        Returns:
+            tuple: (对齐后的纬度, 经度, 缓存键)，不使用缓存和打包存储时坐标不对齐，键只用于合并请求
+        """
+        if self.cache:
+            lat, lon = self.cache.snap(lat, lon)
+            return lat, lon, self.cache.key(kind, lat, lon, quality)
+        if self.packed_store is not None:
+            lat, lon = snap_to_grid(lat, lon)
+            return lat, lon, cache_key(kind, lat, lon, quality)
+        return lat, lon, self.flight_key(kind, lat, lon, quality)
+
+    def lookup_key(self, key):
+        """
+        依次查询内存/磁盘缓存和打包存储
+
+        Returns:
+            tuple: 命中时为 (图像内容, Content-Type, 命中层)，否则为 None
+        """
+        cached = None
+        if self.cache:
+            cached = self.cache.get(key)
+        if cached is None and self.packed_store is not None:
+            entry = self.packed_store.get(key)
+            if entry is not None:
+                cached = entry[0], entry[1], 'store'
+                if self.cache:
+                    self.cache.put(key, entry[0], entry[1], disk=False)
+        return cached
+
+    def has_image(self, key):
+        """缓存或打包存储中是否有 key (不读取内容，不计入命中统计)"""
+        if self.cache and key in self.cache:
+            return True
+        return self.packed_store is not None and key in self.packed_store
+
+    def flight_key(self, kind, lat, lon, quality=None):
+        if self.cache:
+            return self.cache.key(kind, lat, lon, quality)
+        key = f"{kind}_{lat:.6f}_{lon:.6f}"
+        return f"{key}_{quality}" if quality else key
+
+    def save_image(self, key, content, content_type):
+        """可写的打包存储代替磁盘缓存，内存缓存照常"""
+        if self.packed_store is not None and not self.packed_store.readonly:
+            self.packed_store.put(key, content, content_type)
+            if self.cache:
+                self.cache.put(key, content, content_type, disk=False)
+        elif self.cache:
+            self.cache.put(key, content, content_type)
+        return content, content_type
+
+class ImageServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认 backlog 为 5，大量并发连接同时到达时会被丢弃并在约 1 秒后重传
+    request_queue_size = 128
+
+def make_server(api, host='localhost', port=8081, threaded=True, cache=None, search_cache=None, packed_store=None,
+                tiles=None, streetview_index=None, streetview_radius=100, transcoder=None, max_age=86400,
+                batch_workers=16, batch_max_points=2000):
+    """
+    创建图像服务器
+    threaded=False 时与原来的单线程 HTTP/1.0 服务器相同 (仅用于压测对比)，cache 为 None 时不缓存图像，
+    packed_store 为打包存储，只读打开时只用于查询；tiles 为 satellite_tiles.TileCompositor 时用瓦片合成卫星图；
+    streetview_index 为 streetview_index.StreetViewIndex 时在本地查找 streetview_radius 米内最近的街景；
+    transcoder 为 image_variants.Transcoder 时支持 size 参数；max_age 为图像响应的 Cache-Control max-age(秒)；
+    所有批量请求共用 batch_workers 个线程，每个批量请求最多 batch_max_points 个坐标
+    """
+    attributes = {'api': api, 'cache': cache, 'flights': SingleFlight(),
+                  'search_cache': search_cache or MetadataCache(), 'packed_store': packed_store, 'tiles': tiles,
+                  'streetview_index': streetview_index, 'streetview_radius': streetview_radius,
+                  'transcoder': transcoder, 'max_age': max_age,
+                  'batch_executor': ThreadPoolExecutor(batch_workers, thread_name_prefix='batch'),
+                  'batch_max_points': batch_max_points, 'blobs': MetadataCache(max_entries=1_000_000, ttl=86400)}
+    if not threaded:
+        attributes['protocol_version'] = 'HTTP/1.0'
+    handler = type('Handler', (ImageHandler,), attributes)
+    server_class = ImageServer if threaded else HTTPServer
+    return server_class((host, port), handler)
+
+def main():
+    parser = argparse.ArgumentParser(description='卫星图和街景图服务器')
+    parser.add_argument('port', type=int, nargs='?', default=8081, help='端口')
+    parser.add_argument('--host', default='localhost', help='监听地址')
+    parser.add_argument('--esri-url', default=ESRI_BASE_URL, help='卫星图像服务地址')
+    parser.add_argument('--mapillary-url', default=MAPILLARY_BASE_URL, help='街景服务地址')
+    parser.add_argument('--satellite-mode', choices=['export', 'tiles'], default='export',
+                        help='export: 按点请求 ESRI export; tiles: 用缓存的 XYZ 瓦片合成')
+    parser.add_argument('--esri-tile-url', default=ESRI_TILE_URL, help='卫星瓦片地址模板')
+    parser.add_argument('--tile-zoom', type=int, default=18, help='瓦片缩放级别 (18 或 19)')
+    parser.add_argument('--tile-cache-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'tiles'),
+                        help='瓦片缓存目录 (使用打包存储时瓦片存入打包存储)')
+    parser.add_argument('--tile-memory-mb', type=int, default=128, help='瓦片内存缓存上限(MB)')
+    parser.add_argument('--pool-size', type=int, default=16, help='每个上游主机的最大连接数')
+    parser.add_argument('--connect-timeout', type=float, default=5, help='上游连接超时(秒)')
+    parser.add_argument('--read-timeout', type=float, default=30, help='上游读取超时(秒)')
+    parser.add_argument('--retries', type=int, default=3, help='上游请求重试次数')
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'images'),
+                        help='磁盘缓存目录')
+    parser.add_argument('--memory-cache-mb', type=int, default=64, help='内存缓存上限(MB)')
+    parser.add_argument('--disk-cache-mb', type=int, default=1024, help='磁盘缓存上限(MB)')
+    parser.add_argument('--cache-ttl-days', type=float, default=30, help='缓存过期时间(天)')
+    parser.add_argument('--search-cache-ttl', type=float, default=3600,
+                        help='街景搜索结果缓存时间(秒)，不超过 Mapillary 缩略图 URL 的有效期')
+    parser.add_argument('--no-cache', action='store_true', help='不使用缓存')
+    parser.add_argument('--streetview-index', default=None, help='streetview_index.py 采集的 GeoParquet 街景索引')
+    parser.add_argument('--streetview-radius', type=float, default=100, help='使用索引时街景的最大距离(米)')
+    parser.add_argument('--streetview-refresh-hours', type=float, default=0,
+                        help='后台重新采集街景索引的间隔(小时)，0 时只在索引文件更新后重新加载')
+    parser.add_argument('--image-formats', default='webp',
+                        help='size 参数返回的转码格式，逗号分隔 (webp, avif)；none 时不转码')
+    parser.add_argument('--transcode-workers', type=int, default=None, help='转码进程数 (默认 CPU 核数)')
+    parser.add_argument('--max-age', type=int, default=86400, help='图像响应的浏览器缓存时间(秒)')
+    parser.add_argument('--batch-workers', type=int, default=16, help='批量请求共用的并发数')
+    parser.add_argument('--batch-max-points', type=int, default=2000, help='每个批量请求的最大坐标数')
+    parser.add_argument('--packed-store', default=None, help='打包存储目录，代替 --cache-dir 的磁盘缓存')
+    parser.add_argument('--packed-store-readonly', action='store_true', help='只读打包存储，未命中的图像仍写入 --cache-dir')
+    args = parser.parse_args()
+
+    api = SatelliteStreetViewAPI(args.esri_url, args.mapillary_url, args.pool_size,
+                                 args.connect_timeout, args.read_timeout, args.retries, args.esri_tile_url)
+    packed_store = None
+    if args.packed_store:
+        packed_store = PackedStore(args.packed_store, readonly=args.packed_store_readonly)
+        print(f"📦 打包存储: {args.packed_store} ({len(packed_store):,} 张图像)")
+    cache = None
+    if not args.no_cache:
+        # 可写的打包存储代替磁盘缓存，只保留内存一级
+        cache_dir = None if packed_store is not None and not packed_store.readonly else args.cache_dir
+        cache = ImageCache(cache_dir, args.memory_cache_mb << 20, args.disk_cache_mb << 20,
+                           args.cache_ttl_days * 86400)
+        if cache_dir:
+            print(f"💾 缓存目录: {cache_dir} ({len(cache.disk.entries)} 张图像)")
+    tiles = None
+    if args.satellite_mode == 'tiles':
+        # 需要 NumPy 和 Pillow，只在瓦片模式下导入
+        from satellite_tiles import TileCache, TileCompositor
+        # 有打包存储时瓦片从打包存储读取 (只读时未命中的瓦片只保存在内存)，否则使用瓦片缓存目录
+        tile_dir = None if args.no_cache or packed_store is not None else args.tile_cache_dir
+        tile_cache = TileCache(tile_dir, packed_store, args.tile_memory_mb << 20, args.cache_ttl_days * 86400)
+        tiles = TileCompositor(api, tile_cache, args.tile_zoom, workers=min(8, args.pool_size))
+        print(f"🧩 卫星图使用 z{args.tile_zoom} 瓦片合成, 瓦片缓存: {tile_dir or args.packed_store or '仅内存'}")
+    streetview_index = None
+    if args.streetview_index:
+        # 需要 pyarrow 和 scipy，只在使用索引时导入
+        from streetview_index import StreetViewIndex, IndexRefresher
+        streetview_index = StreetViewIndex(args.streetview_index)
+        refresh_api = api if args.streetview_refresh_hours > 0 else None
+        IndexRefresher(streetview_index, refresh_api, args.streetview_refresh_hours * 3600).start()
+        print(f"🗂️ 街景索引: {args.streetview_index} ({len(streetview_index):,} 张)")
+    transcoder = None
+    if args.image_formats != 'none':
+        from image_variants import Transcoder
+        formats = [image_format.strip() for image_format in args.image_formats.split(',') if image_format.strip()]
+        try:
+            transcoder = Transcoder(args.transcode_workers, formats)
+            print(f"🎞️ 转码: {', '.join(formats)} ({transcoder.workers} 个进程)")
+        except ImportError:
+            # 转码默认开启，没有 Pillow 时只返回原图
+            print("⚠️  未安装 Pillow，不支持 size 参数 (pip install pillow)")
+    server = make_server(api, args.host, args.port, cache=cache, search_cache=MetadataCache(ttl=args.search_cache_ttl),
+                         packed_store=packed_store, tiles=tiles, streetview_index=streetview_index,
+                         streetview_radius=args.streetview_radius, transcoder=transcoder, max_age=args.max_age,
+                         batch_workers=args.batch_workers, batch_max_points=args.batch_max_points)
+    print(f"🚀 Image server running on http://{args.host}:{args.port}")
     print("Endpoints:")
     print(f"  /api/images?lat=40.7589&lon=-73.9851")
     print(f"  /api/satellite?lat=40.7589&lon=-73.9851")
     print(f"  /api/streetview?lat=40.7589&lon=-73.9851")
+    print(f"  /api/streetview?lat=40.7589&lon=-73.9851&size=panel")
+    print(f"  POST /api/images/batch")
     print(f"  /health")
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if transcoder is not None:
+            transcoder.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+请求合并 (single-flight)
+同一个键同时只有一个上游请求在进行，其他并发请求等待并共用它的结果或异常，
+避免多个用户同时点击同一网格点时重复请求 ESRI / Mapillary
+"""
+
+import threading
+from typing import Any, Callable, Dict, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[str, _Call] = {}
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行 fn，同一个 key 已有请求在进行时等待它完成
+
+        Returns:
+            tuple: (fn 的结果, 是否共用了其他请求的结果)；fn 抛出的异常会在所有等待者中重新抛出
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self.calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # 先移除再唤醒，之后到达的请求重新查缓存或发起新请求
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'in_flight': len(self.calls), 'coalesced': self.coalesced}
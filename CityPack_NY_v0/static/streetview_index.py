@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+本地街景元数据索引
+search_nearby_streetview 每次查询都请求 Mapillary (固定 ±0.001° 范围, limit=10)，并直接取第一张作为"最近"的图像。
+这里预先采集范围内所有街景图像的位置 (id、经纬度、拍摄时间、朝向、缩略图 URL)，保存为 GeoParquet，
+加载后建 KD 树，在本地回答真正的 k 近邻和按朝向过滤的查询 (每次查询几十微秒)，图像服务器只为图像内容请求上游
+
+- harvest: 把范围切成小格分别查询 Mapillary，返回数量达到 limit 的格子再四等分，直到取全
+- GeoParquet: 每张图像一行，geometry 列为 WKB 点 (WGS84)，可直接用 geopandas.read_parquet 读取
+- 距离按等距圆柱投影换算为米，曼哈顿范围内误差可以忽略
+- IndexRefresher: 后台定期重新采集并原子替换索引文件，或只在文件被其他进程更新后重新加载
+
+Usage:
+    python streetview_index.py harvest --index cache/streetview_index.parquet
+    python streetview_index.py query --lat 40.7589 --lon -73.9851 --heading 90 --k 3
+    python streetview_index.py bench --queries 100000
+"""
+
+import argparse
+import json
+import math
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy.spatial import cKDTree
+
+from image_cache import METERS_PER_DEGREE
+
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INDEX = os.path.join(STATIC_DIR, 'cache', 'streetview_index.parquet')
+# 与 manifest.yaml 中的 extent 一致
+MANHATTAN_EXTENT = (-74.0479, 40.6829, -73.9067, 40.8820)
+THUMB_SIZES = ('256', '1024', '2048')
+COLUMNS = ['id', 'lon', 'lat', 'captured_at', 'compass_angle'] + [f'thumb_{size}_url' for size in THUMB_SIZES] + \
+          ['harvested_at']
+SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('lon', pa.float64()),
+    ('lat', pa.float64()),
+    ('captured_at', pa.int64()),
+    ('compass_angle', pa.float64()),
+    ('thumb_256_url', pa.string()),
+    ('thumb_1024_url', pa.string()),
+    ('thumb_2048_url', pa.string()),
+    ('harvested_at', pa.float64()),
+    ('geometry', pa.binary())
+])
+
+
+def harvest(api, bbox: Tuple[float, float, float, float] = MANHATTAN_EXTENT, cell: float = 0.005,
+            limit: int = 2000, workers: int = 4, min_cell: float = 0.0002) -> List[Dict[str, Any]]:
+    """
+    采集 bbox (min_lon, min_lat, max_lon, max_lat) 内的街景图像，同一 id 只保留一条
+
+    Returns:
+        list: 索引记录 (COLUMNS 中除 harvested_at 外的字段)
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    cells = [(lon, lat, min(lon + cell, max_lon), min(lat + cell, max_lat))
+             for lon in np.arange(min_lon, max_lon, cell) for lat in np.arange(min_lat, max_lat, cell)]
+    records = {}
+    queries = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while cells:
+            results = list(executor.map(lambda box: api.search_streetview_bbox(*box, limit=limit), cells))
+            queries += len(cells)
+            next_cells = []
+            for box, images in zip(cells, results):
+                if len(images) >= limit and box[2] - box[0] > min_cell:
+                    # 可能没有取全，四等分后重新查询
+                    mid_lon, mid_lat = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+                    next_cells += [(box[0], box[1], mid_lon, mid_lat), (mid_lon, box[1], box[2], mid_lat),
+                                   (box[0], mid_lat, mid_lon, box[3]), (mid_lon, mid_lat, box[2], box[3])]
+                    continue
+                for image in images:
+                    record = to_record(image)
+                    if record is not None:
+                        records[record['id']] = record
+            cells = next_cells
+            print(f"   已查询 {queries:,} 个范围, {len(records):,} 张街景")
+    return list(records.values())
+
+
+def to_record(image: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Mapillary 图像字段 -> 索引记录，没有位置的图像返回 None"""
+    geometry = image.get('computed_geometry')
+    if not geometry:
+        return None
+    lon, lat = geometry['coordinates'][:2]
+    record = {'id': str(image['id']), 'lon': float(lon), 'lat': float(lat),
+              'captured_at': image.get('captured_at'), 'compass_angle': image.get('compass_angle')}
+    for size in THUMB_SIZES:
+        record[f'thumb_{size}_url'] = image.get(f'thumb_{size}_url')
+    return record
+
+
+def write_index(records: List[Dict[str, Any]], path: str, harvested_at: Optional[float] = None):
+    """写入 GeoParquet (先写临时文件再原子替换，正在读取的进程不受影响)"""
+    harvested_at = time.time() if harvested_at is None else harvested_at
+    columns = {name: [record.get(name) for record in records] for name in COLUMNS[:-1]}
+    columns['harvested_at'] = [harvested_at] * len(records)
+    columns['geometry'] = [struct.pack('<BIdd', 1, 1, lon, lat) for lon, lat in zip(columns['lon'], columns['lat'])]
+    table = pa.table(columns, schema=SCHEMA)
+    lons, lats = columns['lon'], columns['lat']
+    geo = {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': ['Point'],
+                                 'bbox': [min(lons), min(lats), max(lons), max(lats)] if records else []}}
+    }
+    table = table.replace_schema_metadata({b'geo': json.dumps(geo).encode()})
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, compression='zstd')
+    os.replace(tmp_path, path)
+
+
+def angle_difference(a, b):
+    """两个朝向 (度) 的夹角，0-180"""
+    difference = np.abs((np.asarray(a) - b) % 360)
+    return np.minimum(difference, 360 - difference)
+
+
+class _Snapshot:
+    """一次加载的索引，查询期间不变，刷新时整体替换"""
+
+    def __init__(self, table: pa.Table, mtime: float):
+        self.mtime = mtime
+        self.ids = table.column('id').to_pylist()
+        self.lon = table.column('lon').to_numpy()
+        self.lat = table.column('lat').to_numpy()
+        self.captured_at = table.column('captured_at').to_pylist()
+        self.compass_angle = table.column('compass_angle').to_numpy(zero_copy_only=False).astype(np.float64)
+        self.thumbs = {size: table.column(f'thumb_{size}_url').to_pylist() for size in THUMB_SIZES}
+        self.harvested_at = table.column('harvested_at').to_numpy()
+        reference_lat = float(np.mean(self.lat)) if len(self.lat) else 40.78
+        # 等距圆柱投影 (米)
+        self.lon_scale = METERS_PER_DEGREE * math.cos(math.radians(reference_lat))
+        points = np.column_stack([self.lon * self.lon_scale, self.lat * METERS_PER_DEGREE])
+        self.tree = cKDTree(points) if len(self.ids) else None
+
+
+class StreetViewIndex:
+    """线程安全，查询结果与 SatelliteStreetViewAPI.find_nearby_streetview 的字段相同"""
+
+    def __init__(self, path: str = DEFAULT_INDEX):
+        self.path = path
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.reload()
+
+    def reload(self):
+        mtime = os.path.getmtime(self.path)
+        table = pq.read_table(self.path, columns=COLUMNS)
+        self.snapshot = _Snapshot(table, mtime)
+
+    def reload_if_changed(self) -> bool:
+        try:
+            changed = os.path.getmtime(self.path) != self.snapshot.mtime
+        except OSError:
+            return False
+        if changed:
+            self.reload()
+        return changed
+
+    def __len__(self) -> int:
+        return len(self.snapshot.ids)
+
+    def _result(self, snapshot: _Snapshot, index: int, distance: float) -> Dict[str, Any]:
+        angle = snapshot.compass_angle[index]
+        result = {
+            'id': snapshot.ids[index],
+            'distance_m': round(float(distance), 1),
+            'lat': float(snapshot.lat[index]),
+            'lon': float(snapshot.lon[index]),
+            'captured_at': snapshot.captured_at[index],
+            'compass_angle': None if np.isnan(angle) else float(angle)
+        }
+        for size in THUMB_SIZES:
+            result[f'thumb_{size}_url'] = snapshot.thumbs[size][index]
+        result['harvested_at'] = float(snapshot.harvested_at[index])
+        return result
+
+    def nearest(self, lat: float, lon: float, k: int = 1, max_distance: float = math.inf,
+                heading: Optional[float] = None, tolerance: float = 45, candidates: int = 64) -> List[Dict[str, Any]]:
+        """
+        最近的 k 张街景，按距离排序
+
+        Args:
+            max_distance: 最大距离(米)
+            heading: 期望朝向 (度，0 为正北，顺时针)，不为 None 时只返回朝向相差不超过 tolerance 的图像
+            candidates: 按朝向过滤时先取的近邻数
+        """
+        snapshot = self.snapshot
+        with self.lock:
+            self.queries += 1
+        if snapshot.tree is None:
+            return []
+        count = min(len(snapshot.ids), k if heading is None else max(k, candidates))
+        distances, indices = snapshot.tree.query((lon * snapshot.lon_scale, lat * METERS_PER_DEGREE), k=count,
+                                                 distance_upper_bound=max_distance)
+        distances, indices = np.atleast_1d(distances), np.atleast_1d(indices)
+        found = np.isfinite(distances)
+        distances, indices = distances[found], indices[found]
+        if heading is not None:
+            matches = angle_difference(snapshot.compass_angle[indices], heading) <= tolerance
+            distances, indices = distances[matches], indices[matches]
+        return [self._result(snapshot, index, distance) for distance, index in zip(distances[:k], indices[:k])]
+
+    def find(self, lat: float, lon: float, heading: Optional[float] = None,
+             max_distance: float = 100) -> Optional[Dict[str, Any]]:
+        """最近的一张街景，max_distance 米内没有时返回 None"""
+        results = self.nearest(lat, lon, 1, max_distance, heading)
+        return results[0] if results else None
+
+    def bbox(self) -> Tuple[float, float, float, float]:
+        snapshot = self.snapshot
+        return (float(snapshot.lon.min()), float(snapshot.lat.min()),
+                float(snapshot.lon.max()), float(snapshot.lat.max())) if len(snapshot.ids) else MANHATTAN_EXTENT
+
+    def stats(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {
+            'images': len(snapshot.ids),
+            'queries': self.queries,
+            'harvested_at': float(snapshot.harvested_at.max()) if len(snapshot.ids) else None
+        }
+
+
+class IndexRefresher:
+    """
+    后台刷新索引：api 不为 None 时每 interval 秒重新采集 bbox 并替换索引文件，
+    否则每 check_interval 秒检查文件是否被其他进程 (如定时运行的 harvest) 更新
+    """
+
+    def __init__(self, index: StreetViewIndex, api=None, interval: float = 86400, check_interval: float = 60,
+                 bbox: Optional[Tuple[float, float, float, float]] = None):
+        self.index = index
+        self.api = api
+        self.interval = interval
+        self.check_interval = check_interval
+        self.bbox = bbox
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='streetview-index-refresh', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def refresh(self):
+        bbox = self.bbox or self.index.bbox()
+        print(f"🔄 重新采集街景索引 {bbox}")
+        records = harvest(self.api, bbox)
+        write_index(records, self.index.path)
+        self.index.reload()
+        print(f"✅ 街景索引已更新: {len(records):,} 张")
+
+    def run(self):
+        last_refresh = time.time()
+        while not self.stop_event.wait(self.check_interval):
+            try:
+                if self.api is not None and time.time() - last_refresh >= self.interval:
+                    last_refresh = time.time()
+                    self.refresh()
+                else:
+                    self.index.reload_if_changed()
+            except Exception as e:
+                # 刷新失败时继续使用当前索引
+                print(f"❌ 刷新街景索引失败: {e}")
+
+
+def main():
+    from satellite_streetview_api import SatelliteStreetViewAPI, MAPILLARY_BASE_URL
+
+    parser = argparse.ArgumentParser(description='本地街景元数据索引')
+    parser.add_argument('command', choices=['harvest', 'query', 'bench'])
+    parser.add_argument('--index', default=DEFAULT_INDEX, help='GeoParquet 索引文件')
+    parser.add_argument('--bbox', default=None, help='harvest: min_lon,min_lat,max_lon,max_lat (默认曼哈顿)')
+    parser.add_argument('--cell', type=float, default=0.005, help='harvest: 每次查询的范围(度)')
+    parser.add_argument('--workers', type=int, default=4, help='harvest: 并发查询数')
+    parser.add_argument('--mapillary-url', default=MAPILLARY_BASE_URL, help='街景服务地址')
+    parser.add_argument('--lat', type=float, default=40.7589)
+    parser.add_argument('--lon', type=float, default=-73.9851)
+    parser.add_argument('--heading', type=float, default=None, help='query: 期望朝向(度)')
+    parser.add_argument('--k', type=int, default=1)
+    parser.add_argument('--max-distance', type=float, default=100, help='query: 最大距离(米)')
+    parser.add_argument('--queries', type=int, default=100000, help='bench: 查询次数')
+    args = parser.parse_args()
+
+    if args.command == 'harvest':
+        bbox = tuple(map(float, args.bbox.split(','))) if args.bbox else MANHATTAN_EXTENT
+        api = SatelliteStreetViewAPI(mapillary_base_url=args.mapillary_url, pool_size=args.workers)
+        print(f"🛰️ 采集街景位置 {bbox}")
+        begin = time.time()
+        records = harvest(api, bbox, args.cell, workers=args.workers)
+        write_index(records, args.index)
+        print(f"💾 {len(records):,} 张街景已保存到 {args.index} ({time.time() - begin:.1f}s)")
+        return
+
+    index = StreetViewIndex(args.index)
+    if args.command == 'query':
+        results = index.nearest(args.lat, args.lon, args.k, args.max_distance, args.heading)
+        print(json.dumps(results, indent=2, ensure_ascii=False))
+    else:
+        min_lon, min_lat, max_lon, max_lat = index.bbox()
+        rng = np.random.default_rng(0)
+        points = np.column_stack([rng.uniform(min_lat, max_lat, args.queries), rng.uniform(min_lon, max_lon, args.queries)])
+        for heading in (None, 90.0):
+            begin = time.perf_counter()
+            for lat, lon in points:
+                index.find(lat, lon, heading)
+            elapsed = time.perf_counter() - begin
+            label = '按朝向' if heading is not None else '最近'
+            print(f"⏱️ {label}查询: {elapsed / args.queries * 1e6:.1f}µs/次 ({len(index):,} 张街景, {args.queries:,} 次)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Fixtures shared by the tests: a temporary directory, the mock upstream and image servers on random ports."""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, STATIC_DIR)
+import mock_upstream  # noqa: E402
+import simple_image_server  # noqa: E402
+from load_test_image_server import start_local  # noqa: E402
+from satellite_streetview_api import SatelliteStreetViewAPI  # noqa: E402
+
+
+class ServerTestCase(unittest.TestCase):
+    """self.directory is removed after the test, servers passed to stop_on_cleanup are shut down"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def stop_on_cleanup(self, server):
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return "http://localhost:%d" % server.server_address[1]
+
+    def serve(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return self.stop_on_cleanup(server)
+
+
+class MockUpstreamTestCase(ServerTestCase):
+    """self.upstream (options in upstream_options) and self.api talking to it without retries"""
+
+    upstream_options = {}
+
+    def setUp(self):
+        super().setUp()
+        self.upstream = mock_upstream.MockUpstream(**{"latency": 0, **self.upstream_options})
+        self.upstream_url = self.serve(mock_upstream.make_server(self.upstream, port=0))
+        self.api = SatelliteStreetViewAPI(self.upstream_url + "/export", self.upstream_url, retries=0,
+                                          esri_tile_url=self.upstream_url + "/tile/{z}/{y}/{x}")
+
+    def start_image_server(self, **kwargs):
+        """image server on self.api, kwargs go to simple_image_server.make_server"""
+        return self.serve(simple_image_server.make_server(self.api, port=0, **kwargs))
+
+
+class ImageServerTestCase(ServerTestCase):
+    """the environment of the load test (load_test_image_server.start_local) caching in self.directory, at self.url"""
+
+    latency = 0
+    local_options = {}
+
+    def setUp(self):
+        super().setUp()
+        self.url, self.upstream, servers = start_local(self.latency, 0, 4, True, cache_dir=self.directory,
+                                                       **self.local_options)
+        for server in servers:
+            self.stop_on_cleanup(server)
+        transcoder = servers[1].RequestHandlerClass.transcoder
+        if transcoder is not None:
+            self.addCleanup(transcoder.close)
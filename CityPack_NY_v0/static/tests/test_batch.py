@@ -0,0 +1,120 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import requests
+
+from support import ImageServerTestCase
+from image_cache import snap_to_grid  # noqa: E402
+from satellite_streetview_api import ImageServerClient  # noqa: E402
+
+LAT, LON = snap_to_grid(40.7589, -73.9851)
+# the first two points share a grid cell, the third is 30 m north
+POINTS = [[LAT, LON], [LAT + 0.00003, LON - 0.00003], [LAT + 0.00027, LON]]
+
+
+class TestBatch(ImageServerTestCase):
+
+    def post(self, body, **kwargs):
+        return requests.post(self.url + "/api/images/batch", json=body, timeout=30, **kwargs)
+
+    def test_json_response_and_blobs(self):
+        response = self.post({"points": POINTS})
+        self.assertEqual(response.status_code, 200)
+        manifest = response.json()
+        self.assertEqual((manifest["count"], manifest["errors"]), (3, 0))
+        results = manifest["results"]
+        self.assertEqual([result["index"] for result in results], [0, 1, 2])
+        self.assertEqual(results[0]["location"], {"lat": POINTS[0][0], "lon": POINTS[0][1]})
+
+        satellite = [result["satellite"] for result in results]
+        self.assertEqual(satellite[0]["sha256"], satellite[1]["sha256"])
+        self.assertEqual(satellite[0]["content_type"], "image/png")
+        self.assertTrue(all(result["streetview"]["available"] for result in results))
+        self.assertIn("id", results[0]["streetview"]["info"])
+        digests = {result[kind]["sha256"] for result in results for kind in ("satellite", "streetview")}
+        self.assertEqual(manifest["images"], len(digests))
+        # one upstream export per grid cell
+        self.assertEqual(self.upstream.stats()["export"], 2)
+
+        for result in results:
+            entry = result["streetview"]
+            blob = requests.get(self.url + entry["url"], timeout=10)
+            self.assertEqual(blob.status_code, 200)
+            self.assertEqual(blob.headers["Content-Type"], entry["content_type"])
+            self.assertEqual(hashlib.sha256(blob.content).hexdigest(), entry["sha256"])
+            self.assertEqual(len(blob.content), entry["bytes"])
+        self.assertEqual(requests.get(self.url + "/api/blobs/" + "0" * 64, timeout=10).status_code, 404)
+
+    def test_tar_response(self):
+        response = self.post({"points": POINTS, "kinds": ["satellite"], "response": "tar"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-tar")
+        self.assertEqual(response.headers["Transfer-Encoding"], "chunked")
+        with tarfile.open(fileobj=io.BytesIO(response.content)) as archive:
+            names = archive.getnames()
+            self.assertEqual(names[-1], "manifest.json")
+            manifest = json.loads(archive.extractfile("manifest.json").read())
+            digests = {result["satellite"]["sha256"] for result in manifest["results"]}
+            # the mock upstream returns the same image for every point, which is stored once
+            self.assertEqual(len(names) - 1, manifest["images"])
+            self.assertEqual(manifest["images"], len(digests))
+            for result in manifest["results"]:
+                entry = result["satellite"]
+                self.assertNotIn("streetview", result)
+                data = archive.extractfile(entry["path"]).read()
+                self.assertEqual(entry["path"], "images/%s.png" % entry["sha256"])
+                self.assertEqual(hashlib.sha256(data).hexdigest(), entry["sha256"])
+
+    def test_accept_header_selects_tar(self):
+        response = self.post({"points": POINTS[:1], "kinds": ["satellite"]}, headers={"Accept": "application/x-tar"})
+        self.assertEqual(response.headers["Content-Type"], "application/x-tar")
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post({"points": []}).status_code, 400)
+        self.assertEqual(self.post({"points": POINTS, "kinds": ["aerial"]}).status_code, 400)
+        self.assertEqual(self.post({"points": [["north", "west"]]}).status_code, 400)
+        self.assertEqual(self.post({"points": POINTS, "size": "poster"}).status_code, 400)
+        self.assertEqual(self.post({"points": [[LAT, LON]] * 2001}).status_code, 413)
+
+    def test_upstream_errors_are_reported_per_point(self):
+        self.upstream.failure_rate = 1.0
+        response = self.post({"points": POINTS[2:], "kinds": ["satellite"]})
+        self.assertEqual(response.status_code, 200)
+        manifest = response.json()
+        self.assertEqual(manifest["errors"], 1)
+        self.assertIn("Upstream error", manifest["results"][0]["satellite"]["error"])
+
+
+class TestImageServerClient(ImageServerTestCase):
+
+    def test_get_images_batch_keeps_order_across_chunks(self):
+        client = ImageServerClient(self.url)
+        results = client.get_images_batch(POINTS, chunk_size=2, workers=2)
+        self.assertEqual([result["location"]["lat"] for result in results], [point[0] for point in POINTS])
+        data, content_type = client.get_blob(results[2]["satellite"]["sha256"])
+        self.assertEqual((data, content_type), (self.upstream.png, "image/png"))
+        with self.assertRaises(requests.HTTPError):
+            client.get_blob("0" * 64)
+
+    def test_download_batch(self):
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        results = ImageServerClient(self.url).download_batch(POINTS, output_dir, chunk_size=2, workers=2)
+        self.assertEqual(len(results), 3)
+        digests = set()
+        for result in results:
+            for kind in ("satellite", "streetview"):
+                digests.add(result[kind]["sha256"])
+                with open(os.path.join(output_dir, result[kind]["path"]), "rb") as f:
+                    self.assertEqual(hashlib.sha256(f.read()).hexdigest(), result[kind]["sha256"])
+        self.assertEqual(len(os.listdir(os.path.join(output_dir, "images"))), len(digests))
+
+
+if __name__ == "__main__":
+    unittest.main()
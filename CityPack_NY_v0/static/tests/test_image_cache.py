@@ -0,0 +1,106 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_cache import ImageCache, MetadataCache, cache_key, snap_to_grid  # noqa: E402
+
+
+class TestGrid(unittest.TestCase):
+
+    def test_nearby_points_share_key(self):
+        """points a few meters apart snap to the same 15 m grid point"""
+        lat, lon = snap_to_grid(40.7589, -73.9851)
+        self.assertEqual(cache_key("satellite", lat, lon), cache_key("satellite", lat + 0.00003, lon - 0.00003))
+        self.assertNotEqual(cache_key("satellite", lat, lon), cache_key("satellite", lat + 0.0002, lon))
+        self.assertEqual(cache_key("streetview", 40.7589, -73.9851, "1024"), "streetview_%.6f_%.6f_1024" % snap_to_grid(40.7589, -73.9851))
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_memory_and_disk_tiers(self):
+        cache = ImageCache(self.directory)
+        key = cache.key("satellite", 40.7589, -73.9851)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, b"png" * 10, "image/png")
+        self.assertEqual(cache.get(key), (b"png" * 10, "image/png", "memory"))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, key + ".png")))
+
+        # a new process only has the disk tier; a disk hit is promoted to memory
+        cache = ImageCache(self.directory)
+        self.assertEqual(cache.get(key), (b"png" * 10, "image/png", "disk"))
+        self.assertEqual(cache.get(key)[2], "memory")
+        self.assertEqual(cache.stats()["hit_rate"], 1.0)
+
+    def test_memory_eviction_by_bytes(self):
+        cache = ImageCache(None, memory_bytes=250)
+        for name in "abc":
+            cache.put(name, name.encode() * 100, "image/jpeg")
+        # a + b + c = 300 bytes > 250: the least recently used entry goes first
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("b"))
+        cache.put("d", b"d" * 100, "image/jpeg")
+        self.assertIsNotNone(cache.get("b"))
+        self.assertIsNone(cache.get("c"))
+        stats = cache.stats()["memory"]
+        self.assertLessEqual(stats["bytes"], 250)
+        self.assertEqual(stats["evictions"], 2)
+
+        # an entry larger than the whole tier is not cached and evicts nothing
+        cache.put("huge", b"x" * 300, "image/jpeg")
+        self.assertIsNone(cache.get("huge"))
+        self.assertIsNotNone(cache.get("d"))
+
+    def test_disk_eviction_by_bytes(self):
+        cache = ImageCache(self.directory, memory_bytes=0, disk_bytes=250)
+        for name in "abc":
+            cache.put(name, name.encode() * 100, "image/jpeg")
+        self.assertEqual(sorted(os.listdir(self.directory)), ["b.jpg", "c.jpg"])
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b")[2], "disk")
+
+    def test_ttl(self):
+        cache = ImageCache(self.directory, ttl=0.2)
+        cache.put("a", b"a" * 10, "image/jpeg")
+        self.assertIsNotNone(cache.get("a"))
+        time.sleep(0.3)
+        self.assertIsNone(cache.get("a"))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, "a.jpg")))
+        self.assertNotIn("a", cache)
+
+    def test_scan_ignores_temp_files_and_prefers_snapped_names(self):
+        key = cache_key("satellite", 40.7589, -73.9851)
+        with open(os.path.join(self.directory, ".tmpabc"), "wb") as f:
+            f.write(b"partial")
+        with open(os.path.join(self.directory, "satellite_40.758910_-73.985090.png"), "wb") as f:
+            f.write(b"legacy")
+        with open(os.path.join(self.directory, key + ".png"), "wb") as f:
+            f.write(b"snapped")
+        cache = ImageCache(self.directory)
+        self.assertEqual(cache.get(key)[0], b"snapped")
+        self.assertFalse(os.path.exists(os.path.join(self.directory, ".tmpabc")))
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def test_caches_misses_and_expires(self):
+        cache = MetadataCache(max_entries=2, ttl=0.2)
+        self.assertEqual(cache.get("a"), (False, None))
+        cache.put("a", None)
+        self.assertEqual(cache.get("a"), (True, None))
+        cache.put("b", {"id": 1})
+        cache.put("c", {"id": 2})
+        self.assertEqual(cache.get("a"), (False, None))
+        time.sleep(0.3)
+        self.assertEqual(cache.get("c"), (False, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import io
+import unittest
+
+import requests
+from PIL import Image
+
+from support import ImageServerTestCase, MockUpstreamTestCase
+from image_cache import ImageCache  # noqa: E402
+from image_variants import Transcoder, is_variant, supported_formats, transcode, variant_key  # noqa: E402
+from mock_upstream import make_photo  # noqa: E402
+
+SATELLITE = "/api/satellite?lat=40.7589&lon=-73.9851"
+STREETVIEW = "/api/streetview?lat=40.7589&lon=-73.9851"
+
+
+def image_size(data):
+    with Image.open(io.BytesIO(data)) as image:
+        return image.size
+
+
+class TestTranscode(unittest.TestCase):
+
+    def test_sizes(self):
+        variants = transcode(make_photo(1024, 768, "JPEG"), "webp")
+        self.assertEqual({size: image_size(data) for size, data in variants.items()},
+                         {"full": (1024, 768), "panel": (512, 384), "thumb": (256, 192)})
+        self.assertTrue(all(data[8:12] == b"WEBP" for data in variants.values()))
+
+    def test_small_images_are_not_upscaled(self):
+        """a size the image already fits in reuses the encoding of the size before it"""
+        variants = transcode(make_photo(300, 200, "PNG"), "webp")
+        self.assertIs(variants["panel"], variants["full"])
+        self.assertEqual(image_size(variants["panel"]), (300, 200))
+        self.assertEqual(image_size(variants["thumb"]), (256, 171))
+
+        variants = transcode(make_photo(200, 100, "PNG"), "webp")
+        self.assertIs(variants["thumb"], variants["full"])
+        self.assertEqual(image_size(variants["thumb"]), (200, 100))
+
+    def test_variant_keys(self):
+        key = variant_key("streetview_40.758848_-73.985028_1024", "panel", "webp")
+        self.assertEqual(key, "streetview_40.758848_-73.985028_1024_panel_webp")
+        self.assertTrue(is_variant(key))
+        self.assertFalse(is_variant("streetview_40.758848_-73.985028_1024"))
+
+
+class TestServerVariants(ImageServerTestCase):
+    """start_local with WebP transcoding and decodable mock images"""
+
+    local_options = {"transcode": True, "photo": True, "image_size": 512}
+
+    def setUp(self):
+        super().setUp()
+        self.get(SATELLITE)  # the first request starts the transcoder processes
+
+    def get(self, path, **headers):
+        return requests.get(self.url + path, headers=headers, timeout=60)
+
+    def test_size_selects_variant(self):
+        response = self.get(SATELLITE + "&size=thumb")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/webp")
+        self.assertEqual(response.headers["Vary"], "Accept")
+        self.assertEqual(image_size(response.content), (256, 256))
+        self.assertIn(response.headers["X-Cache"], ("transcoded", "memory", "disk"))
+        # all sizes are stored at once, the next request is a cache hit
+        response = self.get(SATELLITE + "&size=full")
+        self.assertEqual(response.headers["X-Cache"], "memory")
+        self.assertEqual(image_size(response.content), (512, 512))
+
+        response = self.get(STREETVIEW + "&size=panel")
+        self.assertEqual(response.headers["Content-Type"], "image/webp")
+        self.assertEqual(image_size(response.content), (512, 384))
+
+    def test_original_without_size(self):
+        response = self.get(SATELLITE)
+        self.assertEqual(response.headers["Content-Type"], "image/png")
+        self.assertNotIn("Vary", response.headers)
+        self.assertEqual(image_size(response.content), (512, 512))
+
+    def test_etag_revalidation(self):
+        for path in (SATELLITE, SATELLITE + "&size=panel"):
+            response = self.get(path)
+            etag = response.headers["ETag"]
+            self.assertIn("max-age=", response.headers["Cache-Control"])
+            revalidated = self.get(path, **{"If-None-Match": etag})
+            self.assertEqual((revalidated.status_code, revalidated.content), (304, b""))
+            self.assertEqual(revalidated.headers["ETag"], etag)
+            self.assertEqual(self.get(path, **{"If-None-Match": '"stale"'}).status_code, 200)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.get(SATELLITE + "&size=poster").status_code, 400)
+        self.assertEqual(self.get(SATELLITE + "&size=panel&format=png").status_code, 400)
+        # AVIF is not enabled by start_local
+        self.assertEqual(self.get(SATELLITE + "&size=panel&format=avif").status_code, 400)
+        response = self.get(SATELLITE + "&size=panel", Accept="image/avif,image/webp")
+        self.assertEqual(response.headers["Content-Type"], "image/webp")
+
+
+class TestServerWithoutTranscoder(ImageServerTestCase):
+    """size is ignored when transcoding is disabled, the viewer always sends size=panel"""
+
+    def test_size_serves_original(self):
+        response = requests.get(self.url + SATELLITE + "&size=panel", timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.headers["Content-Type"], response.content), ("image/png", self.upstream.png))
+        self.assertNotIn("Vary", response.headers)
+        self.assertEqual(requests.get(self.url + SATELLITE + "&size=poster", timeout=10).status_code, 400)
+
+
+@unittest.skipUnless("avif" in supported_formats(), "Pillow cannot encode AVIF")
+class TestAcceptNegotiation(MockUpstreamTestCase):
+
+    upstream_options = {"photo": True}
+
+    def setUp(self):
+        super().setUp()
+        transcoder = Transcoder(workers=2, formats=("webp", "avif"))
+        self.addCleanup(transcoder.close)
+        self.url = self.start_image_server(cache=ImageCache(self.directory), transcoder=transcoder)
+
+    def test_avif_when_accepted(self):
+        def content_type(accept, query=""):
+            response = requests.get(self.url + SATELLITE + "&size=thumb" + query, headers={"Accept": accept},
+                                    timeout=60)
+            self.assertEqual(response.headers["Vary"], "Accept")
+            return response.headers["Content-Type"]
+
+        self.assertEqual(content_type("image/avif,image/webp,*/*"), "image/avif")
+        self.assertEqual(content_type("image/webp,*/*"), "image/webp")
+        self.assertEqual(content_type("image/avif", "&format=webp"), "image/webp")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from support import MockUpstreamTestCase
+from image_cache import ImageCache, cache_key  # noqa: E402
+from packed_store import PackedStore, list_shards  # noqa: E402
+
+
+class TestPackedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open(self, **kwargs):
+        store = PackedStore(self.directory, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_put_get(self):
+        store = self.open()
+        self.assertIsNone(store.get("satellite_a"))
+        store.put("satellite_a", b"png data", "image/png")
+        store.put("streetview_a_1024", b"jpeg data", "image/jpeg")
+        self.assertEqual(store.get("satellite_a"), (b"png data", "image/png"))
+        self.assertEqual(store.get("streetview_a_1024"), (b"jpeg data", "image/jpeg"))
+        self.assertIn("satellite_a", store)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(list(store.keys()), ["satellite_a", "streetview_a_1024"])
+
+        # an overwrite points the index at the new record and leaves the old one as garbage
+        store.put("satellite_a", b"newer", "image/png")
+        self.assertEqual(store.get("satellite_a"), (b"newer", "image/png"))
+        self.assertGreater(store.stats()["garbage_bytes"], 0)
+        store.remove("streetview_a_1024")
+        self.assertIsNone(store.get("streetview_a_1024"))
+        self.assertEqual(len(store), 1)
+
+    def test_rolls_over_to_new_shards(self):
+        store = self.open(shard_bytes=100)
+        for i in range(5):
+            store.put("key_%d" % i, bytes([i]) * 60, "image/jpeg")
+        self.assertEqual(len(list_shards(self.directory)), 5)
+        for i in range(5):
+            self.assertEqual(store.get("key_%d" % i)[0], bytes([i]) * 60)
+
+    def test_compact(self):
+        store = self.open(shard_bytes=200)
+        for round_ in range(3):
+            for i in range(4):
+                store.put("key_%d" % i, bytes([round_]) * 50, "image/jpeg")
+        store.remove("key_3")
+        before = store.stats()
+        result = store.compact()
+        after = store.stats()
+        self.assertEqual(result["entries"], 3)
+        self.assertLess(result["after_bytes"], result["before_bytes"])
+        self.assertEqual(after["garbage_bytes"], 0)
+        self.assertLess(after["shards"], before["shards"])
+        for i in range(3):
+            self.assertEqual(store.get("key_%d" % i), (bytes([2]) * 50, "image/jpeg"))
+        # appends after a compaction go to the new shards
+        store.put("key_9", b"after", "image/png")
+        self.assertEqual(store.get("key_9"), (b"after", "image/png"))
+
+    def test_reindex(self):
+        store = self.open()
+        store.put("key_a", b"first", "image/png")
+        store.put("key_a", b"second", "image/png")
+        store.put("key_b", b"other", "image/jpeg")
+        store.close()
+        os.remove(os.path.join(self.directory, "index.sqlite"))
+
+        store = self.open()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.reindex(), 2)
+        # the last record written for a key wins
+        self.assertEqual(store.get("key_a"), (b"second", "image/png"))
+        self.assertEqual(store.get("key_b"), (b"other", "image/jpeg"))
+
+    def test_reindex_ignores_truncated_record(self):
+        store = self.open()
+        store.put("key_a", b"complete", "image/png")
+        store.put("key_b", b"interrupted", "image/png")
+        store.close()
+        path = os.path.join(self.directory, "shard_00000.pack")
+        os.truncate(path, os.path.getsize(path) - 3)
+
+        store = self.open()
+        self.assertEqual(store.reindex(), 1)
+        self.assertEqual(store.get("key_a"), (b"complete", "image/png"))
+
+    def test_two_handles_on_one_directory(self):
+        """e.g. the image server and a prefetch job writing the same store"""
+        first = self.open()
+        second = self.open()
+
+        def write(store, prefix):
+            for i in range(50):
+                store.put("%s_%d" % (prefix, i), ("%s %d" % (prefix, i)).encode() * 10, "image/jpeg")
+
+        threads = [threading.Thread(target=write, args=(first, "a")), threading.Thread(target=write, args=(second, "b"))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        reader = self.open(readonly=True)
+        for store in (first, second, reader):
+            self.assertEqual(len(store), 100)
+            for prefix in "ab":
+                for i in range(50):
+                    self.assertEqual(store.get("%s_%d" % (prefix, i))[0], ("%s %d" % (prefix, i)).encode() * 10)
+
+        # a compaction through one handle stays readable through the other
+        first.compact()
+        self.assertEqual(second.get("b_7")[0], b"b 7" * 10)
+        second.put("c_0", b"late", "image/png")
+        self.assertEqual(first.get("c_0"), (b"late", "image/png"))
+
+    def test_readonly(self):
+        with self.assertRaises(FileNotFoundError):
+            PackedStore(self.directory, readonly=True)
+        self.open().put("key_a", b"data", "image/png")
+        reader = self.open(readonly=True)
+        self.assertEqual(reader.get("key_a"), (b"data", "image/png"))
+        with self.assertRaises(PermissionError):
+            reader.put("key_b", b"data", "image/png")
+
+    def test_migrate(self):
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        key = cache_key("satellite", 40.7589, -73.9851)
+        for name, data in [(key + ".png", b"snapped"), ("satellite_40.758910_-73.985090.png", b"legacy"),
+                           ("streetview_40.758900_-73.985100_1024.jpg", b"jpeg"), ("notes.txt", b"ignored")]:
+            with open(os.path.join(source, name), "wb") as f:
+                f.write(data)
+
+        store = self.open()
+        self.assertEqual(store.migrate(source), {"imported": 2, "skipped": 0})
+        self.assertEqual(store.get(key), (b"snapped", "image/png"))
+        self.assertEqual(store.get(cache_key("streetview", 40.7589, -73.9851, "1024")), (b"jpeg", "image/jpeg"))
+        self.assertEqual(store.migrate(source), {"imported": 0, "skipped": 2})
+
+
+class TestServerDiskTier(MockUpstreamTestCase):
+    """with a writable --packed-store the store replaces the per-file disk cache"""
+
+    def setUp(self):
+        super().setUp()
+        self.store = PackedStore(self.directory)
+        self.addCleanup(self.store.close)
+        self.url = self.start_image_server(cache=ImageCache(None), packed_store=self.store)
+
+    def test_misses_are_appended_to_the_store(self):
+        response = requests.get(self.url + "/api/satellite?lat=40.7589&lon=-73.9851", timeout=10)
+        self.assertEqual((response.status_code, response.headers["X-Cache"]), (200, "miss"))
+        self.assertEqual(self.store.get(cache_key("satellite", 40.7589, -73.9851)), (self.upstream.png, "image/png"))
+        self.assertEqual(requests.get(self.url + "/health", timeout=10).json()["packed_store"]["entries"], 1)
+        response = requests.get(self.url + "/api/satellite?lat=40.7589&lon=-73.9851", timeout=10)
+        self.assertEqual(response.headers["X-Cache"], "memory")
+        self.assertEqual(self.upstream.stats(), {"export": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import requests
+
+from support import STATIC_DIR, MockUpstreamTestCase
+from image_cache import cache_key  # noqa: E402
+from packed_store import PackedStore  # noqa: E402
+from prefetch_images import Checkpoint, Prefetcher, bbox_grid, unique_points  # noqa: E402
+
+BBOX = "-73.9860,40.7585,-73.9850,40.7590"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "checkpoint.json")
+
+    def test_watermark_only_advances_over_contiguous_points(self):
+        checkpoint = Checkpoint(self.path, {"source": "a"})
+        checkpoint.complete(1, True)
+        checkpoint.complete(3, False)
+        self.assertEqual(checkpoint.done, 0)
+        checkpoint.complete(0, True)
+        self.assertEqual(checkpoint.done, 2)
+        checkpoint.save()
+
+        resumed = Checkpoint(self.path, {"source": "a"})
+        self.assertEqual((resumed.done, resumed.failed), (2, [3]))
+
+    def test_new_signature_starts_over(self):
+        checkpoint = Checkpoint(self.path, {"source": "a"})
+        checkpoint.complete(0, False)
+        checkpoint.save()
+        restarted = Checkpoint(self.path, {"source": "b"})
+        self.assertEqual((restarted.done, restarted.failed), (0, []))
+
+
+class TestPrefetcher(MockUpstreamTestCase):
+
+    def test_fetches_into_store_and_skips_on_rerun(self):
+        points = unique_points(bbox_grid(BBOX))
+        store = PackedStore(os.path.join(self.directory, "packed"))
+        self.addCleanup(store.close)
+        checkpoint = Checkpoint(None, {})
+        counts = Prefetcher(self.api, store).run(points, list(range(len(points))), checkpoint, workers=4)
+        self.assertEqual(counts["failed"], 0)
+        self.assertEqual(counts["fetched"] + counts["no_streetview"], 2 * len(points))
+        self.assertEqual(checkpoint.done, len(points))
+        lat, lon = points[0]
+        self.assertIn(cache_key("satellite", lat, lon), store)
+        self.assertEqual(store.get(cache_key("satellite", lat, lon))[1], "image/png")
+
+        requests_before = sum(self.upstream.stats().values())
+        counts = Prefetcher(self.api, store).run(points, list(range(len(points))), Checkpoint(None, {}), workers=4)
+        self.assertEqual(counts["fetched"], 0)
+        self.assertEqual(counts["skipped"], len(store))
+        self.assertEqual(sum(self.upstream.stats().values()) - requests_before, counts["no_streetview"])
+
+    def test_retry_failed(self):
+        """the first run cannot reach the upstream; --retry-failed fetches exactly the failed points"""
+        store_dir = os.path.join(self.directory, "packed")
+        command = [sys.executable, os.path.join(STATIC_DIR, "prefetch_images.py"), "--bbox=" + BBOX, "--kinds", "satellite",
+                   "--store", store_dir, "--rate", "0", "--retries", "0", "--workers", "2"]
+        dead_url = "http://localhost:%d/export" % free_port()
+        subprocess.run(command + ["--esri-url", dead_url], check=True, capture_output=True, cwd=STATIC_DIR)
+        with open(os.path.join(store_dir, "prefetch_checkpoint.json")) as f:
+            state = json.load(f)
+        points = state["signature"]["points"]
+        self.assertEqual(state["done"], points)
+        self.assertEqual(state["failed"], list(range(points)))
+
+        subprocess.run(command + ["--esri-url", self.upstream_url + "/export", "--retry-failed"], check=True, capture_output=True, cwd=STATIC_DIR)
+        with open(os.path.join(store_dir, "prefetch_checkpoint.json")) as f:
+            self.assertEqual(json.load(f)["failed"], [])
+        self.assertEqual(self.upstream.stats(), {"export": points})
+        with PackedStore(store_dir, readonly=True) as store:
+            self.assertEqual(len(store), points)
+
+        # a plain rerun resumes after the watermark and has nothing left to do
+        subprocess.run(command + ["--esri-url", self.upstream_url + "/export"], check=True, capture_output=True, cwd=STATIC_DIR)
+        self.assertEqual(self.upstream.stats(), {"export": points})
+
+
+class TestServerWithPackedStore(MockUpstreamTestCase):
+
+    def test_upstream_miss_and_store_hit(self):
+        store_dir = os.path.join(self.directory, "packed")
+        with PackedStore(store_dir) as store:
+            store.put(cache_key("satellite", 40.7589, -73.9851), b"prefetched", "image/png")
+        store = PackedStore(store_dir, readonly=True)
+        self.addCleanup(store.close)
+        url = self.start_image_server(packed_store=store)
+
+        response = requests.get(url + "/api/satellite?lat=40.7589&lon=-73.9851", timeout=10)
+        self.assertEqual((response.status_code, response.content, response.headers["X-Cache"]), (200, b"prefetched", "store"))
+        # a point that was not prefetched goes upstream
+        response = requests.get(url + "/api/satellite?lat=40.7600&lon=-73.9800", timeout=10)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.upstream.png)
+        self.assertEqual(self.upstream.stats(), {"export": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+import io
+import math
+import threading
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from support import MockUpstreamTestCase
+from packed_store import PackedStore  # noqa: E402
+from satellite_tiles import TILE_SIZE, TileCache, TileCompositor, lonlat_to_pixel, window_tiles  # noqa: E402
+
+ZOOM = 18
+
+
+def pixel_to_lonlat(x, y, zoom=ZOOM):
+    """inverse of lonlat_to_pixel, returns (lat, lon)"""
+    scale = TILE_SIZE * (1 << zoom)
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / scale)))), x / scale * 360 - 180
+
+
+# a tile in midtown Manhattan
+TILE_X, TILE_Y = (int(value) // TILE_SIZE for value in lonlat_to_pixel(40.7589, -73.9851, ZOOM))
+
+
+class TestWindow(unittest.TestCase):
+
+    def test_lonlat_to_pixel(self):
+        scale = TILE_SIZE << ZOOM
+        self.assertEqual(lonlat_to_pixel(0, 0, ZOOM), (scale / 2, scale / 2))
+        self.assertEqual(lonlat_to_pixel(0, -180, ZOOM)[0], 0)
+        x, y = lonlat_to_pixel(40.7589, -73.9851, ZOOM)
+        self.assertEqual((round(x, 6), round(y, 6)), tuple(round(value * 2, 6) for value in
+                                                            lonlat_to_pixel(40.7589, -73.9851, ZOOM - 1)))
+        self.assertLess(y, scale / 2)  # north of the equator
+        self.assertEqual(tuple(round(value, 6) for value in lonlat_to_pixel(*pixel_to_lonlat(x, y), ZOOM)),
+                         (round(x, 6), round(y, 6)))
+
+    def window(self, center_x, center_y, size):
+        return window_tiles(*pixel_to_lonlat(center_x, center_y), ZOOM, size)
+
+    def test_window_inside_one_tile(self):
+        left, top = TILE_X * TILE_SIZE, TILE_Y * TILE_SIZE
+        self.assertEqual(self.window(left + 128, top + 128, (256, 256)), ([(TILE_X, TILE_Y)], 1, 1, (0, 0)))
+        self.assertEqual(self.window(left + 128, top + 128, (100, 50)), ([(TILE_X, TILE_Y)], 1, 1, (78, 103)))
+
+    def test_window_on_tile_corner(self):
+        tiles, columns, rows, offset = self.window(TILE_X * TILE_SIZE, TILE_Y * TILE_SIZE, (512, 512))
+        self.assertEqual((columns, rows, offset), (2, 2, (0, 0)))
+        self.assertEqual(tiles, [(TILE_X - 1, TILE_Y - 1), (TILE_X, TILE_Y - 1), (TILE_X - 1, TILE_Y), (TILE_X, TILE_Y)])
+
+    def test_window_straddling_tile_boundary(self):
+        # 10 pixels right of the boundary: 118 pixels in the tile to the left
+        tiles, columns, rows, offset = self.window(TILE_X * TILE_SIZE + 10, TILE_Y * TILE_SIZE + 128, (256, 256))
+        self.assertEqual((tiles, columns, rows, offset), ([(TILE_X - 1, TILE_Y), (TILE_X, TILE_Y)], 2, 1, (138, 0)))
+        # one pixel past a 512 window covering two tiles exactly needs a third column and row
+        tiles, columns, rows, offset = self.window(TILE_X * TILE_SIZE + 1, TILE_Y * TILE_SIZE + 1, (512, 512))
+        self.assertEqual((len(tiles), columns, rows, offset), (9, 3, 3, (1, 1)))
+
+
+class TestCompositor(MockUpstreamTestCase):
+
+    upstream_options = {"photo": True, "photo_variants": 64}
+
+    def compositor(self, size=(512, 512), workers=4):
+        compositor = TileCompositor(self.api, TileCache(), ZOOM, size, workers=workers)
+        self.addCleanup(compositor.executor.shutdown)
+        return compositor
+
+    def test_compose_crops_window(self):
+        """the composed window equals the same pixels cut from the individual mock tiles"""
+        for size in ((512, 512), (300, 200)):
+            lat, lon = pixel_to_lonlat(TILE_X * TILE_SIZE + 37.2, TILE_Y * TILE_SIZE + 201.7)
+            pixels = self.compositor(size).compose(lat, lon)
+            width, height = size
+            self.assertEqual(pixels.shape, (height, width, 3))
+
+            center_x, center_y = lonlat_to_pixel(lat, lon, ZOOM)
+            left, top = round(center_x - width / 2), round(center_y - height / 2)
+            tiles = {}
+            for row in range(height):
+                for column in (0, width // 2, width - 1):
+                    x, y = left + column, top + row
+                    tile = (x // TILE_SIZE, y // TILE_SIZE)
+                    if tile not in tiles:
+                        content, _ = self.api.fetch(self.api.get_satellite_tile_url(ZOOM, *tile))
+                        tiles[tile] = np.asarray(Image.open(io.BytesIO(content)).convert('RGB'))
+                    np.testing.assert_array_equal(pixels[row, column], tiles[tile][y % TILE_SIZE, x % TILE_SIZE])
+            self.assertEqual(len(tiles), len(window_tiles(lat, lon, ZOOM, size)[0]))
+
+    def test_render(self):
+        content, content_type = self.compositor().render(*pixel_to_lonlat(TILE_X * TILE_SIZE, TILE_Y * TILE_SIZE))
+        self.assertEqual(content_type, 'image/jpeg')
+        self.assertEqual(Image.open(io.BytesIO(content)).size, (512, 512))
+
+    def test_dense_grid_fetches_each_tile_once(self):
+        compositor = self.compositor()
+        # 20 x 20 points 0.0001° apart (about 11 m, 20-30 pixels at z18)
+        points = [(40.7589 + i * 0.0001, -73.9851 + j * 0.0001) for i in range(20) for j in range(20)]
+        needed = {tile for lat, lon in points for tile in window_tiles(lat, lon, ZOOM, compositor.size)[0]}
+        for lat, lon in points:
+            compositor.compose(lat, lon)
+        self.assertEqual(self.upstream.stats()['tile'], len(needed))
+        self.assertEqual(compositor.fetched, len(needed))
+        self.assertLess(len(needed), len(points))
+        for lat, lon in points[:10]:
+            compositor.compose(lat, lon)
+        self.assertEqual(self.upstream.stats()['tile'], len(needed))
+        self.assertEqual(compositor.stats()['misses'], len(needed))
+
+
+class TestPackedStoreTiles(MockUpstreamTestCase):
+
+    def open(self, **kwargs):
+        store = PackedStore(self.directory, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_readonly_store_serves_tiles(self):
+        """tiles come from a read-only store, tiles it lacks are fetched and kept in memory only"""
+        lat, lon = pixel_to_lonlat(TILE_X * TILE_SIZE, TILE_Y * TILE_SIZE)
+        writer = TileCompositor(self.api, TileCache(packed_store=self.open()), ZOOM, (256, 256), workers=4)
+        self.addCleanup(writer.executor.shutdown)
+        writer.compose(lat, lon)
+        self.assertEqual(self.upstream.stats()['tile'], 4)
+
+        store = self.open(readonly=True)
+        reader = TileCompositor(self.api, TileCache(packed_store=store), ZOOM, (256, 256), workers=4)
+        self.addCleanup(reader.executor.shutdown)
+        reader.compose(lat, lon)
+        self.assertEqual(self.upstream.stats()['tile'], 4)
+        self.assertEqual(reader.stats()['disk_hits'], 4)
+
+        reader.compose(*pixel_to_lonlat(TILE_X * TILE_SIZE, TILE_Y * TILE_SIZE + 256))
+        self.assertEqual(self.upstream.stats()['tile'], 6)
+        self.assertEqual(len(store), 4)
+
+
+class TestCoalescing(MockUpstreamTestCase):
+
+    upstream_options = {"latency": 0.2}
+
+    def test_concurrent_windows_share_tile_requests(self):
+        compositor = TileCompositor(self.api, TileCache(), ZOOM, (256, 256), workers=16)
+        self.addCleanup(compositor.executor.shutdown)
+        # windows around one tile corner all need the same four tiles
+        corner_x, corner_y = TILE_X * TILE_SIZE, TILE_Y * TILE_SIZE
+        points = [pixel_to_lonlat(corner_x + dx, corner_y + dy) for dx in (-20, 0, 20) for dy in (-20, 0, 20)]
+        self.assertEqual(len({tile for lat, lon in points for tile in window_tiles(lat, lon, ZOOM, (256, 256))[0]}), 4)
+        threads = [threading.Thread(target=compositor.compose, args=point) for point in points]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.upstream.stats()['tile'], 4)
+        self.assertEqual(compositor.fetched, 4)
+        self.assertGreater(compositor.stats()['coalesced'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from support import ImageServerTestCase
+from single_flight import SingleFlight  # noqa: E402
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def run_concurrently(self, flights, key, fn, callers=8):
+        """call flights.do from several threads once the first call is in flight"""
+        started = threading.Event()
+
+        def leader():
+            started.set()
+            return fn()
+
+        def follower():
+            started.wait()
+            return flights.do(key, fn)
+
+        with ThreadPoolExecutor(callers) as executor:
+            first = executor.submit(flights.do, key, leader)
+            started.wait()
+            others = [executor.submit(follower) for _ in range(callers - 1)]
+            return first, others
+
+    def test_coalesces_concurrent_calls(self):
+        flights = SingleFlight()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return "image"
+
+        first, others = self.run_concurrently(flights, "satellite_a", fetch)
+        self.assertEqual(first.result(), ("image", False))
+        for future in others:
+            self.assertEqual(future.result(), ("image", True))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.stats(), {"in_flight": 0, "coalesced": 7})
+
+        # the key is released once the call finishes
+        self.assertEqual(flights.do("satellite_a", lambda: "again"), ("again", False))
+
+    def test_error_is_raised_in_every_waiter(self):
+        flights = SingleFlight()
+
+        def fail():
+            time.sleep(0.2)
+            raise ValueError("upstream failed")
+
+        first, others = self.run_concurrently(flights, "satellite_a", fail, callers=4)
+        for future in [first] + others:
+            with self.assertRaises(ValueError):
+                future.result()
+        self.assertEqual(flights.stats()["in_flight"], 0)
+        self.assertEqual(flights.do("satellite_a", lambda: "ok"), ("ok", False))
+
+    def test_different_keys_run_in_parallel(self):
+        flights = SingleFlight()
+        start = time.time()
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(lambda key: flights.do(key, lambda: time.sleep(0.2) or key), "abcd"))
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(results, [(key, False) for key in "abcd"])
+        self.assertEqual(flights.stats()["coalesced"], 0)
+
+
+class TestServerCoalescing(ImageServerTestCase):
+    """concurrent requests for one grid point against the mock upstream"""
+
+    latency = 0.3
+
+    def get(self, path):
+        response = requests.get(self.url + path, timeout=10)
+        return response.status_code, response.headers.get("X-Cache")
+
+    def test_one_upstream_call_per_key(self):
+        with ThreadPoolExecutor(10) as executor:
+            results = list(executor.map(self.get, ["/api/satellite?lat=40.7589&lon=-73.9851"] * 10))
+        self.assertEqual([status for status, _ in results], [200] * 10)
+        self.assertEqual(self.upstream.stats(), {"export": 1})
+        self.assertEqual(sorted(set(cache for _, cache in results)), ["coalesced", "miss"])
+        self.assertEqual(self.get("/api/satellite?lat=40.7589&lon=-73.9851"), (200, "memory"))
+
+    def test_streetview_search_is_cached(self):
+        self.assertEqual(self.get("/api/images?lat=40.7589&lon=-73.9851")[0], 200)
+        self.assertEqual(self.upstream.stats().get("images"), 1)
+        # /api/streetview reuses the search made by /api/images
+        self.assertEqual(self.get("/api/streetview?lat=40.7589&lon=-73.9851&quality=1024")[0], 200)
+        self.assertEqual(self.upstream.stats().get("images"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
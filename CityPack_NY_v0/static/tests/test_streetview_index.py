@@ -0,0 +1,143 @@
+import json
+import os
+import struct
+import unittest
+
+import pyarrow.parquet as pq
+import requests
+
+from support import MockUpstreamTestCase, ServerTestCase
+from image_cache import METERS_PER_DEGREE, ImageCache  # noqa: E402
+from streetview_index import StreetViewIndex, IndexRefresher, angle_difference, harvest, write_index  # noqa: E402
+
+LAT, LON = 40.759, -73.985
+
+
+def make_record(image_id, meters_north, compass_angle, thumb_url=None):
+    """a street view image meters_north of (LAT, LON)"""
+    return {'id': image_id, 'lon': LON, 'lat': LAT + meters_north / METERS_PER_DEGREE, 'captured_at': 1700000000000,
+            'compass_angle': compass_angle, 'thumb_256_url': None, 'thumb_1024_url': thumb_url, 'thumb_2048_url': None}
+
+
+class TestIndex(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.directory, "streetview_index.parquet")
+        self.records = [make_record('a', 30, 10.0), make_record('b', 10, 350.0), make_record('c', 20, 90.0),
+                        make_record('d', 500, None)]
+        write_index(self.records, self.path, harvested_at=1000.0)
+
+    def test_geoparquet_round_trip(self):
+        table = pq.read_table(self.path)
+        geo = json.loads(table.schema.metadata[b'geo'])
+        self.assertEqual(geo['primary_column'], 'geometry')
+        column = geo['columns']['geometry']
+        self.assertEqual((column['encoding'], column['geometry_types']), ('WKB', ['Point']))
+        self.assertEqual(column['bbox'], [LON, self.records[0]['lat'] - 20 / METERS_PER_DEGREE, LON,
+                                          self.records[3]['lat']])
+        for record, geometry in zip(self.records, table.column('geometry').to_pylist()):
+            # little endian, type 1 (Point), x, y
+            self.assertEqual(struct.unpack('<BIdd', geometry), (1, 1, record['lon'], record['lat']))
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        index = StreetViewIndex(self.path)
+        self.assertEqual(len(index), 4)
+        result = index.nearest(LAT, LON, k=4)[3]
+        self.assertEqual({name: result[name] for name in self.records[3]}, self.records[3])
+        self.assertEqual(result['harvested_at'], 1000.0)
+
+    def test_nearest(self):
+        index = StreetViewIndex(self.path)
+        results = index.nearest(LAT, LON, k=3)
+        self.assertEqual([result['id'] for result in results], ['b', 'c', 'a'])
+        self.assertEqual([result['distance_m'] for result in results], [10.0, 20.0, 30.0])
+        self.assertEqual([result['id'] for result in index.nearest(LAT, LON, k=10, max_distance=25)], ['b', 'c'])
+        self.assertEqual(index.nearest(LAT - 1, LON, k=10, max_distance=100), [])
+        self.assertEqual(index.find(LAT, LON)['id'], 'b')
+        self.assertIsNone(index.find(LAT - 1, LON))
+
+    def test_heading_wraps_around_north(self):
+        self.assertEqual(angle_difference(350, 10), 20)
+        self.assertEqual(angle_difference(5, 355), 10)
+        self.assertEqual(list(angle_difference([0, 180, 359, 90], 1)), [1, 179, 2, 89])
+
+        index = StreetViewIndex(self.path)
+        self.assertEqual([result['id'] for result in index.nearest(LAT, LON, k=3, heading=0)], ['b', 'a'])
+        self.assertEqual([result['id'] for result in index.nearest(LAT, LON, k=3, heading=360)], ['b', 'a'])
+        self.assertEqual(index.find(LAT, LON, heading=100)['id'], 'c')
+        # images without a compass angle never match a heading
+        self.assertIsNone(index.find(LAT + 500 / METERS_PER_DEGREE, LON, heading=180, max_distance=10))
+
+    def test_reload_if_changed(self):
+        index = StreetViewIndex(self.path)
+        self.assertFalse(index.reload_if_changed())
+        write_index(self.records[:2], self.path)
+        # the mtime may not change within the file system's timestamp resolution
+        os.utime(self.path, (index.snapshot.mtime + 10, index.snapshot.mtime + 10))
+        self.assertTrue(index.reload_if_changed())
+        self.assertEqual(len(index), 2)
+        self.assertFalse(index.reload_if_changed())
+        os.remove(self.path)
+        self.assertFalse(index.reload_if_changed())
+        self.assertEqual(len(index), 2)
+
+
+class TestHarvest(MockUpstreamTestCase):
+
+    bbox = (-73.990, 40.750, -73.988, 40.752)
+
+    def test_full_cells_are_split(self):
+        expected = {record['id'] for record in harvest(self.api, self.bbox, cell=0.01, limit=10000)}
+        self.assertGreater(len(expected), 100)
+        queries = self.upstream.stats()['images']
+
+        records = harvest(self.api, self.bbox, cell=0.01, limit=50)
+        self.assertEqual({record['id'] for record in records}, expected)
+        self.assertEqual(len(records), len(expected))
+        # the full cell and its four quarters
+        self.assertEqual(self.upstream.stats()['images'] - queries, 5)
+
+    def test_min_cell_stops_splitting(self):
+        records = harvest(self.api, self.bbox, cell=0.01, limit=50, min_cell=0.01)
+        self.assertEqual(len(records), 50)
+
+    def test_refresher_replaces_index(self):
+        path = os.path.join(self.directory, "streetview_index.parquet")
+        write_index([make_record('a', 0, 90.0)], path)
+        index = StreetViewIndex(path)
+        IndexRefresher(index, self.api, bbox=self.bbox).refresh()
+        expected = harvest(self.api, self.bbox, cell=0.01, limit=50)
+        self.assertEqual({result['id'] for result in index.nearest(LAT, LON, k=len(expected) + 1)},
+                         {record['id'] for record in expected})
+
+
+class TestServerWithIndex(MockUpstreamTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.directory, "streetview_index.parquet")
+
+    def start(self, thumb_url):
+        # 203795_m369925 is the mock image at (LAT, LON)
+        write_index([make_record('203795_m369925', 0, 90.0, self.upstream_url + thumb_url)], self.path)
+        return self.start_image_server(cache=ImageCache(None), streetview_index=StreetViewIndex(self.path))
+
+    def get_streetview(self, url):
+        return requests.get(url + "/api/streetview?lat=%s&lon=%s" % (LAT, LON), timeout=10)
+
+    def test_thumb_from_index(self):
+        response = self.get_streetview(self.start("/thumb/203795_m369925_1024.jpg"))
+        self.assertEqual((response.status_code, response.headers["Content-Type"]), (200, "image/jpeg"))
+        self.assertEqual(self.upstream.stats(), {'thumb': 1})
+
+    def test_expired_thumb_url_is_fetched_again_by_id(self):
+        response = self.get_streetview(self.start("/thumb/203795_m369925_1024.jpg?exp=1"))
+        self.assertEqual((response.status_code, response.headers["Content-Type"]), (200, "image/jpeg"))
+        self.assertEqual(response.content, self.upstream.jpeg)
+        # the expired URL, the image by id and its fresh URL
+        self.assertEqual(self.upstream.stats(), {'thumb': 2, 'image': 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
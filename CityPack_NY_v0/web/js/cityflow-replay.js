@@ -41,6 +41,7 @@ const CONFIG = {
 let map;
 let roadnetData = null;
 let replayData = null;
+let georeferenced = false; // replay already holds lng/lat and bearings
 let currentStep = 0;
 let totalSteps = 0;
 let isPlaying = false;
@@ -52,6 +53,9 @@ let lastFrameTime = 0;
 let nodes = {};
 let edges = {};
 let trafficLights = {};
+let lightStatuses = {}; // last light statuses of each edge, decimated replays omit unchanged ones
+let lightKeyframeInterval = null; // steps between frames holding every light, from the #lights header
+let renderedStep = -1; // step drawn last, the lights of any other step than the next are rebuilt
 
 // Initialize the application
 document.addEventListener('DOMContentLoaded', () => {
@@ -164,6 +168,8 @@ function cleanupExistingLayers() {
     nodes = {};
     edges = {};
     trafficLights = {};
+    lightStatuses = {};
+    renderedStep = -1;
     currentStep = 0;
     
     logInfo('Cleaned up previous simulation');
@@ -197,14 +203,47 @@ async function handleStartClick() {
         logInfo('Loading replay file...');
         const replayText = await readFile(replayFile);
         replayData = replayText.trim().split('\n');
+        georeferenced = false;
+        lightKeyframeInterval = null;
+        while (replayData.length && replayData[0].startsWith('#')) {
+            const line = replayData.shift();
+            if (line.startsWith('#georef ')) {
+                // written by tools/replay/georeference_replay.py
+                const header = JSON.parse(line.slice('#georef '.length));
+                if (header.crs !== 'EPSG:4326') {
+                    throw new Error(`replay georeferenced to ${header.crs}, EPSG:4326 is needed`);
+                }
+                georeferenced = true;
+            } else if (line.startsWith('#lights ')) {
+                // written by tools/replay/decimate_replay.py --dropUnchangedLights
+                lightKeyframeInterval = JSON.parse(line.slice('#lights '.length)).keyframeInterval;
+            }
+        }
         totalSteps = replayData.length;
         logInfo(`Replay loaded: ${totalSteps} steps`);
         
         // Process and render
-        processRoadnet();
-        renderRoadnet();
-        initializeVehicleLayer();
-        initializeTrafficLightLayer();
+        if (roadnetData.coordFactor !== undefined) {
+            // geometry package of static/build_roadnet_geometry.py, nothing to compute
+            if (!roadnetGeometryMatches(roadnetData, CONFIG)) {
+                throw new Error('roadnet geometry was built for another transform, rebuild it with ' +
+                    `build_roadnet_geometry.py --center=${CONFIG.MAP_CENTER.join(',')} --rotation 0`);
+            }
+            const geometry = decodeRoadnetGeometry(roadnetData);
+            addRoadnetLayers(geometry);
+            initializeVehicleLayer();
+            trafficLights = {};
+            for (const edgeId in geometry.trafficLights) {
+                trafficLights[edgeId] = geometry.trafficLights[edgeId].map(light => ({ ...light, status: 'r' }));
+            }
+            addTrafficLightLayer();
+            logInfo(`Loaded roadnet geometry: ${geometry.roads.features.length} roads`);
+        } else {
+            processRoadnet();
+            renderRoadnet();
+            initializeVehicleLayer();
+            initializeTrafficLightLayer();
+        }
         
         // Update UI
         document.getElementById('total-steps').textContent = totalSteps;
@@ -510,15 +549,23 @@ function renderRoadnet() {
         }
     }
     
-    // Add sources and layers to map
-    
+    const collection = features => ({ type: 'FeatureCollection', features: features });
+    addRoadnetLayers({
+        intersections: collection(intersectionFeatures),
+        roads: collection(roadPolygonFeatures),
+        centerLines: collection(centerLineFeatures),
+        laneMarkings: collection(laneLineFeatures)
+    });
+}
+
+/**
+ * Add the roadnet sources and layers and fit the map to the roads
+ */
+function addRoadnetLayers(data) {
     // Intersections (filled polygons)
     map.addSource('intersections', {
         type: 'geojson',
-        data: {
-            type: 'FeatureCollection',
-            features: intersectionFeatures
-        }
+        data: data.intersections
     });
     
     map.addLayer({
@@ -534,10 +581,7 @@ function renderRoadnet() {
     // Road polygons (filled areas)
     map.addSource('roads', {
         type: 'geojson',
-        data: {
-            type: 'FeatureCollection',
-            features: roadPolygonFeatures
-        }
+        data: data.roads
     });
     
     map.addLayer({
@@ -553,10 +597,7 @@ function renderRoadnet() {
     // Center lines for bidirectional roads (solid lines)
     map.addSource('center-lines', {
         type: 'geojson',
-        data: {
-            type: 'FeatureCollection',
-            features: centerLineFeatures
-        }
+        data: data.centerLines
     });
     
     map.addLayer({
@@ -580,10 +621,7 @@ function renderRoadnet() {
     // Lane markings (dashed lines)
     map.addSource('lane-markings', {
         type: 'geojson',
-        data: {
-            type: 'FeatureCollection',
-            features: laneLineFeatures
-        }
+        data: data.laneMarkings
     });
     
     map.addLayer({
@@ -606,7 +644,7 @@ function renderRoadnet() {
     });
     
     // Fit map to road network bounds
-    const allCoords = roadPolygonFeatures.flatMap(f => f.geometry.coordinates[0]);
+    const allCoords = data.roads.features.flatMap(f => f.geometry.coordinates[0]);
     if (allCoords.length > 0) {
         const bounds = allCoords.reduce((bounds, coord) => {
             return bounds.extend(coord);
@@ -805,6 +843,13 @@ function initializeTrafficLightLayer() {
         }
     }
     
+    addTrafficLightLayer();
+}
+
+/**
+ * Add the traffic light source and layer, positions are in trafficLights
+ */
+function addTrafficLightLayer() {
     // Add line layer for traffic lights (more accurate representation)
     map.addSource('traffic-lights', {
         type: 'geojson',
@@ -879,6 +924,8 @@ function startAnimation() {
  */
 function updateStep(step) {
     if (!replayData || step >= replayData.length) return;
+    if (lightKeyframeInterval && step !== renderedStep + 1) restoreLightStatuses(step);
+    renderedStep = step;
     
     const [carLogsStr, tlLogsStr] = replayData[step].split(';');
     
@@ -897,8 +944,8 @@ function updateStep(step) {
             const length = parseFloat(parts[5]);
             const width = parseFloat(parts[6]);
             
-            const position = convertCoords([x, y]);
-            const bearing = convertBearing(angle);
+            const position = georeferenced ? [x, y] : convertCoords([x, y]);
+            const bearing = georeferenced ? angle : convertBearing(angle);
             const colorIndex = hashString(id) % CONFIG.COLORS.CAR.length;
             
             vehicleFeatures.push({
@@ -923,48 +970,44 @@ function updateStep(step) {
     });
     
     // Update traffic lights
-    const tlLogs = tlLogsStr.split(',').filter(s => s.trim());
     const trafficLightFeatures = [];
+    applyLightRecords(tlLogsStr);
     
-    tlLogs.forEach(tlLog => {
-        const parts = tlLog.trim().split(' ');
-        if (parts.length >= 2) {
-            const edgeId = parts[0];
-            const statuses = parts.slice(1);
-            
-            if (trafficLights[edgeId]) {
-                trafficLights[edgeId].forEach((light, index) => {
-                    if (index < statuses.length) {
-                        const status = statuses[index];
-                        let color = CONFIG.COLORS.LIGHT_GRAY;
-                        let opacity = 1;
-                        
-                        if (status === 'r') {
-                            color = CONFIG.COLORS.LIGHT_RED;
-                        } else if (status === 'g') {
-                            color = CONFIG.COLORS.LIGHT_GREEN;
-                        } else if (status === 'i') {
-                            opacity = 0;
-                        }
-                        
-                        trafficLightFeatures.push({
-                            type: 'Feature',
-                            properties: {
-                                id: `${edgeId}_${index}`,
-                                color: color,
-                                opacity: opacity,
-                                status: status
-                            },
-                            geometry: {
-                                type: 'Point',
-                                coordinates: light.position
-                            }
-                        });
+    for (const edgeId in lightStatuses) {
+        const statuses = lightStatuses[edgeId];
+        
+        if (trafficLights[edgeId]) {
+            trafficLights[edgeId].forEach((light, index) => {
+                if (index < statuses.length) {
+                    const status = statuses[index];
+                    let color = CONFIG.COLORS.LIGHT_GRAY;
+                    let opacity = 1;
+                    
+                    if (status === 'r') {
+                        color = CONFIG.COLORS.LIGHT_RED;
+                    } else if (status === 'g') {
+                        color = CONFIG.COLORS.LIGHT_GREEN;
+                    } else if (status === 'i') {
+                        opacity = 0;
                     }
-                });
-            }
+                    
+                    trafficLightFeatures.push({
+                        type: 'Feature',
+                        properties: {
+                            id: `${edgeId}_${index}`,
+                            color: color,
+                            opacity: opacity,
+                            status: status
+                        },
+                        geometry: {
+                            type: 'Point',
+                            coordinates: light.position
+                        }
+                    });
+                }
+            });
         }
-    });
+    }
     
     map.getSource('traffic-lights').setData({
         type: 'FeatureCollection',
@@ -977,6 +1020,30 @@ function updateStep(step) {
     document.getElementById('progress').textContent = ((step / totalSteps) * 100).toFixed(1) + '%';
 }
 
+/**
+ * Rebuild the light statuses before a step reached by a jump (step backward, loop
+ * or reset), replays decimated with --dropUnchangedLights only hold every light
+ * in their keyframes
+ */
+function restoreLightStatuses(step) {
+    lightStatuses = {};
+    for (let i = step - step % lightKeyframeInterval; i < step; i++) {
+        applyLightRecords(replayData[i].split(';')[1]);
+    }
+}
+
+/**
+ * Update the light statuses with the light part of a frame
+ */
+function applyLightRecords(tlLogsStr) {
+    tlLogsStr.split(',').forEach(tlLog => {
+        const parts = tlLog.trim().split(' ');
+        if (parts.length >= 2) {
+            lightStatuses[parts[0]] = parts.slice(1);
+        }
+    });
+}
+
 /**
  * Toggle pause/play
  */
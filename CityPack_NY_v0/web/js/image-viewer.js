@@ -105,12 +105,12 @@ class ImageViewer {
    * 更新图像弹窗内容
    */
   updateImagePopup(popup, info, lat, lon) {
-    const satelliteUrl = `${this.imageApiUrl}/api/satellite?lat=${lat}&lon=${lon}`;
+    const satelliteUrl = `${this.imageApiUrl}/api/satellite?lat=${lat}&lon=${lon}&size=panel`;
     let streetviewHtml = '';
 
     if (info.streetview.available) {
       const streetInfo = info.streetview.info;
-      const streetviewUrl = `${this.imageApiUrl}/api/streetview?lat=${lat}&lon=${lon}&quality=1024`;
+      const streetviewUrl = `${this.imageApiUrl}/api/streetview?lat=${lat}&lon=${lon}&quality=1024&size=panel`;
       streetviewHtml = `
         <div class="popup-image-container">
           <img src="${streetviewUrl}" alt="Street View" class="popup-image">
@@ -0,0 +1,134 @@
+/**
+ * Precomputed roadnet geometry (static/build_roadnet_geometry.py)
+ *
+ * The package stores the left and right edge of every road polygon, lane
+ * widths and intersection outlines. Lane markings, center lines, stop lines
+ * and signal positions lie between the two road edges and are interpolated
+ * here, so a page only downloads the package instead of the full roadnet.
+ * Used by traffic-flow.js and cityflow-replay.js.
+ */
+
+const ROADNET_GEOMETRY_VERSION = 2;
+const ROADNET_FLAG_CENTER_LINE = 1;
+const ROADNET_FLAG_STOP_LINE = 2;
+const ROADNET_FLAG_STOP_REVERSED = 4;
+
+/**
+ * Check whether a geometry package was built for the coordinate transform
+ * of a page (MAP_CENTER, COORD_SCALE and ROTATION_DEGREES, 0 if absent)
+ */
+function roadnetGeometryMatches(geometry, config) {
+  const transform = geometry.transform;
+  return geometry.version === ROADNET_GEOMETRY_VERSION &&
+    transform.center[0] === config.MAP_CENTER[0] && transform.center[1] === config.MAP_CENTER[1] &&
+    transform.scale.lng === config.COORD_SCALE.lng && transform.scale.lat === config.COORD_SCALE.lat &&
+    transform.rotation === (config.ROTATION_DEGREES || 0);
+}
+
+/**
+ * Decode polylines delta encoded across the whole array [dx, dy, ...],
+ * counts holds the number of points of each polyline
+ */
+function decodePolylines(counts, encoded, factor) {
+  const lines = [];
+  let x = 0;
+  let y = 0;
+  let i = 0;
+  for (const count of counts) {
+    const line = [];
+    for (let n = 0; n < count; n++, i += 2) {
+      x += encoded[i];
+      y += encoded[i + 1];
+      line.push([x / factor, y / factor]);
+    }
+    lines.push(line);
+  }
+  return lines;
+}
+
+/**
+ * Build the GeoJSON layers and traffic light positions of a geometry package
+ *
+ * @returns {Object} FeatureCollections intersections, roads, centerLines,
+ *   laneMarkings and stopLines, and trafficLights: road id -> per lane
+ *   [{position, laneWidth}] in the lane order of the replay light records
+ */
+function decodeRoadnetGeometry(geometry) {
+  const factor = geometry.coordFactor;
+  const roads = geometry.roads;
+  const feature = (id, type, geometryType, coordinates) => ({
+    type: 'Feature',
+    properties: { id: id, type: type },
+    geometry: { type: geometryType, coordinates: coordinates }
+  });
+  const close = ring => [...ring, ring[0]];
+  // point at a fraction of the way from the left to the right road edge
+  const across = (left, right, fraction) => left.map((point, i) => [
+    point[0] + (right[i][0] - point[0]) * fraction,
+    point[1] + (right[i][1] - point[1]) * fraction
+  ]);
+
+  const layers = { intersections: [], roads: [], centerLines: [], laneMarkings: [], stopLines: [] };
+  const trafficLights = {};
+  const leftLines = decodePolylines(roads.counts, roads.left, factor);
+  let offset = 0;
+  let laneOffset = 0;
+
+  roads.ids.forEach((edgeId, index) => {
+    const left = leftLines[index];
+    const right = left.map((point, i) => [
+      point[0] + roads.offsets[offset + 2 * i] / factor,
+      point[1] + roads.offsets[offset + 2 * i + 1] / factor
+    ]);
+    offset += 2 * left.length;
+    const laneWidths = roads.laneWidths.slice(laneOffset, laneOffset + roads.lanes[index]);
+    laneOffset += laneWidths.length;
+    const roadWidth = laneWidths.reduce((sum, width) => sum + width, 0);
+    const flags = roads.flags[index];
+
+    layers.roads.push(feature(edgeId, 'road', 'Polygon', [close([...left, ...[...right].reverse()])]));
+
+    let cumulativeWidth = 0;
+    for (let lane = 0; lane < laneWidths.length - 1; lane++) {
+      cumulativeWidth += laneWidths[lane];
+      layers.laneMarkings.push(feature(`${edgeId}_lane_${lane}`, 'lane-marking', 'LineString',
+        across(left, right, cumulativeWidth / roadWidth)));
+    }
+
+    if (flags & ROADNET_FLAG_CENTER_LINE) {
+      layers.centerLines.push(feature(`${edgeId}_center`, 'center-line', 'LineString', left));
+    }
+
+    if (flags & ROADNET_FLAG_STOP_LINE) {
+      const start = left[left.length - 1];
+      let end = right[right.length - 1];
+      if (flags & ROADNET_FLAG_STOP_REVERSED) {
+        // the intersection is wider than the last segment, the stop line points the other way
+        end = [2 * start[0] - end[0], 2 * start[1] - end[1]];
+      }
+      const stopLine = [start, end];
+      layers.stopLines.push(feature(`${edgeId}_stop`, 'stop-line', 'LineString', stopLine));
+      let laneStart = 0;
+      trafficLights[edgeId] = laneWidths.map(laneWidth => {
+        const position = across([stopLine[0]], [stopLine[1]], (laneStart + laneWidth / 2) / roadWidth)[0];
+        laneStart += laneWidth;
+        return { position: position, laneWidth: laneWidth };
+      });
+    }
+  });
+
+  const outlines = decodePolylines(geometry.intersections.counts, geometry.intersections.coords, factor);
+  geometry.intersections.ids.forEach((nodeId, index) => {
+    layers.intersections.push(feature(nodeId, 'intersection', 'Polygon', [close(outlines[index])]));
+  });
+
+  const collection = features => ({ type: 'FeatureCollection', features: features });
+  return {
+    intersections: collection(layers.intersections),
+    roads: collection(layers.roads),
+    centerLines: collection(layers.centerLines),
+    laneMarkings: collection(layers.laneMarkings),
+    stopLines: collection(layers.stopLines),
+    trafficLights: trafficLights
+  };
+}
@@ -11,6 +11,7 @@ class TrafficFlowManager {
     this.isActive = false;
     this.roadnetData = null;
     this.replayData = null;
+    this.georeferenced = false;
     this.currentStep = 0;
     this.totalSteps = 0;
     this.isPlaying = false;
@@ -23,6 +24,11 @@ class TrafficFlowManager {
     this.nodes = {};
     this.edges = {};
     this.trafficLights = {};
+    this.lightStatuses = {}; // last light statuses of each edge, decimated replays omit unchanged ones
+    this.lightKeyframeInterval = null; // steps between frames holding every light, from the #lights header
+    this.renderedStep = -1; // step drawn last, the lights of any other step than the next are rebuilt
+    this.liveStream = null; // EventSource of sim/CityFlow/tools/live/live_server.py
+    this.replayUrl = null; // replay served by sim/CityFlow/tools/replay/replay_server.py
     
     // Coordinate transformation parameters
     // Adjust these if road network doesn't align with buildings/roads
@@ -92,6 +98,16 @@ class TrafficFlowManager {
       // Hide loading overlay
       this.hideLoadingOverlay();
       
+      // index.html?replay=<replay_server.py URL> or ?live=<live_server.py URL> starts playing right away
+      const params = new URLSearchParams(window.location.search);
+      if (params.get('replay')) {
+        document.getElementById('tf-replay-url').value = params.get('replay');
+        this.loadReplayFromServer(params.get('replay'));
+      } else if (params.get('live')) {
+        document.getElementById('tf-replay-url').value = params.get('live');
+        this.connectLiveStream(params.get('live'));
+      }
+      
       console.log('✅ Traffic Flow activated');
     } catch (error) {
       console.error('❌ Error activating traffic flow:', error);
@@ -111,6 +127,7 @@ class TrafficFlowManager {
     
     // Stop animation
     this.stopSimulation();
+    this.disconnectLiveStream();
     
     // Clean up layers
     this.cleanupLayers();
@@ -124,6 +141,7 @@ class TrafficFlowManager {
     // Reset state
     this.roadnetLoaded = false;
     this.replayData = null;
+    this.replayUrl = null;
     this.currentStep = 0;
     this.totalSteps = 0;
     
@@ -136,6 +154,15 @@ class TrafficFlowManager {
    */
   async loadRoadnet(url) {
     try {
+      // Geometry precomputed by static/build_roadnet_geometry.py skips the processing below
+      if (await this.loadRoadnetGeometry(url.replace(/\.json$/, '_geometry.json'))) {
+        this.initializeVehicleLayer();
+        this.roadnetLoaded = true;
+        this.updateInfo('✅ Road network loaded successfully', 'success');
+        this.updateRoadnetStatus('loaded');
+        return;
+      }
+      
       this.updateInfo('⬇️ Downloading road network data...', 'info');
       this.updateLoadingMessage('Downloading road network data...');
       
@@ -190,8 +217,11 @@ class TrafficFlowManager {
       this.updateInfo('Loading replay data...', 'info');
       
       const text = await this.readFile(file);
-      this.replayData = text.trim().split('\n');
+      this.replayUrl = null;
+      this.replayData = this.readReplayHeader(text.trim().split('\n'));
       this.totalSteps = this.replayData.length;
+      this.lightStatuses = {};
+      this.renderedStep = -1;
       
       this.updateInfo(`Replay loaded: ${this.totalSteps} steps`, 'success');
       this.updateStats();
@@ -208,6 +238,38 @@ class TrafficFlowManager {
     }
   }
   
+  /**
+   * Load precomputed roadnet geometry, returns false if it is missing or
+   * was built for another coordinate transform
+   */
+  async loadRoadnetGeometry(url) {
+    let geometry;
+    try {
+      this.updateInfo('⬇️ Downloading road network geometry...', 'info');
+      this.updateLoadingMessage('Downloading road network geometry...');
+      const response = await fetch(url);
+      if (!response.ok) return false;
+      geometry = await response.json();
+    } catch (error) {
+      return false;
+    }
+    
+    if (!roadnetGeometryMatches(geometry, this.config)) {
+      console.warn('Roadnet geometry was built for another transform or format, computing it from the roadnet');
+      return false;
+    }
+    
+    const decoded = decodeRoadnetGeometry(geometry);
+    this.addRoadnetLayers(decoded);
+    
+    this.trafficLights = {};
+    for (const edgeId in decoded.trafficLights) {
+      this.trafficLights[edgeId] = decoded.trafficLights[edgeId].map(light => ({ position: light.position, status: 'r' }));
+    }
+    this.addTrafficLightLayer();
+    return true;
+  }
+  
   /**
    * Process roadnet data
    */
@@ -452,13 +514,22 @@ class TrafficFlowManager {
       }
     }
     
-    // Add sources and layers to map
+    const collection = features => ({ type: 'FeatureCollection', features: features });
+    this.addRoadnetLayers({
+      intersections: collection(intersectionFeatures),
+      roads: collection(roadPolygonFeatures),
+      centerLines: collection(centerLineFeatures),
+      laneMarkings: collection(laneLineFeatures)
+    });
+  }
+  
+  /**
+   * Add the roadnet sources and layers and fit the map to the roads
+   */
+  addRoadnetLayers(data) {
     this.map.addSource('tf-intersections', {
       type: 'geojson',
-      data: {
-        type: 'FeatureCollection',
-        features: intersectionFeatures
-      }
+      data: data.intersections
     });
     
     this.map.addLayer({
@@ -473,10 +544,7 @@ class TrafficFlowManager {
     
     this.map.addSource('tf-roads', {
       type: 'geojson',
-      data: {
-        type: 'FeatureCollection',
-        features: roadPolygonFeatures
-      }
+      data: data.roads
     });
     
     this.map.addLayer({
@@ -491,10 +559,7 @@ class TrafficFlowManager {
     
     this.map.addSource('tf-center-lines', {
       type: 'geojson',
-      data: {
-        type: 'FeatureCollection',
-        features: centerLineFeatures
-      }
+      data: data.centerLines
     });
     
     this.map.addLayer({
@@ -517,10 +582,7 @@ class TrafficFlowManager {
     
     this.map.addSource('tf-lane-markings', {
       type: 'geojson',
-      data: {
-        type: 'FeatureCollection',
-        features: laneLineFeatures
-      }
+      data: data.laneMarkings
     });
     
     this.map.addLayer({
@@ -542,8 +604,27 @@ class TrafficFlowManager {
       }
     });
     
+    if (data.stopLines) {
+      this.map.addSource('tf-stop-lines', {
+        type: 'geojson',
+        data: data.stopLines
+      });
+      
+      this.map.addLayer({
+        id: 'tf-stop-lines',
+        type: 'line',
+        source: 'tf-stop-lines',
+        minzoom: 15,
+        paint: {
+          'line-color': '#ffffff',
+          'line-width': 1.5,
+          'line-opacity': 0.8
+        }
+      });
+    }
+    
     // Fit map to road network bounds
-    const allCoords = roadPolygonFeatures.flatMap(f => f.geometry.coordinates[0]);
+    const allCoords = data.roads.features.flatMap(f => f.geometry.coordinates[0]);
     if (allCoords.length > 0) {
       const bounds = allCoords.reduce((bounds, coord) => {
         return bounds.extend(coord);
@@ -724,6 +805,13 @@ class TrafficFlowManager {
       }
     }
     
+    this.addTrafficLightLayer();
+  }
+  
+  /**
+   * Add the traffic light source and layer, positions are in this.trafficLights
+   */
+  addTrafficLightLayer() {
     this.map.addSource('tf-traffic-lights', {
       type: 'geojson',
       data: {
@@ -795,8 +883,45 @@ class TrafficFlowManager {
    */
   updateStep(step) {
     if (!this.replayData || step >= this.replayData.length) return;
-    
-    const [carLogsStr, tlLogsStr] = this.replayData[step].split(';');
+    if (this.replayUrl) this.updateReplayWindows(step);
+    // steps of a served replay not fetched yet are skipped
+    if (this.replayData[step] === undefined) return;
+    if (this.lightKeyframeInterval && step !== this.renderedStep + 1) this.restoreLightStatuses(step);
+    this.renderFrame(this.replayData[step], step);
+    this.renderedStep = step;
+  }
+  
+  /**
+   * Rebuild the light statuses before a step reached by a jump (seek, step backward,
+   * loop or window change), replays decimated with --dropUnchangedLights only hold
+   * every light in their keyframes and in the first step of a served window
+   */
+  restoreLightStatuses(step) {
+    let from = step;
+    while (from % this.lightKeyframeInterval !== 0 && this.replayData[from - 1] !== undefined) from--;
+    this.lightStatuses = {};
+    for (let i = from; i < step; i++) {
+      this.applyLightRecords(this.replayData[i].split(';')[1]);
+    }
+  }
+  
+  /**
+   * Update the light statuses with the light part of a frame
+   */
+  applyLightRecords(tlLogsStr) {
+    tlLogsStr.split(',').forEach(tlLog => {
+      const parts = tlLog.trim().split(' ');
+      if (parts.length >= 2) {
+        this.lightStatuses[parts[0]] = parts.slice(1);
+      }
+    });
+  }
+  
+  /**
+   * Draw one frame in the text replay format
+   */
+  renderFrame(frame, step) {
+    const [carLogsStr, tlLogsStr] = frame.split(';');
     
     // Update vehicles
     const carLogs = carLogsStr.split(',').filter(s => s.trim());
@@ -810,8 +935,8 @@ class TrafficFlowManager {
         const angle = parseFloat(parts[2]);
         const id = parts[3];
         
-        const position = this.convertCoords([x, y]);
-        const bearing = this.convertBearing(angle);
+        const position = this.georeferenced ? [x, y] : this.convertCoords([x, y]);
+        const bearing = this.georeferenced ? angle : this.convertBearing(angle);
         const colorIndex = this.hashString(id) % this.config.COLORS.CAR.length;
         
         vehicleFeatures.push({
@@ -835,48 +960,44 @@ class TrafficFlowManager {
     });
     
     // Update traffic lights
-    const tlLogs = tlLogsStr.split(',').filter(s => s.trim());
     const trafficLightFeatures = [];
+    this.applyLightRecords(tlLogsStr);
     
-    tlLogs.forEach(tlLog => {
-      const parts = tlLog.trim().split(' ');
-      if (parts.length >= 2) {
-        const edgeId = parts[0];
-        const statuses = parts.slice(1);
-        
-        if (this.trafficLights[edgeId]) {
-          this.trafficLights[edgeId].forEach((light, index) => {
-            if (index < statuses.length) {
-              const status = statuses[index];
-              let color = this.config.COLORS.LIGHT_GRAY;
-              let opacity = 1;
-              
-              if (status === 'r') {
-                color = this.config.COLORS.LIGHT_RED;
-              } else if (status === 'g') {
-                color = this.config.COLORS.LIGHT_GREEN;
-              } else if (status === 'i') {
-                opacity = 0;
-              }
-              
-              trafficLightFeatures.push({
-                type: 'Feature',
-                properties: {
-                  id: `${edgeId}_${index}`,
-                  color: color,
-                  opacity: opacity,
-                  status: status
-                },
-                geometry: {
-                  type: 'Point',
-                  coordinates: light.position
-                }
-              });
+    for (const edgeId in this.lightStatuses) {
+      const statuses = this.lightStatuses[edgeId];
+      
+      if (this.trafficLights[edgeId]) {
+        this.trafficLights[edgeId].forEach((light, index) => {
+          if (index < statuses.length) {
+            const status = statuses[index];
+            let color = this.config.COLORS.LIGHT_GRAY;
+            let opacity = 1;
+            
+            if (status === 'r') {
+              color = this.config.COLORS.LIGHT_RED;
+            } else if (status === 'g') {
+              color = this.config.COLORS.LIGHT_GREEN;
+            } else if (status === 'i') {
+              opacity = 0;
             }
-          });
-        }
+            
+            trafficLightFeatures.push({
+              type: 'Feature',
+              properties: {
+                id: `${edgeId}_${index}`,
+                color: color,
+                opacity: opacity,
+                status: status
+              },
+              geometry: {
+                type: 'Point',
+                coordinates: light.position
+              }
+            });
+          }
+        });
       }
-    });
+    }
     
     this.map.getSource('tf-traffic-lights').setData({
       type: 'FeatureCollection',
@@ -887,6 +1008,243 @@ class TrafficFlowManager {
     this.updateStats(vehicleFeatures.length, step);
   }
   
+  /**
+   * Drop the header lines of a replay, replays written by tools/replay/georeference_replay.py
+   * already hold lng/lat and bearings, the #lights header of tools/replay/decimate_replay.py
+   * gives the steps between frames holding every light
+   */
+  readReplayHeader(lines) {
+    this.georeferenced = false;
+    this.lightKeyframeInterval = null;
+    while (lines.length && lines[0].startsWith('#')) {
+      const line = lines.shift();
+      if (line.startsWith('#lights ')) {
+        this.lightKeyframeInterval = JSON.parse(line.slice('#lights '.length)).keyframeInterval;
+        continue;
+      }
+      if (!line.startsWith('#georef ')) continue;
+      const header = JSON.parse(line.slice('#georef '.length));
+      if (header.crs !== 'EPSG:4326') {
+        throw new Error(`replay georeferenced to ${header.crs}, EPSG:4326 is needed`);
+      }
+      this.georeferenced = true;
+    }
+    return lines;
+  }
+  
+  /**
+   * Load the URL of the replay panel: a replay of replay_server.py (.../replay/<name>)
+   * is played, any other URL is taken as a live_server.py stream
+   */
+  loadFromUrl(url) {
+    url = url.trim().replace(/\/$/, '');
+    if (/\/replay\/[^/]+$/.test(url)) {
+      this.loadReplayFromServer(url);
+    } else {
+      this.connectLiveStream(url);
+    }
+  }
+  
+  /**
+   * Play a replay served by sim/CityFlow/tools/replay/replay_server.py, e.g. http://127.0.0.1:8766/replay/replay.txt
+   * Only the window being played and the next one are fetched and kept
+   */
+  async loadReplayFromServer(url) {
+    if (!this.roadnetLoaded) {
+      this.updateInfo('Please wait for road network to load first', 'error');
+      return;
+    }
+    
+    try {
+      this.updateInfo('Loading replay index...', 'info');
+      this.pauseSimulation();
+      this.disconnectLiveStream();
+      const response = await fetch(`${url}/index`);
+      if (!response.ok) throw new Error(`Failed to load replay index: ${response.statusText}`);
+      const index = await response.json();
+      
+      this.replayUrl = url;
+      this.replayWindowSize = Math.min(index.maxWindow, 500);
+      this.replayWindows = new Map(); // window start -> Promise of its fetch
+      this.replayData = new Array(index.frames);
+      this.totalSteps = index.frames;
+      this.lightStatuses = {};
+      this.renderedStep = -1;
+      await this.fetchReplayWindow(0);
+      
+      this.updateInfo(`Replay loaded: ${this.totalSteps} steps`, 'success');
+      this.updateStats();
+      this.currentStep = 0;
+      this.isPlaying = true;
+      this.startAnimation();
+    } catch (error) {
+      this.updateInfo(`Error loading replay: ${error.message}`, 'error');
+      console.error(error);
+    }
+  }
+  
+  fetchReplayWindow(start) {
+    if (this.replayWindows.has(start)) return this.replayWindows.get(start);
+    const url = this.replayUrl;
+    const stop = Math.min(start + this.replayWindowSize, this.totalSteps);
+    const promise = fetch(`${url}?from=${start}&to=${stop}`)
+      .then(response => {
+        if (!response.ok) throw new Error(`Failed to load steps ${start}-${stop}: ${response.statusText}`);
+        return response.text();
+      })
+      .then(text => {
+        if (this.replayUrl !== url || this.replayWindows.get(start) !== promise) return;
+        this.readReplayHeader(text.trim().split('\n')).forEach((line, i) => {
+          this.replayData[start + i] = line;
+        });
+      })
+      .catch(error => {
+        this.replayWindows.delete(start);
+        console.error(error);
+      });
+    this.replayWindows.set(start, promise);
+    return promise;
+  }
+  
+  /**
+   * Fetch the window of step and the next one, forget the others
+   */
+  updateReplayWindows(step) {
+    const size = this.replayWindowSize;
+    const current = Math.floor(step / size) * size;
+    const next = current + size < this.totalSteps ? current + size : 0;
+    for (const start of this.replayWindows.keys()) {
+      if (start === current || start === next) continue;
+      this.replayWindows.delete(start);
+      this.replayData.fill(undefined, start, Math.min(start + size, this.totalSteps));
+    }
+    this.fetchReplayWindow(current);
+    this.fetchReplayWindow(next);
+  }
+  
+  /**
+   * Show a running simulation streamed by sim/CityFlow/tools/live/live_server.py
+   * Frames arrive in the binary replay format and are drawn as they come, replacing the loaded replay
+   */
+  connectLiveStream(url) {
+    if (!this.roadnetLoaded) {
+      this.updateInfo('Please wait for road network to load first', 'error');
+      return;
+    }
+    this.pauseSimulation();
+    this.disconnectLiveStream();
+    this.replayData = null;
+    this.replayUrl = null;
+    this.georeferenced = false;
+    this.lightKeyframeInterval = null;
+    this.lightStatuses = {};
+    
+    const stream = new EventSource(url.replace(/\/$/, '') + '/stream');
+    const ids = [];
+    let layout = null;
+    stream.addEventListener('header', (e) => {
+      layout = this.decodeLiveHeader(this.decodeBase64(e.data));
+      ids.length = 0;
+    });
+    stream.addEventListener('ids', (e) => {
+      ids.push(...JSON.parse(e.data));
+    });
+    stream.addEventListener('frame', (e) => {
+      if (!layout) return;
+      const [step, data] = e.data.split(' ');
+      this.currentStep = parseInt(step, 10);
+      this.totalSteps = this.currentStep + 1;
+      this.renderFrame(this.decodeLiveFrame(this.decodeBase64(data), layout, ids), this.currentStep);
+    });
+    stream.onerror = () => {
+      this.updateInfo('Live stream disconnected, retrying...', 'error');
+    };
+    stream.onopen = () => {
+      this.updateInfo(`Live simulation connected: ${url}`, 'success');
+    };
+    this.liveStream = stream;
+  }
+  
+  disconnectLiveStream() {
+    if (this.liveStream) {
+      this.liveStream.close();
+      this.liveStream = null;
+    }
+  }
+  
+  decodeBase64(text) {
+    const binary = atob(text);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+    return new DataView(bytes.buffer);
+  }
+  
+  readLiveString(view, offset) {
+    const length = view.getUint16(offset, true);
+    const bytes = new Uint8Array(view.buffer, view.byteOffset + offset + 2, length);
+    return [new TextDecoder().decode(bytes), offset + 2 + length];
+  }
+  
+  /**
+   * Road layout of a binary replay header, see sim/CityFlow/tools/replay/readme.md
+   */
+  decodeLiveHeader(view) {
+    const roadCount = view.getUint32(8, true);
+    const roads = [];
+    let offset = 12;
+    for (let i = 0; i < roadCount; i++) {
+      let roadId;
+      [roadId, offset] = this.readLiveString(view, offset);
+      const laneCount = view.getUint16(offset, true);
+      offset += 2;
+      const implicit = [];
+      for (let j = 0; j < laneCount; j++) implicit.push(view.getUint8(offset + j) !== 0);
+      offset += laneCount;
+      roads.push({ id: roadId, implicit: implicit });
+    }
+    return roads;
+  }
+  
+  /**
+   * Binary replay frame to a text replay line, new ids are appended to ids
+   */
+  decodeLiveFrame(view, layout, ids) {
+    const vehicleCount = view.getUint32(0, true);
+    const newIdCount = view.getUint32(4, true);
+    let offset = 8;
+    for (let i = 0; i < newIdCount; i++) {
+      let id;
+      [id, offset] = this.readLiveString(view, offset);
+      ids.push(id);
+    }
+    
+    let vehicles = '';
+    for (let i = 0; i < vehicleCount; i++, offset += 20) {
+      vehicles += `${view.getInt32(offset, true) / 100} ${view.getInt32(offset + 4, true) / 100} ` +
+        `${view.getInt16(offset + 8, true) / 10000} ${ids[view.getUint32(offset + 16, true)]} ` +
+        `${view.getInt8(offset + 10)} ${view.getUint16(offset + 12, true) / 100} ` +
+        `${view.getUint16(offset + 14, true) / 100},`;
+    }
+    
+    // lights of the signalized lanes, one bit each, least significant bit first
+    let bit = 0;
+    let lights = '';
+    layout.forEach(road => {
+      lights += road.id;
+      road.implicit.forEach(implicit => {
+        if (implicit) {
+          lights += ' i';
+          return;
+        }
+        const green = (view.getUint8(offset + (bit >> 3)) >> (bit & 7)) & 1;
+        lights += green ? ' g' : ' r';
+        bit++;
+      });
+      lights += ',';
+    });
+    return `${vehicles};${lights}`;
+  }
+  
   /**
    * Play simulation
    */
@@ -963,8 +1321,8 @@ class TrafficFlowManager {
    * Clean up all traffic flow layers
    */
   cleanupLayers() {
-    const layersToRemove = ['tf-vehicles', 'tf-traffic-lights', 'tf-lane-markings', 'tf-center-lines', 'tf-roads', 'tf-intersections'];
-    const sourcesToRemove = ['tf-vehicles', 'tf-traffic-lights', 'tf-lane-markings', 'tf-center-lines', 'tf-roads', 'tf-intersections'];
+    const layersToRemove = ['tf-vehicles', 'tf-traffic-lights', 'tf-stop-lines', 'tf-lane-markings', 'tf-center-lines', 'tf-roads', 'tf-intersections'];
+    const sourcesToRemove = ['tf-vehicles', 'tf-traffic-lights', 'tf-stop-lines', 'tf-lane-markings', 'tf-center-lines', 'tf-roads', 'tf-intersections'];
     
     layersToRemove.forEach(layerId => {
       if (this.map.getLayer(layerId)) {
@@ -986,6 +1344,7 @@ class TrafficFlowManager {
     this.nodes = {};
     this.edges = {};
     this.trafficLights = {};
+    this.lightStatuses = {};
     this.currentStep = 0;
   }
   